@@ -37,6 +37,7 @@ import traceback
 import urllib3
 import uuid
 import warnings
+import zlib
 
 from configparser import ConfigParser
 
@@ -152,6 +153,7 @@ def _execute_api_call(
     params=None,
     proxies=None,
     timeout=None,
+    headers=None,
 ):
 
     if remote_host is None:
@@ -185,6 +187,8 @@ def _execute_api_call(
         kwargs["proxies"] = proxies
     if timeout is not None:
         kwargs["timeout"] = timeout
+    if headers is not None:
+        kwargs["headers"] = headers
 
     r = func("https://{}/api/{}".format(remote_host, command), **kwargs)
     r.raise_for_status()
@@ -698,36 +702,269 @@ get_analysis_status_command_parser.add_argument("uuid", help="The UUID of the an
 get_analysis_status_command_parser.set_defaults(func=_cli_get_analysis_status)
 
 
-def download(uuid, target_dir, *args, **kwargs):
+#
+# streaming transfers of storage directories between ACE nodes
+#
+# the tar archive is generated on the fly as it is sent and extracted on the fly as it is received
+# the archive can optionally be compressed (negotiated with the X-ACE-Transfer-Compression header)
+# the archive is generated the same way every time so an interrupted download can be resumed
+# by asking for the archive starting at an offset (with the X-ACE-Transfer-Offset header)
+#
+
+TRANSFER_COMPRESSION_NONE = "none"
+TRANSFER_COMPRESSION_GZIP = "gzip"
+TRANSFER_COMPRESSION_ZSTD = "zstd"
+
+HEADER_TRANSFER_COMPRESSION = "X-ACE-Transfer-Compression"
+HEADER_TRANSFER_OFFSET = "X-ACE-Transfer-Offset"
+
+MIMETYPE_TAR = "application/x-tar"
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def get_supported_transfer_compression():
+    """Returns the list of supported transfer compression methods in order of preference."""
+    result = []
+    if zstandard is not None:
+        result.append(TRANSFER_COMPRESSION_ZSTD)
+
+    result.append(TRANSFER_COMPRESSION_GZIP)
+    result.append(TRANSFER_COMPRESSION_NONE)
+    return result
+
+
+def select_transfer_compression(requested):
+    """Returns the first supported compression method in the given comma separated list,
+    or TRANSFER_COMPRESSION_NONE if none of them are supported."""
+    supported = get_supported_transfer_compression()
+    for compression in (requested or "").split(","):
+        compression = compression.strip().lower()
+        if compression in supported:
+            return compression
+
+    return TRANSFER_COMPRESSION_NONE
+
+
+def iter_tar(source_dir, chunk_size=io.DEFAULT_BUFFER_SIZE):
+    """Yields the bytes of an (uncompressed) tar archive of the given directory as it is read from disk.
+    The archive contains the same entries as tarfile.add(source_dir, ".") and is identical every time
+    it is generated as long as the contents of the directory do not change."""
+    # only used to build the headers of each entry
+    builder = tarfile.open(fileobj=io.BytesIO(), mode="w", format=tarfile.PAX_FORMAT)
+
+    def _entries():
+        yield source_dir, "."
+        for root, dirs, files in os.walk(source_dir):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                path = os.path.join(root, name)
+                yield path, os.path.join(".", os.path.relpath(path, source_dir))
+
+    for path, arcname in _entries():
+        tarinfo = builder.gettarinfo(path, arcname)
+        if tarinfo is None:
+            # sockets and other unsupported file types
+            continue
+
+        yield tarinfo.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+        if not tarinfo.isreg():
+            continue
+
+        remaining = tarinfo.size
+        with open(path, "rb") as fp:
+            while remaining > 0:
+                data = fp.read(min(chunk_size, remaining))
+                if not data:
+                    # the file was truncated while we were reading it
+                    log.warning("{} was truncated during transfer".format(path))
+                    data = b"\0" * remaining
+
+                remaining -= len(data)
+                yield data
+
+        padding = tarinfo.size % tarfile.BLOCKSIZE
+        if padding:
+            yield b"\0" * (tarfile.BLOCKSIZE - padding)
+
+    # end of archive marker
+    yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+
+def compress_chunks(chunks, compression):
+    """Yields the given iterable of bytes compressed with the given compression method."""
+    if compression == TRANSFER_COMPRESSION_NONE:
+        yield from chunks
+        return
+
+    if compression == TRANSFER_COMPRESSION_GZIP:
+        # the gzip header written by zlib has no timestamp so the output is always the same
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif compression == TRANSFER_COMPRESSION_ZSTD:
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError("unsupported transfer compression {}".format(compression))
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def skip_bytes(chunks, offset):
+    """Yields the given iterable of bytes skipping the first offset bytes."""
+    for chunk in chunks:
+        if offset >= len(chunk):
+            offset -= len(chunk)
+            continue
+
+        if offset:
+            chunk = chunk[offset:]
+            offset = 0
+
+        yield chunk
+
+
+class TransferReader(object):
+    """A read-only file-like object over an iterable of (optionally compressed) bytes."""
+
+    def __init__(self, chunks, compression=TRANSFER_COMPRESSION_NONE):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+        self.eof = False
+
+        if compression == TRANSFER_COMPRESSION_NONE:
+            self.decompressor = None
+        elif compression == TRANSFER_COMPRESSION_GZIP:
+            self.decompressor = zlib.decompressobj(31)
+        elif compression == TRANSFER_COMPRESSION_ZSTD:
+            if zstandard is None:
+                raise ValueError("zstd transfer compression requires the zstandard library")
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise ValueError("unsupported transfer compression {}".format(compression))
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self.buffer) < size) and not self.eof:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.eof = True
+                if self.decompressor is not None and hasattr(self.decompressor, "flush"):
+                    self.buffer += self.decompressor.flush()
+                break
+
+            if self.decompressor is not None:
+                chunk = self.decompressor.decompress(chunk)
+
+            self.buffer += chunk
+
+        if size is None or size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+
+
+def extract_tar_stream(fileobj, target_dir):
+    """Extracts the tar archive read from the given file-like object into target_dir as it is read.
+    Entries that would be extracted outside of target_dir are skipped."""
+    target_dir = os.path.realpath(target_dir)
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for tarinfo in tar:
+            target_path = os.path.realpath(os.path.join(target_dir, tarinfo.name))
+            if target_path != target_dir and not target_path.startswith(target_dir + os.sep):
+                log.warning("skipping tar entry {} outside of {}".format(tarinfo.name, target_dir))
+                continue
+
+            if (tarinfo.issym() or tarinfo.islnk()) and os.path.isabs(tarinfo.linkname):
+                log.warning("skipping tar link {} to absolute path {}".format(tarinfo.name, tarinfo.linkname))
+                continue
+
+            tar.extract(tarinfo, path=target_dir)
+
+
+class _ResumableDownload(object):
+    """Iterates over the bytes of a transfer download reconnecting at the current offset if the connection fails."""
+
+    def __init__(self, command, compression, resume_attempts, *args, **kwargs):
+        self.command = command
+        self.resume_attempts = resume_attempts
+        self.args = args
+        self.kwargs = kwargs
+        # the number of (possibly compressed) bytes received so far
+        self.offset = 0
+        self.response = self._request(compression)
+        self.compression = self.response.headers.get(HEADER_TRANSFER_COMPRESSION, TRANSFER_COMPRESSION_NONE)
+
+    def _request(self, compression):
+        headers = {HEADER_TRANSFER_COMPRESSION: compression}
+        if self.offset:
+            headers[HEADER_TRANSFER_OFFSET] = str(self.offset)
+
+        r = _execute_api_call(self.command, stream=True, headers=headers, *self.args, **self.kwargs)
+        if self.offset and r.headers.get(HEADER_TRANSFER_OFFSET) != str(self.offset):
+            r.close()
+            raise RuntimeError("remote host does not support resuming {}".format(self.command))
+
+        return r
+
+    def __iter__(self):
+        attempt = 0
+        while True:
+            try:
+                for chunk in self.response.iter_content(io.DEFAULT_BUFFER_SIZE):
+                    if chunk:
+                        self.offset += len(chunk)
+                        yield chunk
+
+                return
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                attempt += 1
+                if attempt > self.resume_attempts:
+                    raise
+
+                log.warning(
+                    "transfer of {} interrupted at offset {} ({}) - resuming (attempt #{})".format(
+                        self.command, self.offset, e, attempt
+                    )
+                )
+                self.response.close()
+                self.response = self._request(self.compression)
+
+
+def download(uuid, target_dir, *args, compression=None, resume_attempts=3, **kwargs):
     """Download everything related to this uuid and write it to target_dir.
 
     :param str uuid: The ACE analysis/alert uuid.
     :param str target_dir: The directory you want everything written to.
+    :param str compression: (optional) Comma separated list of compression methods to request
+        in order of preference (zstd, gzip or none). Defaults to none.
+    :param int resume_attempts: (optional) The number of times to resume an interrupted download. Defaults to 3.
     """
     if not os.path.isdir(target_dir):
         os.makedirs(target_dir)
 
-    fp, tar_path = tempfile.mkstemp(prefix="download_{}".format(uuid), suffix=".tar")
+    transfer = _ResumableDownload(
+        "engine/download/{}".format(uuid),
+        compression or TRANSFER_COMPRESSION_NONE,
+        resume_attempts,
+        *args,
+        **kwargs,
+    )
 
     try:
-        r = _execute_api_call("engine/download/{}".format(uuid), stream=True, *args, **kwargs)
-
-        size = 0
-        for chunk in r.iter_content(io.DEFAULT_BUFFER_SIZE):
-            if chunk:
-                os.write(fp, chunk)
-                size += len(chunk)
-
-        os.close(fp)
-
-        t = tarfile.open(tar_path, "r|")
-        t.extractall(path=target_dir)
-
+        extract_tar_stream(TransferReader(transfer, transfer.compression), target_dir)
     finally:
-        try:
-            os.remove(tar_path)
-        except:
-            sys.stderr.write("unable to delete temporary file {}: {}\n".format(tar_path, e))
+        transfer.response.close()
 
 
 def _cli_download(args):
@@ -753,40 +990,65 @@ download_command_parser.add_argument(
 download_command_parser.set_defaults(func=_cli_download)
 
 
-def upload(uuid, source_dir, overwrite=False, sync=True, *args, **kwargs):
+def upload(uuid, source_dir, overwrite=False, sync=True, *args, compression=None, **kwargs):
     """Upload an ACE analysis/alert directory.
 
     :param str uuid: A new UUID for ACE to use.
     :param str source_dir: The directory to upload.
+    :param str compression: (optional) The compression method to use (zstd, gzip or none). Defaults to none.
     """
     if not os.path.isdir(source_dir):
         raise ValueError("{} is not a directory".format(source_dir))
 
+    compression = compression or TRANSFER_COMPRESSION_NONE
+    upload_modifiers = json.dumps(
+        {
+            "overwrite": overwrite,
+            "sync": sync,
+        }
+    )
+
+    try:
+        # the archive is streamed as the body of the request
+        return _execute_api_call(
+            "engine/upload/{}".format(uuid),
+            params={"upload_modifiers": upload_modifiers},
+            data=compress_chunks(iter_tar(source_dir), compression),
+            method=METHOD_POST,
+            headers={
+                "Content-Type": MIMETYPE_TAR,
+                HEADER_TRANSFER_COMPRESSION: compression,
+            },
+            *args,
+            **kwargs,
+        ).json()
+    except requests.exceptions.HTTPError as e:
+        # older versions of ACE only accept the archive as a multipart file upload
+        if e.response is None or e.response.status_code != 400 or compression != TRANSFER_COMPRESSION_NONE:
+            raise
+
+        log.info("streaming upload of {} rejected ({}) - trying multipart upload".format(uuid, e))
+
     fp, tar_path = tempfile.mkstemp(suffix=".tar", prefix="upload_{}".format(uuid))
     try:
-        tar = tarfile.open(fileobj=os.fdopen(fp, "wb"), mode="w|")
-        tar.add(source_dir, ".")
-        tar.close()
+        with os.fdopen(fp, "wb") as tar_fp:
+            for chunk in iter_tar(source_dir):
+                tar_fp.write(chunk)
 
         with open(tar_path, "rb") as fp:
             return _execute_api_call(
                 "engine/upload/{}".format(uuid),
-                data={
-                    "upload_modifiers": json.dumps(
-                        {
-                            "overwrite": overwrite,
-                            "sync": sync,
-                        }
-                    )
-                },
+                data={"upload_modifiers": upload_modifiers},
                 method=METHOD_POST,
                 files=[("archive", (os.path.basename(tar_path), fp))],
+                *args,
+                **kwargs,
             ).json()
     finally:
         try:
             os.remove(tar_path)
         except Exception as e:
-            log.warning("unable to remove {}: {}".foramt(tar_path, e))
+            log.warning("unable to remove {}: {}".format(tar_path, e))
 
 
 def clear(uuid, lock_uuid, *args, **kwargs):
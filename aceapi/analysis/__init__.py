@@ -300,8 +300,9 @@ def get_analysis(uuid):
     if not os.path.exists(storage_dir):
         abort(Response("invalid uuid {}".format(uuid), 400))
 
+    # the JSON is returned as it was loaded so there is no need to materialize the analysis
     root = RootAnalysis(storage_dir=storage_dir)
-    root.load()
+    root.load(lazy=True)
     return json_result({'result': root.json})
 
 @analysis_bp.route('/submission/<uuid>', methods=['GET'])
@@ -8,18 +8,29 @@ import logging
 import os
 import os.path
 import shutil
-import tarfile
-import tempfile
 import threading
 
 import saq
 from .. import json_result, json_request
+from ace_api import (
+        HEADER_TRANSFER_COMPRESSION,
+        HEADER_TRANSFER_OFFSET,
+        MIMETYPE_TAR,
+        TRANSFER_COMPRESSION_NONE,
+        TransferReader,
+        compress_chunks,
+        extract_tar_stream,
+        get_supported_transfer_compression,
+        iter_tar,
+        select_transfer_compression,
+        skip_bytes )
 from saq.analysis import RootAnalysis
 from saq.database import use_db
 from saq.error import report_exception
 from saq.util import validate_uuid, storage_dir_from_uuid, workload_storage_dir
 
 from flask import Blueprint, request, abort, Response, make_response
+from werkzeug.exceptions import HTTPException
 
 engine_bp = Blueprint('engine', __name__, url_prefix='/engine')
 
@@ -40,33 +51,29 @@ def download(uuid):
         abort(make_response("unknown target {}".format(target_dir), 400))
         #abort(Response("unknown target {}".format(target_dir)))
 
-    logging.info("received request to download {} to {}".format(uuid, request.remote_addr))
+    # the client can ask for the archive to be compressed
+    compression = select_transfer_compression(request.headers.get(HEADER_TRANSFER_COMPRESSION))
 
-    # create the tar file we're going to send back
-    fp, path = tempfile.mkstemp(prefix="download_{}".format(uuid), suffix='.tar', dir=saq.TEMP_DIR)
-
-    tar = tarfile.open(fileobj=os.fdopen(fp, 'wb'), mode='w|')
-    tar.add(target_dir, '.')
-    tar.close()
-
-    os.close(fp)
-    #os.lseek(fp, 0, os.SEEK_SET)
-
-    def _iter_send(_path):
-        with open(_path, 'rb') as fp:
-            while True:
-                data = fp.read(io.DEFAULT_BUFFER_SIZE)
-                if data == b'':
-                    break
+    # the client can resume an interrupted download by asking for the archive starting at an offset
+    try:
+        offset = int(request.headers.get(HEADER_TRANSFER_OFFSET, '0'))
+        if offset < 0:
+            raise ValueError()
+    except ValueError:
+        abort(make_response("invalid {} {}".format(HEADER_TRANSFER_OFFSET, request.headers.get(HEADER_TRANSFER_OFFSET)), 400))
 
-                yield data
+    logging.info("received request to download {} to {} compression {} offset {}".format(
+                 uuid, request.remote_addr, compression, offset))
 
-        try:
-            os.remove(_path)
-        except Exception as e:
-            logging.error(f"unable to remove {path}: {e}")
+    # the archive is generated as it is sent
+    stream = compress_chunks(iter_tar(target_dir), compression)
+    if offset:
+        stream = skip_bytes(stream, offset)
 
-    return Response(_iter_send(path), mimetype='application/octet-stream')
+    response = Response(stream, mimetype='application/octet-stream')
+    response.headers[HEADER_TRANSFER_COMPRESSION] = compression
+    response.headers[HEADER_TRANSFER_OFFSET] = str(offset)
+    return response
 
 KEY_UPLOAD_MODIFIERS = 'upload_modifiers'
 KEY_OVERWRITE = 'overwrite'
@@ -81,9 +88,6 @@ def upload(uuid):
     if KEY_UPLOAD_MODIFIERS not in request.values:
         abort(Response("missing key {} in request".format(KEY_UPLOAD_MODIFIERS), 400))
 
-    if KEY_ARCHIVE not in request.files:
-        abort(Response("missing files key {}".format(KEY_ARCHIVE), 400))
-
     upload_modifiers = json.loads(request.values[KEY_UPLOAD_MODIFIERS])
     if not isinstance(upload_modifiers, dict):
         abort(Response("{} should be a dict".format(KEY_UPLOAD_MODIFIERS), 400))
@@ -121,21 +125,27 @@ def upload(uuid):
 
     logging.debug("target directory for {} is {}".format(uuid, target_dir))
 
-    # save the tar file so we can extract it
-    fp, tar_path = tempfile.mkstemp(suffix='.tar', prefix='upload_{}'.format(uuid), dir=saq.TEMP_DIR)
-    os.close(fp)
-
     try:
-        request.files[KEY_ARCHIVE].save(tar_path)
+        # the archive is extracted as it is received
+        # it is either the body of the request or (for older clients) a multipart file upload
+        if request.mimetype == MIMETYPE_TAR:
+            compression = request.headers.get(HEADER_TRANSFER_COMPRESSION, TRANSFER_COMPRESSION_NONE)
+            if compression not in get_supported_transfer_compression():
+                abort(Response("unsupported {} {}".format(HEADER_TRANSFER_COMPRESSION, compression), 400))
+
+            chunks = iter(lambda: request.stream.read(io.DEFAULT_BUFFER_SIZE), b'')
+            extract_tar_stream(TransferReader(chunks, compression), target_dir)
+        else:
+            if KEY_ARCHIVE not in request.files:
+                abort(Response("missing files key {}".format(KEY_ARCHIVE), 400))
 
-        t = tarfile.open(tar_path, 'r|')
-        t.extractall(path=target_dir)
+            extract_tar_stream(request.files[KEY_ARCHIVE].stream, target_dir)
 
         logging.debug("extracted {} to {}".format(uuid, target_dir))
 
         # update the root analysis to indicate it's new location 
         root = RootAnalysis(storage_dir=target_dir)
-        root.load()
+        root.load(lazy=True)
 
         root.location = saq.SAQ_NODE
         root.company_id = saq.COMPANY_ID
@@ -149,17 +159,14 @@ def upload(uuid):
         # looks like it worked
         return json_result({'result': True})
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         logging.error("unable to upload {}: {}".format(uuid, e))
         report_exception()
         abort(Response("unable to upload {}: {}".format(uuid, e)))
 
-    finally:
-        try:
-            os.remove(tar_path)
-        except Exception as e:
-            logging.error("unable to remove {}: {}".format(tar_path,e ))
-
 @engine_bp.route('/clear/<uuid>/<lock_uuid>', methods=['GET'])
 @use_db
 def clear(uuid, lock_uuid, db, c):
@@ -15,6 +15,15 @@ from saq.database import acquire_lock, release_lock, use_db
 from aceapi.test import *
 from saq.test import *
 from saq.util import storage_dir_from_uuid
+from ace_api import (
+        HEADER_TRANSFER_COMPRESSION,
+        HEADER_TRANSFER_OFFSET,
+        MIMETYPE_TAR,
+        TRANSFER_COMPRESSION_GZIP,
+        TransferReader,
+        compress_chunks,
+        extract_tar_stream,
+        iter_tar )
 
 from flask import url_for
 
@@ -86,6 +95,79 @@ class APIEngineTestCase(APIBasicTestCase):
             except:
                 pass
 
+    def _create_download_target(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        root.details = { 'hello': 'world' }
+        with open(os.path.join(root.storage_dir, 'test.dat'), 'w') as fp:
+            fp.write('test' * 10000)
+        file_observable = root.add_observable(F_FILE, 'test.dat')
+        root.save()
+        return root, file_observable
+
+    def _verify_download(self, output_dir, file_observable):
+        root = RootAnalysis(storage_dir=output_dir)
+        root.load()
+        self.assertEquals(root.details, { 'hello': 'world' })
+        file_observable = root.get_observable(file_observable.id)
+        with open(os.path.join(root.storage_dir, file_observable.value), 'r') as fp:
+            self.assertEquals(fp.read(), 'test' * 10000)
+
+    def test_download_compressed(self):
+        root, file_observable = self._create_download_target()
+        result = self.client.get(url_for('engine.download', uuid=root.uuid), 
+                                 headers={HEADER_TRANSFER_COMPRESSION: 'unknown, gzip'})
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(result.headers[HEADER_TRANSFER_COMPRESSION], TRANSFER_COMPRESSION_GZIP)
+
+        output_dir = os.path.join(saq.TEMP_DIR, 'download')
+        try:
+            extract_tar_stream(TransferReader([result.data], TRANSFER_COMPRESSION_GZIP), output_dir)
+            self._verify_download(output_dir, file_observable)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    def test_download_resume(self):
+        root, file_observable = self._create_download_target()
+        result = self.client.get(url_for('engine.download', uuid=root.uuid))
+        self.assertEquals(result.status_code, 200)
+        data = result.data
+
+        # the archive is the same every time so we can ask for the rest of it
+        offset = len(data) // 2
+        result = self.client.get(url_for('engine.download', uuid=root.uuid), headers={HEADER_TRANSFER_OFFSET: str(offset)})
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(result.headers[HEADER_TRANSFER_OFFSET], str(offset))
+        self.assertEquals(data[:offset] + result.data, data)
+
+        output_dir = os.path.join(saq.TEMP_DIR, 'download')
+        try:
+            extract_tar_stream(TransferReader([data[:offset], result.data]), output_dir)
+            self._verify_download(output_dir, file_observable)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        result = self.client.get(url_for('engine.download', uuid=root.uuid), headers={HEADER_TRANSFER_OFFSET: '-1'})
+        self.assertEquals(result.status_code, 400)
+
+    def test_upload_stream(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()), storage_dir=os.path.join(saq.TEMP_DIR, 'test_upload'))
+        root.initialize_storage()
+        root.details = { 'hello': 'world' }
+        root.save()
+
+        result = self.client.post(url_for('engine.upload', uuid=root.uuid), 
+                                  query_string={ 'upload_modifiers': json.dumps({ 'overwrite': False, 'sync': False, }) },
+                                  data=b''.join(compress_chunks(iter_tar(root.storage_dir), TRANSFER_COMPRESSION_GZIP)),
+                                  content_type=MIMETYPE_TAR,
+                                  headers={HEADER_TRANSFER_COMPRESSION: TRANSFER_COMPRESSION_GZIP})
+        self.assertEquals(result.status_code, 200)
+
+        root = RootAnalysis(storage_dir=storage_dir_from_uuid(root.uuid))
+        root.load()
+        self.assertEquals(root.details, { 'hello': 'world' })
+        self.assertEquals(root.location, saq.SAQ_NODE)
+
     def test_upload(self):
         
         # first create something to upload
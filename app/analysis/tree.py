@@ -0,0 +1,303 @@
+# vim: sw=4:ts=4:et
+#
+# the display tree of the analysis of an alert
+#
+# the tree is computed from the loaded alert (visibility, references and ordering)
+# and then cached in a compact form keyed by the modification time of the data.json of the alert
+# so that it is only computed once per revision of the alert (per GUI process)
+#
+# see the [gui] display_tree_cache_size configuration setting
+#
+
+import collections
+import logging
+import os
+import threading
+import uuid as uuidlib
+
+import saq
+import saq.analysis
+
+class TreeNode(object):
+    def __init__(self, obj, parent=None, uuid=None):
+        # unique ID that can be used in the GUI to track nodes
+        self.uuid = uuid or str(uuidlib.uuid4())
+        # Analysis or Observable object
+        self.obj = obj
+        self.parent = parent
+        self.children = []
+        # points to an already existing TreeNode for the analysis of this Observable
+        self.reference_node = None
+        # nodes are not visible unless something along the path has a "detection point"
+        self.visible = False
+        # a list of nodes that refer to this node
+        self.referents = []
+
+    def add_child(self, child):
+        assert isinstance(child, TreeNode)
+        self.children.append(child)
+        child.parent = self
+
+    def remove_child(self, child):
+        assert isinstance(child, TreeNode)
+        self.children.remove(child)
+        child.parent = self
+
+    def refer_to(self, node):
+        self.reference_node = node
+        node.add_referent(self)
+
+    def add_referent(self, node):
+        self.referents.append(node)
+
+    def walk(self, callback):
+        callback(self)
+        for node in self.children:
+            node.walk(callback)
+
+    def __str__(self):
+        return "TreeNode({}, {}, {})".format(self.obj, self.reference_node, self.visible)
+
+def _recurse(current_node, node_tracker=None):
+    assert isinstance(current_node, TreeNode)
+    assert isinstance(current_node.obj, saq.analysis.Analysis)
+    assert node_tracker is None or isinstance(node_tracker, dict)
+
+    analysis = current_node.obj
+    if node_tracker is None:
+        node_tracker = {}
+
+    for observable in analysis.observables:
+        child_node = TreeNode(observable)
+        current_node.add_child(child_node)
+
+        # if the observable is already in the current tree then we want to display a link to the existing analysis display
+        if observable.id in node_tracker:
+            child_node.refer_to(node_tracker[observable.id])
+            continue
+
+        node_tracker[observable.id] = child_node
+
+        for observable_analysis in [a for a in observable.all_analysis if a]:
+            observable_analysis_node = TreeNode(observable_analysis)
+            child_node.add_child(observable_analysis_node)
+            _recurse(observable_analysis_node, node_tracker)
+
+def _sort(node):
+    assert isinstance(node, TreeNode)
+
+    node.children = sorted(node.children, key=lambda x: x.obj)
+    for node in node.children:
+        _sort(node)
+
+def _prune(node, current_path=[]):
+    assert isinstance(node, TreeNode)
+    current_path.append(node)
+
+    if node.children:
+        for child in node.children:
+            _prune(child, current_path)
+    else:
+        # all nodes are visible up to nodes that have "detection points" or tags
+        # nodes tagged as "high_fp_frequency" are not visible
+        update_index = 0
+        index = 0
+        while index < len(current_path):
+            _has_detection_points = current_path[index].obj.has_detection_points()
+            #_has_tags = len(current_path[index].obj.tags) > 0
+            _always_visible = current_path[index].obj.always_visible()
+            #_high_fp_freq = current_path[index].obj.has_tag('high_fp_frequency')
+            _critical_analysis = current_path[index].obj.has_tag('critical_analysis')
+
+            # 5/18/2020 - jdavison - changing how this works -- will refactor these out once these changes are approved
+            _has_tags = False
+            _high_fp_freq = False
+
+            if _has_detection_points or _has_tags or _always_visible or _critical_analysis:
+                # if we have tags but no detection points and we also have the high_fp_freq tag then we hide that
+                if _high_fp_freq and not ( _has_detection_points or _always_visible ):
+                    index += 1
+                    continue
+
+                while update_index <= index:
+                    current_path[update_index].visible = True
+                    update_index += 1
+
+            index += 1
+
+    current_path.pop()
+
+def _resolve_references(node):
+    # in the case were we have a visible node that is refering to a node that is NOT visible
+    # then we need to use the data of the refering node
+    def _resolve(node):
+        if node.visible and node.reference_node and not node.reference_node.visible:
+            node.children = node.reference_node.children
+            for referent in node.reference_node.referents:
+                referent.reference_node = node
+
+            node.reference_node = None
+
+    node.walk(_resolve)
+
+def build_display_tree(alert, prune, show_root_observables):
+    """Returns the root TreeNode of the display tree of the given (loaded) alert."""
+    display_tree = TreeNode(alert)
+    _recurse(display_tree)
+    _sort(display_tree)
+    if prune:
+        _prune(display_tree)
+        # root node is visible
+        display_tree.visible = True
+
+        # if the show_root_observables config option is True then
+        # also all observables in the root node
+        if show_root_observables:
+            for child in display_tree.children:
+                child.visible = True
+
+        _resolve_references(display_tree)
+
+    return display_tree
+
+#
+# compact form of the display tree
+#
+# the tree is stored as a list of nodes in the order they are first visited
+# each node is a tuple of (key, uuid, visible, reference_index, child_indexes)
+# where key is None for the root, observable_id for Observables and (observable_id, module_path) for Analysis
+# child indexes are used (instead of nesting) because resolved references share the children of other nodes
+#
+
+def _node_key(node):
+    if isinstance(node.obj, saq.analysis.RootAnalysis):
+        return None
+
+    if isinstance(node.obj, saq.analysis.Observable):
+        return node.obj.id
+
+    return (node.obj.observable.id, node.obj.module_path)
+
+def compact_display_tree(display_tree):
+    """Returns the compact form of the given display tree."""
+    indexes = {} # key = id(TreeNode), value = index into nodes
+    order = []
+
+    def _visit(node):
+        if id(node) in indexes:
+            return
+
+        indexes[id(node)] = len(order)
+        order.append(node)
+        for child in node.children:
+            _visit(child)
+
+    _visit(display_tree)
+    # a referenced node is normally already in the tree
+    index = 0
+    while index < len(order):
+        if order[index].reference_node is not None:
+            _visit(order[index].reference_node)
+
+        index += 1
+
+    return [ (_node_key(node),
+              node.uuid,
+              node.visible,
+              indexes[id(node.reference_node)] if node.reference_node is not None else None,
+              tuple([indexes[id(child)] for child in node.children])) for node in order ]
+
+def expand_display_tree(alert, compact_tree):
+    """Returns the root TreeNode of the given compact display tree using the objects of the given (loaded) alert.
+       Raises KeyError if the tree refers to something that does not exist in the alert."""
+    nodes = []
+    for key, uuid, visible, _, _ in compact_tree:
+        if key is None:
+            obj = alert
+        elif isinstance(key, tuple):
+            observable_id, module_path = key
+            obj = alert.observable_store[observable_id].analysis[module_path]
+        else:
+            obj = alert.observable_store[key]
+
+        node = TreeNode(obj, uuid=uuid)
+        node.visible = visible
+        nodes.append(node)
+
+    for node, (_, _, _, reference_index, child_indexes) in zip(nodes, compact_tree):
+        if reference_index is not None:
+            node.refer_to(nodes[reference_index])
+
+        node.children = [nodes[index] for index in child_indexes]
+        for child in node.children:
+            if child.parent is None:
+                child.parent = node
+
+    return nodes[0]
+
+class DisplayTreeCache(object):
+    """LRU cache of compact display trees keyed by alert uuid and display options.
+       An entry is only valid for the revision of the data.json it was computed from."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # key = (uuid, prune, show_root_observables), value = ((st_mtime_ns, st_size), compact_tree)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, revision):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if entry[0] != revision:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, revision, compact_tree):
+        with self.lock:
+            self.entries[key] = (revision, compact_tree)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_display_tree_cache = None
+
+def get_display_tree_cache():
+    global _display_tree_cache
+    if _display_tree_cache is None:
+        _display_tree_cache = DisplayTreeCache(saq.CONFIG['gui'].getint('display_tree_cache_size', fallback=100))
+
+    return _display_tree_cache
+
+def get_display_tree(alert, prune, show_root_observables):
+    """Returns the display tree of the given (loaded) alert, using the cached tree if it is still valid."""
+    cache = get_display_tree_cache()
+    if cache.max_size < 1:
+        return build_display_tree(alert, prune, show_root_observables)
+
+    try:
+        st = os.stat(alert.json_path)
+        revision = (st.st_mtime_ns, st.st_size)
+    except OSError as e:
+        logging.debug(f"unable to stat {alert.json_path}: {e}")
+        return build_display_tree(alert, prune, show_root_observables)
+
+    key = (alert.uuid, prune, show_root_observables)
+    compact_tree = cache.get(key, revision)
+    if compact_tree is not None:
+        try:
+            return expand_display_tree(alert, compact_tree)
+        except KeyError as e:
+            logging.warning(f"cached display tree for {alert} is invalid: {e}")
+
+    display_tree = build_display_tree(alert, prune, show_root_observables)
+    cache.put(key, revision, compact_display_tree(display_tree))
+    return display_tree
@@ -56,7 +56,7 @@ from saq.database import User, UserAlertMetrics, Comment, get_db_connection, Eve
                          acquire_lock, release_lock, \
                          get_available_nodes, use_db, set_dispositions, add_workload, \
                          add_observable_tag_mapping, remove_observable_tag_mapping, \
-                         Remediation, Owner, DispositionBy, RemediatedBy
+                         Remediation, Owner, DispositionBy, RemediatedBy, get_sla_config_hash
 from saq.email import search_archive, get_email_archive_sections
 from saq.error import report_exception
 from saq.gui import GUIAlert
@@ -72,6 +72,7 @@ import ace_api
 from app import db
 from app.analysis import *
 from app.analysis.filters import *
+from app.analysis.tree import get_display_tree
 from flask import jsonify, render_template, redirect, request, url_for, flash, session, \
                   make_response, g, send_from_directory, send_file, stream_with_context, Response
 from flask_login import login_user, logout_user, login_required, current_user
@@ -1804,7 +1805,17 @@ def manage():
     # we want to display alerts that are either approaching or exceeding SLA
     sla_ids = [] # list of alert IDs that need to be displayed
     if saq.GLOBAL_SLA_SETTINGS.enabled or any([s.enabled for s in saq.OTHER_SLA_SETTINGS]):
-        _query = db.session.query(GUIAlert).filter(GUIAlert.disposition == None)
+        # the SLA dates are precomputed (see saq.database.update_sla_dates)
+        # an alert that is approaching SLA is either approaching it or over it
+        sla_config = get_sla_config_hash()
+        sla_ids = [row[0] for row in db.session.query(GUIAlert.id).filter(
+            GUIAlert.disposition == None,
+            GUIAlert.sla_config == sla_config,
+            GUIAlert.sla_approaching_date <= datetime.datetime.now())]
+
+        # alerts that have not had their SLA dates computed with the current configuration yet are checked the slow way
+        _query = db.session.query(GUIAlert).filter(GUIAlert.disposition == None,
+                                                   or_(GUIAlert.sla_config == None, GUIAlert.sla_config != sla_config))
         for alert_type in saq.EXCLUDED_SLA_ALERT_TYPES:
             _query = _query.filter(GUIAlert.alert_type != alert_type)
         for alert in _query:
@@ -2647,151 +2658,16 @@ def index():
     special_tag_names = [tag for tag in saq.CONFIG['tags'].keys() if saq.CONFIG['tags'][tag] == 'special']
     alert_tags = [tag for tag in alert_tags if tag.name not in special_tag_names]
 
-    # compute the display tree
-    class TreeNode(object):
-        def __init__(self, obj, parent=None):
-            # unique ID that can be used in the GUI to track nodes
-            self.uuid = str(uuidlib.uuid4())
-            # Analysis or Observable object
-            self.obj = obj
-            self.parent = parent
-            self.children = []
-            # points to an already existing TreeNode for the analysis of this Observable
-            self.reference_node = None
-            # nodes are not visible unless something along the path has a "detection point"
-            self.visible = False
-            # a list of nodes that refer to this node
-            self.referents = []
-
-        def add_child(self, child):
-            assert isinstance(child, TreeNode)
-            self.children.append(child)
-            child.parent = self
-
-        def remove_child(self, child):
-            assert isinstance(child, TreeNode)
-            self.children.remove(child)
-            child.parent = self
-
-        def refer_to(self, node):
-            self.reference_node = node
-            node.add_referent(self)
-
-        def add_referent(self, node):
-            self.referents.append(node)
-
-        def walk(self, callback):
-            callback(self)
-            for node in self.children:
-                node.walk(callback)
-
-        def __str__(self):
-            return "TreeNode({}, {}, {})".format(self.obj, self.reference_node, self.visible)
-
-    def _recurse(current_node, node_tracker=None):
-        assert isinstance(current_node, TreeNode)
-        assert isinstance(current_node.obj, saq.analysis.Analysis)
-        assert node_tracker is None or isinstance(node_tracker, dict)
-
-        analysis = current_node.obj
-        if node_tracker is None:
-            node_tracker = {}
-
-        for observable in analysis.observables:
-            child_node = TreeNode(observable)
-            current_node.add_child(child_node)
-
-            # if the observable is already in the current tree then we want to display a link to the existing analysis display
-            if observable.id in node_tracker:
-                child_node.refer_to(node_tracker[observable.id])
-                continue
-
-            node_tracker[observable.id] = child_node
-
-            for observable_analysis in [a for a in observable.all_analysis if a]:
-                observable_analysis_node = TreeNode(observable_analysis)
-                child_node.add_child(observable_analysis_node)
-                _recurse(observable_analysis_node, node_tracker)
-
-    def _sort(node):
-        assert isinstance(node, TreeNode)
-
-        node.children = sorted(node.children, key=lambda x: x.obj)
-        for node in node.children:
-            _sort(node)
-
-    def _prune(node, current_path=[]):
-        assert isinstance(node, TreeNode)
-        current_path.append(node)
-
-        if node.children:
-            for child in node.children:
-                _prune(child, current_path)
-        else:
-            # all nodes are visible up to nodes that have "detection points" or tags
-            # nodes tagged as "high_fp_frequency" are not visible
-            update_index = 0
-            index = 0
-            while index < len(current_path):
-                _has_detection_points = current_path[index].obj.has_detection_points()
-                #_has_tags = len(current_path[index].obj.tags) > 0
-                _always_visible = current_path[index].obj.always_visible()
-                #_high_fp_freq = current_path[index].obj.has_tag('high_fp_frequency')
-                _critical_analysis = current_path[index].obj.has_tag('critical_analysis')
-
-                # 5/18/2020 - jdavison - changing how this works -- will refactor these out once these changes are approved
-                _has_tags = False
-                _high_fp_freq = False
-
-                if _has_detection_points or _has_tags or _always_visible or _critical_analysis:
-                    # if we have tags but no detection points and we also have the high_fp_freq tag then we hide that
-                    if _high_fp_freq and not ( _has_detection_points or _always_visible ):
-                        index += 1
-                        continue
-
-                    while update_index <= index:
-                        current_path[update_index].visible = True
-                        update_index += 1
-
-                index += 1
-
-        current_path.pop()
-
-    def _resolve_references(node):
-        # in the case were we have a visible node that is refering to a node that is NOT visible
-        # then we need to use the data of the refering node
-        def _resolve(node):
-            if node.visible and node.reference_node and not node.reference_node.visible:
-                node.children = node.reference_node.children
-                for referent in node.reference_node.referents:
-                    referent.reference_node = node
-
-                node.reference_node = None
-
-        node.walk(_resolve)
-
     # are we viewing all analysis?
     if 'prune' not in session:
         session['prune'] = True
 
     # we only display the tree if we're looking at the alert
+    # the display tree is computed once per revision of the alert (see app.analysis.tree)
     display_tree = None
     if alert is analysis:
-        display_tree = TreeNode(analysis)
-        _recurse(display_tree)
-        _sort(display_tree)
-        if session['prune']:
-            _prune(display_tree)
-            # root node is visible
-            display_tree.visible = True
-
-            # if the show_root_observables config option is True then
-            # also all observables in the root node
-            if saq.CONFIG['gui'].getboolean('show_root_observables'):
-                for child in display_tree.children:
-                    child.visible = True
-
-            _resolve_references(display_tree)
+        display_tree = get_display_tree(alert, session['prune'], 
+                                        saq.CONFIG['gui'].getboolean('show_root_observables'))
 
     try:
         # go ahead and get the list of all the users, we'll end up using it
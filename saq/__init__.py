@@ -136,7 +136,7 @@ def initialize(
         args=None,
         relative_dir=None):
 
-    from saq.database import initialize_database, initialize_node, initialize_automation_user
+    from saq.database import initialize_database, initialize_node, initialize_automation_user, listen_for_sla_property_changes
 
     global API_PREFIX
     global AUTOMATION_USER_ID
@@ -455,6 +455,9 @@ def initialize(
                                       CONFIG[section]['property'],
                                       CONFIG[section]['value']))
 
+    # the SLA of an alert changes with the properties the SLA settings match on
+    listen_for_sla_property_changes()
+
     # what node is this?
     try:
         SAQ_NODE = CONFIG['global']['node']
@@ -527,6 +530,10 @@ def initialize(
     # initialize fallback semaphores
     initialize_fallback_semaphores()
 
+    # the analysis cache is created (on demand) from the configuration we just loaded
+    from saq.analysis.cache import reset_analysis_cache
+    reset_analysis_cache()
+
     # XXX get rid of this
     try:
         maliciousdir = CONFIG.get("global", "malicious")
@@ -18,6 +18,7 @@ import shutil
 import sys
 import time
 import uuid
+import weakref
 
 import dateutil.parser
 import requests
@@ -26,6 +27,7 @@ from typing import List
 from urllib.parse import urlsplit
 
 import saq
+from saq.analysis.pack import DetailsPack, get_details_format, is_packed, DETAILS_FORMAT_PACKED
 from saq.constants import *
 from saq.error import report_exception
 from saq.indicators import Indicator, IndicatorList
@@ -186,33 +188,108 @@ def _get_io_read_count():
 # 
 ##############################################################################
 
+class _EmptyList(list):
+    """An immutable empty list. See EMPTY_LIST."""
+
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("EMPTY_LIST cannot be modified")
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _immutable
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+
+    def __reduce__(self):
+        # copies (and pickles) of the sentinel are the sentinel
+        return 'EMPTY_LIST'
+
+# most Observables and Analysis objects never get tags, detection points, directives, etc...
+# so these properties all share this list until something is actually added (see _writable_list)
+EMPTY_LIST = _EmptyList()
+
+def _writable_list(value):
+    """Returns a new list if the given value is EMPTY_LIST, otherwise returns the value."""
+    return [] if value is EMPTY_LIST else value
+
+class _EventListeners(dict):
+    """An immutable table of event listeners (key = event, value = tuple of callbacks.)
+       Objects that have the same listeners added in the same order share the same table (see EventSource.add_event_listener.)"""
+
+    __slots__ = ('predecessor', 'successors', '__weakref__')
+
+    def __init__(self, *args, predecessor=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the table this table was created from (which keeps the chain of tables alive while this table is used)
+        self.predecessor = predecessor
+        # the tables that result from adding a listener to this table
+        # key = (event, id of the object of the callback, id of the function of the callback), value = _EventListeners
+        # bound methods are created every time they are referenced so they are identified by the object and the function
+        # (the ids stay valid as long as the resulting table exists since it references the callback)
+        self.successors = weakref.WeakValueDictionary()
+
+    def add(self, event, callback):
+        """Returns the table that has the given callback added to the listeners of the given event."""
+        key = (event, id(getattr(callback, '__self__', callback)), id(getattr(callback, '__func__', callback)))
+        result = self.successors.get(key)
+        if result is None:
+            result = _EventListeners(self, predecessor=self)
+            dict.__setitem__(result, event, self.get(event, ()) + (callback,))
+            self.successors[key] = result
+
+        return result
+
+# the table of every EventSource that has no event listeners
+_NO_EVENT_LISTENERS = _EventListeners()
+
 class EventSource(object):
     """Supports callbacks for events by keyword."""
 
+    __slots__ = ('event_listeners',)
+
+    # methods of the object that are called when the object fires an event (before the event listeners are called)
+    # key = event, value = tuple of method names
+    event_handlers = {}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.clear_event_listeners()
 
     def clear_event_listeners(self):
-        self.event_listeners = {} # key = string, value = [] of callback functions
+        self.event_listeners = _NO_EVENT_LISTENERS # key = string, value = () of callback functions
+
+    def invalidate_json_cache(self):
+        """Called when something that is serialized into the data.json file changes.
+           See Observable.json_fragment."""
+        pass
+
+    def invalidate_root_index(self):
+        """Called when something changes that the indexes of the RootAnalysis do not track through events.
+           See RootAnalysis.invalidate_analysis_index."""
+        root = getattr(self, 'root', None)
+        if isinstance(root, RootAnalysis):
+            root.invalidate_analysis_index()
 
     def add_event_listener(self, event, callback):
         assert isinstance(event, str)
         assert callback
 
-        if event not in self.event_listeners:
-            self.event_listeners[event] = []
+        if callback in self.event_listeners.get(event, ()):
+            return
 
-        if callback not in self.event_listeners[event]:
-            self.event_listeners[event].append(callback)
+        self.event_listeners = self.event_listeners.add(event, callback)
 
     def fire_event(self, source, event, *args, **kwargs):
         assert isinstance(source, Analysis) or isinstance(source, Observable)
         assert event in VALID_EVENTS
 
-        if event in self.event_listeners:
-            for callback in self.event_listeners[event]:
-                callback(source, event, *args, **kwargs)
+        # every event is the result of a change to the source object
+        source.invalidate_json_cache()
+
+        for name in self.event_handlers.get(event, ()):
+            getattr(self, name)(source, event, *args, **kwargs)
+
+        for callback in self.event_listeners.get(event, ()):
+            callback(source, event, *args, **kwargs)
 
 class DetectionPoint(object):
     """Represents an observation that would result in a detection."""
@@ -266,9 +343,12 @@ class DetectableObject(EventSource):
 
     KEY_DETECTIONS = 'detections'
 
+    # NOTE the _detections slot is defined by the classes that use this mixin
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._detections = []
+        self._detections = EMPTY_LIST
 
     @property
     def json(self):
@@ -278,7 +358,7 @@ class DetectableObject(EventSource):
     def json(self, value):
         assert isinstance(value, dict)
         if DetectableObject.KEY_DETECTIONS in value:
-            self._detections = value[DetectableObject.KEY_DETECTIONS]
+            self._detections = value[DetectableObject.KEY_DETECTIONS] or EMPTY_LIST
 
     @property
     def detections(self):
@@ -288,7 +368,9 @@ class DetectableObject(EventSource):
     def detections(self, value):
         assert isinstance(value, list)
         assert all([isinstance(x, DetectionPoint) for x in value]) or all([isinstance(x, dict) for x in value])
-        self._detections = value
+        self._detections = value or EMPTY_LIST
+        self.invalidate_json_cache()
+        self.invalidate_root_index()
 
     def has_detection_points(self):
         """Returns True if this object has at least one detection point, False otherwise."""
@@ -306,15 +388,18 @@ class DetectableObject(EventSource):
 
         detection = DetectionPoint(description, details)
 
-        if detection in self._detections:
+        if detection in self.detections:
             return
 
+        self._detections = _writable_list(self.detections)
         self._detections.append(detection)
         logging.debug("added detection point {} to {}".format(detection, self))
         self.fire_event(self, EVENT_DETECTION_ADDED, detection)
 
     def clear_detection_points(self):
-        self._detections.clear()
+        self._detections = EMPTY_LIST
+        self.invalidate_json_cache()
+        self.invalidate_root_index()
 
 # utility class to translate custom objects into JSON
 class _JSONEncoder(json.JSONEncoder):
@@ -329,6 +414,39 @@ class _JSONEncoder(json.JSONEncoder):
             logging.debug('json type {0}'.format(type(obj)))
             return super(_JSONEncoder, self).default(obj)
 
+# orjson is an optional dependency that encodes JSON significantly faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _orjson_default(obj):
+    # same translations as _JSONEncoder.default
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime(event_time_format_json_tz)
+    elif isinstance(obj, bytes):
+        return obj.decode('unicode_escape', 'replace')
+    elif hasattr(obj, 'json'):
+        return obj.json
+
+    raise TypeError(f"object of type {type(obj).__name__} is not JSON serializable")
+
+def _use_fast_json():
+    return orjson is not None and saq.CONFIG['global'].getboolean('fast_json_encoder', fallback=True)
+
+def encode_json(obj):
+    """Encodes the given object as a JSON string the same way _JSONEncoder does.
+       Uses orjson if it is installed and the fast_json_encoder configuration option is enabled."""
+    if _use_fast_json():
+        try:
+            return orjson.dumps(obj, default=_orjson_default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode('utf8')
+        except TypeError as e:
+            # fall back to the json module for anything orjson does not handle (like integers larger than 64 bits)
+            logging.debug(f"orjson unable to encode {type(obj)}: {e}")
+
+    return _JSONEncoder().encode(obj)
+
 class Tag(object):
     """Gives a bit of metadata to an observable or analysis.  Tags defined in the configuration file are also signals for detection."""
 
@@ -399,11 +517,14 @@ class TaggableObject(EventSource):
 
     KEY_TAGS = 'tags'
 
+    # NOTE the _tags slot is defined by the classes that use this mixin
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         # list of strings 
-        self._tags = []
+        self._tags = EMPTY_LIST
 
     @property
     def json(self):
@@ -425,7 +546,9 @@ class TaggableObject(EventSource):
     def tags(self, value):
         assert isinstance(value, list)
         assert all([isinstance(i, str) or isinstance(i, Tag) for i in value])
-        self._tags = value
+        self._tags = value or EMPTY_LIST
+        self.invalidate_json_cache()
+        self.invalidate_root_index()
 
     def add_tag(self, tag):
         assert isinstance(tag, str)
@@ -433,12 +556,15 @@ class TaggableObject(EventSource):
             return
 
         t = Tag(name=tag)
-        self.tags.append(t)
+        self._tags = _writable_list(self.tags)
+        self._tags.append(t)
         logging.debug("added {} to {}".format(t, self))
         self.fire_event(self, EVENT_TAG_ADDED, t)
 
     def clear_tags(self):
-        self._tags = []
+        self._tags = EMPTY_LIST
+        self.invalidate_json_cache()
+        self.invalidate_root_index()
 
     def has_tag(self, tag_value):
         """Returns True if this object has this tag."""
@@ -474,6 +600,19 @@ class Analysis(TaggableObject, DetectableObject):
 
     KEY_IOCS = 'iocs'
 
+    # a large root can have many thousands of these so the attributes are slots
+    # (the subclasses of Analysis do not define __slots__ so they can still have other attributes)
+    __slots__ = ('_tags', '_detections', 'root', '_observables', '_observable_ids', 'instance', '_is_modified',
+                 '_details', 'external_details_path', 'external_details', '_details_digest', 'external_details_loaded',
+                 '_observable', '_summary', '_completed', '_alerted', '_delayed', '_iocs', '_tip')
+
+    # when we add a tag we automatically add a detection if the tag's score is > 0
+    # certain observables also generate detections
+    event_handlers = {
+        EVENT_TAG_ADDED: ('tag_detection',),
+        EVENT_OBSERVABLE_ADDED: ('observable_detection',),
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -481,7 +620,10 @@ class Analysis(TaggableObject, DetectableObject):
         self.root = None
 
         # list of Observables generated by this Analysis
-        self._observables = []
+        self._observables = EMPTY_LIST
+
+        # the set of the ids of the Observables in self.observables (see _has_observable_id)
+        self._observable_ids = None
 
         # represents the instance of the AnalysisModule that generated this Analysis
         # this defaults to None if the module has no defined instances
@@ -499,11 +641,11 @@ class Analysis(TaggableObject, DetectableObject):
         self._details = None
         # the path to the storage of the details
         self.external_details_path = None
+        # md5 of the JSON of the details as they were last saved (see save())
+        self._details_digest = None
         # gets set to True when the external details has been loaded from disk
         self.external_details_loaded = False
 
-        self.defined_details_properties = {}
-
         # the observable this Analysis is for
         self._observable = None
 
@@ -526,17 +668,12 @@ class Analysis(TaggableObject, DetectableObject):
         # but eventually I would like to be able to alert from any Analysis object
         self._alerted = False
 
-        # when we add a tag we automatically add a detection if the tag's score is > 0
-        self.add_event_listener(EVENT_TAG_ADDED, self.tag_detection)
-
-        # certain observables also generate detections
-        self.add_event_listener(EVENT_OBSERVABLE_ADDED, self.observable_detection)
-
         # set to True when delayed analysis is requested
         self._delayed = False
 
         # List of IOCs that the analysis contains
-        self._iocs = IndicatorList()
+        # this is created when first needed (see the iocs property)
+        self._iocs = None
 
         # Intel database / TIP to use
         self._tip = None
@@ -566,6 +703,13 @@ class Analysis(TaggableObject, DetectableObject):
         """Calling this function indicates that the details will become modified and thus need to be saved."""
         # this is called automatically when you add an Analysis object to an Observable
         self._is_modified = True # tells ACE to save the details
+        self.invalidate_json_cache()
+
+    def invalidate_json_cache(self):
+        # the JSON of an Analysis is stored as part of the JSON of the Observable it is for
+        observable = getattr(self, '_observable', None)
+        if observable is not None:
+            observable.invalidate_json_cache()
 
     def save(self):
         """Saves the current results of the Analysis to disk."""
@@ -589,9 +733,13 @@ class Analysis(TaggableObject, DetectableObject):
         # this gets stored in the main json data structure
         if not self.delayed:
             try:
-                self._summary = self.generate_summary()
+                summary = self.generate_summary()
             except Exception as e:
-                self._summary = f"Failed to generate summary for {self}: {e}"
+                summary = f"Failed to generate summary for {self}: {e}"
+
+            if summary != self._summary:
+                self._summary = summary
+                self.invalidate_json_cache()
 
         # this is a thing now -- analysis modules are over-writing the details of the root analysis since we got rid of the "engines" 
         # try to catch a case where we set the data but forgot to load first
@@ -611,6 +759,7 @@ class Analysis(TaggableObject, DetectableObject):
                 target_name += '_' + self.instance
 
             self.external_details_path = '{}_{}.json'.format(target_name, str(uuid.uuid4()))
+            self.invalidate_json_cache()
 
         # make sure the containing directory exists
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir)):
@@ -620,11 +769,26 @@ class Analysis(TaggableObject, DetectableObject):
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
         
+        # the details are often modified in place so we compare what we have to what was last saved
+        details_json = encode_json(self._details)
+        details_digest = hashlib.md5(details_json.encode('utf8')).digest()
+        if details_digest == self._details_digest:
+            #logging.debug(f"details of {self} have not changed since the last save")
+            self.external_details_loaded = True
+            return
+
         # save the details
         logging.debug("SAVE: saving external details for {} to {}".format(self, self.external_details_path))
-        with open(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path), 'w') as fp:
-            json.dump(self._details, fp, cls=_JSONEncoder)
+        details_pack = self.root.details_pack
+        if details_pack is not None:
+            details_pack.write(self.external_details_path, details_json)
             _track_writes()
+        else:
+            with open(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path), 'w', encoding='utf8') as fp:
+                fp.write(details_json)
+                _track_writes()
+
+        self._details_digest = details_digest
 
         #if overwrite_warning:
             #full_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.root.storage_dir, '.ace', self.external_details_path)
@@ -644,8 +808,12 @@ class Analysis(TaggableObject, DetectableObject):
         """Deletes the current analysis output if it exists."""
         logging.debug("called reset() on {}".format(self))
         if self.external_details_path is not None:
+            details_pack = self.root.details_pack
             full_path = abs_path(os.path.join(self.root.storage_dir, '.ace', self.external_details_path))
-            if os.path.exists(full_path):
+            if details_pack is not None and details_pack.delete(self.external_details_path):
+                logging.debug("removed external details {} from {}".format(
+                              self.external_details_path, details_pack.pack_path))
+            elif os.path.exists(full_path):
                 logging.debug("removing external details file {}".format(full_path))
                 os.remove(full_path)
             else:
@@ -655,6 +823,8 @@ class Analysis(TaggableObject, DetectableObject):
         self.external_details_path = None
         self.external_details = None
         self.external_details_loaded = False
+        self._details_digest = None
+        self.invalidate_json_cache()
 
     @property
     def question(self):
@@ -718,6 +888,23 @@ class Analysis(TaggableObject, DetectableObject):
             return None
 
         self._details = None
+
+        # the details could be in the details pack
+        details_pack = self.root.details_pack
+        if details_pack is not None and self.external_details_path in details_pack:
+            try:
+                self._details = json.loads(details_pack.read(self.external_details_path))
+                _track_reads()
+                self.external_details_loaded = True
+                logging.debug("LOAD: loaded external details {} from {}".format(
+                              self.external_details_path, details_pack.pack_path))
+                return self._details
+            except Exception as e:
+                logging.error("unable to load json {} from {}: {}".format(
+                              self.external_details_path, details_pack.pack_path, e))
+                report_exception()
+                return None
+
         details_file_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path)
 
         if not os.path.exists(details_file_path):
@@ -728,7 +915,7 @@ class Analysis(TaggableObject, DetectableObject):
             logging.debug("JSON file {0} is very large: {1} bytes".format(details_file_path, os.path.getsize(details_file_path)))
 
         try:
-            with open(details_file_path, 'r') as fp:
+            with open(details_file_path, 'r', encoding='utf8') as fp:
                 self._details = json.load(fp)
 
             _track_reads()
@@ -756,7 +943,7 @@ class Analysis(TaggableObject, DetectableObject):
             Analysis.KEY_COMPLETED: self.completed,
             Analysis.KEY_ALERTED: self.alerted,
             Analysis.KEY_DELAYED: self.delayed,
-            Analysis.KEY_IOCS: self.iocs.json
+            Analysis.KEY_IOCS: self._iocs.json if self._iocs is not None else [],
         })
         return result
 
@@ -802,14 +989,19 @@ class Analysis(TaggableObject, DetectableObject):
 
     @property
     def iocs(self):
+        if self._iocs is None:
+            self._iocs = IndicatorList()
+
         return self._iocs
 
     @iocs.setter
     def iocs(self, value):
         assert isinstance(value, list)
-        self._iocs = IndicatorList()
+        self._iocs = None
         for i in value:
-            self._iocs.append(i)
+            self.iocs.append(i)
+
+        self.invalidate_json_cache()
 
     @property
     def delayed(self):
@@ -839,7 +1031,10 @@ class Analysis(TaggableObject, DetectableObject):
     def observables(self, value):
         assert isinstance(value, list)
         assert all(isinstance(o, str) or isinstance(o, Observable) for o in self._observables)
-        self._observables = value
+        self._observables = value or EMPTY_LIST
+        self._observable_ids = None
+        self.invalidate_json_cache()
+        self.invalidate_root_index()
 
     def has_observable(self, o_or_o_type=None, o_value=None):
         """Returns True if this Analysis has this Observable.  Accepts a single Observable or o_type, o_value."""
@@ -852,7 +1047,10 @@ class Analysis(TaggableObject, DetectableObject):
 
     def clear_observables(self):
         """Clears any existing Observables. This is typically only used in special cases such as merging."""
-        self._observables = []
+        self._observables = EMPTY_LIST
+        self._observable_ids = None
+        self.invalidate_json_cache()
+        self.invalidate_root_index()
 
     @property
     def children(self):
@@ -872,9 +1070,25 @@ class Analysis(TaggableObject, DetectableObject):
             else:
                 _buffer.append(self.root.observable_store[uuid])
 
-        self._observables = _buffer
+        self._observables = _buffer or EMPTY_LIST
+        self._observable_ids = None
+        self.invalidate_root_index()
         #self._observables = [self.root.observable_store[uuid] for uuid in self._observables]
 
+    def _has_observable_id(self, observable):
+        """Returns True if the given Observable (as returned by RootAnalysis.record_observable) is in self.observables.
+           Faster than observable in self.observables since the Observables are the ones recorded in the observable_store."""
+        if self._observable_ids is None:
+            self._observable_ids = set([o.id for o in self._observables if isinstance(o, Observable)])
+
+        return observable.id in self._observable_ids
+
+    def _append_observable(self, observable):
+        self._observables = _writable_list(self.observables)
+        self._observables.append(observable)
+        if self._observable_ids is not None:
+            self._observable_ids.add(observable.id)
+
     @property
     def observable_types(self):
         """Returns the list of unique observable types for all Observables generated by this Analysis."""
@@ -945,7 +1159,9 @@ class Analysis(TaggableObject, DetectableObject):
     @observable.setter
     def observable(self, value):
         assert value is None or isinstance(value, Observable)
+        self.invalidate_json_cache()
         self._observable = value
+        self.invalidate_json_cache()
 
     @property
     def summary(self):
@@ -954,6 +1170,7 @@ class Analysis(TaggableObject, DetectableObject):
     @summary.setter
     def summary(self, value):
         self._summary = value
+        self.invalidate_json_cache()
 
     @property
     def completed(self):
@@ -1074,8 +1291,8 @@ class Analysis(TaggableObject, DetectableObject):
         # load any user-defined tag mappings from the database
         observable.fetch_tags()
 
-        if observable not in self.observables:
-            self.observables.append(observable)
+        if not self._has_observable_id(observable):
+            self._append_observable(observable)
             self.fire_event(self, EVENT_OBSERVABLE_ADDED, observable)
 
         return observable
@@ -1093,8 +1310,8 @@ class Analysis(TaggableObject, DetectableObject):
         # load any user-defined tag mappings from the database
         observable.fetch_tags()
 
-        if observable not in self.observables:
-            self.observables.append(observable)
+        if not self._has_observable_id(observable):
+            self._append_observable(observable)
             self.fire_event(self, EVENT_OBSERVABLE_ADDED, observable)
 
         return observable
@@ -1102,6 +1319,7 @@ class Analysis(TaggableObject, DetectableObject):
     def add_ioc(self, indicator_type: str, indicator_value: str, status: str = '', tags: List[str] = []):
         indicator = self.tip.create_indicator(indicator_type, indicator_value, status=status, tags=tags)
         self.iocs.append(indicator)
+        self.invalidate_json_cache()
 
     def tag_detection(self, source, event, tag):
         """Adds detections points when tags are added if their score is > 0."""
@@ -1306,44 +1524,59 @@ class Observable(TaggableObject, DetectableObject):
     KEY_RELATIONSHIPS = 'relationships'
     KEY_GROUPING_TARGET = 'grouping_target'
 
+    # a large root can have many thousands of these so the attributes are slots
+    # (the subclasses of Observable do not define __slots__ so they can still have other attributes)
+    __slots__ = ('_tags', '_detections', '_id', '_type', '_value', '_time', '_analysis', '_directives', '_redirection',
+                 '_links', '_limited_analysis', '_excluded_analysis', '_relationships', '_grouping_target',
+                 '_json_fragment', '_disposition_history', '_tags_fetched', 'root')
+
+    # when we add a tag we automatically add a detection if the tag's score is > 0
+    event_handlers = {
+        EVENT_TAG_ADDED: ('tag_detection',),
+    }
+
     def __init__(self, type=None, value=None, time=None, json=None, *args, **kwargs):
+        # the cached JSON encoding of this Observable (see json_fragment)
+        self._json_fragment = None
+
+        # reference to the RootAnalysis object
+        self.root = None
+
         super().__init__(*args, **kwargs)
 
-        self._directives = []
+        # the lists default to EMPTY_LIST until something is added to them
+        self._directives = EMPTY_LIST
         self._redirection = None
-        self._links = []
-        self._limited_analysis = []
-        self._excluded_analysis = []
-        self._relationships = []
+        self._links = EMPTY_LIST
+        self._limited_analysis = EMPTY_LIST
+        self._excluded_analysis = EMPTY_LIST
+        self._relationships = EMPTY_LIST
         self._grouping_target = False
 
         if json is not None:
             self.json = json
         else:
             self._id = str(uuid.uuid4())
-            self._type = type
+            self._type = sys.intern(type) if isinstance(type, str) else type
             self.value = value
             self._time = time
             self._analysis = {}
-            self._directives = [] # of str
+            self._directives = EMPTY_LIST # of str
             self._redirection = None # (str)
-            self._links = [] # [ str ]
-            self._limited_analysis = [] # [ str ]
-            self._excluded_analysis = [] # [ str ]
-            self._relationships = [] # [ Relationship ]
+            self._links = EMPTY_LIST # [ str ]
+            self._limited_analysis = EMPTY_LIST # [ str ]
+            self._excluded_analysis = EMPTY_LIST # [ str ]
+            self._relationships = EMPTY_LIST # [ Relationship ]
             self._grouping_target = False
 
-        self.cache_id = str(uuid.uuid3(uuid.NAMESPACE_X500, f"{self.type}:{self.value}"))
-
-        # reference to the RootAnalysis object
-        self.root = None
-
-        # when we add a tag we automatically add a detection if the tag's score is > 0
-        self.add_event_listener(EVENT_TAG_ADDED, self.tag_detection)
-
         # state variable gets set to True when fetch_tags is called
         self._tags_fetched = False
 
+    @property
+    def cache_id(self):
+        """Returns the id used to cache the analysis of this Observable (see AnalysisModule.cache_key.)"""
+        return str(uuid.uuid3(uuid.NAMESPACE_X500, f"{self.type}:{self.value}"))
+
     @staticmethod
     def from_json(json_data):
         """Returns an object inheriting from Observable built from the given json."""
@@ -1489,13 +1722,13 @@ class Observable(TaggableObject, DetectableObject):
         if Observable.KEY_REDIRECTION in value:
             self._redirection = value[Observable.KEY_REDIRECTION]
         if Observable.KEY_LINKS in value:
-            self._links = value[Observable.KEY_LINKS]
+            self._links = value[Observable.KEY_LINKS] or EMPTY_LIST
         if Observable.KEY_LIMITED_ANALYSIS in value:
-            self._limited_analysis = value[Observable.KEY_LIMITED_ANALYSIS]
+            self._limited_analysis = value[Observable.KEY_LIMITED_ANALYSIS] or EMPTY_LIST
         if Observable.KEY_EXCLUDED_ANALYSIS in value:
-            self._excluded_analysis = value[Observable.KEY_EXCLUDED_ANALYSIS]
+            self._excluded_analysis = value[Observable.KEY_EXCLUDED_ANALYSIS] or EMPTY_LIST
         if Observable.KEY_RELATIONSHIPS in value:
-            self._relationships = value[Observable.KEY_RELATIONSHIPS]
+            self._relationships = value[Observable.KEY_RELATIONSHIPS] or EMPTY_LIST
         if Observable.KEY_GROUPING_TARGET in value:
             self._grouping_target = value[Observable.KEY_GROUPING_TARGET]
 
@@ -1508,6 +1741,7 @@ class Observable(TaggableObject, DetectableObject):
     def id(self, value):
         assert isinstance(value, str)
         self._id = value
+        self.invalidate_json_cache()
 
     @property
     def type(self):
@@ -1516,7 +1750,9 @@ class Observable(TaggableObject, DetectableObject):
     @type.setter
     def type(self, value):
         #assert value in VALID_OBSERVABLE_TYPES
-        self._type = value
+        # there are only a few types of observables so every Observable of the same type shares the same string
+        self._type = sys.intern(value) if isinstance(value, str) else value
+        self.invalidate_json_cache()
 
     @property
     def value(self):
@@ -1525,6 +1761,7 @@ class Observable(TaggableObject, DetectableObject):
     @value.setter
     def value(self, value):
         self._value = value
+        self.invalidate_json_cache()
 
     @property
     def md5_hex(self):
@@ -1556,6 +1793,8 @@ class Observable(TaggableObject, DetectableObject):
             raise ValueError("time must be a datetime.datetime object or a string in the format "
                              "%Y-%m-%d %H:%M:%S %z but you passed {}".format(type(value).__name__))
 
+        self.invalidate_json_cache()
+
     @property
     def time_datetime(self):
         """Returns self.time. Remains for backwards compatibility."""
@@ -1568,7 +1807,8 @@ class Observable(TaggableObject, DetectableObject):
     @directives.setter
     def directives(self, value):
         assert isinstance(value, list)
-        self._directives = value
+        self._directives = value or EMPTY_LIST
+        self.invalidate_json_cache()
 
     @property
     def remediation_targets(self):
@@ -1579,7 +1819,8 @@ class Observable(TaggableObject, DetectableObject):
         """Adds a directive that analysis modules might use to change their behavior."""
         assert isinstance(self.directives, list)
         if directive not in self.directives:
-            self.directives.append(directive)
+            self._directives = _writable_list(self._directives)
+            self._directives.append(directive)
             logging.debug("added directive {} to {}".format(directive, self))
             self.fire_event(self, EVENT_DIRECTIVE_ADDED, directive)
 
@@ -1594,6 +1835,7 @@ class Observable(TaggableObject, DetectableObject):
         """Removes the given directive from this observable."""
         if directive in self.directives:
             self.directives.remove(directive)
+            self.invalidate_json_cache()
             logging.debug("removed directive {} from {}".format(directive, self))
 
     def copy_directives_to(self, target):
@@ -1613,6 +1855,7 @@ class Observable(TaggableObject, DetectableObject):
     def redirection(self, value):
         assert isinstance(value, Observable)
         self._redirection = value.id
+        self.invalidate_json_cache()
 
     @property
     def links(self):
@@ -1628,6 +1871,7 @@ class Observable(TaggableObject, DetectableObject):
             assert isinstance(v, Observable)
 
         self._links = [x.id for x in value]
+        self.invalidate_json_cache()
 
     def add_link(self, target):
         """Links this Observable object to another Observable object.  Any tags
@@ -1642,7 +1886,9 @@ class Observable(TaggableObject, DetectableObject):
             return
         
         if target.id not in self._links:
+            self._links = _writable_list(self._links)
             self._links.append(target.id)
+            self.invalidate_json_cache()
 
         logging.debug("linked {} to {}".format(self, target))
 
@@ -1654,7 +1900,8 @@ class Observable(TaggableObject, DetectableObject):
     def limited_analysis(self, value):
         assert isinstance(value, list)
         assert all([isinstance(x, str) for x in value])
-        self._limited_analysis = value
+        self._limited_analysis = value or EMPTY_LIST
+        self.invalidate_json_cache()
 
     def limit_analysis(self, analysis_module):
         """Limit the analysis of this observable to the analysis module specified by configuration section name.
@@ -1663,11 +1910,14 @@ class Observable(TaggableObject, DetectableObject):
         from saq.modules import AnalysisModule
         assert isinstance(analysis_module, str) or isinstance(analysis_module, AnalysisModule)
 
+        self._limited_analysis = _writable_list(self._limited_analysis)
         if isinstance(analysis_module, AnalysisModule):
             self._limited_analysis.append(analysis_module.config_section_name)
         else:
             self._limited_analysis.append(analysis_module)
 
+        self.invalidate_json_cache()
+
     @property
     def excluded_analysis(self):
         """Returns a list of analysis modules in the form of module:class that are excluded from analyzing this Observable."""
@@ -1676,7 +1926,8 @@ class Observable(TaggableObject, DetectableObject):
     @excluded_analysis.setter
     def excluded_analysis(self, value):
         assert isinstance(value, list)
-        self._excluded_analysis = value
+        self._excluded_analysis = value or EMPTY_LIST
+        self.invalidate_json_cache()
 
     def exclude_analysis(self, analysis_module, instance=None):
         """Directs the engine to avoid analyzing this Observabe with this AnalysisModule.
@@ -1695,7 +1946,9 @@ class Observable(TaggableObject, DetectableObject):
             name += f'{instance}'
 
         if name not in self.excluded_analysis:
-            self.excluded_analysis.append(name)
+            self._excluded_analysis = _writable_list(self._excluded_analysis)
+            self._excluded_analysis.append(name)
+            self.invalidate_json_cache()
 
     def is_excluded(self, analysis_module):
         """Returns True if this Observable has been excluded from analysis by this AnalysisModule."""
@@ -1725,6 +1978,7 @@ class Observable(TaggableObject, DetectableObject):
 
         while name in self.excluded_analysis:
             self.excluded_analysis.remove(name)
+            self.invalidate_json_cache()
 
     @property
     def relationships(self):
@@ -1732,7 +1986,8 @@ class Observable(TaggableObject, DetectableObject):
 
     @relationships.setter
     def relationships(self, value):
-        self._relationships = value
+        self._relationships = value or EMPTY_LIST
+        self.invalidate_json_cache()
 
     def has_relationship(self, _type):
         for r in self.relationships:
@@ -1759,7 +2014,7 @@ class Observable(TaggableObject, DetectableObject):
 
             temp.append(value)
 
-        self._relationships = temp
+        self._relationships = temp or EMPTY_LIST
 
     def add_relationship(self, r_type, target):
         """Adds a new Relationship to this Observable.
@@ -1772,7 +2027,8 @@ class Observable(TaggableObject, DetectableObject):
                 return r
 
         r = Relationship(r_type, target)
-        self.relationships.append(r)
+        self._relationships = _writable_list(self._relationships)
+        self._relationships.append(r)
         self.fire_event(self, EVENT_RELATIONSHIP_ADDED, target, relationship=r)
         return r
 
@@ -1809,12 +2065,26 @@ class Observable(TaggableObject, DetectableObject):
     def grouping_target(self, value):
         assert isinstance(value, bool)
         self._grouping_target = value
+        self.invalidate_json_cache()
 
     def add_tag(self, *args, **kwargs):
         super().add_tag(*args, **kwargs)
         for target in self.links:
             target.add_tag(*args, **kwargs)
 
+    def invalidate_json_cache(self):
+        self._json_fragment = None
+
+    @property
+    def json_fragment(self):
+        """Returns the JSON encoding of this Observable (including the Analysis performed on it) as a string.
+           The result is cached until something that is part of the JSON changes.
+           This is used by RootAnalysis.save() to avoid re-encoding Observables that have not changed."""
+        if self._json_fragment is None:
+            self._json_fragment = encode_json(self.json)
+
+        return self._json_fragment
+
     # typically tag mapping is looked up using the type and value of the observable
     # in some cases we actually want to look up something else
 
@@ -1871,6 +2141,8 @@ class Observable(TaggableObject, DetectableObject):
     def analysis(self, value):
         assert isinstance(value, dict)
         self._analysis = value
+        self.invalidate_json_cache()
+        self.invalidate_root_index()
 
     @property
     def all_analysis(self):
@@ -1938,6 +2210,7 @@ class Observable(TaggableObject, DetectableObject):
         if analysis.module_path in self.analysis and not (self.analysis[analysis.module_path] is analysis):
             logging.error("replacing analysis {} with {} for {} (are you returning the correct type from generated_analysis_type()?)".format(
                 self.analysis[analysis.module_path], analysis, self))
+            self.invalidate_root_index()
         
         # newly added analysis is always set to modified so it gets saved to JSON file
         analysis.set_modified()
@@ -1961,6 +2234,7 @@ class Observable(TaggableObject, DetectableObject):
 
         # this is used to remember that analysis was not generated
         self.analysis[MODULE_PATH(analysis, instance=instance)] = False
+        self.invalidate_json_cache()
         logging.debug("recorded no analysis of type {} instance {} for observable {}".format(analysis, instance, self))
 
     def get_analysis(self, obj, instance=None):
@@ -2111,9 +2385,12 @@ class Observable(TaggableObject, DetectableObject):
             # set up the EVENT_GLOBAL_* events
             a.add_event_listener(EVENT_OBSERVABLE_ADDED, a.root._fire_global_events)
             a.add_event_listener(EVENT_TAG_ADDED, a.root._fire_global_events)
+            a.root._add_index_listeners(a)
 
             self.analysis[module_path] = a # replace the JSON dict with the actual object
 
+        self.invalidate_root_index()
+
     def clear_analysis(self):
         """Deletes all analysis records for this observable."""
         self.analysis = {}
@@ -2150,6 +2427,17 @@ class Observable(TaggableObject, DetectableObject):
            By default does == comparison, can be overridden."""
         return self.value == other_value
 
+    def _index_value(self, value):
+        """Returns the form of the value used in the index_key. This must be consistent with _compare_value
+           (two values that compare equal must have the same index value.)"""
+        return value
+
+    @property
+    def index_key(self):
+        """Returns the (type, value, time) identity of this Observable.
+           Observables with the same index_key are equal (see __eq__.) Used by RootAnalysis to index the observable_store."""
+        return (self.type, self._index_value(self.value), self.time)
+
     def __eq__(self, other):
         if not isinstance(other, Observable):
             return False
@@ -2361,6 +2649,9 @@ def _get_failed_analysis_key(observable_type, observable_value):
 class RootAnalysis(Analysis):
     """Root of analysis. Also see saq.database.Alert."""
 
+    # the JSON loaded by load(lazy=True) until the analysis tree is materialized (see _materialize_lazy_json)
+    _lazy_json = None
+
     def __init__(self, 
                  tool=None, 
                  tool_instance=None, 
@@ -2502,6 +2793,12 @@ class RootAnalysis(Analysis):
         # these objects are what are serialized to and from JSON
         self._observable_store = {} # key = uuid, value = Observable object
 
+        # index of the observable_store by the identity of the observables (see Observable.index_key)
+        self._observable_index = {} # key = (type, value, time), value = Observable object
+
+        # the DetailsPack used to store analysis details (see the details_pack property)
+        self._details_pack = None
+
         # set to True after load() is called
         self.is_loaded = False
 
@@ -2514,10 +2811,19 @@ class RootAnalysis(Analysis):
         # list of AnalysisDependency objects
         self.dependency_tracking = []
 
+        # indexes of the analysis tree (see _build_analysis_index)
+        # these are built when first needed and then kept up to date by _update_analysis_index
+        self._analysis_index = None # key = id(Analysis), value = Analysis (in the order of all_analysis)
+        self._analysis_type_index = None # key = type of Analysis, value = { id(Analysis): Analysis }
+        self._reference_index = None # key = Observable.id, value = { id(Analysis): Analysis } of the Analysis that have the Observable
+        self._tag_index = None # set of all Tags
+        self._detection_index = None # set of id() of all the Analysis and Observables that have detection points
+
         # we fire EVENT_GLOBAL_TAG_ADDED and EVENT_GLOBAL_OBSERVABLE_ADDED when we add tags and observables to anything
         # (note that we also need to add these global event listeners when we deserialize)
         self.add_event_listener(EVENT_TAG_ADDED, self._fire_global_events)
         self.add_event_listener(EVENT_OBSERVABLE_ADDED, self._fire_global_events)
+        self._add_index_listeners(self)
 
     def _fire_global_events(self, source, event_type, *args, **kwargs):
         """Fires EVENT_GLOBAL_* events."""
@@ -2567,7 +2873,25 @@ class RootAnalysis(Analysis):
 
     @property
     def json(self):
-        result = Analysis.json.fget(self)
+        if self._lazy_json is not None:
+            # the analysis tree was never materialized so nothing in it could have changed
+            result = dict(self._lazy_json)
+            result.update({
+                Analysis.KEY_DETAILS: {
+                    Analysis.KEY_FILE_PATH: self.external_details_path },
+                Analysis.KEY_SUMMARY: self.summary,
+                Analysis.KEY_COMPLETED: self.completed,
+                Analysis.KEY_ALERTED: self.alerted,
+                Analysis.KEY_DELAYED: self.delayed,
+                Analysis.KEY_IOCS: self._iocs.json if self._iocs is not None else [],
+            })
+        else:
+            result = Analysis.json.fget(self)
+            result.update({
+                RootAnalysis.KEY_OBSERVABLE_STORE: self.observable_store,
+                RootAnalysis.KEY_DEPENDECY_TRACKING: self.dependency_tracking,
+            })
+
         result.update({
             RootAnalysis.KEY_ANALYSIS_MODE: self.analysis_mode,
             RootAnalysis.KEY_UUID: self.uuid,
@@ -2578,7 +2902,6 @@ class RootAnalysis(Analysis):
             RootAnalysis.KEY_EVENT_TIME: self.event_time,
             RootAnalysis.KEY_ACTION_COUNTERS: self.action_counters,
             #RootAnalysis.KEY_DETAILS: self.details, <-- this is saved externally
-            RootAnalysis.KEY_OBSERVABLE_STORE: self.observable_store,
             RootAnalysis.KEY_NAME: self.name,
             RootAnalysis.KEY_REMEDIATION: self.remediation,
             RootAnalysis.KEY_STATE: self.state,
@@ -2586,7 +2909,6 @@ class RootAnalysis(Analysis):
             RootAnalysis.KEY_COMPANY_NAME: self.company_name,
             RootAnalysis.KEY_COMPANY_ID: self.company_id,
             RootAnalysis.KEY_DELAYED_ANALYSIS_TRACKING: self.delayed_analysis_tracking,
-            RootAnalysis.KEY_DEPENDECY_TRACKING: self.dependency_tracking,
             RootAnalysis.KEY_QUEUE: self.queue,
             RootAnalysis.KEY_INSTRUCTIONS: self.instructions,
             RootAnalysis.KEY_ANALYSIS_FAILURES: self.analysis_failures,
@@ -2851,14 +3173,64 @@ class RootAnalysis(Analysis):
     @property
     def observable_store(self):
         """Hash of the actual Observable objects generated during the analysis of this Alert.  key = uuid, value = Observable."""
+        self._materialize_lazy_json()
         return self._observable_store
 
     @observable_store.setter
     def observable_store(self, value):
         assert isinstance(value, dict)
         self._observable_store = value
+        self.rebuild_observable_index()
+        self.invalidate_analysis_index()
         self.set_modified()
 
+    def rebuild_observable_index(self):
+        """Rebuilds the index of the observable_store. Call this after modifying the observable_store directly."""
+        self._observable_index = {}
+        for observable in self._observable_store.values():
+            # the store contains JSON dicts until it is loaded
+            if isinstance(observable, Observable):
+                self._index_observable(observable)
+
+    def _index_observable(self, observable):
+        try:
+            # the first observable recorded with a given identity is the one that is kept
+            self._observable_index.setdefault(observable.index_key, observable)
+        except TypeError:
+            # the value is not hashable
+            pass
+
+    def _find_indexed_observable(self, observable):
+        """Returns the recorded Observable that is equal to the given Observable, or None if none is recorded."""
+        self._materialize_lazy_json()
+
+        # exactly the same?
+        existing = self._observable_store.get(observable.id)
+        if isinstance(existing, Observable):
+            return existing
+
+        try:
+            key = observable.index_key
+            existing = self._observable_index.get(key)
+        except TypeError:
+            # the value is not hashable so we have to look at all of them
+            for o in self._observable_store.values():
+                if o == observable:
+                    return o
+
+            return None
+
+        if existing is None:
+            return None
+
+        # the index is out of date if the observable was removed from the store or changed
+        if self._observable_store.get(existing.id) is not existing or existing.index_key != key:
+            logging.debug(f"rebuilding stale observable index of {self}")
+            self.rebuild_observable_index()
+            return self._observable_index.get(key)
+
+        return existing
+
     @property
     def storage_dir(self):
         """The base storage directory for output."""
@@ -2870,6 +3242,24 @@ class RootAnalysis(Analysis):
         self._storage_dir = value
         self.set_modified()
 
+    @property
+    def details_pack(self):
+        """Returns the DetailsPack used to store the details of the analysis in this root, 
+           or None if details are stored as individual files.
+           A pack is used if the storage directory already has one, or if the analysis_details_format 
+           configuration option is set to packed."""
+        if self.storage_dir is None:
+            return None
+
+        if self._details_pack is not None and self._details_pack.storage_dir == self.storage_dir:
+            return self._details_pack
+
+        self._details_pack = None
+        if get_details_format() == DETAILS_FORMAT_PACKED or is_packed(self.storage_dir):
+            self._details_pack = DetailsPack(self.storage_dir)
+
+        return self._details_pack
+
     def initialize_storage(self):
         assert self.storage_dir
         try:
@@ -3020,6 +3410,10 @@ class RootAnalysis(Analysis):
     @property
     def delayed(self):
         """Returns True if any delayed analysis is outstanding."""
+        # the value saved with the analysis tree is current until the tree is materialized
+        if self._lazy_json is not None:
+            return self._lazy_json.get(Analysis.KEY_DELAYED, False)
+
         for observable in self.all_observables:
             for analysis in observable.all_analysis:
                 if analysis.delayed:
@@ -3176,19 +3570,62 @@ class RootAnalysis(Analysis):
         """Returns the list of all AnalysisDependency objects."""
         return self.dependency_tracking
 
+    @property
+    def dependency_tracking(self):
+        """The list of AnalysisDependency objects."""
+        self._materialize_lazy_json()
+        return self._dependency_tracking
+
+    @dependency_tracking.setter
+    def dependency_tracking(self, value):
+        assert isinstance(value, list)
+        self._dependency_tracking = value
+
+    # the observables, tags and detection points of the root are also part of the analysis tree
+
+    @property
+    def observables(self):
+        self._materialize_lazy_json()
+        return self._observables
+
+    @observables.setter
+    def observables(self, value):
+        Analysis.observables.fset(self, value)
+
+    @property
+    def tags(self):
+        self._materialize_lazy_json()
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        Analysis.tags.fset(self, value)
+
+    @property
+    def detections(self):
+        self._materialize_lazy_json()
+        return self._detections
+
+    @detections.setter
+    def detections(self, value):
+        Analysis.detections.fset(self, value)
+
     def record_observable(self, observable):
         """Records the given observable into the observable_store if it does not already exist.  
            Returns the new one if recorded or the existing one if not."""
         assert isinstance(observable, Observable)
 
-        # XXX gross this is probably pretty inefficient
-        for o in self.observable_store.values():
-            if o == observable:
-                logging.debug("returning existing observable {} ({}) [{}] <{}> for {} ({}) [{}] <{}>".format(o, id(o), o.id, o.type, observable, id(observable), observable.id, observable.type))
-                return o
+        o = self._find_indexed_observable(observable)
+        if o is not None:
+            logging.debug("returning existing observable {} ({}) [{}] <{}> for {} ({}) [{}] <{}>".format(o, id(o), o.id, o.type, observable, id(observable), observable.id, observable.type))
+            return o
 
         observable.root = self
         self.observable_store[observable.id] = observable
+        self._index_observable(observable)
+        self._add_index_listeners(observable)
+        if self._analysis_index is not None:
+            self._add_observable_to_index(observable)
         logging.debug("recorded observable {} with id {}".format(observable, observable.id))
         self.set_modified()
         return observable
@@ -3248,14 +3685,19 @@ class RootAnalysis(Analysis):
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
 
-        # save all analysis
-        for analysis in self.all_analysis:
-            if analysis is not self:
-                analysis.save()
+        # save all analysis (if the analysis tree was never materialized then none of it could have changed)
+        if self._lazy_json is None:
+            for analysis in self.all_analysis:
+                if analysis is not self:
+                    analysis.save()
 
         # save our own details
         Analysis.save(self)
 
+        # the index of the details pack is only written once per save
+        if self.details_pack is not None:
+            self.details_pack.save_index()
+
         # now the rest should encode as JSON with the custom JSON encoder
         # XXX hack
         for try_count in range(3):
@@ -3263,8 +3705,9 @@ class RootAnalysis(Analysis):
                 # we use a temporary file to deal with very large JSON files taking a long time to encode
                 # if we don't do this then the GUI will occasionally hit 0-byte data.json files
                 temp_path = '{}.tmp'.format(self.json_path)
-                with open(temp_path, 'w') as fp:
-                    fp.write(_JSONEncoder().encode(self))
+                json_str = self.encode_data_json()
+                with open(temp_path, 'w', encoding='utf8') as fp:
+                    fp.write(json_str)
                     _track_writes()
                 shutil.move(temp_path, self.json_path)
                 break
@@ -3276,8 +3719,35 @@ class RootAnalysis(Analysis):
 
         return True
 
-    def load(self):
-        """Loads the Alert object from the JSON file.  Note that this does NOT load the details property."""
+    def encode_data_json(self):
+        """Returns the JSON string that gets stored in the data.json file.
+           If the incremental_save configuration option is enabled then the cached JSON of each Observable
+           is used and only the Observables that changed since the last save are encoded again."""
+        if not saq.CONFIG['global'].getboolean('incremental_save', fallback=False):
+            return encode_json(self)
+
+        # the observable store is by far the largest part of the JSON
+        root_json = self.json
+        observable_store = root_json.pop(RootAnalysis.KEY_OBSERVABLE_STORE)
+        root_json_str = encode_json(root_json)
+
+        observable_store_json = []
+        for observable_id, observable in observable_store.items():
+            if isinstance(observable, Observable):
+                observable_store_json.append(f'{json.dumps(observable_id)}:{observable.json_fragment}')
+            else:
+                observable_store_json.append(f'{json.dumps(observable_id)}:{encode_json(observable)}')
+
+        # and then splice the observable store back into the JSON of the root
+        return '{},{}:{{{}}}}}'.format(
+            root_json_str[:-1], 
+            json.dumps(RootAnalysis.KEY_OBSERVABLE_STORE), 
+            ','.join(observable_store_json))
+
+    def load(self, lazy=False):
+        """Loads the Alert object from the JSON file.  Note that this does NOT load the details property.
+           If lazy is True then the Observables and Analysis are not materialized until something accesses them.
+           This is much faster when only the properties of the root are needed (see also load_summary.)"""
         assert self.json_path is not None
         logging.debug("LOAD: called load() on {}".format(self))
 
@@ -3285,14 +3755,20 @@ class RootAnalysis(Analysis):
             logging.warning("alert {} already loaded".format(self))
 
         try:
-            with open(self.json_path, 'r') as fp:
+            with open(self.json_path, 'r', encoding='utf8') as fp:
                 json_str = fp.read()
 
-            self.json = json.loads(json_str)
+            json_data = json.loads(json_str)
+            self._lazy_json = None
+            self.json = json_data
             _track_reads()
 
             # translate the json into runtime objects
-            self._materialize()
+            if lazy:
+                self._lazy_json = json_data
+            else:
+                self._materialize()
+
             self.is_loaded = True
             # loaded Alerts are read-only until something is modified
             self._ready_only = True
@@ -3317,9 +3793,13 @@ class RootAnalysis(Analysis):
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
 
-        for analysis in self.all_analysis:
-            if analysis is not self:
-                analysis.flush()
+        if self._lazy_json is None:
+            for analysis in self.all_analysis:
+                if analysis is not self:
+                    analysis.flush()
+
+        if self.details_pack is not None:
+            self.details_pack.save_index()
 
         freed_items = gc.collect()
         #logging.debug("{} items freed by gc".format(freed_items))
@@ -3433,6 +3913,20 @@ class RootAnalysis(Analysis):
             else:
                 target_analysis.add_observable(existing_observable)
 
+    @property
+    def is_materialized(self):
+        """Returns False if this was loaded with load(lazy=True) and nothing has accessed the analysis tree yet."""
+        return self._lazy_json is None
+
+    def _materialize_lazy_json(self):
+        """Materializes the analysis tree if it was loaded with load(lazy=True)."""
+        if self._lazy_json is None:
+            return
+
+        logging.debug("materializing {}".format(self))
+        self._lazy_json = None
+        self._materialize()
+
     def _materialize(self):
         """Utility function to replace specific dict() in json with runtime object references."""
         # in other words, load the JSON
@@ -3468,9 +3962,9 @@ class RootAnalysis(Analysis):
         # load dependency tracking
         _buffer = []
         for dep_dict in self.dependency_tracking:
-            _buffer.append(AnalysisDependency.from_json(dep_dict))
-            for dep in _buffer:
-                dep.root = self
+            dep = AnalysisDependency.from_json(dep_dict)
+            dep.root = self
+            _buffer.append(dep)
 
         self.dependency_tracking = _buffer
         for dep in self.dependency_tracking:
@@ -3492,6 +3986,7 @@ class RootAnalysis(Analysis):
                 # set up the EVENT_GLOBAL_* events
                 o.add_event_listener(EVENT_ANALYSIS_ADDED, o.root._fire_global_events)
                 o.add_event_listener(EVENT_TAG_ADDED, o.root._fire_global_events)
+                self._add_index_listeners(o)
 
                 self.observable_store[uuid] = o
             else:
@@ -3501,6 +3996,9 @@ class RootAnalysis(Analysis):
         for uuid in invalid_uuids:
             del self.observable_store[uuid]
 
+        self.rebuild_observable_index()
+        self.invalidate_analysis_index()
+
     def reset(self):
         """Removes analysis, dispositions and any observables that did not originally come with the alert."""
         from saq.database import acquire_lock, release_lock, LockedException
@@ -3543,20 +4041,29 @@ class RootAnalysis(Analysis):
             if uuid not in original_uuids:
                 remove_list.append(uuid)
 
+        # the sha256 hashes of the files we remove (released from the blob store)
+        removed_hashes = set()
         for uuid in remove_list:
             # if the observable is a F_FILE then try to also delete the file
             if self.observable_store[uuid].type == F_FILE:
-                target_path = abs_path(self.observable_store[uuid].value)
+                target_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, self.observable_store[uuid].value)
                 if os.path.exists(target_path):
                     logging.debug("deleting observable file {}".format(target_path))
 
                     try:
                         os.remove(target_path)
+                        if self.observable_store[uuid]._sha256_hash is not None:
+                            removed_hashes.add(self.observable_store[uuid]._sha256_hash)
                     except Exception as e:
                         logging.error("unable to remove {}: {}".format(target_path, str(e)))
 
             del self.observable_store[uuid]
 
+        self._release_blobs(removed_hashes)
+
+        self.rebuild_observable_index()
+        self.invalidate_analysis_index()
+
         # remove tags from observables
         # NOTE there's currently no way to know which tags originally came with the alert
         for o in self.observables:
@@ -3588,7 +4095,13 @@ class RootAnalysis(Analysis):
 
             _analysis.reset()
 
+        # reclaim the space used by the details we just removed
+        if self.details_pack is not None:
+            self.details_pack.compact()
+
         retained_files = set()
+        # the sha256 hashes of the files we remove (released from the blob store)
+        removed_hashes = set()
         for o in self.all_observables:
             # skip the ones that came with the alert
             if o in self.observables:
@@ -3605,6 +4118,8 @@ class RootAnalysis(Analysis):
 
                     try:
                         os.remove(target_path)
+                        if o._sha256_hash is not None:
+                            removed_hashes.add(o._sha256_hash)
                     except Exception as e:
                         logging.error("unable to remove {}: {}".format(target_path, str(e)))
 
@@ -3638,6 +4153,28 @@ class RootAnalysis(Analysis):
         p = Popen(['find', os.path.join(saq.SAQ_HOME, self.storage_dir), '-type', 'd', '-empty', '-delete'])
         p.wait()
 
+        self._release_blobs(removed_hashes)
+
+    def store_files(self):
+        """Stores the files of all the F_FILE observables in the blob store (see saq.blobs)
+           This is called once analysis has completed since stored files are read-only."""
+        for observable in self.all_observables:
+            if observable.type == F_FILE:
+                observable.store()
+
+    def _release_blobs(self, hashes):
+        """Releases the blobs (see saq.blobs) of files that were removed from the storage directory."""
+        from saq.blobs import get_blob_store
+        blob_store = get_blob_store()
+        if blob_store is None:
+            return
+
+        for sha256 in hashes:
+            try:
+                blob_store.release(sha256)
+            except Exception as e:
+                logging.error(f"unable to release blob {sha256}: {e}")
+
     def move(self, dest_dir):
         """Moves the contents of self.storage_dir into dest_dir."""
         assert dest_dir
@@ -3670,28 +4207,117 @@ class RootAnalysis(Analysis):
             logging.error("unable to delete {}: {}".format(self, e))
             raise e
 
+        self._release_blobs([o._sha256_hash for o in self.get_observables_by_type(F_FILE) 
+                             if o._sha256_hash is not None])
+
     def __str__(self):
         return "RootAnalysis({})".format(self.uuid)
 
+    #
+    # indexes of the analysis tree
+    #
+    # all_analysis, get_analysis_by_type, all_tags, has_detections and iterate_all_references used to walk the entire tree
+    # on every call, which made the analysis of a RootAnalysis with many observables quadratic
+    # the indexes are built once (when first needed) and then updated incrementally as analysis, observables, tags and
+    # detection points are added (see _update_analysis_index)
+    # changes that do not fire events (such as assigning the tags property) invalidate the indexes so they are rebuilt
+    #
+
+    def invalidate_analysis_index(self):
+        """Discards the indexes of the analysis tree. They are rebuilt the next time they are needed."""
+        self._analysis_index = None
+        self._analysis_type_index = None
+        self._reference_index = None
+        self._tag_index = None
+        self._detection_index = None
+
+    def _build_analysis_index(self):
+        self._materialize_lazy_json()
+        if self._analysis_index is not None:
+            return
+
+        self._analysis_index = {}
+        self._analysis_type_index = {}
+        self._reference_index = {}
+        self._tag_index = set()
+        self._detection_index = set()
+
+        self._add_analysis_to_index(self)
+        for observable in self._observable_store.values():
+            self._add_observable_to_index(observable)
+
+    def _add_index_listeners(self, target):
+        """Registers the event listeners that keep the indexes up to date on the given Analysis or Observable."""
+        for event in [ EVENT_ANALYSIS_ADDED, EVENT_OBSERVABLE_ADDED, EVENT_TAG_ADDED, EVENT_DETECTION_ADDED ]:
+            target.add_event_listener(event, self._update_analysis_index)
+
+    def _update_analysis_index(self, source, event_type, *args, **kwargs):
+        # new analysis need the listeners too
+        if event_type == EVENT_ANALYSIS_ADDED:
+            self._add_index_listeners(args[0])
+
+        if self._analysis_index is None:
+            return
+
+        if event_type == EVENT_ANALYSIS_ADDED:
+            self._add_observable_to_index(source)
+        elif event_type == EVENT_OBSERVABLE_ADDED:
+            if id(source) not in self._analysis_index:
+                self._add_analysis_to_index(source)
+            elif isinstance(args[0], Observable):
+                self._reference_index.setdefault(args[0].id, {})[id(source)] = source
+        elif event_type == EVENT_TAG_ADDED:
+            self._tag_index.add(args[0])
+        elif event_type == EVENT_DETECTION_ADDED:
+            self._detection_index.add(id(source))
+
+    def _is_indexed_observable(self, observable):
+        return isinstance(observable, Observable) and self._observable_store.get(observable.id) is observable
+
+    def _add_tags_to_index(self, target):
+        if target.tags is not None:
+            self._tag_index.update(target.tags)
+
+        if target.has_detection_points():
+            self._detection_index.add(id(target))
+
+    def _add_observable_to_index(self, observable):
+        """Adds the given Observable (and all of its Analysis) to the indexes. Calling this more than once is harmless."""
+        # only observables in the observable_store are part of the tree
+        if not self._is_indexed_observable(observable):
+            return
+
+        self._add_tags_to_index(observable)
+        for analysis in observable.all_analysis:
+            self._add_analysis_to_index(analysis)
+
+    def _add_analysis_to_index(self, analysis):
+        """Adds the given Analysis to the indexes. Calling this more than once is harmless."""
+        if analysis is not self and not self._is_indexed_observable(analysis.observable):
+            return
+
+        self._analysis_index[id(analysis)] = analysis
+        self._analysis_type_index.setdefault(type(analysis), {})[id(analysis)] = analysis
+        self._add_tags_to_index(analysis)
+        for observable in analysis.observables:
+            if isinstance(observable, Observable):
+                self._reference_index.setdefault(observable.id, {})[id(analysis)] = analysis
+
     @property   
     def all_analysis(self):
         """Returns the list of all Analysis performed for this Alert."""
-        result = []
-        result.append(self)
-        for observable in self.observable_store.values():
-            for analysis in observable.analysis.values():
-                if analysis:
-                    result.append(analysis)
-
-        return result
+        self._build_analysis_index()
+        return list(self._analysis_index.values())
 
     @property
     def all_iocs(self) -> IndicatorList:
         iocs = IndicatorList()
 
         for analysis in self.all_analysis:
-            for ioc in analysis.iocs:
-                iocs.append(ioc)
+            # analysis without iocs do not have an IndicatorList (see Analysis.iocs)
+            if analysis._iocs is not None:
+                for ioc in analysis._iocs:
+                    iocs.append(ioc)
 
         return iocs
 
@@ -3703,7 +4329,16 @@ class RootAnalysis(Analysis):
     def get_analysis_by_type(self, a_type):
         """Returns the list of all Analysis of a given type()."""
         assert inspect.isclass(a_type) and issubclass(a_type, Analysis)
-        return [a for a in self.all_analysis if isinstance(a, a_type)]
+        self._build_analysis_index()
+        matching_types = [_type for _type in self._analysis_type_index.keys() if issubclass(_type, a_type)]
+        if not matching_types:
+            return []
+
+        if len(matching_types) == 1:
+            return list(self._analysis_type_index[matching_types[0]].values())
+
+        # keep the order of all_analysis when more than one type matches
+        return [a for a in self._analysis_index.values() if isinstance(a, a_type)]
 
     @property
     def all_observables(self):
@@ -3730,22 +4365,14 @@ class RootAnalysis(Analysis):
     @property
     def all_tags(self):
         """Return all unique tags for the entire Alert."""
-        result = []
-        for analysis in self.all_analysis:
-            if analysis.tags is not None:
-                result.extend(analysis.tags)
-        for observable in self.all_observables:
-            if observable.tags is not None:
-                result.extend(observable.tags)
-
-        return list(set(result))
+        self._build_analysis_index()
+        return list(self._tag_index)
 
     def iterate_all_references(self, target):
         """Iterators through all objects that refer to target."""
         if isinstance(target, Observable):
-            for analysis in self.all_analysis:
-                if target in analysis.observables:
-                    yield analysis
+            self._build_analysis_index()
+            yield from list(self._reference_index.get(target.id, {}).values())
         elif isinstance(target, Analysis):
             for observable in self.all_observables:
                 if target in observable.all_analysis:
@@ -3759,12 +4386,14 @@ class RootAnalysis(Analysis):
 
     def get_observable_by_spec(self, o_type, o_value, o_time=None):
         """Returns the Observable object by type and value, and optionally time, or None if it cannot be found."""
-        target = Observable(o_type, o_value, o_time)
-        for o in self.all_observables:
-            if o == target:
-                return o
+        from saq.observables import create_observable
 
-        return None
+        # create a temporary object to make use of any defined custom comparison
+        target = create_observable(o_type, o_value, o_time=o_time)
+        if target is None:
+            return None
+
+        return self._find_indexed_observable(target)
 
     @property
     def all_detection_points(self):
@@ -3789,12 +4418,9 @@ class RootAnalysis(Analysis):
         """Returns True if this RootAnalysis could become an Alert (has at least one DetectionPoint somewhere.)"""
         if self.has_detection_points():
             return True
-        for a in self.all_analysis:
-            if a.has_detection_points():
-                return True
-        for o in self.all_observables:
-            if o.has_detection_points():
-                return True
+
+        self._build_analysis_index()
+        return len(self._detection_index) != 0
 
     @property
     def event_name_candidate(self):
@@ -3939,6 +4565,54 @@ class RootAnalysis(Analysis):
         # Event name in the database can only be 128 characters long
         return result.rstrip('-')[:128]
 
+class RootAnalysisSummary(object):
+    """Read-only summary of a RootAnalysis with just the properties needed to list it. See load_summary."""
+    def __init__(self, storage_dir, json_data):
+        self.storage_dir = storage_dir
+        self.uuid = json_data.get(RootAnalysis.KEY_UUID)
+        self.analysis_mode = json_data.get(RootAnalysis.KEY_ANALYSIS_MODE)
+        self.tool = json_data.get(RootAnalysis.KEY_TOOL)
+        self.tool_instance = json_data.get(RootAnalysis.KEY_TOOL_INSTANCE)
+        self.alert_type = json_data.get(RootAnalysis.KEY_TYPE)
+        self.description = json_data.get(RootAnalysis.KEY_DESCRIPTION)
+        self.event_time = json_data.get(RootAnalysis.KEY_EVENT_TIME)
+        if isinstance(self.event_time, str):
+            self.event_time = parse_event_time(self.event_time)
+
+        self.queue = json_data.get(RootAnalysis.KEY_QUEUE)
+        self.location = json_data.get(RootAnalysis.KEY_LOCATION)
+        self.company_name = json_data.get(RootAnalysis.KEY_COMPANY_NAME)
+        self.company_id = json_data.get(RootAnalysis.KEY_COMPANY_ID)
+        # the names of the tags of the root
+        self.tags = json_data.get(TaggableObject.KEY_TAGS, [])
+
+        observable_store = json_data.get(RootAnalysis.KEY_OBSERVABLE_STORE, {})
+        self.observable_count = len(observable_store)
+
+        # the total number of detection points in the entire tree
+        self.detection_count = len(json_data.get(DetectableObject.KEY_DETECTIONS, []))
+        for observable_json in observable_store.values():
+            self.detection_count += len(observable_json.get(DetectableObject.KEY_DETECTIONS, []))
+            for analysis_json in observable_json.get(Observable.KEY_ANALYSIS, {}).values():
+                # analysis that was not generated is stored as False
+                if isinstance(analysis_json, dict):
+                    self.detection_count += len(analysis_json.get(DetectableObject.KEY_DETECTIONS, []))
+
+    def has_detections(self):
+        return self.detection_count > 0
+
+    def __str__(self):
+        return "RootAnalysisSummary({}:{})".format(self.uuid, self.description)
+
+def load_summary(storage_dir):
+    """Returns a RootAnalysisSummary of the RootAnalysis stored in the given directory.
+       Nothing in the analysis tree is materialized so this is much faster than RootAnalysis.load()."""
+    with open(os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir, 'data.json'), 'r', encoding='utf8') as fp:
+        json_data = json.load(fp)
+
+    _track_reads()
+    return RootAnalysisSummary(storage_dir, json_data)
+
 def recurse_down(target, callback):
     """Calls callback starting at target back to the RootAnalysis."""
     assert isinstance(target, Analysis) or isinstance(target, Observable)
@@ -0,0 +1,329 @@
+# vim: sw=4:ts=4:et
+#
+# analysis result cache
+#
+# analysis modules that have the cache option enabled store the results of their analysis here
+# so that the same observable does not need to be analyzed again until the cached result expires
+#
+# two backends are available (see the [analysis_cache] configuration section)
+#
+# local - a sqlite database in the data directory shared by all the processes on the node
+#         entries expire after their ttl and the least recently used entries are evicted
+#         when the size of the cache exceeds max_size
+#
+# redis - the redis server configured in the [redis] section which allows results to be shared across nodes
+#         entries expire after their ttl and eviction is left to the maxmemory-policy of the redis server
+#
+# hit, miss and store counts are tracked per analysis module (see AnalysisCache.stats())
+#
+
+import collections
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+import saq
+from saq.constants import *
+from saq.error import report_exception
+
+ANALYSIS_CACHE_BACKEND_LOCAL = 'local'
+ANALYSIS_CACHE_BACKEND_REDIS = 'redis'
+
+STAT_HITS = 'hits'
+STAT_MISSES = 'misses'
+STAT_STORES = 'stores'
+STAT_EVICTIONS = 'evictions'
+
+VALID_STATS = [ STAT_HITS, STAT_MISSES, STAT_STORES, STAT_EVICTIONS ]
+
+# the prefix of all the keys stored in redis
+REDIS_KEY_PREFIX = 'analysis_cache:'
+# the hash used to store the stats of each module in redis
+REDIS_STATS_KEY = 'analysis_cache_stats'
+
+class AnalysisCache(object):
+    """Base class for analysis cache backends. Keys and values are strings."""
+
+    def __init__(self):
+        # key = (module, stat), value = count not yet written to the backend
+        self.pending_stats = collections.defaultdict(int)
+        # the process that is tracking the pending stats
+        self.pending_stats_pid = os.getpid()
+        self.stats_frequency = saq.CONFIG['analysis_cache'].getint('stats_frequency', fallback=60)
+        self.next_stats_flush = time.time() + self.stats_frequency
+
+    def get(self, module, key):
+        """Returns the value cached for the given key or None if it does not exist or has expired.
+           The module is the name of the analysis module (used for stats.)"""
+        value = self._get(key)
+        self.record_stat(module, STAT_HITS if value is not None else STAT_MISSES)
+        return value
+
+    def put(self, module, key, value, ttl):
+        """Stores the given value for ttl seconds."""
+        assert isinstance(value, str)
+        self._put(key, value, ttl)
+        self.record_stat(module, STAT_STORES)
+
+    def contains(self, key):
+        """Returns True if the given key is in the cache. This does not count as a hit or miss."""
+        return self._get(key, touch=False) is not None
+
+    def record_stat(self, module, stat, count=1):
+        assert stat in VALID_STATS
+
+        # a forked process starts with a copy of the pending stats of the parent
+        if self.pending_stats_pid != os.getpid():
+            self.pending_stats = collections.defaultdict(int)
+            self.pending_stats_pid = os.getpid()
+
+        self.pending_stats[(module, stat)] += count
+        if time.time() >= self.next_stats_flush:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Writes the pending stats to the backend."""
+        self.next_stats_flush = time.time() + self.stats_frequency
+        if not self.pending_stats:
+            return
+
+        pending_stats = self.pending_stats
+        self.pending_stats = collections.defaultdict(int)
+
+        try:
+            self._flush_stats(pending_stats)
+        except Exception as e:
+            logging.error(f"unable to record analysis cache stats: {e}")
+
+    def stats(self):
+        """Returns a dict of key = module, value = dict of key = stat, value = count."""
+        self.flush_stats()
+        return self._stats()
+
+    def _get(self, key, touch=True):
+        raise NotImplementedError()
+
+    def _put(self, key, value, ttl):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        """Removes all entries and stats from the cache."""
+        raise NotImplementedError()
+
+    def _flush_stats(self, pending_stats):
+        raise NotImplementedError()
+
+    def _stats(self):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush_stats()
+
+class LocalAnalysisCache(AnalysisCache):
+    """Stores cached analysis in a local sqlite database with TTL and LRU eviction."""
+
+    def __init__(self, path, max_size):
+        super().__init__()
+        # path to the sqlite database
+        self.path = path
+        # the maximum size of the cached values (in bytes)
+        self.max_size = max_size
+        # how often (in seconds) we check to see if we need to evict entries
+        self.eviction_frequency = saq.CONFIG['analysis_cache'].getint('eviction_frequency', fallback=60)
+        self.next_eviction_check = 0
+
+        self._db = None
+        # the process that opened the database connection
+        self._db_pid = None
+
+    @property
+    def db(self):
+        # sqlite connections cannot be shared across forked processes
+        if self._db is None or self._db_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # autocommit mode
+            self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._db_pid = os.getpid()
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expiration REAL NOT NULL,
+    last_access REAL NOT NULL )""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_cache_expiration ON cache(expiration)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache(last_access)")
+            self._db.execute("""
+CREATE TABLE IF NOT EXISTS stats (
+    module TEXT NOT NULL,
+    stat TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (module, stat) )""")
+
+        return self._db
+
+    def _get(self, key, touch=True):
+        now = time.time()
+        row = self.db.execute("SELECT value, expiration FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        value, expiration = row
+        if expiration < now:
+            return None
+
+        if touch:
+            self.db.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+
+        return value
+
+    def _put(self, key, value, ttl):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO cache ( key, value, size, expiration, last_access ) VALUES ( ?, ?, ?, ?, ? )",
+                        (key, value, len(value), now + ttl, now))
+
+        if now >= self.next_eviction_check:
+            self.next_eviction_check = now + self.eviction_frequency
+            self.evict()
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self.db.execute("DELETE FROM cache")
+        self.db.execute("DELETE FROM stats")
+
+    @property
+    def size(self):
+        """Returns the total size of the cached values (in bytes)."""
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def evict(self):
+        """Removes expired entries and then the least recently used entries until the cache is under max_size.
+           Returns the number of entries removed."""
+        evicted = self.db.execute("DELETE FROM cache WHERE expiration < ?", (time.time(),)).rowcount
+
+        excess = self.size - self.max_size
+        if excess > 0:
+            keys = []
+            for key, size in self.db.execute("SELECT key, size FROM cache ORDER BY last_access ASC"):
+                keys.append(key)
+                excess -= size
+                if excess <= 0:
+                    break
+
+            for key in keys:
+                self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+            evicted += len(keys)
+
+        if evicted:
+            logging.debug(f"evicted {evicted} entries from analysis cache {self.path}")
+            self.record_stat(None, STAT_EVICTIONS, evicted)
+
+        return evicted
+
+    def _flush_stats(self, pending_stats):
+        for (module, stat), count in pending_stats.items():
+            self.db.execute("INSERT OR IGNORE INTO stats ( module, stat, count ) VALUES ( ?, ?, 0 )", (module or '', stat))
+            self.db.execute("UPDATE stats SET count = count + ? WHERE module = ? AND stat = ?", (count, module or '', stat))
+
+    def _stats(self):
+        result = {}
+        for module, stat, count in self.db.execute("SELECT module, stat, count FROM stats ORDER BY module, stat"):
+            result.setdefault(module or None, {})[stat] = count
+
+        return result
+
+    def close(self):
+        super().close()
+        if self._db is not None and self._db_pid == os.getpid():
+            self._db.close()
+
+        self._db = None
+
+class RedisAnalysisCache(AnalysisCache):
+    """Stores cached analysis in redis so that it is shared across nodes."""
+
+    def __init__(self):
+        super().__init__()
+        self._redis_connection = None
+
+    @property
+    def redis_connection(self):
+        if self._redis_connection is None:
+            import redis
+            self._redis_connection = redis.Redis(saq.CONFIG['redis']['host'],
+                                                 saq.CONFIG['redis'].getint('port'),
+                                                 db=REDIS_DB_ANALYSIS_CACHE,
+                                                 decode_responses=True,
+                                                 encoding='utf-8')
+
+        return self._redis_connection
+
+    def _get(self, key, touch=True):
+        return self.redis_connection.get(f'{REDIS_KEY_PREFIX}{key}')
+
+    def _put(self, key, value, ttl):
+        self.redis_connection.set(f'{REDIS_KEY_PREFIX}{key}', value, ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.redis_connection.delete(f'{REDIS_KEY_PREFIX}{key}')
+
+    def clear(self):
+        self.redis_connection.flushdb()
+
+    def _flush_stats(self, pending_stats):
+        pipeline = self.redis_connection.pipeline()
+        for (module, stat), count in pending_stats.items():
+            pipeline.hincrby(REDIS_STATS_KEY, f'{module or ""}:{stat}', count)
+
+        pipeline.execute()
+
+    def _stats(self):
+        result = {}
+        for field, count in self.redis_connection.hgetall(REDIS_STATS_KEY).items():
+            module, stat = field.rsplit(':', 1)
+            result.setdefault(module or None, {})[stat] = int(count)
+
+        return result
+
+# the AnalysisCache used by this process
+_analysis_cache = None
+
+def get_analysis_cache():
+    """Returns the AnalysisCache configured in the [analysis_cache] section."""
+    global _analysis_cache
+    if _analysis_cache is not None:
+        return _analysis_cache
+
+    backend = saq.CONFIG['analysis_cache'].get('backend', fallback=ANALYSIS_CACHE_BACKEND_LOCAL)
+    if backend == ANALYSIS_CACHE_BACKEND_REDIS:
+        _analysis_cache = RedisAnalysisCache()
+    elif backend == ANALYSIS_CACHE_BACKEND_LOCAL:
+        _analysis_cache = LocalAnalysisCache(
+            os.path.join(saq.SAQ_HOME, saq.DATA_DIR, saq.CONFIG['analysis_cache']['local_path']),
+            saq.CONFIG['analysis_cache'].getint('max_size') * 1024 * 1024)
+    else:
+        raise ValueError(f"invalid analysis cache backend {backend}")
+
+    return _analysis_cache
+
+def reset_analysis_cache():
+    """Closes the current AnalysisCache (if any) so that the next call to get_analysis_cache() creates a new one.
+       This is called by saq.initialize() when the configuration is (re)loaded, including the setup of each test."""
+    global _analysis_cache
+    if _analysis_cache is not None:
+        try:
+            _analysis_cache.close()
+        except Exception as e:
+            logging.error(f"unable to close analysis cache: {e}")
+            report_exception()
+
+    _analysis_cache = None
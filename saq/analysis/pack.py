@@ -0,0 +1,306 @@
+# vim: sw=4:ts=4:et
+#
+# packed storage for analysis details
+#
+# by default the details of each Analysis object are stored in their own JSON file
+# inside the .ace directory of the storage directory of the RootAnalysis
+# large alerts end up with thousands of these files
+#
+# a DetailsPack stores all of these in a single append-only file (.ace/details.pack)
+# each record in the file is a header line followed by the JSON encoded details
+#
+#   external_details_path<TAB>length<NEWLINE>
+#   <length bytes of data><NEWLINE>
+#
+# a record with a length of -1 (and no data) marks the path as deleted
+# the .ace/details.idx file stores the offset of the most recent record for each path
+# and the size of the pack file the index covers
+# anything written past that size is recovered by scanning the records
+#
+
+import json
+import logging
+import os
+import os.path
+import re
+
+import saq
+
+PACK_FILE_NAME = 'details.pack'
+INDEX_FILE_NAME = 'details.idx'
+
+# the ratio of unreferenced data in a pack file that triggers compaction
+COMPACTION_RATIO = 0.5
+
+# the names of the analysis details files (see Analysis.save_external_details)
+DETAILS_FILE_NAME_REGEX = re.compile(r'^.+_[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.json$')
+
+DETAILS_FORMAT_FILES = 'files'
+DETAILS_FORMAT_PACKED = 'packed'
+
+def get_details_format():
+    """Returns the configured format for new analysis details (DETAILS_FORMAT_FILES or DETAILS_FORMAT_PACKED)."""
+    return saq.CONFIG['global'].get('analysis_details_format', fallback=DETAILS_FORMAT_FILES)
+
+def _record_size(path, length):
+    """Returns the number of bytes the record for the given path and data length uses in the pack file."""
+    return len(f'{path}\t{length}\n'.encode('utf8')) + length + 1
+
+def is_packed(storage_dir):
+    """Returns True if the given storage directory has a details pack."""
+    return os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, storage_dir, '.ace', PACK_FILE_NAME))
+
+class DetailsPack(object):
+    """Stores the details of the Analysis objects of a RootAnalysis in a single append-only file."""
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        # key = external_details_path, value = (offset, length) of the record
+        self.index = None
+        # the size of the pack file covered by self.index
+        self.indexed_size = 0
+        # the total number of bytes (headers and data) of the records referenced by the index
+        self.live_size = 0
+        # set to True when the index has changes that are not saved to disk
+        self.index_modified = False
+
+    @property
+    def ace_dir(self):
+        return os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')
+
+    @property
+    def pack_path(self):
+        return os.path.join(self.ace_dir, PACK_FILE_NAME)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.ace_dir, INDEX_FILE_NAME)
+
+    def exists(self):
+        return os.path.exists(self.pack_path)
+
+    def load_index(self):
+        """Loads the index from disk, scanning any records written after the index was last saved."""
+        self.index = {}
+        self.indexed_size = 0
+        self.live_size = 0
+        self.index_modified = False
+
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as fp:
+                    index_json = json.load(fp)
+
+                self.index = { path: tuple(record) for path, record in index_json['records'].items() }
+                self.indexed_size = index_json['size']
+                self.live_size = sum([_record_size(path, length) for path, (offset, length) in self.index.items()])
+            except Exception as e:
+                logging.warning(f"unable to load details index {self.index_path}: {e}")
+                self.index = {}
+                self.indexed_size = 0
+                self.live_size = 0
+
+        if not self.exists():
+            return
+
+        # did anything get written to the pack that the index does not know about?
+        if os.path.getsize(self.pack_path) != self.indexed_size:
+            self._scan(self.indexed_size if os.path.getsize(self.pack_path) > self.indexed_size else 0)
+
+    def _scan(self, start):
+        """Updates the index with the records in the pack file starting at the given offset."""
+        if start == 0:
+            self.index = {}
+            self.live_size = 0
+
+        with open(self.pack_path, 'rb') as fp:
+            fp.seek(start)
+            while True:
+                offset = fp.tell()
+                header = fp.readline()
+                if not header:
+                    break
+
+                try:
+                    path, length = header.decode('utf8').rstrip('\n').split('\t')
+                    length = int(length)
+                except ValueError:
+                    logging.error(f"corrupt record at offset {offset} in {self.pack_path}")
+                    break
+
+                if path in self.index:
+                    self.live_size -= _record_size(path, self.index[path][1])
+
+                if length < 0:
+                    self.index.pop(path, None)
+                    continue
+
+                data = fp.read(length + 1)
+                if len(data) != length + 1:
+                    # this record is still being written
+                    break
+
+                self.index[path] = (offset, length)
+                self.live_size += _record_size(path, length)
+
+            self.indexed_size = offset
+
+        self.index_modified = True
+
+    def _ensure_index(self):
+        if self.index is None:
+            self.load_index()
+
+    def save_index(self):
+        """Writes the index to disk if it has been modified."""
+        if self.index is None or not self.index_modified:
+            return
+
+        temp_path = f'{self.index_path}.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump({ 'size': self.indexed_size, 'records': self.index }, fp)
+
+        os.replace(temp_path, self.index_path)
+        self.index_modified = False
+
+    def __contains__(self, path):
+        self._ensure_index()
+        if path not in self.index:
+            # some other process may have written it
+            self.load_index()
+
+        return path in self.index
+
+    def _append(self, path, data):
+        """Appends a record to the pack and returns the (offset, length) of the record."""
+        with open(self.pack_path, 'ab') as fp:
+            offset = fp.tell()
+            if data is None:
+                fp.write(f'{path}\t-1\n'.encode('utf8'))
+                length = -1
+            else:
+                fp.write(f'{path}\t{len(data)}\n'.encode('utf8'))
+                fp.write(data)
+                fp.write(b'\n')
+                length = len(data)
+
+            self.indexed_size = fp.tell()
+
+        self.index_modified = True
+        return offset, length
+
+    def write(self, path, details_json):
+        """Stores the given JSON string as the details for the given path."""
+        self._ensure_index()
+        if path in self.index:
+            self.live_size -= _record_size(path, self.index[path][1])
+
+        self.index[path] = self._append(path, details_json.encode('utf8'))
+        self.live_size += _record_size(path, self.index[path][1])
+
+    def read(self, path):
+        """Returns the JSON string stored for the given path, or None if it does not exist."""
+        self._ensure_index()
+        for attempt in range(2):
+            if path not in self.index:
+                if attempt == 0:
+                    self.load_index()
+                    continue
+
+                return None
+
+            offset, length = self.index[path]
+            with open(self.pack_path, 'rb') as fp:
+                fp.seek(offset)
+                header = fp.readline().decode('utf8', errors='replace')
+                # the pack may have been compacted by another process since we loaded the index
+                if header.split('\t')[0] == path:
+                    return fp.read(length).decode('utf8')
+
+            self.load_index()
+
+        logging.error(f"unable to read details {path} from {self.pack_path}")
+        return None
+
+    def delete(self, path):
+        """Removes the details for the given path. Returns True if the path existed."""
+        self._ensure_index()
+        if path not in self.index:
+            return False
+
+        self.live_size -= _record_size(path, self.index[path][1])
+        del self.index[path]
+        self._append(path, None)
+        return True
+
+    @property
+    def garbage_ratio(self):
+        """Returns the ratio of the pack file that is no longer referenced (replaced records and deletion markers.)"""
+        self._ensure_index()
+        if not self.indexed_size:
+            return 0.0
+
+        return 1.0 - (self.live_size / self.indexed_size)
+
+    def compact(self, force=False):
+        """Rewrites the pack file with only the records that are still referenced.
+           Unless force is True this only happens if the garbage_ratio exceeds COMPACTION_RATIO."""
+        self._ensure_index()
+        if not self.exists():
+            return
+
+        if not force and self.garbage_ratio < COMPACTION_RATIO:
+            return
+
+        temp_path = f'{self.pack_path}.tmp'
+        new_index = {}
+        with open(self.pack_path, 'rb') as fp_in, open(temp_path, 'wb') as fp_out:
+            for path, (offset, length) in self.index.items():
+                fp_in.seek(offset)
+                fp_in.readline()
+                new_index[path] = (fp_out.tell(), length)
+                fp_out.write(f'{path}\t{length}\n'.encode('utf8'))
+                fp_out.write(fp_in.read(length))
+                fp_out.write(b'\n')
+
+            new_size = fp_out.tell()
+
+        logging.debug(f"compacted {self.pack_path} from {self.indexed_size} to {new_size} bytes")
+        os.replace(temp_path, self.pack_path)
+        self.index = new_index
+        self.indexed_size = new_size
+        self.live_size = new_size
+        self.index_modified = True
+        self.save_index()
+
+def pack_storage_dir(storage_dir, remove=True):
+    """Moves the analysis details JSON files of the given storage directory into a DetailsPack.
+       Only files named like analysis details (see DETAILS_FILE_NAME_REGEX) are packed
+       so other files in the .ace directory (such as submission.json) are left alone.
+       If remove is True then the JSON files are deleted after they are packed.
+       Returns the number of files packed."""
+    pack = DetailsPack(storage_dir)
+    if not os.path.isdir(pack.ace_dir):
+        return 0
+
+    packed_files = []
+    for file_name in sorted(os.listdir(pack.ace_dir)):
+        if not DETAILS_FILE_NAME_REGEX.match(file_name):
+            continue
+
+        file_path = os.path.join(pack.ace_dir, file_name)
+        if not os.path.isfile(file_path):
+            continue
+
+        with open(file_path, 'r') as fp:
+            pack.write(file_name, fp.read())
+
+        packed_files.append(file_path)
+
+    pack.save_index()
+
+    if remove:
+        for file_path in packed_files:
+            os.remove(file_path)
+
+    return len(packed_files)
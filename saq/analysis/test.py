@@ -9,7 +9,7 @@ import unittest
 
 import saq
 
-from saq.analysis import _JSONEncoder, RootAnalysis, _get_io_write_count, _get_io_read_count, MODULE_PATH, SPLIT_MODULE_PATH
+from saq.analysis import _JSONEncoder, encode_json, RootAnalysis, _get_io_write_count, _get_io_read_count, MODULE_PATH, SPLIT_MODULE_PATH
 from saq.modules import AnalysisModule
 from saq.modules.test import BasicTestAnalysis, BasicTestAnalyzer, TestInstanceAnalysis
 from saq.constants import *
@@ -49,6 +49,11 @@ class JSONSeralizerTestCase(ACEBasicTestCase):
         json_output = json.dumps(test_data, sort_keys=True, cls=_JSONEncoder)
         self.assertEqual(json_output, r'{"binary_string": "\u00e4\u00bd\u00a0\u00e5\u00a5\u00bd\u00ef\u00bc\u008c\u00e4\u00b8\u0096\u00e7\u0095\u008c", "bool": true, "custom_object": "hello world", "datetime": "2017-11-11T07:36:01.000001", "dict": {}, "float": 1.0, "int": 1, "list": [], "null": null, "str": "test"}')
 
+        # the fast encoder (if available) produces the same JSON
+        saq.CONFIG['global']['fast_json_encoder'] = 'yes'
+        self.assertEqual(json.loads(encode_json(test_data)), json.loads(json_output))
+        saq.CONFIG['global']['fast_json_encoder'] = 'no'
+        self.assertEqual(json.loads(encode_json(test_data)), json.loads(json_output))
 
 class RootAnalysisTestCase(ACEBasicTestCase):
     def test_create(self):
@@ -87,6 +92,90 @@ class RootAnalysisTestCase(ACEBasicTestCase):
         # and then one read
         self.assertEquals(_get_io_read_count(), 1)
 
+    @track_io
+    def test_unmodified_details_not_saved(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test')
+        analysis = BasicTestAnalysis()
+        analysis.details = { 'hello': 'world' }
+        observable.add_analysis(analysis)
+        root.save()
+        # the data.json and the details of the analysis
+        self.assertEquals(_get_io_write_count(), 2)
+
+        # nothing changed in the details so only data.json is written
+        root.save()
+        self.assertEquals(_get_io_write_count(), 3)
+
+        # details that are modified in place are detected
+        analysis.details['hello'] = 'there'
+        root.save()
+        self.assertEquals(_get_io_write_count(), 5)
+
+    def test_incremental_save(self):
+        saq.CONFIG['global']['incremental_save'] = 'yes'
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        o1 = root.add_observable(F_TEST, 'test_1')
+        o2 = root.add_observable(F_TEST, 'test_2')
+        root.save()
+
+        # the JSON of each observable is cached after the save
+        fragment = o2.json_fragment
+        self.assertIsNotNone(o1._json_fragment)
+
+        # and is invalidated when the observable changes
+        o1.add_tag('test_tag')
+        self.assertIsNone(o1._json_fragment)
+        self.assertIs(o2.json_fragment, fragment)
+
+        # or when any analysis of the observable changes
+        analysis = BasicTestAnalysis()
+        analysis.details = { 'hello': 'world' }
+        o2.add_analysis(analysis)
+        self.assertIsNone(o2._json_fragment)
+        root.save()
+        analysis.add_detection_point('test detection')
+        self.assertIsNone(o2._json_fragment)
+        root.save()
+
+        # the incremental output is the same as the full output
+        with open(root.json_path, 'r') as fp:
+            incremental_json = json.load(fp)
+
+        saq.CONFIG['global']['incremental_save'] = 'no'
+        self.assertEquals(incremental_json, json.loads(root.encode_data_json()))
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.get_observable(o1.id).has_tag('test_tag'))
+        analysis = root.get_observable(o2.id).get_analysis(BasicTestAnalysis)
+        self.assertTrue(analysis.has_detection_points())
+        self.assertEquals(analysis.details, { 'hello': 'world' })
+
+    def test_incremental_save_file_observable(self):
+        saq.CONFIG['global']['incremental_save'] = 'yes'
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        with open(os.path.join(root.storage_dir, 'test.txt'), 'w') as fp:
+            fp.write('hello world')
+
+        observable = root.add_observable(F_FILE, 'test.txt')
+        root.save()
+        self.assertIsNotNone(observable._json_fragment)
+
+        # the mime type is determined lazily and still needs to be saved
+        mime_type = observable.mime_type
+        self.assertIsNone(observable._json_fragment)
+        root.save()
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertEquals(root.get_observable(observable.id)._mime_type, mime_type)
+
     def test_has_observable(self):
         root = create_root_analysis()
         root.initialize_storage()
@@ -114,6 +203,193 @@ class RootAnalysisTestCase(ACEBasicTestCase):
         # search by lambda, multi observable
         self.assertEquals(sorted(root.find_observables(lambda o: o.type == F_TEST)), o_all)
 
+    def test_observable_index(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+
+        o1 = root.add_observable(F_FQDN, 'Test.Local')
+        o2 = root.add_observable(F_TEST, 'test', '2020-01-01 00:00:00 +0000')
+        # the same observable is only recorded once (caseless observables ignore case)
+        self.assertTrue(root.add_observable(F_FQDN, 'test.local') is o1)
+        self.assertTrue(root.add_observable(F_TEST, 'test', '2020-01-01 00:00:00 +0000') is o2)
+        self.assertFalse(root.add_observable(F_TEST, 'test') is o2)
+        self.assertEquals(len(root.observables), 3)
+
+        self.assertTrue(root.get_observable_by_spec(F_FQDN, 'TEST.local') is o1)
+        self.assertIsNone(root.get_observable_by_spec(F_FQDN, 'test2.local'))
+
+        # the index is rebuilt when the observable_store is loaded
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        o1 = root.get_observable_by_spec(F_FQDN, 'test.local')
+        self.assertIsNotNone(o1)
+        self.assertTrue(root.record_observable_by_spec(F_FQDN, 'TEST.LOCAL') is o1)
+
+        # removed observables are no longer found
+        del root.observable_store[o1.id]
+        self.assertIsNone(root.get_observable_by_spec(F_FQDN, 'test.local'))
+
+    def test_analysis_index(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+
+        o1 = root.add_observable(F_TEST, 'test_1')
+        # build the indexes before anything is added so that everything below is added incrementally
+        self.assertEquals(root.all_analysis, [root])
+        self.assertFalse(root.has_detections())
+
+        analysis = BasicTestAnalysis()
+        o1.add_analysis(analysis)
+        o2 = analysis.add_observable(F_TEST, 'test_2')
+        o2.add_tag('test_tag')
+        self.assertEquals(root.all_analysis, [root, analysis])
+        self.assertEquals(root.get_analysis_by_type(BasicTestAnalysis), [analysis])
+        self.assertEquals(list(root.iterate_all_references(o2)), [analysis])
+        self.assertTrue('test_tag' in [tag.name for tag in root.all_tags])
+
+        analysis.add_detection_point('test detection')
+        self.assertTrue(root.has_detections())
+
+        # changes that do not fire events invalidate the indexes
+        o2.clear_tags()
+        self.assertEquals(root.all_tags, [])
+        analysis.clear_detection_points()
+        self.assertFalse(root.has_detections())
+        o1.clear_analysis()
+        self.assertEquals(root.all_analysis, [root])
+        self.assertEquals(root.get_analysis_by_type(BasicTestAnalysis), [])
+        self.assertEquals(list(root.iterate_all_references(o2)), [])
+
+        # the indexes are rebuilt when the analysis is loaded
+        o1.add_analysis(analysis)
+        analysis.add_detection_point('test detection')
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        o1 = root.get_observable(o1.id)
+        analysis = o1.get_analysis(BasicTestAnalysis)
+        self.assertEquals(root.get_analysis_by_type(BasicTestAnalysis), [analysis])
+        self.assertEquals(list(root.iterate_all_references(root.get_observable(o2.id))), [analysis])
+        self.assertTrue(root.has_detections())
+
+    def test_lazy_load(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        observable.add_tag('test_tag')
+        analysis = BasicTestAnalysis()
+        observable.add_analysis(analysis)
+        analysis.add_detection_point('test detection')
+        root.save()
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load(lazy=True)
+        self.assertFalse(root.is_materialized)
+        self.assertEquals(root.description, EV_ROOT_ANALYSIS_DESCRIPTION)
+
+        # saving without accessing the analysis tree keeps it as it was
+        root.location = 'test_location'
+        root.save()
+        self.assertFalse(root.is_materialized)
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load(lazy=True)
+        self.assertEquals(root.location, 'test_location')
+        # the analysis tree is materialized when it is first accessed
+        observable = root.get_observable(observable.id)
+        self.assertTrue(root.is_materialized)
+        self.assertTrue(observable.has_tag('test_tag'))
+        self.assertTrue(isinstance(observable.get_analysis(BasicTestAnalysis), BasicTestAnalysis))
+        self.assertTrue(root.has_detections())
+
+    def test_lazy_load_delayed(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        analysis = BasicTestAnalysis()
+        observable.add_analysis(analysis)
+        analysis.delayed = True
+        root.save()
+
+        # delayed is answered (and saved) without materializing the analysis tree
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load(lazy=True)
+        self.assertTrue(root.delayed)
+        root.location = 'test_location'
+        root.save()
+        self.assertFalse(root.is_materialized)
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load(lazy=True)
+        self.assertTrue(root.delayed)
+        root.get_observable(observable.id).get_analysis(BasicTestAnalysis).delayed = False
+        self.assertFalse(root.delayed)
+
+    def test_load_summary(self):
+        from saq.analysis import load_summary
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        observable.add_detection_point('test detection')
+        analysis = BasicTestAnalysis()
+        observable.add_analysis(analysis)
+        analysis.add_detection_point('test detection')
+        root.add_observable(F_TEST, 'test_2')
+        root.save()
+
+        summary = load_summary(root.storage_dir)
+        self.assertEquals(summary.uuid, root.uuid)
+        self.assertEquals(summary.description, root.description)
+        self.assertEquals(summary.event_time, root.event_time)
+        self.assertEquals(summary.observable_count, 2)
+        self.assertEquals(summary.detection_count, 2)
+        self.assertTrue(summary.has_detections())
+
+    def test_compact_observables(self):
+        from saq.analysis import EMPTY_LIST
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        o1 = root.add_observable(F_TEST, 'test_1')
+        o2 = root.add_observable(F_TEST, 'test_2')
+
+        # unused lists share the same (immutable) empty list
+        self.assertTrue(o1.tags is EMPTY_LIST)
+        self.assertTrue(o1.directives is EMPTY_LIST)
+        with self.assertRaises(TypeError):
+            o1.directives.append(DIRECTIVE_CRAWL)
+
+        # observables with the same listeners share the same listener table
+        self.assertTrue(o1.event_listeners is o2.event_listeners)
+        self.assertTrue(o1.type is o2.type)
+        self.assertNotEquals(o1.cache_id, o2.cache_id)
+
+        o1.add_directive(DIRECTIVE_CRAWL)
+        o1.add_tag('test_tag')
+        self.assertEquals(o1.directives, [DIRECTIVE_CRAWL])
+        self.assertEquals(o2.directives, [])
+        self.assertTrue(o1.event_listeners is o2.event_listeners)
+
+        # adding a listener to one observable does not change the listeners of the other
+        events = []
+        o1.add_event_listener(EVENT_TAG_ADDED, lambda *args: events.append(args))
+        self.assertFalse(o1.event_listeners is o2.event_listeners)
+        o2.add_tag('test_tag')
+        self.assertEquals(events, [])
+        o1.add_tag('other_tag')
+        self.assertEquals(len(events), 1)
+
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        o1 = root.get_observable(o1.id)
+        o2 = root.get_observable(o2.id)
+        self.assertEquals(o1.directives, [DIRECTIVE_CRAWL])
+        self.assertTrue(o2.directives is EMPTY_LIST)
+        self.assertTrue(o1.has_tag('test_tag'))
+
     def test_observable_md5(self):
         
         root = create_root_analysis()
@@ -299,3 +575,160 @@ class RootAnalysisTestCase(ACEBasicTestCase):
         root.add_ioc(I_EMAIL_FROM_ADDRESS, 'badguy@evil.com', tags=['from_address'])
         assert len(root.iocs) == 1
         assert root.iocs[0].type == I_EMAIL_FROM_ADDRESS
+
+class DetailsPackTestCase(ACEBasicTestCase):
+    def test_pack_read_write(self):
+        from saq.analysis.pack import DetailsPack
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        os.makedirs(os.path.join(root.storage_dir, '.ace'), exist_ok=True)
+
+        pack = DetailsPack(root.storage_dir)
+        pack.write('a.json', json.dumps({'a': 1}))
+        pack.write('b.json', json.dumps({'b': 1}))
+        # a pack without any replaced or deleted records has no garbage
+        self.assertEquals(pack.garbage_ratio, 0.0)
+        pack.write('a.json', json.dumps({'a': 2}))
+        self.assertTrue(pack.garbage_ratio > 0.0)
+        self.assertEquals(json.loads(pack.read('a.json')), {'a': 2})
+
+        # records written after the index was saved are found by scanning
+        other = DetailsPack(root.storage_dir)
+        self.assertEquals(json.loads(other.read('b.json')), {'b': 1})
+
+        pack.save_index()
+        self.assertTrue(pack.delete('b.json'))
+        self.assertFalse('b.json' in DetailsPack(root.storage_dir))
+        self.assertIsNone(DetailsPack(root.storage_dir).read('b.json'))
+
+        # compaction only keeps the latest record for each path
+        size = os.path.getsize(pack.pack_path)
+        pack.compact(force=True)
+        self.assertTrue(os.path.getsize(pack.pack_path) < size)
+        self.assertEquals(pack.garbage_ratio, 0.0)
+        self.assertEquals(DetailsPack(root.storage_dir).garbage_ratio, 0.0)
+        self.assertEquals(json.loads(DetailsPack(root.storage_dir).read('a.json')), {'a': 2})
+
+    def test_packed_root(self):
+        saq.CONFIG['global']['analysis_details_format'] = 'packed'
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test')
+        analysis = BasicTestAnalysis()
+        analysis.details = { 'hello': 'world' }
+        observable.add_analysis(analysis)
+        root.save()
+
+        # only the pack and the index exist in the .ace directory
+        self.assertEquals(sorted(os.listdir(os.path.join(root.storage_dir, '.ace'))), ['details.idx', 'details.pack'])
+
+        # the pack is used even if the configuration changes
+        saq.CONFIG['global']['analysis_details_format'] = 'files'
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        analysis = root.get_observable(observable.id).get_analysis(BasicTestAnalysis)
+        self.assertEquals(analysis.details, { 'hello': 'world' })
+
+        root.archive()
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        analysis = root.get_observable(observable.id).get_analysis(BasicTestAnalysis)
+        self.assertIsNone(analysis.details)
+
+    def test_pack_storage_dir(self):
+        from saq.analysis.pack import pack_storage_dir
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test')
+        analysis = BasicTestAnalysis()
+        analysis.details = { 'hello': 'world' }
+        observable.add_analysis(analysis)
+        root.save()
+
+        # other json files in the .ace directory are not analysis details
+        with open(os.path.join(root.storage_dir, '.ace', 'submission.json'), 'w') as fp:
+            json.dump({}, fp)
+
+        self.assertTrue(pack_storage_dir(root.storage_dir) > 0)
+        self.assertEquals(sorted(os.listdir(os.path.join(root.storage_dir, '.ace'))), 
+                          ['details.idx', 'details.pack', 'submission.json'])
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        analysis = root.get_observable(observable.id).get_analysis(BasicTestAnalysis)
+        self.assertEquals(analysis.details, { 'hello': 'world' })
+
+class AnalysisCacheTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        from saq.analysis.cache import LocalAnalysisCache
+        self.cache_path = os.path.join(saq.TEMP_DIR, 'analysis_cache.db')
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+        self.cache = LocalAnalysisCache(self.cache_path, 1024)
+        # evictions are triggered manually in these tests
+        self.cache.next_eviction_check = time.time() + 3600
+
+    def tearDown(self, *args, **kwargs):
+        self.cache.close()
+        super().tearDown(*args, **kwargs)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('test', 'key'))
+        self.cache.put('test', 'key', 'value', 60)
+        self.assertEquals(self.cache.get('test', 'key'), 'value')
+        self.assertTrue(self.cache.contains('key'))
+        self.cache.delete('key')
+        self.assertFalse(self.cache.contains('key'))
+
+    def test_expiration(self):
+        self.cache.put('test', 'key', 'value', 0)
+        time.sleep(0.01)
+        self.assertIsNone(self.cache.get('test', 'key'))
+        # expired entries are the first to get evicted
+        self.assertEquals(self.cache.evict(), 1)
+
+    def test_lru_eviction(self):
+        self.cache.max_size = 10
+        self.cache.put('test', 'key_1', '12345', 60)
+        self.cache.put('test', 'key_2', '12345', 60)
+        # access key_1 so that key_2 becomes the least recently used
+        time.sleep(0.01)
+        self.assertIsNotNone(self.cache.get('test', 'key_1'))
+        self.cache.put('test', 'key_3', '12345', 60)
+        self.assertEquals(self.cache.evict(), 1)
+        self.assertTrue(self.cache.contains('key_1'))
+        self.assertFalse(self.cache.contains('key_2'))
+        self.assertTrue(self.cache.contains('key_3'))
+        self.assertEquals(self.cache.size, 10)
+
+    def test_stats(self):
+        self.cache.get('module_a', 'key')
+        self.cache.put('module_a', 'key', 'value', 60)
+        self.cache.get('module_a', 'key')
+        self.cache.get('module_a', 'key')
+        self.cache.get('module_b', 'key')
+
+        stats = self.cache.stats()
+        self.assertEquals(stats['module_a'], { 'hits': 2, 'misses': 1, 'stores': 1 })
+        self.assertEquals(stats['module_b'], { 'hits': 1 })
+
+        # stats are shared by everything that uses the same database
+        from saq.analysis.cache import LocalAnalysisCache
+        other_cache = LocalAnalysisCache(self.cache_path, 1024)
+        self.assertEquals(other_cache.stats(), stats)
+        other_cache.close()
+
+    def test_reset_analysis_cache(self):
+        from saq.analysis.cache import get_analysis_cache
+        cache = get_analysis_cache()
+        self.assertTrue(get_analysis_cache() is cache)
+
+        # a new cache is created when the configuration is loaded again
+        initialize_test_environment()
+        self.assertFalse(get_analysis_cache() is cache)
@@ -0,0 +1,325 @@
+# vim: sw=4:ts=4:et
+#
+# content addressed file storage
+#
+# files in the storage directories of alerts and submissions are stored once in the blob store
+# (named by the sha256 of their content) and hard linked into every storage directory that uses them
+#
+# the reference count of a blob is the link count of the file in the blob store
+# a blob with a link count of 1 is no longer used by any storage directory and is removed by collect()
+# so deleting a storage directory (RootAnalysis.archive(), RootAnalysis.delete(), cleanup_alerts, rm -rf)
+# releases the blobs it used without any additional bookkeeping
+#
+# files are stored explicitly (RootAnalysis.store_files() once analysis has completed, collectors for submitted files)
+# and never as a side effect of hashing them
+#
+# blobs are read-only since writing to a hard link would change the content for every storage directory that uses it
+# code that needs to modify a stored file in place calls detach() first to replace the link with a private copy
+# the size and modification time of each blob are also recorded when it is stored
+# and a blob that no longer matches (modified by root or after a chmod) is not used for any new files
+#
+# the hashes of each blob are recorded in a sqlite database (keyed by device and inode)
+# so that files that are already in the store do not need to be hashed again
+#
+# see the [blob_store] configuration section
+#
+
+import hashlib
+import io
+import logging
+import os
+import os.path
+import shutil
+import sqlite3
+import stat
+import uuid
+
+import saq
+
+class BlobStore(object):
+    """Stores files by the sha256 of their content and hard links them into storage directories."""
+
+    def __init__(self, path, min_size=0):
+        # the directory that contains the blobs
+        self.path = path
+        # files smaller than this (in bytes) are not stored
+        self.min_size = min_size
+
+        self._db = None
+        # the process that opened the database connection
+        self._db_pid = None
+
+    @property
+    def db(self):
+        # sqlite connections cannot be shared across forked processes
+        if self._db is None or self._db_pid != os.getpid():
+            os.makedirs(self.path, exist_ok=True)
+            # autocommit mode
+            self._db = sqlite3.connect(os.path.join(self.path, 'blobs.db'), timeout=30, isolation_level=None)
+            self._db_pid = os.getpid()
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    md5 TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    mtime INTEGER NOT NULL DEFAULT 0 )""")
+            # databases created before the mtime column was added
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(blobs)")]
+            if 'mtime' not in columns:
+                self._db.execute("ALTER TABLE blobs ADD COLUMN mtime INTEGER NOT NULL DEFAULT 0")
+
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_blobs_inode ON blobs(dev, ino)")
+
+        return self._db
+
+    def blob_path(self, sha256):
+        """Returns the path to the blob with the given sha256."""
+        return os.path.join(self.path, sha256[0:2], sha256)
+
+    def get_hashes(self, path):
+        """Returns the (md5, sha1, sha256) of the given file if it is a link to a blob, None otherwise."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        # files in the store always have at least two links
+        if st.st_nlink < 2:
+            return None
+
+        row = self.db.execute("SELECT md5, sha1, sha256, size, mtime FROM blobs WHERE dev = ? AND ino = ?",
+                              (st.st_dev, st.st_ino)).fetchone()
+        if row is None:
+            return None
+
+        # the content was modified in place after it was stored
+        if not self._is_unchanged(st, row[3], row[4]):
+            return None
+
+        return tuple(row[0:3])
+
+    def _is_unchanged(self, st, size, mtime):
+        """Returns True if the given os.stat() result matches the recorded size and modification time of a blob."""
+        return st.st_size == size and st.st_mtime_ns == mtime
+
+    def _is_modified_blob(self, sha256):
+        """Returns True if the blob with the given sha256 has been modified since it was stored."""
+        try:
+            st = os.stat(self.blob_path(sha256))
+        except FileNotFoundError:
+            return False
+
+        # a blob that was just added by another process may not be recorded yet
+        row = self.db.execute("SELECT size, mtime FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        return row is not None and not self._is_unchanged(st, row[0], row[1])
+
+    def _record(self, sha256, md5, sha1):
+        st = os.stat(self.blob_path(sha256))
+        self.db.execute("INSERT OR REPLACE INTO blobs ( sha256, md5, sha1, size, dev, ino, mtime ) "
+                        "VALUES ( ?, ?, ?, ?, ?, ?, ? )",
+                        (sha256, md5, sha1, st.st_size, st.st_dev, st.st_ino, st.st_mtime_ns))
+
+    def store(self, path):
+        """Replaces the given file with a link to the blob of the same content (adding the blob if it's new.)
+           Returns the (md5, sha1, sha256) of the file, or None if the file was not stored."""
+        hashes = self.get_hashes(path)
+        if hashes is not None:
+            return hashes
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+            return None
+
+        md5_hasher = hashlib.md5()
+        sha1_hasher = hashlib.sha1()
+        sha256_hasher = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            while True:
+                data = fp.read(io.DEFAULT_BUFFER_SIZE)
+                if data == b'':
+                    break
+
+                md5_hasher.update(data)
+                sha1_hasher.update(data)
+                sha256_hasher.update(data)
+
+        md5 = md5_hasher.hexdigest()
+        sha1 = sha1_hasher.hexdigest()
+        sha256 = sha256_hasher.hexdigest()
+
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        # the blob can be removed by collect() between the two steps below so we try again if that happens
+        for attempt in range(3):
+            try:
+                # the first copy of the content becomes the blob
+                os.link(path, blob_path)
+                os.chmod(blob_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                logging.debug(f"added blob {sha256} from {path}")
+                break
+            except FileExistsError:
+                pass
+
+            if self._is_modified_blob(sha256):
+                # the existing blob was modified in place so this file replaces it
+                # (the storage directories that link to the old one keep what they have)
+                logging.warning(f"blob {sha256} was modified after it was stored")
+                try:
+                    os.remove(blob_path)
+                except FileNotFoundError:
+                    pass
+
+                continue
+
+            try:
+                # otherwise the file is replaced with a link to the existing blob
+                temp_path = f'{path}.{uuid.uuid4()}.blob'
+                os.link(blob_path, temp_path)
+                os.replace(temp_path, path)
+                logging.debug(f"replaced {path} with blob {sha256}")
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            return None
+
+        self._record(sha256, md5, sha1)
+        return md5, sha1, sha256
+
+    def link(self, source_path, target_path, move=False):
+        """Puts the content of source_path at target_path as a link to a blob.
+           If move is True then source_path is removed. Returns the (md5, sha1, sha256) of the content."""
+        hashes = self.get_hashes(source_path)
+        if hashes is not None:
+            # the source is already in the store
+            try:
+                os.link(self.blob_path(hashes[2]), target_path)
+                if move:
+                    os.remove(source_path)
+
+                return hashes
+            except FileNotFoundError:
+                pass
+
+        if move:
+            shutil.move(source_path, target_path)
+        else:
+            shutil.copy2(source_path, target_path)
+
+        return self.store(target_path)
+
+    def detach(self, path):
+        """Replaces the given file with a private (writable) copy of its content if it is a link to a blob.
+           Call this before modifying a stored file in place. Returns True if the file was a link to a blob."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        if st.st_nlink < 2 or not self.db.execute("SELECT 1 FROM blobs WHERE dev = ? AND ino = ?",
+                                                  (st.st_dev, st.st_ino)).fetchone():
+            return False
+
+        temp_path = f'{path}.{uuid.uuid4()}.detach'
+        try:
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            raise
+
+        logging.debug(f"detached {path} from the blob store")
+        return True
+
+    def release(self, sha256):
+        """Removes the blob with the given sha256 if it is no longer linked into any storage directory.
+           Returns True if the blob was removed."""
+        blob_path = self.blob_path(sha256)
+        try:
+            if os.stat(blob_path).st_nlink > 1:
+                return False
+
+            os.remove(blob_path)
+            logging.debug(f"removed blob {sha256}")
+        except FileNotFoundError:
+            pass
+
+        self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        return True
+
+    def collect(self):
+        """Removes all the blobs that are no longer linked into any storage directory.
+           Returns the number of blobs removed."""
+        count = 0
+        for sha256, in self.db.execute("SELECT sha256 FROM blobs").fetchall():
+            try:
+                if self.release(sha256):
+                    count += 1
+            except Exception as e:
+                logging.error(f"unable to release blob {sha256}: {e}")
+
+        logging.info(f"removed {count} unused blobs from {self.path}")
+        return count
+
+    def stats(self):
+        """Returns a dict with the number of blobs, the total size of the blobs and the number of links to them."""
+        result = { 'blobs': 0, 'size': 0, 'links': 0 }
+        for sha256, size in self.db.execute("SELECT sha256, size FROM blobs").fetchall():
+            try:
+                result['links'] += os.stat(self.blob_path(sha256)).st_nlink - 1
+            except OSError:
+                continue
+
+            result['blobs'] += 1
+            result['size'] += size
+
+        return result
+
+    def close(self):
+        if self._db is not None and self._db_pid == os.getpid():
+            self._db.close()
+
+        self._db = None
+
+# the BlobStore used by this process
+_blob_store = None
+
+def get_blob_store():
+    """Returns the BlobStore configured in the [blob_store] section, or None if it is not enabled."""
+    global _blob_store
+    if not saq.CONFIG['blob_store'].getboolean('enabled', fallback=False):
+        return None
+
+    if _blob_store is None:
+        _blob_store = BlobStore(os.path.join(saq.SAQ_HOME, saq.DATA_DIR, saq.CONFIG['blob_store']['path']),
+                                saq.CONFIG['blob_store'].getint('min_size', fallback=0))
+
+    return _blob_store
+
+def reset_blob_store():
+    """Closes the current BlobStore (if any) so that the next call to get_blob_store() creates a new one."""
+    global _blob_store
+    if _blob_store is not None:
+        _blob_store.close()
+
+    _blob_store = None
+
+def detach(path):
+    """Replaces the given file with a private (writable) copy if it is a link to a blob in the configured BlobStore.
+       Returns True if the file was detached."""
+    blob_store = get_blob_store()
+    if blob_store is None:
+        return False
+
+    return blob_store.detach(path)
@@ -175,7 +175,7 @@ def initialize_url_filter():
     global url_filter
     # initialize the crawlphish url filter
     url_filter = CrawlphishURLFilter()
-    # TODO schedule tasks to reload lists
+    # the lists are reloaded when they are modified (see CrawlphishURLFilter.check_modified)
     url_filter.load()
     logging.debug("url filter loaded")
 
@@ -270,7 +270,7 @@ def _get_cached_analysis(url, db, c):
         if os.path.exists(storage_dir):
             try:
                 root = RootAnalysis(storage_dir=storage_dir)
-                root.load()
+                root.load(lazy=True)
                 root_details = root.details
             except Exception as e:
                 # this isn't really an error -- another process may be in the middle of processing this url
@@ -424,6 +424,7 @@ def analyze_url(url, reprocess, ignore_filters, details):
         # we do not have analysis for this url yet
         # now we check to see if we will even analyze this url
         if not ignore_filters:
+            url_filter.check_modified()
             filtered_result = url_filter.filter(url)
             if filtered_result.filtered:
                 result = CloudphishAnalysisResult(RESULT_OK,
@@ -23,6 +23,7 @@ import uuid
 import ace_api
 
 import saq
+from saq.blobs import get_blob_store
 from saq.constants import *
 from saq.database import (
         use_db,
@@ -682,6 +683,18 @@ class Collector(ACEService, Persistable):
         # NOTE there is no wait if something was previously collected
         self.collection_frequency = collection_frequency
 
+        # the maximum number of submissions to insert into the incoming_workload table in a single transaction
+        # a value of 1 disables batching
+        self.submission_batch_size = self.service_config.getint('submission_batch_size', 
+                                     fallback=saq.CONFIG['collection'].getint('submission_batch_size', fallback=1))
+
+        # the maximum amount of time (in seconds) to spend collecting a batch of submissions
+        self.submission_batch_latency = self.service_config.getfloat('submission_batch_latency', 
+                                        fallback=saq.CONFIG['collection'].getfloat('submission_batch_latency', fallback=1.0))
+
+        # the value of innodb_autoinc_lock_mode of the collection database (loaded on first batch insert)
+        self.autoinc_lock_mode = None
+
         # this is used to filter out submissions according to yara rules
         # see README.SUBMISSION_FILTERS
         self.submission_filter = SubmissionFilter()
@@ -996,14 +1009,33 @@ LIMIT 100""", (self.workload_type_id,))
             if self.is_service_shutdown:
                 break
 
-    def execute(self):
-
+    def _get_next_submission(self):
         if self.test_mode == TEST_MODE_STARTUP:
-            next_submission = None
+            return None
         elif self.test_mode == TEST_MODE_SINGLE_SUBMISSION and self.submission_count > 0:
-            next_submission = None
+            return None
         else:
-            next_submission = self.get_next_submission()
+            return self.get_next_submission()
+
+    def _filter_submission(self, next_submission):
+        """Returns True if the given submission should be submitted, False if it was tuned out."""
+        if not isinstance(next_submission, Submission):
+            logging.critical("get_next_submission() must return an object derived from Submission")
+
+        # does this submission match any tuning rules we have?
+        tuning_matches = self.submission_filter.get_tuning_matches(next_submission)
+        if tuning_matches:
+            self.submission_filter.log_tuning_matches(next_submission, tuning_matches)
+            self.cleanup_submission(next_submission)
+            return False
+
+        return True
+
+    def execute(self):
+        if self.submission_batch_size > 1:
+            return self.execute_batch()
+
+        next_submission = self._get_next_submission()
 
         # did we not get anything to submit?
         if next_submission is None:
@@ -1014,20 +1046,58 @@ LIMIT 100""", (self.workload_type_id,))
             self.service_shutdown_event.wait(self.collection_frequency)
             return
 
-        if not isinstance(next_submission, Submission):
-            logging.critical("get_next_submission() must return an object derived from Submission")
-
-        # does this submission match any tuning rules we have?
-        tuning_matches = self.submission_filter.get_tuning_matches(next_submission)
-        if tuning_matches:
-            self.submission_filter.log_tuning_matches(next_submission, tuning_matches)
-            self.cleanup_submission(next_submission)
+        if not self._filter_submission(next_submission):
             return
 
         self.prepare_submission_files(next_submission)
         self.schedule_submission(next_submission)
         self.cleanup_submission(next_submission)
 
+    def execute_batch(self):
+        """Collects up to submission_batch_size submissions (waiting at most submission_batch_latency seconds) 
+           and schedules them in a single transaction."""
+        submissions = []
+        batch_end = time.time() + self.submission_batch_latency
+        while len(submissions) < self.submission_batch_size and time.time() < batch_end:
+            # in test mode single submission we only send one
+            if self.test_mode == TEST_MODE_SINGLE_SUBMISSION and submissions:
+                break
+
+            next_submission = self._get_next_submission()
+            if next_submission is None:
+                break
+
+            if not self._filter_submission(next_submission):
+                continue
+
+            self.prepare_submission_files(next_submission)
+            submissions.append(next_submission)
+
+        # did we not get anything to submit?
+        if not submissions:
+            if self.service_is_debug:
+                return
+
+            # wait until we check again (defaults to 1 second, passed in on constructor)
+            self.service_shutdown_event.wait(self.collection_frequency)
+            return
+
+        try:
+            self.schedule_submissions(submissions)
+        except Exception as e:
+            # fall back to scheduling them one at a time so that one bad submission does not drop the others
+            logging.error(f"unable to schedule batch of {len(submissions)} submissions: {e}")
+            report_exception()
+            for submission in submissions:
+                try:
+                    self.schedule_submission(submission)
+                except Exception as e:
+                    logging.error(f"unable to schedule {submission.description}: {e}")
+                    report_exception()
+
+        for submission in submissions:
+            self.cleanup_submission(submission)
+
     def prepare_submission_files(self, submission):
         if not submission.files:
             return
@@ -1042,6 +1112,7 @@ LIMIT 100""", (self.workload_type_id,))
 
             # move or copy the files into the storage directory of the submission
             # then update the file list with the new paths
+            blob_store = get_blob_store()
             updated_files = []
             for file_submission in submission.files:
                 # this could be a tuple of (source_file, target_name)
@@ -1052,7 +1123,10 @@ LIMIT 100""", (self.workload_type_id,))
 
                 target_path = os.path.join(submission.storage_dir, os.path.basename(source_path))
                 if source_path != target_path:
-                    if self.delete_files:
+                    if blob_store is not None:
+                        blob_store.link(source_path, target_path, move=self.delete_files)
+                        logging.debug(f"linked file from {source_path} to {target_path}")
+                    elif self.delete_files:
                         shutil.move(source_path, target_path)
                         logging.debug(f"moved file from {source_path} to {target_path}")
                     else:
@@ -1095,6 +1169,30 @@ LIMIT 100""", (self.workload_type_id,))
         # if we are deleting files we add then we would have moved the file instead of copying it
         pass 
 
+    @use_db(name='collection')
+    def schedule_submissions(self, submissions, db, c):
+        """Schedules the given list of submissions in a single transaction."""
+        work_ids = execute_with_retry(db, c, self.insert_workload_batch, (submissions,), commit=True)
+        for submission, work_id in zip(submissions, work_ids):
+            logging.info(f"scheduled {submission.description} mode {submission.analysis_mode} work_id {work_id}")
+
+        self.submission_count += len(submissions)
+
+    def get_node_groups(self, submission):
+        """Returns the list of RemoteNodeGroup objects the given submission should be sent to."""
+        node_groups = self.remote_node_groups
+        
+        # does this submission have a defined set to groups to send to?
+        if submission.group_assignments:
+            node_groups = [ng for ng in node_groups if ng.name in submission.group_assignments]
+
+            if not node_groups:
+                # default to all groups if we end up with an empty list
+                logging.error(f"group assignment {submission.group_assignments} does not map to any known groups")
+                node_groups = self.remote_node_groups
+
+        return node_groups
+
     def insert_workload(self, db, c, next_submission):
         c.execute("INSERT INTO incoming_workload ( type_id, mode, work ) VALUES ( %s, %s, %s )",
                  (self.workload_type_id, next_submission.analysis_mode, pickle.dumps(next_submission)))
@@ -1105,23 +1203,54 @@ LIMIT 100""", (self.workload_type_id,))
         work_id = c.lastrowid
 
         # assign this work to each configured group
-        node_groups = self.remote_node_groups
-        
-        # does this submission have a defined set to groups to send to?
-        if next_submission.group_assignments:
-            node_groups = [ng for ng in node_groups if ng.name in next_submission.group_assignments]
-
-            if not node_groups:
-                # default to all groups if we end up with an empty list
-                logging.error(f"group assignment {next_submission.group_assignments} does not map to any known groups")
-                node_groups = self.remote_node_groups
-            
-        for remote_node_group in node_groups:
+        for remote_node_group in self.get_node_groups(next_submission):
             c.execute("INSERT INTO work_distribution ( work_id, group_id ) VALUES ( %s, %s )",
                      (work_id, remote_node_group.group_id))
 
         return work_id
 
+    def insert_workload_batch(self, db, c, submissions):
+        """Inserts the given submissions using multi-row INSERT statements. Returns the list of work ids."""
+        if self.autoinc_lock_mode is None:
+            c.execute("SELECT @@innodb_autoinc_lock_mode")
+            self.autoinc_lock_mode = int(c.fetchone()[0])
+
+        # a multi-row INSERT is only guaranteed to get consecutive ids when the lock mode is 0 (traditional) or 1 (consecutive)
+        if self.autoinc_lock_mode in [ 0, 1 ]:
+            parameters = []
+            for submission in submissions:
+                parameters.extend([self.workload_type_id, submission.analysis_mode, pickle.dumps(submission)])
+
+            c.execute("INSERT INTO incoming_workload ( type_id, mode, work ) VALUES {}".format(
+                      ','.join(['(%s, %s, %s)' for _ in submissions])), tuple(parameters))
+
+            if c.lastrowid is None:
+                raise RuntimeError("missing lastrowid for INSERT transaction")
+
+            # for a multi-row INSERT lastrowid is the id of the first row
+            work_ids = [ c.lastrowid + index for index in range(len(submissions)) ]
+        else:
+            work_ids = []
+            for submission in submissions:
+                c.execute("INSERT INTO incoming_workload ( type_id, mode, work ) VALUES ( %s, %s, %s )",
+                         (self.workload_type_id, submission.analysis_mode, pickle.dumps(submission)))
+
+                if c.lastrowid is None:
+                    raise RuntimeError("missing lastrowid for INSERT transaction")
+
+                work_ids.append(c.lastrowid)
+
+        parameters = []
+        for submission, work_id in zip(submissions, work_ids):
+            for remote_node_group in self.get_node_groups(submission):
+                parameters.extend([work_id, remote_node_group.group_id])
+
+        if parameters:
+            c.execute("INSERT INTO work_distribution ( work_id, group_id ) VALUES {}".format(
+                      ','.join(['(%s, %s)' for _ in range(len(parameters) // 2)])), tuple(parameters))
+
+        return work_ids
+
     # subclasses can override this function to provide additional functionality
     def extended_collection(self):
         self.execute_in_loop(self.execute_extended_collection)
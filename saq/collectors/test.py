@@ -187,6 +187,81 @@ class TestCase(CollectorBaseTestCase):
         collector.stop()
         collector.wait()
 
+    @use_db
+    def test_work_item_batch(self, db, c):
+        saq.CONFIG['service_test_collector']['submission_batch_size'] = '10'
+
+        class _custom_collector(TestCollector):
+            def __init__(_self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                _self.available_work = [self.create_submission() for _ in range(5)]
+
+            def get_next_submission(_self):
+                if not _self.available_work:
+                    return None
+
+                return _self.available_work.pop()
+
+        collector = _custom_collector()
+        self.assertEquals(collector.submission_batch_size, 10)
+        collector.add_group('test_group_1', 100, True, saq.COMPANY_ID, 'ace')
+        collector.add_group('test_group_2', 100, True, saq.COMPANY_ID, 'ace')
+        collector.execute()
+
+        self.assertEquals(collector.submission_count, 5)
+
+        # all five were inserted with two assignments each
+        c.execute("SELECT id FROM incoming_workload ORDER BY id")
+        work_ids = [row[0] for row in c.fetchall()]
+        self.assertEquals(len(work_ids), 5)
+
+        c.execute("SELECT work_id, COUNT(*) FROM work_distribution GROUP BY work_id ORDER BY work_id")
+        assignments = c.fetchall()
+        self.assertEquals([row[0] for row in assignments], work_ids)
+        for work_id, count in assignments:
+            self.assertEquals(count, 2)
+
+    @use_db
+    def test_work_item_batch_failure(self, db, c):
+        saq.CONFIG['service_test_collector']['submission_batch_size'] = '10'
+
+        class _custom_collector(TestCollector):
+            def __init__(_self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                _self.available_work = [self.create_submission() for _ in range(5)]
+                _self.available_work[2].description = 'bad_submission'
+                _self.cleaned_up = []
+
+            def get_next_submission(_self):
+                if not _self.available_work:
+                    return None
+
+                return _self.available_work.pop()
+
+            def insert_workload(_self, db, c, next_submission):
+                if next_submission.description == 'bad_submission':
+                    raise RuntimeError("bad submission")
+
+                return super().insert_workload(db, c, next_submission)
+
+            def insert_workload_batch(_self, db, c, submissions):
+                raise RuntimeError("bad batch")
+
+            def cleanup_submission(_self, submission):
+                _self.cleaned_up.append(submission)
+
+        collector = _custom_collector()
+        collector.add_group('test_group_1', 100, True, saq.COMPANY_ID, 'ace')
+        collector.execute()
+
+        # the other four are scheduled one at a time
+        self.assertEquals(collector.submission_count, 4)
+        c.execute("SELECT COUNT(*) FROM incoming_workload")
+        self.assertEquals(c.fetchone()[0], 4)
+
+        # and all five are cleaned up
+        self.assertEquals(len(collector.cleaned_up), 5)
+
     @use_db
     def test_submit(self, db, c):
 
@@ -564,6 +564,7 @@ QUEUE_DEFAULT = 'default'
 REDIS_DB_SNORT = 1
 REDIS_DB_TIP_A = 2
 REDIS_DB_TIP_B = 3
+REDIS_DB_ANALYSIS_CACHE = 4
 
 EVENT_TYPE_DEFAULT = 'phish'
 EVENT_VECTOR_DEFAULT = 'corporate email'
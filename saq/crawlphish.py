@@ -5,13 +5,15 @@ import sqlite3
 import logging
 import os.path
 import re
+import time
 from ipaddress import IPv4Network, IPv4Address
 from urllib.parse import urlparse, ParseResult, urlunparse
 
 import saq
 from saq.brocess import query_brocess_by_fqdn, add_httplog
 from saq.error import report_exception
-from saq.util import is_ipv4, is_subdomain, iterate_fqdn_parts, add_netmask
+from saq.util import is_ipv4, iterate_fqdn_parts, add_netmask
+from saq.util.matcher import DomainMatcher, NetworkMatcher
 
 analysis_module = 'analysis_module_crawlphish'
 
@@ -76,11 +78,15 @@ class FilterResult(object):
 class CrawlphishURLFilter(object):
 
     def __init__(self):
-        self.blacklisted_cidr = []
-        self.blacklisted_fqdn = []
-        self.whitelisted_cidr = []
-        self.whitelisted_fqdn = []
+        self.blacklisted_cidr = NetworkMatcher()
+        self.blacklisted_fqdn = DomainMatcher()
+        self.whitelisted_cidr = NetworkMatcher()
+        self.whitelisted_fqdn = DomainMatcher()
         self.path_regexes = []
+        # key = path, value = mtime of the file when it was last loaded
+        self.mtimes = {}
+        # the next time check_modified looks at the files
+        self.next_modified_check = None
 
     #def __init__(self):
         #self.reason = REASON_UNKNOWN
@@ -91,6 +97,32 @@ class CrawlphishURLFilter(object):
         self.load_blacklist()
         self.load_path_regexes()
 
+    def _record_mtime(self, path):
+        try:
+            self.mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            self.mtimes.pop(path, None)
+
+    def check_modified(self):
+        """Reloads any of the whitelist, blacklist or path regex files that have been modified since they were loaded.
+           The files are checked at most every check_watched_files_frequency seconds."""
+        now = time.time()
+        if self.next_modified_check is not None and now < self.next_modified_check:
+            return
+
+        self.next_modified_check = now + saq.CONFIG['global'].getint('check_watched_files_frequency', fallback=5)
+        for path, load_function in [ (self.whitelist_path, self.load_whitelist),
+                                     (self.blacklist_path, self.load_blacklist),
+                                     (self.regex_path, self.load_path_regexes) ]:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+
+            if self.mtimes.get(path) != mtime:
+                logging.info(f"{path} modified - reloading")
+                load_function()
+
     @property
     def whitelist_path(self):
         path = saq.CONFIG[analysis_module]['whitelist_path']
@@ -125,6 +157,7 @@ class CrawlphishURLFilter(object):
             return
 
         try:
+            self._record_mtime(self.whitelist_path)
             with open(self.whitelist_path, 'r') as fp:
                 for line in fp:
                     line = line.strip()
@@ -138,12 +171,12 @@ class CrawlphishURLFilter(object):
                         continue
 
                     if is_ipv4(line):
-                        whitelisted_cidr.append(IPv4Network(add_netmask(line)))
+                        whitelisted_cidr.append(str(IPv4Network(add_netmask(line), strict=False)))
                     else:
                         whitelisted_fqdn.append(line)
 
-            self.whitelisted_cidr = whitelisted_cidr
-            self.whitelisted_fqdn = whitelisted_fqdn
+            self.whitelisted_cidr = NetworkMatcher(whitelisted_cidr)
+            self.whitelisted_fqdn = DomainMatcher(whitelisted_fqdn)
             logging.debug("loaded {} cidr {} fqdn whitelisted items".format(
                            len(self.whitelisted_cidr),
                            len(self.whitelisted_fqdn)))
@@ -154,17 +187,17 @@ class CrawlphishURLFilter(object):
 
     def is_whitelisted(self, value):
         if is_ipv4(value):
-            for cidr in self.whitelisted_cidr:
-                if IPv4Address(value) in cidr:
-                    logging.debug("{} matches whitelisted cidr {}".format(value, cidr))
-                    return True
+            cidr = self.whitelisted_cidr.match(value)
+            if cidr is not None:
+                logging.debug("{} matches whitelisted cidr {}".format(value, cidr))
+                return True
 
             return False
 
-        for dst in self.whitelisted_fqdn:
-            if is_subdomain(value, dst):
-                logging.debug("{} matches whitelisted fqdn {}".format(value, dst))
-                return True
+        dst = self.whitelisted_fqdn.match(value)
+        if dst is not None:
+            logging.debug("{} matches whitelisted fqdn {}".format(value, dst))
+            return True
 
         return False
 
@@ -178,6 +211,7 @@ class CrawlphishURLFilter(object):
             return
 
         try:
+            self._record_mtime(self.blacklist_path)
             with open(self.blacklist_path, 'r') as fp:
                 for line in fp:
                     line = line.strip()
@@ -191,12 +225,12 @@ class CrawlphishURLFilter(object):
                         continue
 
                     if is_ipv4(line):
-                        blacklisted_cidr.append(IPv4Network(add_netmask(line)))
+                        blacklisted_cidr.append(str(IPv4Network(add_netmask(line), strict=False)))
                     else:
                         blacklisted_fqdn.append(line)
 
-            self.blacklisted_cidr = blacklisted_cidr
-            self.blacklisted_fqdn = blacklisted_fqdn
+            self.blacklisted_cidr = NetworkMatcher(blacklisted_cidr)
+            self.blacklisted_fqdn = DomainMatcher(blacklisted_fqdn)
             logging.debug("loaded {} cidr {} fqdn blacklisted items".format(
                            len(self.blacklisted_cidr),
                            len(self.blacklisted_fqdn)))
@@ -214,6 +248,7 @@ class CrawlphishURLFilter(object):
             return
 
         try:
+            self._record_mtime(self.regex_path)
             with open(self.regex_path, 'r') as fp:
                 for line in fp:
                     line = line.strip()
@@ -241,21 +276,17 @@ class CrawlphishURLFilter(object):
 
     def is_blacklisted(self, value):
         if is_ipv4(value):
-            for cidr in self.blacklisted_cidr:
-                try:
-                    if IPv4Address(value) in cidr:
-                        logging.debug("{} matches blacklisted cidr {}".format(value, cidr))
-                        return True
-                except Exception as e:
-                    logging.error("failed to compare {} to {}: {}".format(value, cidr, e))
-                    report_exception()
+            cidr = self.blacklisted_cidr.match(value)
+            if cidr is not None:
+                logging.debug("{} matches blacklisted cidr {}".format(value, cidr))
+                return True
 
             return False
 
-        for dst in self.blacklisted_fqdn:
-            if is_subdomain(value, dst):
-                logging.debug("{} matches blacklisted fqdn {}".format(value, dst))
-                return True
+        dst = self.blacklisted_fqdn.match(value)
+        if dst is not None:
+            logging.debug("{} matches blacklisted fqdn {}".format(value, dst))
+            return True
 
         return False
 
@@ -3,12 +3,15 @@
 # cryptography functions used by ACE
 #
 
+import gzip
 import io
 import logging
 import os.path
 import random
+import shutil
 import socket
 import struct
+import sys
 
 from typing import Optional, Union
 
@@ -24,6 +27,16 @@ from saq.util import create_directory
 
 CHUNK_SIZE = 64 * 1024
 
+# the compression that can be layered under the encryption of a stream (see open_encrypted)
+COMPRESSION_NONE = 'none'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 CONFIG_KEY_ENCRYPTION_KEY = 'encryption-key'
 CONFIG_KEY_ENCRYPTION_SALT = 'encryption-salt'
 CONFIG_KEY_ENCRYPTION_VERIFICATION = 'encryption-verification'
@@ -169,24 +182,9 @@ def encrypt(source_path, target_path, password=None):
        If password is None then saq.ENCRYPTION_PASSWORD is used instead.
        password must be a byte string 32 bytes in length."""
 
-    password = _get_password(password)
-    iv = Crypto.Random.OSRNG.posix.new().read(AES.block_size)
-    encryptor = AES.new(password, AES.MODE_CBC, iv)
-    file_size = os.path.getsize(source_path)
-
     with open(source_path, 'rb') as fp_in:
-        with open(target_path, 'wb') as fp_out:
-            fp_out.write(struct.pack('<Q', file_size))
-            fp_out.write(iv)
-
-            while True:
-                chunk = fp_in.read(CHUNK_SIZE)
-                if len(chunk) == 0:
-                    break
-                elif len(chunk) % 16 != 0:
-                    chunk += b' ' * (16 - len(chunk) % 16)
-
-                fp_out.write(encryptor.encrypt(chunk))
+        with open_encrypted(target_path, 'wb', password=password) as fp_out:
+            shutil.copyfileobj(fp_in, fp_out, CHUNK_SIZE)
 
 def encrypt_chunk(chunk, password=None):
     """Encrypts the given chunk of data and returns the encrypted chunk.
@@ -211,21 +209,14 @@ def decrypt(source_path, target_path=None, password=None):
        If password is None then saq.ENCRYPTION_PASSWORD is used instead.
        password must be a byte string 32 bytes in length."""
 
-    password = _get_password(password)
-    with open(source_path, 'rb') as fp_in:
-        original_size = struct.unpack('<Q', fp_in.read(struct.calcsize('Q')))[0]
-        iv = fp_in.read(16)
-        decryptor = AES.new(password, AES.MODE_CBC, iv)
+    with open_encrypted(source_path, 'rb', password=password) as fp_in:
+        if target_path is None:
+            shutil.copyfileobj(fp_in, sys.stdout.buffer, CHUNK_SIZE)
+            sys.stdout.buffer.flush()
+            return
 
         with open(target_path, 'wb') as fp_out:
-            while True:
-                chunk = fp_in.read(CHUNK_SIZE)
-                if len(chunk) == 0:
-                    break
-
-                fp_out.write(decryptor.decrypt(chunk))
-
-            fp_out.truncate(original_size)
+            shutil.copyfileobj(fp_in, fp_out, CHUNK_SIZE)
 
 def decrypt_chunk(chunk, password=None):
     """Decrypts the given encrypted chunk with the given password and returns the decrypted chunk.
@@ -245,6 +236,204 @@ def decrypt_chunk(chunk, password=None):
     result = decryptor.decrypt(chunk)
     return result[:original_size]
 
+#
+# streaming encryption
+#
+# the encrypted format is the same as the one produced by encrypt()
+# 8 byte little endian size of the original data, 16 byte IV, then the data encrypted with AES CBC
+# with the final block padded with spaces
+#
+# the size is not known until the stream is closed so the writer needs a seekable output to fill it in
+#
+
+class EncryptedWriter(io.RawIOBase):
+    """A write-only file object that encrypts everything written to it into the given (seekable) binary file object.
+       The size of the original data is written into the header when the stream is closed.
+       If closefd is True then the given file object is closed when this stream is closed."""
+    def __init__(self, fp, password=None, closefd=True):
+        super().__init__()
+        self.fp = fp
+        self.closefd = closefd
+        iv = Crypto.Random.OSRNG.posix.new().read(AES.block_size)
+        self.encryptor = AES.new(_get_password(password), AES.MODE_CBC, iv)
+        # the size is filled in when the stream is closed
+        self.header_offset = fp.tell()
+        self.fp.write(struct.pack('<Q', 0))
+        self.fp.write(iv)
+        # the number of bytes written so far
+        self.size = 0
+        # data waiting for a full block
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        length = len(memoryview(data).cast('B'))
+        self.size += length
+
+        if len(self.buffer) >= CHUNK_SIZE:
+            # only full blocks can be encrypted until the end of the stream
+            block_length = len(self.buffer) - (len(self.buffer) % AES.block_size)
+            self.fp.write(self.encryptor.encrypt(bytes(self.buffer[:block_length])))
+            del self.buffer[:block_length]
+
+        return length
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if len(self.buffer) % AES.block_size != 0:
+                self.buffer += b' ' * (AES.block_size - len(self.buffer) % AES.block_size)
+
+            if self.buffer:
+                self.fp.write(self.encryptor.encrypt(bytes(self.buffer)))
+                self.buffer = bytearray()
+
+            end_offset = self.fp.tell()
+            self.fp.seek(self.header_offset)
+            self.fp.write(struct.pack('<Q', self.size))
+            self.fp.seek(end_offset)
+            self.fp.flush()
+        finally:
+            try:
+                if self.closefd:
+                    self.fp.close()
+            finally:
+                super().close()
+
+class EncryptedReader(io.RawIOBase):
+    """A read-only file object that decrypts the data of the given binary file object as it is read.
+       If closefd is True then the given file object is closed when this stream is closed."""
+    def __init__(self, fp, password=None, closefd=True):
+        super().__init__()
+        self.fp = fp
+        self.closefd = closefd
+        header = fp.read(struct.calcsize('<Q') + AES.block_size)
+        if len(header) != struct.calcsize('<Q') + AES.block_size:
+            raise ValueError("missing encryption header")
+
+        # the number of bytes of the original data not read yet
+        self.remaining = struct.unpack('<Q', header[:struct.calcsize('<Q')])[0]
+        self.decryptor = AES.new(_get_password(password), AES.MODE_CBC, header[struct.calcsize('<Q'):])
+        # encrypted data waiting for a full block
+        self.pending = b''
+        # decrypted data not read yet
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def _fill_buffer(self):
+        while not self.buffer and self.remaining > 0:
+            chunk = self.fp.read(CHUNK_SIZE)
+            if not chunk:
+                raise EOFError("encrypted stream ended before the end of the data")
+
+            data = self.pending + chunk
+            block_length = len(data) - (len(data) % AES.block_size)
+            self.pending = data[block_length:]
+            # anything past the original size is padding
+            self.buffer = self.decryptor.decrypt(data[:block_length])[:self.remaining]
+            self.remaining -= len(self.buffer)
+
+    def readinto(self, b):
+        self._fill_buffer()
+        length = min(len(b), len(self.buffer))
+        b[:length] = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        return length
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self.closefd:
+                self.fp.close()
+        finally:
+            super().close()
+
+class _StreamChain(object):
+    """Wraps the outermost of a chain of layered streams so that closing it closes every stream in the chain."""
+    def __init__(self, streams):
+        # the outermost stream is first
+        self.streams = streams
+
+    def __getattr__(self, name):
+        return getattr(self.streams[0], name)
+
+    def __iter__(self):
+        return iter(self.streams[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # everything in the chain is closed even if one of the streams fails to close
+        error = None
+        for stream in self.streams:
+            try:
+                stream.close()
+            except Exception as e:
+                if error is None:
+                    error = e
+
+        if error is not None:
+            raise error
+
+def open_encrypted(target, mode='rb', password=None, compression=COMPRESSION_NONE):
+    """Opens an encrypted stream for reading (mode rb) or writing (mode wb).
+       target is either a path or a binary file object (which is closed when the stream is closed.)
+       When writing to a file object it must be seekable.
+       compression is one of COMPRESSION_NONE (or None), COMPRESSION_GZIP or COMPRESSION_ZSTD
+       and is applied before encryption (and removed after decryption.)
+       If password is None then saq.ENCRYPTION_PASSWORD is used instead.
+       Data is processed in CHUNK_SIZE pieces so memory usage does not depend on the size of the stream."""
+
+    if mode not in [ 'rb', 'wb' ]:
+        raise ValueError(f"invalid mode {mode}")
+
+    if compression is None:
+        compression = COMPRESSION_NONE
+
+    if compression not in [ COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_ZSTD ]:
+        raise ValueError(f"invalid compression {compression}")
+
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard library")
+
+    fp = open(target, mode) if isinstance(target, (str, os.PathLike)) else target
+
+    try:
+        if mode == 'wb':
+            encrypted = EncryptedWriter(fp, password=password)
+            if compression == COMPRESSION_GZIP:
+                return _StreamChain([gzip.GzipFile(fileobj=encrypted, mode='wb'), encrypted])
+            elif compression == COMPRESSION_ZSTD:
+                return _StreamChain([zstandard.ZstdCompressor().stream_writer(encrypted), encrypted])
+
+            return _StreamChain([encrypted])
+
+        encrypted = io.BufferedReader(EncryptedReader(fp, password=password), buffer_size=CHUNK_SIZE)
+        if compression == COMPRESSION_GZIP:
+            return _StreamChain([gzip.GzipFile(fileobj=encrypted, mode='rb'), encrypted])
+        elif compression == COMPRESSION_ZSTD:
+            return _StreamChain([zstandard.ZstdDecompressor().stream_reader(encrypted), encrypted])
+
+        return _StreamChain([encrypted])
+
+    except Exception:
+        fp.close()
+        raise
+
+
 class EncryptionCacheService(ACEService):
     def __init__(self, *args, **kwargs):
         if saq.ENCRYPTION_PASSWORD_PLAINTEXT is None:
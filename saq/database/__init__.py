@@ -1,6 +1,7 @@
 import collections
 import datetime
 import functools
+import hashlib
 import logging
 import os
 import shutil
@@ -25,6 +26,7 @@ from saq.analysis import RootAnalysis, Indicator, IndicatorList
 from saq.constants import *
 from saq.error import report_exception
 from saq.performance import track_execution_time
+from saq.similarity import minhash_signature, pack_signature, unpack_signature, lsh_bands, estimate_similarity
 from saq.util import abs_path, validate_uuid, create_timedelta, find_all_url_domains
 from sqlalchemy.orm import aliased, class_mapper
 from sqlalchemy.orm.collections import attribute_mapped_collection
@@ -924,6 +926,72 @@ class SiteHolidays(Holidays):
         return super(SiteHolidays, self)._day_rule_matches(rule, dt)
 
 
+# tuple of (settings, hash) of the last SLA configuration hashed (see get_sla_config_hash)
+_sla_config_hash = None
+
+def get_sla_config_hash():
+    """Returns a hash of the SLA configuration. Alerts store this value with their precomputed SLA dates
+       so that the dates can be recomputed when the configuration changes."""
+    global _sla_config_hash
+
+    # the settings are replaced (not modified) when the configuration is loaded
+    settings = (saq.CONFIG, saq.GLOBAL_SLA_SETTINGS, saq.OTHER_SLA_SETTINGS, saq.EXCLUDED_SLA_ALERT_TYPES)
+    cached = _sla_config_hash
+    if cached is not None and all([a is b for a, b in zip(settings, cached[0])]):
+        return cached[1]
+
+    h = hashlib.md5()
+    h.update(repr(saq.GLOBAL_SLA_SETTINGS).encode())
+    for sla in saq.OTHER_SLA_SETTINGS:
+        h.update(repr(sla).encode())
+
+    h.update(repr(sorted(saq.EXCLUDED_SLA_ALERT_TYPES)).encode())
+    h.update(saq.CONFIG['SLA']['business_hours'].encode())
+    h.update(saq.CONFIG['SLA']['time_zone'].encode())
+    _sla_config_hash = (settings, h.hexdigest())
+    return _sla_config_hash[1]
+
+def _sla_property_set(target, value, oldvalue, initiator):
+    if value != oldvalue:
+        target.clear_sla()
+
+def listen_for_sla_property_changes():
+    """Clears the SLA of an Alert when a column that selects the SLA (the property of an [SLA_*] section) changes.
+       This is called when the configuration is loaded."""
+    for sla in saq.OTHER_SLA_SETTINGS:
+        if sla._property not in class_mapper(Alert).column_attrs:
+            continue
+
+        attribute = getattr(Alert, sla._property)
+        if not event.contains(attribute, 'set', _sla_property_set):
+            event.listen(attribute, 'set', _sla_property_set, propagate=True)
+
+def update_sla_dates(all_alerts=False, batch_size=1000):
+    """Computes the SLA dates of the open alerts that were computed with a different SLA configuration
+       (or never computed.) If all_alerts is True then the dates of all open alerts are recomputed.
+       Returns the number of alerts updated."""
+    sla_config = get_sla_config_hash()
+    count = 0
+    last_id = 0
+    while True:
+        query = saq.db.query(Alert).filter(Alert.disposition == None, Alert.id > last_id)
+        if not all_alerts:
+            query = query.filter(or_(Alert.sla_config == None, Alert.sla_config != sla_config))
+
+        alerts = query.order_by(Alert.id).limit(batch_size).all()
+        if not alerts:
+            break
+
+        for alert in alerts:
+            if alert.update_sla_dates():
+                count += 1
+
+        saq.db.commit()
+        last_id = alerts[-1].id
+
+    logging.info(f"updated the sla dates of {count} alerts")
+    return count
+
 class Alert(RootAnalysis, Base):
 
     def _initialize(self):
@@ -1180,6 +1248,72 @@ class Alert(RootAnalysis, Base):
         return ((self.business_time.days * hours_per_day * 60 * 60) + 
                 (self.business_time.seconds))
 
+    def _business_time_deadline(self, start, seconds):
+        """Returns the datetime at which the business time elapsed since start reaches the given number of seconds.
+           This is the inverse of the BusinessTime.businesstimedelta calculation used by business_time.
+           Both start and the returned value are naive datetimes in the SLA time zone."""
+        remaining = datetime.timedelta(seconds=seconds)
+        if remaining <= datetime.timedelta():
+            return start
+
+        current = start
+        while True:
+            open_time = datetime.datetime.combine(current.date(), datetime.time(self._start_hour))
+            close_time = datetime.datetime.combine(current.date(), datetime.time(self._end_hour))
+            if self._bt.isbusinessday(current) and current < close_time:
+                current = max(current, open_time)
+                if remaining <= close_time - current:
+                    return current + remaining
+
+                remaining -= close_time - current
+
+            current = datetime.datetime.combine(current.date() + datetime.timedelta(days=1), datetime.time(self._start_hour))
+
+    def compute_sla_dates(self):
+        """Returns a tuple of (approaching_date, over_date) for this alert, or (None, None) if SLA does not apply.
+           The dates are naive datetimes in the same (local) time zone as insert_date."""
+        if self.insert_date is None or self.sla is None:
+            return None, None
+
+        if not self.sla.enabled or self.alert_type in saq.EXCLUDED_SLA_ALERT_TYPES:
+            return None, None
+
+        def _from_sla_time_zone(dt):
+            return self._bh_tz.localize(dt).astimezone().replace(tzinfo=None)
+
+        start = self._datetime_to_sla_time_zone(dt=self.insert_date)
+        return (_from_sla_time_zone(self._business_time_deadline(start, (self.sla.timeout - self.sla.warning) * 60 * 60)),
+                _from_sla_time_zone(self._business_time_deadline(start, self.sla.timeout * 60 * 60)))
+
+    def update_sla_dates(self):
+        """Updates the sla_approaching_date, sla_over_date and sla_config columns of this alert.
+           Returns True if any of the values changed. The caller is responsible for committing the change."""
+        approaching_date, over_date = self.compute_sla_dates()
+        sla_config = get_sla_config_hash()
+        if (self.sla_approaching_date == approaching_date 
+            and self.sla_over_date == over_date 
+            and self.sla_config == sla_config):
+            return False
+
+        self.sla_approaching_date = approaching_date
+        self.sla_over_date = over_date
+        self.sla_config = sla_config
+        return True
+
+    def clear_sla(self):
+        """Clears the SLA of this alert and the SLA dates computed from it.
+           This is called when a property that selects the SLA changes. The dates are computed again by update_sla_dates."""
+        for name in [ '_sla_settings', '_is_approaching_sla', '_is_over_sla' ]:
+            if hasattr(self, name):
+                delattr(self, name)
+
+        self.sla_config = None
+
+    @property
+    def has_current_sla_dates(self):
+        """Returns True if the SLA dates stored for this alert were computed with the current SLA configuration."""
+        return self.sla_config is not None and self.sla_config == get_sla_config_hash()
+
     @property
     def is_approaching_sla(self):
         """Returns True if this Alert is approaching SLA and has not been dispositioned yet."""
@@ -1189,6 +1323,14 @@ class Alert(RootAnalysis, Base):
         if self.insert_date is None:
             return None
 
+        # use the precomputed deadline if we have one
+        if self.has_current_sla_dates:
+            result = (self.disposition is None 
+                      and self.sla_approaching_date is not None 
+                      and datetime.datetime.now() >= self.sla_approaching_date)
+            setattr(self, '_is_approaching_sla', result)
+            return result
+
         if self.sla is None:
             logging.warning("cannot get SLA for {}".format(self))
             return None
@@ -1209,6 +1351,14 @@ class Alert(RootAnalysis, Base):
         if self.insert_date is None:
             return None
 
+        # use the precomputed deadline if we have one
+        if self.has_current_sla_dates:
+            result = (self.disposition is None 
+                      and self.sla_over_date is not None 
+                      and datetime.datetime.now() >= self.sla_over_date)
+            setattr(self, '_is_over_sla', result)
+            return result
+
         if self.sla is None:
             logging.warning("cannot get SLA for {}".format(self))
             return None
@@ -1297,6 +1447,22 @@ class Alert(RootAnalysis, Base):
         nullable=False,
         default=saq.constants.QUEUE_DEFAULT)
 
+    # the time (in the same time zone as insert_date) at which this alert is approaching SLA
+    # NULL if SLA does not apply to this alert
+    sla_approaching_date = Column(
+        TIMESTAMP,
+        nullable=True)
+
+    # the time (in the same time zone as insert_date) at which this alert is over SLA
+    sla_over_date = Column(
+        TIMESTAMP,
+        nullable=True)
+
+    # the hash of the SLA configuration used to compute the SLA dates (see get_sla_config_hash)
+    sla_config = Column(
+        String(32),
+        nullable=True)
+
     disposition_user_id = Column(
         Integer,
         ForeignKey('users.id'),
@@ -1575,6 +1741,11 @@ class Alert(RootAnalysis, Base):
         
         session.add(self)
         session.commit()
+
+        # the SLA dates are computed from the insert_date which is assigned by the database
+        if self.update_sla_dates():
+            session.commit()
+
         self.build_index()
 
         self.save() # save this alert now that it has the id
@@ -1647,104 +1818,35 @@ class Alert(RootAnalysis, Base):
 
     def rebuild_index(self):
         """Rebuilds the data for this Alert in the observables, tags, observable_mapping and tag_mapping tables."""
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            with get_db_connection() as db:
-                c = db.cursor()
-                execute_with_retry(db, c, self._rebuild_index)
+        rebuild_indexes([self])
 
     def _rebuild_index(self, db, c):
-        logging.info(f"rebuilding indexes for {self}")
-        c.execute("""DELETE FROM observable_mapping WHERE alert_id = %s""", ( self.id, ))
-        c.execute("""DELETE FROM tag_mapping WHERE alert_id = %s""", ( self.id, ))
-        c.execute("""DELETE FROM observable_tag_index WHERE alert_id = %s""", ( self.id, ))
-
-        tag_names = tuple([ tag.name for tag in self.all_tags ])
-        if tag_names:
-            sql = "INSERT IGNORE INTO tags ( name ) VALUES {}".format(','.join(['(%s)' for name in tag_names]))
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, tag_names)
-
-        all_observables = self.all_observables
-
-        observables = []
-        observable_hash_mapping = {} # key = md5, value = observable
-        for observable in all_observables:
-            observables.append(observable.type)
-            observables.append(observable.value)
-            observables.append(observable.md5_hex)
-            observable_hash_mapping[observable.md5_hex] = observable
-
-        observables = tuple(observables)
-
-        if all_observables:
-            sql = "INSERT IGNORE INTO observables ( type, value, md5 ) VALUES {}".format(','.join('(%s, %s, UNHEX(%s))' for o in all_observables))
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, observables)
-
-        tag_mapping = {} # key = tag_name, value = tag_id
-        if tag_names:
-            sql = "SELECT id, name FROM tags WHERE name IN ( {} )".format(','.join(['%s' for name in tag_names]))
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, tag_names)
-
-            for row in c:
-                tag_id, tag_name = row
-                tag_mapping[tag_name] = tag_id
-
-            sql = "INSERT INTO tag_mapping ( alert_id, tag_id ) VALUES {}".format(','.join(['(%s, %s)' for name in tag_mapping.values()]))
-            #logging.debug(f"MARKER: sql = {sql}")
-            parameters = []
-            for tag_id in tag_mapping.values():
-                parameters.append(self.id)
-                parameters.append(tag_id)
+        _rebuild_indexes(db, c, [self])
 
-            c.execute(sql, tuple(parameters))
-
-        observable_mapping = {} # key = observable_id, value = observable
-        if all_observables:
-            sql = "SELECT id, HEX(md5) FROM observables WHERE md5 IN ( {} )".format(','.join(['UNHEX(%s)' for o in all_observables]))
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, tuple([o.md5_hex for o in all_observables]))
+    def _rebuild_similarity_index(self, c):
+        """Updates the MinHash signature and LSH bands of this Alert used by similar_alerts()."""
+        if not saq.CONFIG['similar_alerts'].getboolean('enabled'):
+            return
 
-            for row in c:
-                observable_id, md5_hex = row
-                observable_mapping[md5_hex.lower()] = observable_id
+        c.execute("""DELETE FROM alert_similarity_band WHERE alert_id = %s""", ( self.id, ))
+        c.execute("""DELETE FROM alert_similarity_signature WHERE alert_id = %s""", ( self.id, ))
 
-            sql = "INSERT INTO observable_mapping ( alert_id, observable_id ) VALUES {}".format(','.join(['(%s, %s)' for o in observable_mapping.keys()]))
-            #logging.debug(f"MARKER: sql = {sql}")
-            parameters = []
-            for observable_id in observable_mapping.values():
-                parameters.append(self.id)
-                parameters.append(observable_id)
+        features = [ f'tag:{tag.name}' for tag in self.all_tags ]
+        features.extend([ f'observable:{observable.md5_hex}' for observable in self.all_observables ])
+        signature = minhash_signature(features, saq.CONFIG['similar_alerts'].getint('num_perm'))
+        if signature is None:
+            return
 
-            c.execute(sql, tuple(parameters))
+        c.execute("""INSERT INTO alert_similarity_signature ( alert_id, signature ) VALUES ( %s, %s )""", 
+                  ( self.id, pack_signature(signature) ))
 
-        sql = "INSERT IGNORE INTO observable_tag_index ( alert_id, observable_id, tag_id ) VALUES "
         parameters = []
-        sql_clause = []
+        for band, band_hash in lsh_bands(signature, saq.CONFIG['similar_alerts'].getint('bands')):
+            parameters.extend([ self.id, band, band_hash ])
 
-        for observable in all_observables:
-            for tag in observable.tags:
-                try:
-                    tag_id = tag_mapping[tag.name]
-                except KeyError:
-                    logging.debug(f"missing tag mapping for tag {tag.name} in observable {observable} alert {self.uuid}")
-                    continue
-
-                observable_id = observable_mapping[observable.md5_hex.lower()]
-
-                parameters.append(self.id)
-                parameters.append(observable_id)
-                parameters.append(tag_id)
-                sql_clause.append('(%s, %s, %s)')
-
-        if sql_clause:
-            sql += ','.join(sql_clause)
-            #logging.debug(f"MARKER: sql = {sql}")
-            c.execute(sql, tuple(parameters))
-
-        db.commit()
+        sql = "INSERT IGNORE INTO alert_similarity_band ( alert_id, band, hash ) VALUES {}".format(
+              ','.join(['(%s, %s, %s)' for _ in range(len(parameters) // 3)]))
+        c.execute(sql, tuple(parameters))
         
     @track_execution_time
     def rebuild_index_old(self):
@@ -1762,38 +1864,45 @@ class Alert(RootAnalysis, Base):
     def similar_alerts(self):
         """Returns list of similar alerts uuid, similarity score and disposition."""
         similarities = []
+        if not saq.CONFIG['similar_alerts'].getboolean('enabled') or not self.id:
+            return similarities
 
-        #with get_db_connection() as db:
-            #c = db.cursor()
-            #c.execute("""SELECT count(*) FROM tag_mapping where alert_id = %s group by alert_id""", (self.id))
-            #result = c.fetchone()
-            #db.commit()
-            #if result is None:
-                #return similarities
-
-            #num_tags = result[0]
-            #if num_tags == 0:
-                #return similarities
-
-            #c.execute("""
-                #SELECT alerts.uuid, alerts.disposition, 200 * count(*)/(total + %s) AS sim
-                #FROM tag_mapping tm1
-                #JOIN tag_mapping tm2 ON tm1.tag_id = tm2.tag_id
-                #JOIN (SELECT alert_id, count(*) AS total FROM tag_mapping GROUP BY alert_id) AS t1 ON tm1.alert_id = t1.alert_id
-                #JOIN alerts on tm1.alert_id = alerts.id
-                #WHERE tm2.alert_id = %s AND tm1.alert_id != %s AND alerts.disposition IS NOT NULL AND (alerts.alert_type != 'faqueue' OR (alerts.disposition != 'FALSE_POSITIVE' AND alerts.disposition != 'IGNORE'))
-                #GROUP BY tm1.alert_id
-                #ORDER BY sim DESC, alerts.disposition_time DESC
-                #LIMIT 10
-                #""", (num_tags, self.id, self.id))
-            #results = c.fetchall()
-            #if results is None:
-                #return similarities
-
-            #for result in results:
-                #similarities.append(Similarity(result[0], result[1], result[2]))
-
-        return similarities
+        # the signature is computed when the index is built (see _rebuild_similarity_index)
+        with get_db_connection() as db:
+            c = db.cursor()
+            c.execute("""SELECT signature FROM alert_similarity_signature WHERE alert_id = %s""", (self.id,))
+            result = c.fetchone()
+            if result is None:
+                return similarities
+
+            signature = unpack_signature(result[0])
+            bands = lsh_bands(signature, saq.CONFIG['similar_alerts'].getint('bands'))
+
+            # any dispositioned alert that shares at least one band is a candidate
+            parameters = []
+            for band, band_hash in bands:
+                parameters.extend([ band, band_hash ])
+
+            parameters.extend([ self.id, saq.CONFIG['similar_alerts'].getint('max_candidates') ])
+
+            c.execute("""
+                SELECT alerts.uuid, alerts.disposition, alert_similarity_signature.signature
+                FROM alert_similarity_signature
+                JOIN alerts ON alert_similarity_signature.alert_id = alerts.id
+                WHERE alert_similarity_signature.alert_id IN (
+                    SELECT alert_id FROM alert_similarity_band WHERE ( band, hash ) IN ( {} ) )
+                AND alerts.id != %s AND alerts.disposition IS NOT NULL AND (alerts.alert_type != 'faqueue' OR (alerts.disposition != 'FALSE_POSITIVE' AND alerts.disposition != 'IGNORE'))
+                ORDER BY alerts.disposition_time DESC
+                LIMIT %s""".format(','.join(['(%s, %s)' for _ in bands])), tuple(parameters))
+
+            for alert_uuid, disposition, candidate_signature in c:
+                similarity = estimate_similarity(signature, unpack_signature(candidate_signature))
+                if similarity > 0:
+                    similarities.append(Similarity(alert_uuid, disposition, similarity * 100.0))
+
+        # the sort is stable so the most recently dispositioned alerts come first for equal scores
+        similarities.sort(key=lambda s: s.percent, reverse=True)
+        return similarities[:saq.CONFIG['similar_alerts'].getint('max_results')]
 
     #@property
     #def delayed(self):
@@ -1829,6 +1938,127 @@ class Alert(RootAnalysis, Base):
     def node_location(self):
         return self.nodes.location
 
+# the maximum number of rows inserted or deleted by a single statement when rebuilding indexes
+INDEX_BATCH_SIZE = 1000
+
+def _execute_batched(c, sql, row_template, rows):
+    """Executes the given sql formatted with a comma separated list of row_template for each row in rows.
+       Large lists of rows are split across multiple statements."""
+    rows = sorted(rows)
+    for index in range(0, len(rows), INDEX_BATCH_SIZE):
+        batch = rows[index:index + INDEX_BATCH_SIZE]
+        parameters = []
+        for row in batch:
+            parameters.extend(row)
+
+        c.execute(sql.format(','.join([row_template for _ in batch])), tuple(parameters))
+
+def rebuild_indexes(alerts):
+    """Rebuilds the data for the given Alerts in the observables, tags, observable_mapping, tag_mapping
+       and observable_tag_index tables in a single transaction."""
+    alerts = [alert for alert in alerts if alert.id]
+    if not alerts:
+        return
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with get_db_connection() as db:
+            c = db.cursor()
+            execute_with_retry(db, c, _rebuild_indexes, (alerts,))
+
+def _rebuild_indexes(db, c, alerts):
+    # only the differences between what is already in the database and what is in the alerts are written
+    # rows are always inserted and deleted in sorted order to keep lock ordering consistent across processes
+    alerts = sorted(alerts, key=lambda alert: alert.id)
+    alert_ids = tuple([alert.id for alert in alerts])
+    alert_id_list = ','.join(['%s' for _ in alert_ids])
+    logging.info("rebuilding indexes for {}".format(','.join([str(alert) for alert in alerts])))
+
+    tag_ids = {} # key = tag name, value = tag id
+    observable_ids = {} # key = md5_hex, value = observable id
+
+    current_tag_mapping = set() # of (tag_id, alert_id)
+    c.execute(f"""SELECT tag_mapping.tag_id, tag_mapping.alert_id, tags.name FROM tag_mapping 
+                  JOIN tags ON tag_mapping.tag_id = tags.id WHERE tag_mapping.alert_id IN ( {alert_id_list} )""", alert_ids)
+    for tag_id, alert_id, tag_name in c:
+        current_tag_mapping.add((tag_id, alert_id))
+        tag_ids[tag_name] = tag_id
+
+    current_observable_mapping = set() # of (observable_id, alert_id)
+    c.execute(f"""SELECT observable_mapping.observable_id, observable_mapping.alert_id, HEX(observables.md5) FROM observable_mapping 
+                  JOIN observables ON observable_mapping.observable_id = observables.id 
+                  WHERE observable_mapping.alert_id IN ( {alert_id_list} )""", alert_ids)
+    for observable_id, alert_id, md5_hex in c:
+        current_observable_mapping.add((observable_id, alert_id))
+        observable_ids[md5_hex.lower()] = observable_id
+
+    current_observable_tag_index = set() # of (observable_id, tag_id, alert_id)
+    c.execute(f"""SELECT observable_id, tag_id, alert_id FROM observable_tag_index WHERE alert_id IN ( {alert_id_list} )""", alert_ids)
+    for row in c:
+        current_observable_tag_index.add(tuple(row))
+
+    # make sure any new tags and observables exist and get their ids
+    new_tag_names = set()
+    new_observables = {} # key = md5_hex, value = observable
+    for alert in alerts:
+        new_tag_names.update([tag.name for tag in alert.all_tags if tag.name not in tag_ids])
+        for observable in alert.all_observables:
+            if observable.md5_hex not in observable_ids:
+                new_observables[observable.md5_hex] = observable
+
+    if new_tag_names:
+        _execute_batched(c, "INSERT IGNORE INTO tags ( name ) VALUES {}", '(%s)', [(name,) for name in new_tag_names])
+        c.execute("SELECT id, name FROM tags WHERE name IN ( {} )".format(','.join(['%s' for _ in new_tag_names])), 
+                  tuple(new_tag_names))
+        for tag_id, tag_name in c:
+            tag_ids[tag_name] = tag_id
+
+    if new_observables:
+        _execute_batched(c, "INSERT IGNORE INTO observables ( type, value, md5 ) VALUES {}", '(%s, %s, UNHEX(%s))',
+                         [(o.type, o.value, o.md5_hex) for o in new_observables.values()])
+        c.execute("SELECT id, HEX(md5) FROM observables WHERE md5 IN ( {} )".format(
+                  ','.join(['UNHEX(%s)' for _ in new_observables])), tuple(new_observables.keys()))
+        for observable_id, md5_hex in c:
+            observable_ids[md5_hex.lower()] = observable_id
+
+    # compute what the index should look like
+    tag_mapping = set()
+    observable_mapping = set()
+    observable_tag_index = set()
+    for alert in alerts:
+        for tag in alert.all_tags:
+            tag_mapping.add((tag_ids[tag.name], alert.id))
+
+        for observable in alert.all_observables:
+            observable_id = observable_ids[observable.md5_hex]
+            observable_mapping.add((observable_id, alert.id))
+            for tag in observable.tags:
+                try:
+                    observable_tag_index.add((observable_id, tag_ids[tag.name], alert.id))
+                except KeyError:
+                    logging.debug(f"missing tag mapping for tag {tag.name} in observable {observable} alert {alert.uuid}")
+
+    for table, columns, current, target in [
+        ('tag_mapping', ('tag_id', 'alert_id'), current_tag_mapping, tag_mapping),
+        ('observable_mapping', ('observable_id', 'alert_id'), current_observable_mapping, observable_mapping),
+        ('observable_tag_index', ('observable_id', 'tag_id', 'alert_id'), current_observable_tag_index, observable_tag_index), ]:
+
+        row_template = '({})'.format(', '.join(['%s' for _ in columns]))
+        deleted = current - target
+        if deleted:
+            _execute_batched(c, f"DELETE FROM {table} WHERE ( {', '.join(columns)} ) IN ( {{}} )", row_template, deleted)
+
+        inserted = target - current
+        if inserted:
+            _execute_batched(c, f"INSERT IGNORE INTO {table} ( {', '.join(columns)} ) VALUES {{}}", row_template, inserted)
+
+        logging.debug(f"{table}: {len(inserted)} inserted {len(deleted)} deleted {len(target & current)} unchanged")
+
+    for alert in alerts:
+        alert._rebuild_similarity_index(c)
+
+    db.commit()
+
 @retry
 def sync_observable(observable):
     """Syncs the given observable to the database by inserting a row in the observables table if it does not currently exist.
@@ -268,6 +268,209 @@ def maintain_archive(verbose=False):
             c.execute(sql)
             db.commit()
 
+#
+# trigram index of the archive_search table
+#
+# each value in archive_search is broken up into the set of 3 byte sequences (trigrams) it contains
+# and (field, trigram, archive_id) is recorded in the archive_trigram table
+# a substring search only needs to look at the archives that contain the trigrams of the term
+# and those candidates are then verified against archive_search
+#
+
+TRIGRAM_SIZE = 3
+
+# the number of rows inserted into archive_trigram per statement
+TRIGRAM_BATCH_SIZE = 1000
+
+def get_trigrams(value):
+    """Returns the set of trigrams (as integers) contained in the given str or bytes value."""
+    if isinstance(value, str):
+        value = value.encode('utf8', errors='ignore')
+
+    return { int.from_bytes(value[i:i + TRIGRAM_SIZE], 'big') for i in range(len(value) - TRIGRAM_SIZE + 1) }
+
+def get_covering_trigrams(value):
+    """Returns the list of non-overlapping trigrams (as integers) that cover the given str or bytes value.
+       The last trigram overlaps the one before it if the length of the value is not a multiple of TRIGRAM_SIZE.
+       Returns an empty list if the value is shorter than TRIGRAM_SIZE."""
+    if isinstance(value, str):
+        value = value.encode('utf8', errors='ignore')
+
+    if len(value) < TRIGRAM_SIZE:
+        return []
+
+    positions = list(range(0, len(value) - TRIGRAM_SIZE + 1, TRIGRAM_SIZE))
+    if positions[-1] != len(value) - TRIGRAM_SIZE:
+        positions.append(len(value) - TRIGRAM_SIZE)
+
+    result = []
+    for position in positions:
+        trigram = int.from_bytes(value[position:position + TRIGRAM_SIZE], 'big')
+        if trigram not in result:
+            result.append(trigram)
+
+    return result
+
+def index_archive_trigrams(db, c, archive_id, values):
+    """Records the trigrams of the given list of (field, value) tuples for the given archive_id.
+       The caller is responsible for committing the transaction."""
+    from saq.database import execute_with_retry
+
+    rows = set()
+    for field, value in values:
+        for trigram in get_trigrams(value):
+            rows.add((field, trigram))
+
+    # sorted to keep the lock order consistent between concurrent inserts
+    rows = sorted(rows)
+    for index in range(0, len(rows), TRIGRAM_BATCH_SIZE):
+        batch = rows[index:index + TRIGRAM_BATCH_SIZE]
+        params = []
+        for field, trigram in batch:
+            params.extend((field, trigram, archive_id))
+
+        execute_with_retry(db, c, "INSERT IGNORE INTO archive_trigram ( field, trigram, archive_id ) VALUES {}".format(
+                           ','.join(['( %s, %s, %s )'] * len(batch))), tuple(params))
+
+def escape_like(value):
+    """Escapes the LIKE wildcards in the given value.
+       Archive searches (with or without the trigram index) match % and _ literally."""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+class ArchiveTrigramSearch(object):
+    """Searches archive_search for values that contain the given terms using the archive_trigram table.
+
+       The posting list (the archive_ids that contain a trigram) of each trigram is loaded at most once
+       so searching for many terms at once (see prefetch) shares the lookups of common trigrams.
+       Trigrams with more than max_postings archives are ignored since they do little to narrow the search."""
+
+    def __init__(self, c, fields=None, max_postings=None):
+        self.c = c
+        # optional list of fields to limit the search to
+        self.fields = list(fields) if fields else None
+        if max_postings is None:
+            max_postings = saq.CONFIG['email_archive'].getint('trigram_max_postings', fallback=100000)
+
+        self.max_postings = max_postings
+        # key = trigram, value = set of archive_id (or None if the trigram is too common to use)
+        self.postings = {}
+
+    def _field_clause(self):
+        if not self.fields:
+            return '', []
+
+        return ' AND field IN ( {} )'.format(','.join(['%s'] * len(self.fields))), list(self.fields)
+
+    def get_postings(self, trigram):
+        """Returns the set of archive_ids that contain the given trigram, or None if there are too many."""
+        if trigram in self.postings:
+            return self.postings[trigram]
+
+        field_clause, field_params = self._field_clause()
+        self.c.execute("SELECT DISTINCT archive_id FROM archive_trigram WHERE trigram = %s{} LIMIT %s".format(field_clause),
+                       tuple([trigram] + field_params + [self.max_postings + 1]))
+
+        result = set([row[0] for row in self.c])
+        if len(result) > self.max_postings:
+            result = None
+
+        self.postings[trigram] = result
+        return result
+
+    def prefetch(self, terms, chunk_size=500):
+        """Loads the posting lists of all the trigrams needed to search for the given terms in as few queries as possible."""
+        trigrams = set()
+        for term in terms:
+            trigrams.update([t for t in get_covering_trigrams(term) if t not in self.postings])
+
+        trigrams = sorted(trigrams)
+        field_clause, field_params = self._field_clause()
+        for index in range(0, len(trigrams), chunk_size):
+            chunk = trigrams[index:index + chunk_size]
+            in_clause = ','.join(['%s'] * len(chunk))
+
+            # skip loading the posting lists that are too large to be useful
+            self.c.execute("SELECT trigram, COUNT(*) FROM archive_trigram WHERE trigram IN ( {} ){} GROUP BY trigram".format(
+                           in_clause, field_clause), tuple(chunk + field_params))
+
+            counts = dict(self.c.fetchall())
+            selected = []
+            for trigram in chunk:
+                count = counts.get(trigram, 0)
+                if count > self.max_postings:
+                    self.postings[trigram] = None
+                else:
+                    self.postings[trigram] = set()
+                    if count:
+                        selected.append(trigram)
+
+            if not selected:
+                continue
+
+            self.c.execute("SELECT trigram, archive_id FROM archive_trigram WHERE trigram IN ( {} ){}".format(
+                           ','.join(['%s'] * len(selected)), field_clause), tuple(selected + field_params))
+
+            for trigram, archive_id in self.c:
+                self.postings[trigram].add(archive_id)
+
+    def get_candidates(self, term):
+        """Returns the set of archive_ids that may contain the given term, 
+           or None if the index cannot be used to narrow the search."""
+        posting_lists = []
+        for trigram in get_covering_trigrams(term):
+            postings = self.get_postings(trigram)
+            if postings is None:
+                continue
+
+            if not postings:
+                return set()
+
+            posting_lists.append(postings)
+
+        if not posting_lists:
+            return None
+
+        # intersect starting with the smallest list
+        posting_lists.sort(key=len)
+        result = set(posting_lists[0])
+        for postings in posting_lists[1:]:
+            result.intersection_update(postings)
+            if not result:
+                break
+
+        return result
+
+    def search(self, term, chunk_size=1000):
+        """Returns the set of archive_ids that have a value that contains the given term."""
+        field_clause, field_params = self._field_clause()
+        pattern = '%{}%'.format(escape_like(term))
+        candidates = self.get_candidates(term)
+
+        if candidates is None:
+            # the term is too short (or too common) to use the index
+            self.c.execute("SELECT DISTINCT archive_id FROM archive_search WHERE value LIKE %s{}".format(field_clause),
+                           tuple([pattern] + field_params))
+            return set([row[0] for row in self.c])
+
+        result = set()
+        candidates = sorted(candidates)
+        for index in range(0, len(candidates), chunk_size):
+            chunk = candidates[index:index + chunk_size]
+            self.c.execute("SELECT DISTINCT archive_id FROM archive_search WHERE archive_id IN ( {} ) AND value LIKE %s{}".format(
+                           ','.join(['%s'] * len(chunk)), field_clause), tuple(chunk + [pattern] + field_params))
+            result.update([row[0] for row in self.c])
+
+        return result
+
+    def search_many(self, terms):
+        """Returns the set of archive_ids that have a value that contains any of the given terms."""
+        self.prefetch(terms)
+        result = set()
+        for term in terms:
+            result.update(self.search(term))
+
+        return result
+
 
 def normalize_message_id(message_id):
     """Returns message id with < and > prepended and appended respectively
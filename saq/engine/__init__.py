@@ -33,6 +33,7 @@ import saq.analysis
 import saq.database
 
 from saq.analysis import Observable, Analysis, RootAnalysis, MODULE_PATH, SPLIT_MODULE_PATH
+from saq.analysis.cache import get_analysis_cache
 from saq.constants import *
 from saq.database import Alert, use_db, \
                          get_db_connection, add_workload, acquire_lock, release_lock, execute_with_retry, \
@@ -155,10 +156,13 @@ class AnalysisModuleTrackingMessage(TrackingMessage):
 class Worker(object):
     """Responsible for maintaining an executing analysis process."""
 
-    def __init__(self, mode=None):
+    def __init__(self, mode=None, dispatcher=None):
         self.mode = mode # the primary analysis mode for the worker
         self.process = None
 
+        # the WorkDispatcher that hands out work to this worker (or None if the worker looks for work itself)
+        self.dispatcher = dispatcher
+
         # when this is set the worker will exit
         self.worker_shutdown_event = None
 
@@ -452,6 +456,9 @@ analysis_module = {self.last_analysis_module}
                 report_exception()
                 time.sleep(1)
 
+        # stop the watchdog thread started by setup()
+        CURRENT_ENGINE.analysis_watchdog.stop()
+
         logging.debug("worker {} exiting".format(os.getpid()))
 
     def start_tracker_thread(self):
@@ -563,9 +570,12 @@ class WorkerManager(object):
         # set this Event when you want to restart all the workers
         self.restart_workers_event = None
 
+        # claims work in batches for all the workers (if enabled)
+        self.dispatcher = None
+
     def add_worker(self, mode=None):
         """Adds a worker for the given mode. This must be called before calling start()."""
-        self.workers.append(Worker(mode))
+        self.workers.append(Worker(mode, dispatcher=self.dispatcher))
 
     def start(self):
         self.restart_workers_event = Event()
@@ -596,6 +606,10 @@ class WorkerManager(object):
     def manager_loop(self):
         logging.info("worker manager started on pid {}".format(os.getpid()))
 
+        # the queues used by the dispatcher need to exist before the worker processes are created
+        if saq.CONFIG['service_engine'].getboolean('work_dispatcher_enabled', False):
+            self.dispatcher = WorkDispatcher(CURRENT_ENGINE.analysis_pools.keys())
+
         # load the workers
         for mode in CURRENT_ENGINE.analysis_pools.keys():
             for i in range(CURRENT_ENGINE.analysis_pools[mode]):
@@ -620,6 +634,9 @@ class WorkerManager(object):
         for worker in self.workers:
             worker.wait_for_start()
 
+        if self.dispatcher:
+            self.dispatcher.start()
+
         # everything seems to be up and running
         self.startup_event.set()
 
@@ -664,8 +681,266 @@ class WorkerManager(object):
         for worker in self.workers:
             worker.wait()
 
+        if self.dispatcher:
+            self.dispatcher.stop()
+
         logging.info("worker manager on pid {} exiting".format(os.getpid()))
 
+WORK_ITEM_TYPE_WORKLOAD = 'workload'
+WORK_ITEM_TYPE_DELAYED = 'delayed'
+
+class DispatchedWorkItem(object):
+    """A unit of work claimed by the WorkDispatcher on behalf of a worker.
+       The lock on the uuid has already been acquired using lock_uuid."""
+    def __init__(self, type, database_id, uuid, storage_dir, lock_uuid,
+                 analysis_mode=None, node_id=None, observable_uuid=None, analysis_module=None, delayed_until=None):
+        self.type = type
+        self.database_id = database_id
+        self.uuid = uuid
+        self.storage_dir = storage_dir
+        self.lock_uuid = lock_uuid
+        self.analysis_mode = analysis_mode
+        self.node_id = node_id
+        self.observable_uuid = observable_uuid
+        self.analysis_module = analysis_module
+        self.delayed_until = delayed_until
+        # when the lock was acquired (time.time())
+        self.lock_time = time.time()
+
+    def __str__(self):
+        return f"DispatchedWorkItem({self.type},{self.uuid},{self.analysis_mode})"
+
+class WorkDispatcher(object):
+    """Claims batches of work for all of the workers on this node and hands them out over queues.
+
+       Rather than having every worker poll the workload and delayed_analysis tables (up to five queries)
+       and then call acquire_lock row-by-row, a single thread in the worker manager process selects up to
+       batch_size available rows in one query and locks them all with a single multi-row insert into
+       the locks table. Each claimed row gets its own lock_uuid which the worker adopts when it picks the item up.
+
+       Work for an analysis mode that has a dedicated analysis pool goes to the queue for that mode,
+       everything else goes to the shared queue."""
+
+    def __init__(self, modes):
+        # maximum number of work items that are claimed but not yet picked up by a worker
+        self.batch_size = saq.CONFIG['service_engine'].getint('work_dispatcher_batch_size', 8)
+        # how often (in seconds) we look for more work when the queues are not full
+        self.frequency = saq.CONFIG['service_engine'].getfloat('work_dispatcher_frequency', 1.0)
+
+        # key = analysis_mode, value = multiprocessing.Queue
+        self.mode_queues = {}
+        for mode in modes:
+            if mode and mode not in self.mode_queues:
+                self.mode_queues[mode] = Queue()
+
+        self.shared_queue = Queue()
+
+        self.lock_owner = None
+        self.control_event = None
+        self.thread = None
+
+    @property
+    def queues(self):
+        return list(self.mode_queues.values()) + [ self.shared_queue ]
+
+    @property
+    def queue_size(self):
+        """Returns the total number of claimed work items waiting to be picked up."""
+        result = 0
+        for q in self.queues:
+            try:
+                result += q.qsize()
+            except NotImplementedError:
+                pass
+
+        return result
+
+    def start(self):
+        self.lock_owner = '{}-dispatcher-{}'.format(saq.SAQ_NODE, os.getpid())
+        self.control_event = threading.Event()
+        self.thread = threading.Thread(target=self.dispatcher_loop, name="Work Dispatcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.control_event.set()
+        logging.debug("waiting for work dispatcher to stop...")
+        self.thread.join()
+        self.thread = None
+        self.release_pending()
+
+    def dispatcher_loop(self):
+        logging.info("work dispatcher started on pid {}".format(os.getpid()))
+        while not self.control_event.is_set():
+            try:
+                claimed = 0
+                available = self.batch_size - self.queue_size
+                if available > 0:
+                    claimed = self.dispatch(available)
+
+                # if we filled the batch then go right back for more once the workers catch up
+                if claimed and claimed == available:
+                    if self.control_event.wait(0.1):
+                        break
+
+                    continue
+
+            except Exception as e:
+                logging.error("uncaught exception in work dispatcher: {}".format(e))
+                report_exception()
+
+            if self.control_event.wait(self.frequency):
+                break
+
+        logging.info("work dispatcher on pid {} exiting".format(os.getpid()))
+
+    def dispatch(self, limit):
+        """Claims up to limit work items and puts them on the work queues. Returns the number claimed."""
+        items = self.claim_work(limit)
+        for item in items:
+            if item.type == WORK_ITEM_TYPE_WORKLOAD and item.analysis_mode in self.mode_queues:
+                self.mode_queues[item.analysis_mode].put(item)
+            else:
+                self.shared_queue.put(item)
+
+        if items:
+            logging.debug("dispatched {} work items".format(len(items)))
+
+        return len(items)
+
+    @use_db
+    def claim_work(self, limit, db, c):
+        """Selects and locks up to limit available work items in a single transaction.
+           Delayed analysis that is ready is claimed before new work, local work before remote work.
+           Returns the list of DispatchedWorkItem objects that were successfully locked."""
+        delayed_exclusive_clause = 'delayed_analysis.exclusive_uuid IS NULL'
+        delayed_params = [ saq.SAQ_NODE_ID ]
+        if CURRENT_ENGINE.exclusive_uuid is not None:
+            delayed_exclusive_clause = 'delayed_analysis.exclusive_uuid = %s'
+            delayed_params.append(CURRENT_ENGINE.exclusive_uuid)
+
+        workload_clause, workload_params = CURRENT_ENGINE.get_workload_where_clause(priority=False, local=None)
+
+        c.execute(f"""
+( SELECT
+    '{WORK_ITEM_TYPE_DELAYED}',
+    delayed_analysis.id,
+    delayed_analysis.uuid,
+    delayed_analysis.storage_dir,
+    NULL,
+    delayed_analysis.node_id,
+    delayed_analysis.observable_uuid,
+    delayed_analysis.analysis_module,
+    delayed_analysis.delayed_until
+FROM
+    delayed_analysis LEFT JOIN locks ON delayed_analysis.uuid = locks.uuid
+WHERE
+    delayed_analysis.node_id = %s
+    AND locks.uuid IS NULL
+    AND NOW() > delayed_until
+    AND {delayed_exclusive_clause}
+ORDER BY
+    delayed_until ASC
+LIMIT %s )
+UNION ALL
+( SELECT
+    '{WORK_ITEM_TYPE_WORKLOAD}',
+    workload.id,
+    workload.uuid,
+    workload.storage_dir,
+    workload.analysis_mode,
+    workload.node_id,
+    NULL,
+    NULL,
+    NULL
+FROM
+    workload LEFT JOIN locks ON workload.uuid = locks.uuid
+WHERE
+    {workload_clause}
+ORDER BY
+    workload.node_id = %s DESC,
+    workload.id ASC
+LIMIT %s )""", tuple(delayed_params + [ limit ] + workload_params + [ saq.SAQ_NODE_ID, limit ]))
+
+        candidates = {} # key = uuid, value = DispatchedWorkItem
+        for _type, _id, _uuid, storage_dir, analysis_mode, node_id, observable_uuid, analysis_module, delayed_until in c:
+            # the same root can have both delayed analysis and new work -- one lock covers both
+            if _uuid in candidates:
+                continue
+
+            candidates[_uuid] = DispatchedWorkItem(_type, _id, _uuid, storage_dir, str(uuid.uuid4()),
+                                                   analysis_mode=analysis_mode,
+                                                   node_id=node_id,
+                                                   observable_uuid=observable_uuid,
+                                                   analysis_module=analysis_module,
+                                                   delayed_until=delayed_until)
+
+            if len(candidates) >= limit:
+                break
+
+        if not candidates:
+            return []
+
+        # lock everything we found in one statement
+        # other nodes may be racing for the same rows so we then check which ones we actually got
+        values = []
+        params = []
+        for item in candidates.values():
+            values.append('( %s, %s, %s, NOW() )')
+            params.extend([ item.uuid, item.lock_uuid, self.lock_owner ])
+
+        execute_with_retry(db, c, "INSERT IGNORE INTO locks ( uuid, lock_uuid, lock_owner, lock_time ) VALUES {}".format(
+                                  ','.join(values)), tuple(params), commit=True)
+
+        c.execute("SELECT uuid, lock_uuid FROM locks WHERE uuid IN ( {} )".format(
+                  ','.join([ '%s' for _ in candidates ])), tuple(candidates.keys()))
+
+        locked = { _uuid for _uuid, lock_uuid in c if candidates[_uuid].lock_uuid == lock_uuid }
+        return [ item for item in candidates.values() if item.uuid in locked ]
+
+    def get(self, mode=None, timeout=1):
+        """Returns the next DispatchedWorkItem for a worker with the given priority mode,
+           or None if nothing became available within timeout seconds.
+           Work for the worker's own mode comes first, then shared work, then work for other modes."""
+        queues = []
+        if mode in self.mode_queues:
+            queues.append(self.mode_queues[mode])
+
+        queues.append(self.shared_queue)
+        queues.extend([ q for _mode, q in self.mode_queues.items() if _mode != mode ])
+
+        for q in queues:
+            try:
+                return q.get_nowait()
+            except Empty:
+                pass
+
+        try:
+            return queues[0].get(timeout=timeout)
+        except Empty:
+            return None
+
+    @use_db
+    def release_pending(self, db, c):
+        """Releases the locks on any work items that were claimed but never picked up."""
+        pending = []
+        for q in self.queues:
+            while True:
+                try:
+                    pending.append(q.get_nowait())
+                except Empty:
+                    break
+
+        for item in pending:
+            execute_with_retry(db, c, "DELETE FROM locks WHERE uuid = %s AND lock_uuid = %s", 
+                              (item.uuid, item.lock_uuid))
+
+        db.commit()
+        if pending:
+            logging.info("released {} unprocessed work items".format(len(pending)))
+
 # syntactic suger for if self.is_local: return None
 def exclude_if_local(target_function):
     """A member function of Engine wrapped with this function will not execute if the Engine is in "local" mode."""
@@ -716,6 +991,134 @@ def load_module(section):
 class AnalysisFailedException(Exception):
     pass
 
+class AnalysisWatchdog(object):
+    """Watches how long the current analysis module has been executing on the current target.
+
+       A single long-lived thread is used per worker instead of a new thread for every call to analyze().
+       When the maximum analysis time is exceeded a warning is logged (repeated every warning_frequency seconds) 
+       and, if cancel_on_timeout is True, the analysis module is asked to cancel what it is doing."""
+
+    def __init__(self, warning_frequency=5, cancel_on_timeout=False):
+        self.warning_frequency = warning_frequency
+        self.cancel_on_timeout = cancel_on_timeout
+
+        # the module and target currently being watched
+        self.analysis_module = None
+        self.target = None
+        self.start_time = None # time.monotonic()
+        self.maximum_analysis_time = None
+        # the next time (time.monotonic()) the watchdog needs to look at the current execution
+        self.deadline = None
+        # set to True once the current execution exceeds the maximum analysis time
+        self.timed_out = False
+        # set to True if we requested the module to cancel the current execution
+        self.cancelled = False
+        # set to True while the watchdog thread is calling cancel_analysis() (without holding the lock)
+        self.cancelling = False
+
+        self.condition = threading.Condition()
+        self.thread = None
+        self.started = False
+
+    def start(self):
+        self.started = True
+        self.thread = threading.Thread(target=self.watchdog_loop, name="Analysis Watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.started:
+            return
+
+        with self.condition:
+            self.started = False
+            self.condition.notify()
+
+        self.thread.join()
+        self.thread = None
+
+    def _wait_for_cancel(self):
+        """Waits for the watchdog thread to finish cancelling the current execution. Requires the lock."""
+        while self.cancelling:
+            self.condition.wait()
+
+    def watch(self, analysis_module, target, maximum_analysis_time):
+        """Starts watching the given analysis module executing on the given target."""
+        with self.condition:
+            self._wait_for_cancel()
+            # a cancel requested for a previous execution does not carry over to this one
+            analysis_module.cancel_analysis_flag = False
+            self.analysis_module = analysis_module
+            self.target = target
+            self.start_time = time.monotonic()
+            self.maximum_analysis_time = maximum_analysis_time
+            self.deadline = self.start_time + maximum_analysis_time
+            self.timed_out = False
+            self.cancelled = False
+            self.condition.notify()
+
+    def clear(self):
+        """Stops watching the current execution. Returns True if it exceeded the maximum analysis time."""
+        with self.condition:
+            # otherwise a cancel that is still in progress could land on the next execution
+            self._wait_for_cancel()
+            timed_out = self.timed_out
+            if self.start_time is not None and time.monotonic() - self.start_time > self.maximum_analysis_time:
+                timed_out = True
+
+            self.analysis_module = None
+            self.target = None
+            self.start_time = None
+            self.deadline = None
+            return timed_out
+
+    def was_cancelled(self):
+        """Returns True if the watchdog cancelled the last execution it watched."""
+        with self.condition:
+            return self.cancelled
+
+    def watchdog_loop(self):
+        with self.condition:
+            while self.started:
+                if self.deadline is None:
+                    self.condition.wait()
+                    continue
+
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+
+                self.timed_out = True
+                logging.warning(f"excessive time - analysis module {self.analysis_module} "
+                                f"has been analyzing {self.target} "
+                                f"for {time.monotonic() - self.start_time:.2f} seconds")
+
+                if self.cancel_on_timeout and not self.cancelled:
+                    logging.warning(f"cancelling analysis of {self.target} by {self.analysis_module}")
+                    self.cancelled = True
+                    self.cancelling = True
+                    analysis_module = self.analysis_module
+                    start_time = self.start_time
+
+                    # the module is cancelled without holding the lock
+                    # clear() and watch() wait until this is done
+                    self.condition.release()
+                    try:
+                        analysis_module.cancel_analysis()
+                    except Exception as e:
+                        logging.error(f"unable to cancel analysis module {analysis_module}: {e}")
+                    finally:
+                        self.condition.acquire()
+                        self.cancelling = False
+                        self.condition.notify_all()
+
+                    # did the module return (or the worker move on to something else) in the meantime?
+                    if self.start_time != start_time:
+                        continue
+
+                # repeat the warning until the module returns
+                self.deadline = time.monotonic() + self.warning_frequency
+
 class Engine(ACEService):
     """Analysis Correlation Engine"""
 
@@ -797,6 +1200,18 @@ class Engine(ACEService):
         # a mapping of analysis module configuration section headers to the load analysis modules
         self.analysis_module_mapping = {} # key = analysis_module_blah, value = AnalysisModule
 
+        # for each analysis mode, the analysis modules that can accept a given observable type
+        # key = analysis_mode, value = { key = observable type (or None for any type), value = [ AnalysisModule ] }
+        self.analysis_mode_type_index = {}
+
+        # the required directives and tags of each analysis module
+        # key = analysis_module.config_section, value = tuple(tuple(directives), tuple(tags))
+        self.analysis_module_requirements = {}
+
+        # the number of times accepts() was called (or skipped by the index) for the current root
+        self.accepts_called = 0
+        self.accepts_skipped = 0
+
         # the list of analysis modes this engine supports
         # if this list is empty then it will work on any analysis mode
         # if the analysis_modes parameter is passed to the constructor then we use that instead
@@ -905,6 +1320,22 @@ class Engine(ACEService):
         # maximum amount of time (in seconds) that an individual analysis module should take
         self.maximum_analysis_time = saq.CONFIG['global'].getint('maximum_analysis_time')
 
+        # watches the execution time of individual analysis modules (started in setup)
+        self.analysis_watchdog = AnalysisWatchdog(
+                cancel_on_timeout=saq.CONFIG['global'].getboolean('cancel_analysis_on_timeout', False))
+
+        # the number of times an analysis module can exceed the maximum analysis time before it is quarantined
+        # a quarantined module is not executed again for the lifetime of the worker
+        # a value of 0 disables quarantine
+        self.analysis_module_quarantine_threshold = \
+                saq.CONFIG['global'].getint('analysis_module_quarantine_threshold', 0)
+
+        # key = analysis_module.config_section, value = number of times it exceeded the maximum analysis time
+        self.analysis_module_timeouts = {}
+
+        # set of analysis_module.config_section values that are quarantined
+        self.quarantined_analysis_modules = set()
+
         # the threads that manages the execution of the maintenance routines of analysis modules
         # there is one thread per analysis module that has a maintenance_frequency > 0
         self.maintenance_threads = []
@@ -1386,6 +1817,68 @@ class Engine(ACEService):
             for _module in self.analysis_mode_mapping[mode]:
                 logging.info("mode {} activated module {}".format(mode, _module))
 
+        self.build_analysis_mode_type_index()
+
+    def build_analysis_mode_type_index(self):
+        """Builds the analysis_mode_type_index used to select the analysis modules that can possibly
+           accept a given observable."""
+        self.analysis_mode_type_index = {}
+        self.analysis_module_requirements = {}
+
+        for analysis_module in self.analysis_modules:
+            self.analysis_module_requirements[analysis_module.config_section] = (
+                tuple(analysis_module.required_directives), 
+                tuple(analysis_module.required_tags))
+
+        for mode in self.analysis_mode_mapping.keys():
+            # modules that do not generate analysis never accept anything
+            analysis_modules = [m for m in self.get_analysis_modules_by_mode(mode) 
+                                if m.generated_analysis_type is not None]
+
+            valid_types = {} # key = analysis_module.config_section, value = set(types) or None for any type
+            for analysis_module in analysis_modules:
+                types = analysis_module.valid_observable_types
+                if isinstance(types, str):
+                    types = [types]
+
+                valid_types[analysis_module.config_section] = None if types is None else set(types)
+
+            # modules that accept any observable type are in every list
+            index = { None: [m for m in analysis_modules if valid_types[m.config_section] is None] }
+            for types in valid_types.values():
+                for o_type in types or []:
+                    if o_type not in index:
+                        index[o_type] = [m for m in analysis_modules 
+                                         if valid_types[m.config_section] is None 
+                                         or o_type in valid_types[m.config_section]]
+
+            self.analysis_mode_type_index[mode] = index
+            logging.debug("analysis mode {} indexed {} observable types".format(mode, len(index) - 1))
+
+    def get_analysis_modules_by_observable(self, analysis_mode, observable):
+        """Returns the list of analysis modules configured for the given mode that could accept the given observable,
+           sorted alphabetically by configuration section name. 
+           This is based on the observable type and the required directives and tags of the modules.
+           AnalysisModule.accepts() still needs to be called on each module returned."""
+        if analysis_mode not in self.analysis_mode_type_index:
+            analysis_mode = self.default_analysis_mode
+
+        index = self.analysis_mode_type_index[analysis_mode]
+        candidates = index.get(observable.type, index[None])
+
+        result = []
+        for analysis_module in candidates:
+            directives, tags = self.analysis_module_requirements[analysis_module.config_section]
+            if directives and not all([observable.has_directive(d) for d in directives]):
+                continue
+
+            if tags and not all([observable.has_tag(t) for t in tags]):
+                continue
+
+            result.append(analysis_module)
+
+        return result
+
 
     #
     # MAINTENANCE
@@ -1867,7 +2360,9 @@ class Engine(ACEService):
                 return False
 
             remote_host = row[0]
-            download(uuid, target_dir, remote_host=remote_host)
+            download(uuid, target_dir, remote_host=remote_host,
+                     compression=saq.CONFIG['service_engine'].get('transfer_compression', fallback='none'),
+                     resume_attempts=saq.CONFIG['service_engine'].getint('transfer_resume_attempts', fallback=3))
 
             # update the node (location) of this workitem to the local node
             execute_with_retry(db, c, "UPDATE workload SET node_id = %s, storage_dir = %s WHERE uuid = %s", (
@@ -1884,7 +2379,7 @@ class Engine(ACEService):
 
             # load the analysis we moved over and change the location there as well
             root = RootAnalysis(storage_dir=target_dir)
-            root.load()
+            root.load(lazy=True)
             root.location = saq.SAQ_NODE
             root.save()
 
@@ -1958,15 +2453,13 @@ ORDER BY
 
         return None
 
-    @use_db
-    def get_work_target(self, db, c, priority=True, local=True):
-        """Returns the next work item available. 
+    def get_workload_where_clause(self, priority=True, local=True):
+        """Returns a tuple of (where_clause, params) used to select available work from the workload table.
            If priority is True then only work items with analysis_modes that match the analysis_mode_priority
            of this worker are selected.
            If local is True then only work items on the local node are selected.
-           Remote work items are moved to become local.
-           Note that the target_nodes configuration option controls which nodes are valid to pull from.
-           Returns a valid work item, or None if none are available."""
+           If local is False then only work items for the company of this node are selected.
+           If local is None then both are selected."""
     
         where_clause = [ 'locks.uuid IS NULL' ]
         params = []
@@ -1975,7 +2468,10 @@ ORDER BY
             where_clause.append('workload.analysis_mode = %s')
             params.append(self.analysis_mode_priority)
 
-        if local:
+        if local is None:
+            where_clause.append('workload.node_id = %s OR workload.company_id = %s')
+            params.extend([saq.SAQ_NODE_ID, saq.COMPANY_ID])
+        elif local:
             where_clause.append('workload.node_id = %s')
             params.append(saq.SAQ_NODE_ID)
         else:
@@ -2005,7 +2501,17 @@ ORDER BY
             where_clause.append(f"workload.node_id IN ( SELECT id FROM nodes WHERE name IN ( {param_str} ) )")
             params.extend(self.target_nodes)
 
-        where_clause = ' AND '.join(['({})'.format(clause) for clause in where_clause])
+        return ' AND '.join(['({})'.format(clause) for clause in where_clause]), params
+
+    @use_db
+    def get_work_target(self, db, c, priority=True, local=True):
+        """Returns the next work item available. 
+           See get_workload_where_clause for the meaning of priority and local.
+           Remote work items are moved to become local.
+           Note that the target_nodes configuration option controls which nodes are valid to pull from.
+           Returns a valid work item, or None if none are available."""
+
+        where_clause, params = self.get_workload_where_clause(priority=priority, local=local)
 
         if saq.UNIT_TESTING:
             logging.debug("looking for work with {} ({})".format(where_clause, ','.join([str(_) for _ in params])))
@@ -2039,8 +2545,45 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
 
         return None
 
+    def get_dispatched_work_target(self, dispatcher):
+        """Returns the next work target claimed by the given WorkDispatcher, or None if none are available."""
+        item = dispatcher.get(self.analysis_mode_priority)
+        if item is None:
+            return None
+
+        # the dispatcher already acquired the lock for us but the item may have been queued for a while
+        # once the lock has expired some other node could be working on it
+        if time.time() - item.lock_time >= saq.LOCK_TIMEOUT_SECONDS:
+            logging.warning(f"dropping {item} (the lock expired while it was queued)")
+            return None
+
+        # otherwise the lock is refreshed before we start working on it
+        if not acquire_lock(item.uuid, item.lock_uuid, lock_owner=self.lock_owner):
+            logging.warning(f"dropping {item} (unable to refresh the lock)")
+            return None
+
+        self.lock_uuid = item.lock_uuid
+
+        if item.type == WORK_ITEM_TYPE_DELAYED:
+            return DelayedAnalysisRequest(item.uuid,
+                                          item.observable_uuid,
+                                          item.analysis_module,
+                                          item.delayed_until,
+                                          item.storage_dir,
+                                          database_id=item.database_id)
+
+        # is this work item on a different node?
+        if item.node_id != saq.SAQ_NODE_ID:
+            return self.transfer_work_target(item.uuid, item.node_id)
+
+        return RootAnalysis(uuid=item.uuid, storage_dir=item.storage_dir, analysis_mode=item.analysis_mode)
+
     def get_next_work_target(self):
         try:
+            # is the work being handed out by the node's dispatcher?
+            if self.worker and self.worker.dispatcher:
+                return self.get_dispatched_work_target(self.worker.dispatcher)
+
             # get any delayed analysis work that is ready to be processed
             target = self.get_delayed_analysis_work_target()
             if target:
@@ -2113,6 +2656,9 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
             report_exception()
             return
 
+        if not self.single_threaded_mode:
+            self.analysis_watchdog.start()
+
         self.initialize_signal_handlers()
         
     def execute(self):
@@ -2356,6 +2902,8 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
     
         # reset total analysis measurements
         self.total_analysis_time.clear()
+        self.accepts_called = 0
+        self.accepts_skipped = 0
 
         # reset each module to it's default state
         for analysis_module in self.analysis_modules:
@@ -2423,6 +2971,9 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                         state[analysis_module.config_section] = True
                         report_exception()
 
+                # the files can be stored (as read-only blobs) once all the analysis has completed
+                self.root.store_files()
+
             elapsed_time = time.time() - start_time
              
             logging.info("completed analysis {} in {:.2f} seconds".format(target, elapsed_time))
@@ -2469,6 +3020,9 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                 logging.error("unable to clean up analysis module {}: {}".format(analysis_module, e))
                 report_exception()
 
+        # record the analysis cache stats collected while analyzing this root
+        get_analysis_cache().flush_stats()
+
         # if analysis failed, copy all the details to error_reports for review
         if self.copy_analysis_on_error:
             error_report_stats_dir = None
@@ -2864,6 +3418,15 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
             # first we limit ourselves to whatever analysis modules are available for the current analysis mode
             # if we didn't specify an analysis mode then we just use the default
             analysis_modules = self.get_analysis_modules_by_mode(self.root.analysis_mode)
+
+            # for observables we only consider the modules that could possibly accept it
+            if work_item.dependency is None and work_item.observable and not work_item.observable.limited_analysis \
+            and not work_item.analysis_module:
+                candidate_modules = self.get_analysis_modules_by_observable(self.root.analysis_mode, 
+                                                                            work_item.observable)
+                self.accepts_skipped += len([m for m in analysis_modules 
+                                            if m.generated_analysis_type is not None]) - len(candidate_modules)
+                analysis_modules = candidate_modules
                 
             # an Observable can specify a limited set of analysis modules to run
             # by using the limit_analysis() function
@@ -2946,8 +3509,16 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                 if analysis_module.generated_analysis_type is None:
                     continue
 
+                # has this module been quarantined for taking too long?
+                if analysis_module.config_section in self.quarantined_analysis_modules:
+                    if work_item.dependency:
+                        work_item.dependency.set_status_failed('analysis module quarantined')
+                        work_item.dependency.increment_status()
+                    continue
+
                 if work_item.observable:
                     # does this module accept this observable type?
+                    self.accepts_called += 1
                     if not analysis_module.accepts(work_item.observable):
                         if work_item.dependency:
                             work_item.dependency.set_status_failed('unaccepted for analysis')
@@ -2982,30 +3553,6 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                         logging.debug("analyzing {} with {} (final analysis={})".format(
                                        work_item.observable, analysis_module, final_analysis_mode))
 
-                        def _monitor(monitor_event, monitor_module, monitor_target):
-                            monitor_start_time = datetime.datetime.now()
-                            monitor_event.wait(timeout=maximum_analysis_time)
-                            while True:
-                                monitor_elapsed_time = (datetime.datetime.now() - monitor_start_time).total_seconds()
-                                if monitor_elapsed_time > maximum_analysis_time:
-                                    logging.warning(f"excessive time - analysis module {monitor_module} " \
-                                                    f"has been analyzing {monitor_target} " \
-                                                    f"for {monitor_elapsed_time} seconds")
-
-                                # repeat warning every 10 seconds until we bail
-                                # TODO possibly kill the analysis somehow
-                                if monitor_event.wait(timeout=5):
-                                    break
-
-                        # start a side thread that watches how long a single analysis request can take
-                        if not self.single_threaded_mode:
-                            monitor_event = threading.Event()
-                            monitor_thread = threading.Thread(target=_monitor, args=(monitor_event, 
-                                                                                     analysis_module, 
-                                                                                     work_item.observable))
-                            monitor_thread.daemon = True
-                            monitor_thread.start()
-
                         # we indicate that the analysis module refused to generate analysis (for whatever reason)
                         # by returning False here
                         try:
@@ -3013,14 +3560,14 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                             # let the tracker know that we're starting analysis for this observable and analysis module
                             # so that if this fails then the tracker can mark it as such
                             self.track_current_analysis_module(analysis_module, work_item.observable)
+                            # and let the watchdog know so it can watch how long this takes
+                            self.analysis_watchdog.watch(analysis_module, work_item.observable, maximum_analysis_time)
                             analysis_result = analysis_module.analyze(work_item.observable, final_analysis_mode)
                             # let the tracker know that we completed analysis work for this module
                             self.clear_module_tracking()
                         finally:
-                            # make sure we stop the monitor thread
-                            if not self.single_threaded_mode:
-                                monitor_event.set()
-                                monitor_thread.join()
+                            if self.analysis_watchdog.clear():
+                                self.handle_analysis_timeout(analysis_module, work_item.observable)
 
                         # this should always return a boolean
                         # but just warn if it doesn't
@@ -3165,11 +3712,32 @@ LIMIT 16""".format(where_clause=where_clause), tuple(params))
                         # then we exit final analysis mode so that everything can get a chance to execute again
                         final_analysis_mode = False
 
+        logging.info(f"analysis of {self.root} called accepts() {self.accepts_called} times "
+                     f"and skipped {self.accepts_skipped} calls")
+
         # did analysis complete when there was work left to do?
         #if len(work_stack):
             #logging.info("work on {} was incomplete".format(self.root))
             #self.work_incomplete(self.root)
 
+    def handle_analysis_timeout(self, analysis_module, observable):
+        """Called when the given analysis module exceeded the maximum analysis time on the given observable.
+           If the watchdog cancelled the analysis then it is marked as failed for the observable.
+           The module is quarantined if it times out too often."""
+        logging.warning(f"analysis module {analysis_module} exceeded maximum analysis time on {observable}")
+        # NOTE the cancel_analysis_flag of the module is reset by the watchdog before the next execution
+        if self.analysis_watchdog.was_cancelled():
+            self.root.set_analysis_failed(MODULE_PATH(analysis_module), observable.type, observable.value,
+                                          error_message="exceeded maximum analysis time")
+
+        count = self.analysis_module_timeouts.get(analysis_module.config_section, 0) + 1
+        self.analysis_module_timeouts[analysis_module.config_section] = count
+
+        if self.analysis_module_quarantine_threshold and count >= self.analysis_module_quarantine_threshold:
+            logging.error(f"analysis module {analysis_module} exceeded maximum analysis time {count} times "
+                           "and is quarantined")
+            self.quarantined_analysis_modules.add(analysis_module.config_section)
+
     def is_module_enabled(self, _type_or_string):
         """Returns True if the given module is enabled. 
            _type_or_string can be an instance of the class type, the string representation of that,
@@ -18,6 +18,7 @@ from queue import Empty
 
 import saq, saq.test
 from saq.analysis import RootAnalysis, _get_io_read_count, _get_io_write_count, Observable, Analysis
+from saq.analysis.cache import get_analysis_cache
 from saq.constants import *
 from saq.database import get_db_connection, use_db, acquire_lock, clear_expired_locks, initialize_node
 from saq.engine import Engine, DelayedAnalysisRequest, add_workload
@@ -239,6 +240,81 @@ class TestCase(ACEEngineTestCase):
         analysis = observable.get_analysis(BasicTestAnalysis)
         self.assertIsNotNone(analysis)
 
+    def test_work_dispatcher_analysis(self):
+
+        saq.CONFIG['service_engine']['work_dispatcher_enabled'] = 'yes'
+
+        roots = []
+        for i in range(3):
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.storage_dir = storage_dir_from_uuid(root.uuid)
+            root.initialize_storage()
+            root.add_observable(F_TEST, f'test_{i}')
+            root.analysis_mode = 'test_single'
+            root.save()
+            root.schedule()
+            roots.append(root)
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_basic_test')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        from saq.modules.test import BasicTestAnalysis
+        for root in roots:
+            root.load()
+            observable = root.find_observable(lambda o: o.type == F_TEST)
+            self.assertIsNotNone(observable.get_analysis(BasicTestAnalysis))
+
+        # everything should have been claimed by the dispatcher
+        self.assertEquals(len(search_log('got work item')), 3)
+
+    @use_db
+    def test_work_dispatcher_claim(self, db, c):
+        from saq.engine import WorkDispatcher, WORK_ITEM_TYPE_WORKLOAD
+
+        uuids = []
+        for i in range(3):
+            root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_single')
+            root.initialize_storage()
+            root.save()
+            root.schedule()
+            uuids.append(root.uuid)
+
+        # lock one of them ahead of time
+        self.assertTrue(acquire_lock(uuids[1], str(uuid.uuid4())))
+
+        engine = TestEngine()
+        dispatcher = WorkDispatcher(['test_single'])
+        dispatcher.lock_owner = 'unittest-dispatcher'
+        items = dispatcher.claim_work(10)
+        self.assertEquals(sorted([_.uuid for _ in items]), sorted([uuids[0], uuids[2]]))
+        for item in items:
+            self.assertEquals(item.type, WORK_ITEM_TYPE_WORKLOAD)
+            c.execute("SELECT lock_uuid FROM locks WHERE uuid = %s", (item.uuid,))
+            self.assertEquals(c.fetchone()[0], item.lock_uuid)
+
+        # nothing left to claim
+        self.assertEquals(dispatcher.claim_work(10), [])
+
+        # claimed work goes to the queue for the mode
+        dispatcher.mode_queues['test_single'].put(items[0])
+        self.assertEquals(dispatcher.get('test_single').uuid, items[0].uuid)
+
+        # the lock is refreshed (and owned by the worker) when a worker picks the item up
+        engine.analysis_mode_priority = 'test_single'
+        engine.lock_owner = 'unittest-worker'
+        dispatcher.mode_queues['test_single'].put(items[0])
+        self.assertEquals(engine.get_dispatched_work_target(dispatcher).uuid, items[0].uuid)
+        c.execute("SELECT lock_uuid, lock_owner FROM locks WHERE uuid = %s", (items[0].uuid,))
+        self.assertEquals(c.fetchone(), (items[0].lock_uuid, 'unittest-worker'))
+
+        # unless it waited in the queue for longer than the lock timeout
+        items[1].lock_time -= saq.LOCK_TIMEOUT_SECONDS
+        dispatcher.mode_queues['test_single'].put(items[1])
+        self.assertIsNone(engine.get_dispatched_work_target(dispatcher))
+
     def test_missing_analysis_mode(self):
 
         saq.CONFIG['service_engine']['default_analysis_mode'] = 'test_single'
@@ -274,9 +350,7 @@ class TestCase(ACEEngineTestCase):
         root.initialize_storage()
         observable = root.add_observable(F_TEST, 'test')
         # delete cached analysis if it exists
-        path = os.path.join(saq.SAQ_HOME, saq.DATA_DIR, 'analysis_cache')
-        if os.path.isdir(path):
-            shutil.rmtree(path)
+        get_analysis_cache().clear()
         root.save()
         root.schedule()
         engine = TestEngine()
@@ -294,8 +368,7 @@ class TestCase(ACEEngineTestCase):
         analysis = observable.get_analysis('CacheTestAnalysis')
         self.assertIsNotNone(analysis)
         self.assertFalse(analysis.details['cached']) # make sure analysis is correct
-        path = os.path.join(path, f"{observable.cache_id}.CacheTestAnalysis.v1.json")
-        self.assertTrue(os.path.isfile(path)) # make sure cache file was created
+        self.assertTrue(get_analysis_cache().contains(f"{observable.cache_id}.CacheTestAnalysis.v1")) # make sure the analysis was cached
 
         # rerun without deleting the cached file and make sure the analysis is the same
         root = create_root_analysis(uuid=str(uuid.uuid4()))
@@ -1480,6 +1553,34 @@ class TestCase(ACEEngineTestCase):
         # will fire again in final analysis
         self.assertEquals(log_count('excessive time - analysis module'), 2)
 
+    def test_maximum_analysis_time_quarantine(self):
+        # setting this to zero should cause it to happen right away
+        saq.CONFIG['global']['maximum_analysis_time'] = '0'
+        saq.CONFIG['global']['cancel_analysis_on_timeout'] = 'yes'
+        saq.CONFIG['global']['analysis_module_quarantine_threshold'] = '1'
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_groups')
+        root.initialize_storage()
+        test_observable = root.add_observable(F_TEST, 'test_4')
+        root.save()
+        root.schedule()
+        
+        engine = TestEngine(analysis_pools={'test_groups': 1})
+        engine.enable_module('analysis_module_basic_test', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        # the module should not execute again in final analysis
+        self.assertEquals(log_count('excessive time - analysis module'), 1)
+        self.assertEquals(log_count('cancelling analysis of'), 1)
+        self.assertEquals(log_count('is quarantined'), 1)
+
+        root.load()
+        test_observable = root.get_observable(test_observable.id)
+        from saq.modules.test import BasicTestAnalysis
+        self.assertTrue(root.is_analysis_failed(BasicTestAnalysis, test_observable))
+
     def test_is_module_enabled(self):
         root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_groups')
         root.initialize_storage()
@@ -1506,6 +1607,38 @@ class TestCase(ACEEngineTestCase):
             with self.subTest(target=KEY_FAIL, key=key):
                 self.assertFalse(analysis.details[KEY_FAIL][key])
 
+    def test_analysis_mode_type_index(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_groups')
+        root.initialize_storage()
+        test_observable = root.add_observable(F_TEST, 'test_1')
+        ipv4_observable = root.add_observable(F_IPV4, '1.2.3.4')
+
+        engine = TestEngine()
+        engine.enable_module('analysis_module_basic_test', 'test_groups')
+        engine.initialize_modules()
+
+        basic_test = engine.analysis_module_mapping['analysis_module_basic_test']
+        self.assertEquals(engine.get_analysis_modules_by_observable('test_groups', test_observable), [basic_test])
+        self.assertEquals(engine.get_analysis_modules_by_observable('test_groups', ipv4_observable), [])
+
+        # unknown analysis modes use the default analysis mode
+        self.assertEquals(engine.get_analysis_modules_by_observable('test_invalid', test_observable),
+                          engine.get_analysis_modules_by_observable(engine.default_analysis_mode, test_observable))
+
+        root.save()
+        root.schedule()
+
+        engine = TestEngine(analysis_pools={'test_groups': 1})
+        engine.enable_module('analysis_module_basic_test', 'test_groups')
+        engine.controlled_stop()
+        engine.start()
+        engine.wait()
+
+        # the ipv4 observable is never offered to the basic test module
+        results = search_log_regex(re.compile(r'and skipped (\d+) calls'))
+        self.assertEquals(len(results), 1)
+        self.assertTrue(int(re.search(r'and skipped (\d+) calls', results[0].getMessage()).group(1)) > 0)
+
     def test_analysis_mode_priority(self):
 
         root = create_root_analysis(uuid=str(uuid.uuid4()), analysis_mode='test_single')
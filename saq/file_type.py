@@ -0,0 +1,219 @@
+# vim: sw=4:ts=4:et
+#
+# file typing
+#
+# the type of a file (what file -b and file -b --mime-type would report) is determined in process with libmagic
+# (the python-magic package) which avoids running the file command (twice) for every file
+# the file command is still used if python-magic is not installed or libmagic fails
+#
+# the file is opened once, the first CHECK_SIZE bytes are read once and all of the is_* checks are answered from them
+# libmagic reads the open file itself (which gives the same results as the file command)
+# older versions of python-magic (before 0.4.25) can only type a buffer so the first header_size bytes are read for them
+#
+# the results are cached (per process) by the sha256 of the content of the file
+# so that the same content extracted from many different archives is only typed once
+#
+# see the [file_type] configuration section
+#
+
+import collections
+import logging
+import os
+import threading
+
+import saq
+from saq.process_server import Popen, PIPE
+
+# python-magic is an optional dependency (the file command is used without it)
+try:
+    import magic
+    # the bindings that ship with libmagic (file-magic) are also named magic but do not have the same interface
+    if not hasattr(magic, 'Magic'):
+        magic = None
+except ImportError:
+    magic = None
+
+# the number of bytes read from the start of a file for the is_* checks
+CHECK_SIZE = 1024
+
+# the default number of bytes libmagic types when it cannot read the file itself
+DEFAULT_HEADER_SIZE = 1024 * 1024
+
+OLE_SIGNATURE = b'\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1'
+
+#
+# these all answer the question from the first bytes of the file
+#
+
+def is_ole_header(header):
+    return header[:8] == OLE_SIGNATURE
+
+def is_rtf_header(header):
+    return header[:3] == b'\\rt' or header[:4] == b'{\\rt'
+
+def is_pdf_header(header):
+    return b'%PDF-' in header[:CHECK_SIZE]
+
+def is_pe_header(header):
+    return header[:2] == b'MZ'
+
+def is_zip_header(header):
+    return header[:2] == b'PK'
+
+class FileType(object):
+    """The type of a file."""
+
+    def __init__(self, description, mime, header):
+        # the human readable description (file -b)
+        self.description = description
+        # the mime type (file -b --mime-type)
+        self.mime = mime
+        self.is_ole_file = is_ole_header(header)
+        self.is_rtf_file = is_rtf_header(header)
+        self.is_pdf_file = is_pdf_header(header)
+        self.is_pe_file = is_pe_header(header)
+        self.is_zip_file = is_zip_header(header)
+
+    def __str__(self):
+        return f"FileType({self.description}, {self.mime})"
+
+def _file_command(path, *args):
+    """Returns the output of the file command for the given path."""
+    p = Popen(['file', '-b', '-L'] + list(args) + [path], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+
+    if len(stderr) > 0:
+        logging.warning("file command returned error output for {0}".format(path))
+
+    return stdout.decode(errors='ignore').strip()
+
+class FileTyper(object):
+    """Determines the types of files with libmagic (or the file command if libmagic is not available.)"""
+
+    def __init__(self, header_size=DEFAULT_HEADER_SIZE, cache_size=0, use_libmagic=True):
+        # the number of bytes libmagic types when it cannot read the file itself
+        self.header_size = header_size
+        # the maximum number of FileType objects cached
+        self.cache_size = cache_size
+        # set this to False to always use the file command
+        self.use_libmagic = use_libmagic and magic is not None
+
+        # key = sha256, value = FileType
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+
+        # libmagic cookies for the description and the mime type
+        self._magic = None
+        # the process that created them
+        self._magic_pid = None
+        self._magic_lock = threading.Lock()
+
+    @property
+    def cookies(self):
+        """Returns a tuple of (description, mime) python-magic objects, or None if libmagic is not used."""
+        if not self.use_libmagic:
+            return None
+
+        with self._magic_lock:
+            return self._get_cookies()
+
+    def _get_cookies(self):
+        # the caller holds _magic_lock
+        # libmagic cookies are not shared across forked processes
+        if self._magic is None or self._magic_pid != os.getpid():
+            self._magic = (magic.Magic(), magic.Magic(mime=True))
+            self._magic_pid = os.getpid()
+
+        return self._magic
+
+    def get_cached_type(self, sha256):
+        """Returns the cached FileType of the content with the given sha256, or None if it is not cached."""
+        with self.cache_lock:
+            result = self.cache.get(sha256)
+            if result is not None:
+                self.cache.move_to_end(sha256)
+
+            return result
+
+    def cache_type(self, sha256, file_type):
+        if self.cache_size < 1:
+            return
+
+        with self.cache_lock:
+            self.cache[sha256] = file_type
+            self.cache.move_to_end(sha256)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def get_type(self, path, sha256=None):
+        """Returns the FileType of the given file.
+           If the sha256 of the content is given then the result is cached (and looked up) by it.
+           Raises OSError if the file cannot be read."""
+        if sha256 is not None:
+            result = self.get_cached_type(sha256)
+            if result is not None:
+                return result
+
+        with open(path, 'rb') as fp:
+            header = fp.read(CHECK_SIZE)
+            description, mime = self._libmagic_type(path, fp)
+
+        if description is None or mime is None:
+            description = _file_command(path)
+            mime = _file_command(path, '--mime-type')
+
+        result = FileType(description, mime, header)
+        if sha256 is not None:
+            self.cache_type(sha256, result)
+
+        return result
+
+    def _libmagic_type(self, path, fp):
+        """Returns a tuple of (description, mime) determined by libmagic, or (None, None) if libmagic is not used or fails."""
+        if not self.use_libmagic:
+            return None, None
+
+        try:
+            # the cookies are shared by the threads of this process
+            with self._magic_lock:
+                cookies = self._get_cookies()
+                if hasattr(cookies[0], 'from_descriptor'):
+                    result = []
+                    for cookie in cookies:
+                        # libmagic reads from the current offset of the descriptor
+                        # (fp.seek() can be satisfied from the buffer of fp without moving it)
+                        os.lseek(fp.fileno(), 0, os.SEEK_SET)
+                        result.append(cookie.from_descriptor(fp.fileno()))
+
+                    return tuple(result)
+
+                fp.seek(0)
+                buffer = fp.read(self.header_size)
+                return cookies[0].from_buffer(buffer), cookies[1].from_buffer(buffer)
+
+        except Exception as e:
+            logging.warning(f"libmagic unable to determine the type of {path}: {e}")
+            return None, None
+
+    def clear(self):
+        with self.cache_lock:
+            self.cache.clear()
+
+# the FileTyper used by this process
+_file_typer = None
+
+def get_file_typer():
+    """Returns the FileTyper configured in the [file_type] section."""
+    global _file_typer
+    if _file_typer is None:
+        config = saq.CONFIG['file_type']
+        _file_typer = FileTyper(header_size=config.getint('header_size', fallback=DEFAULT_HEADER_SIZE),
+                                cache_size=config.getint('cache_size', fallback=0),
+                                use_libmagic=config.getboolean('use_libmagic', fallback=True))
+
+    return _file_typer
+
+def reset_file_typer():
+    """Discards the current FileTyper (if any) so that the next call to get_file_typer() creates a new one."""
+    global _file_typer
+    _file_typer = None
@@ -19,6 +19,7 @@ import saq
 from saq.error import report_exception
 from saq.constants import *
 from saq.database import Message, MessageRouting
+from saq.performance import record_metric
 
 from sqlalchemy import and_, func, literal, asc, text
 from sqlalchemy.orm import joinedload
@@ -148,6 +149,18 @@ class MessageSystem(object):
 
         logging.debug(f"loaded {len(self.systems)} messaging systems")
 
+def get_message_backlog():
+    """Returns a dict of the message routes that have not been dispatched yet.
+       key = route, value = { 'pending': unlocked count, 'locked': locked count }"""
+    result = {}
+    for route, count, locked in saq.db.query(
+        MessageRouting.route, 
+        func.count(MessageRouting.id), 
+        func.count(MessageRouting.lock)).group_by(MessageRouting.route):
+        result[route] = { 'pending': count - locked, 'locked': locked }
+
+    return result
+
 class ControlledStop(Exception):
     pass
 
@@ -165,10 +178,20 @@ class MessageDispatchSystem(object):
         self.control_event = None
         # the next time we check for timed out locks
         self.next_lock_timeout_check = None
-        # the number of message routing requests we'll lock at a time
+        # the number of message routing requests we'll lock (and dispatch) at a time
         self.batch_size = saq.CONFIG['messaging'].getint('batch_size')
         # used to stop the system once all available messages (for this route) have been processed
         self.controlled_stop = False
+        # throughput metrics
+        self.start_time = time.time()
+        self.dispatched_count = 0
+        self.failed_count = 0
+        self.batch_count = 0
+        # how often (in seconds) metrics are recorded
+        self.metrics_interval = saq.CONFIG['messaging'].getint('metrics_interval', fallback=60)
+        self.next_metrics_time = None
+        # the number of messages dispatched since the last time metrics were recorded
+        self.interval_dispatched_count = 0
 
     def start(self):
         self.control_event = threading.Event()
@@ -215,18 +238,23 @@ class MessageDispatchSystem(object):
         # this will be messages that were locked but never sent for some reason
         if self.next_lock_timeout_check is None or datetime.datetime.now() >= self.next_lock_timeout_check:
             saq.db.execute(MessageRouting.__table__.update().values(lock=None).where(and_(
-                MessageRouting.lock == None,
-                func.TIMESTAMPDIFF(text('SECOND'), MessageRouting.lock_time, func.NOW()))))
+                MessageRouting.route == self.route,
+                MessageRouting.lock != None,
+                func.TIMESTAMPDIFF(text('SECOND'), MessageRouting.lock_time, func.NOW()) >= 
+                    saq.CONFIG['messaging'].getint('lock_timeout'))))
             saq.db.commit()
             self.next_lock_timeout_check = datetime.datetime.now() + \
                 datetime.timedelta(seconds=saq.CONFIG['messaging'].getint('lock_timeout'))
 
-        # get the next message to send
-        message_route = saq.db.query(MessageRouting).options(joinedload('message')).filter(
-            MessageRouting.lock == self.lock_uuid).order_by(asc(MessageRouting.message_id)).first()
+        if self.next_metrics_time is None or datetime.datetime.now() >= self.next_metrics_time:
+            self.record_metrics()
+            self.next_metrics_time = datetime.datetime.now() + datetime.timedelta(seconds=self.metrics_interval)
+
+        # get the next batch of messages to send
+        message_routes = self.get_locked_routes()
 
-        if message_route is None:
-            # if we didn't get one then go ahead and lock the next batch of messages
+        if not message_routes:
+            # if we didn't get any then go ahead and lock the next batch of messages
             target_ids = saq.db.query(MessageRouting.id).filter(and_(
                 MessageRouting.lock == None,
                 MessageRouting.route == self.route))\
@@ -252,30 +280,122 @@ class MessageDispatchSystem(object):
 
             saq.db.commit()
 
-        # try again to get the next message to send
-        message_route = saq.db.query(MessageRouting).options(joinedload('message')).filter(
-            MessageRouting.lock == self.lock_uuid).order_by(asc(MessageRouting.message_id)).first()
+            # try again to get the next batch of messages to send
+            message_routes = self.get_locked_routes()
 
-        # if we still didn't get a message then we wait for a while
-        if message_route is None:
+        # if we still didn't get any messages then we wait for a while
+        if not message_routes:
             if self.controlled_stop:
                 raise ControlledStop()
             else:
                 return 5 # TODO make configurable?
 
-        # dispatch the message
-        logging.debug(f"dispatching message {message_route.message_id} to route {message_route.route} destination {message_route.destination}")
-        self.dispatch(message_route.message, message_route.destination)
-        
-        # clear this message out
-        saq.db.execute(MessageRouting.__table__.delete().where(MessageRouting.id == message_route.id))
+        # dispatch the messages
+        logging.debug(f"dispatching {len(message_routes)} messages to route {self.route}")
+        dispatched_routes = self.dispatch_routes(message_routes)
+        self.batch_count += 1
+        self.dispatched_count += len(dispatched_routes)
+        self.interval_dispatched_count += len(dispatched_routes)
+        self.failed_count += len(message_routes) - len(dispatched_routes)
 
-        # and finally clear the message if all the routes have completed
-        saq.db.execute(Message.__table__.delete().where(Message.id.notin_(saq.db.query(MessageRouting.message_id))))
-        saq.db.commit()
+        if dispatched_routes:
+            # clear these routes out
+            saq.db.execute(MessageRouting.__table__.delete().where(
+                MessageRouting.id.in_([_.id for _ in dispatched_routes])))
+
+            # and finally clear the messages that have completed all of their routes
+            message_ids = set([_.message_id for _ in dispatched_routes])
+            remaining_ids = set([_[0] for _ in saq.db.query(MessageRouting.message_id).filter(
+                MessageRouting.message_id.in_(message_ids)).distinct()])
+
+            if message_ids - remaining_ids:
+                saq.db.execute(Message.__table__.delete().where(Message.id.in_(message_ids - remaining_ids)))
+
+            saq.db.commit()
+
+        if len(dispatched_routes) < len(message_routes):
+            # if nothing could be sent then the destination is probably down (the messages stay locked for the retry)
+            if not dispatched_routes:
+                return 30
+
+            # otherwise the failed messages go back into the queue and we move on to the next batch
+            dispatched_ids = set([_.id for _ in dispatched_routes])
+            saq.db.execute(MessageRouting.__table__.update().values(lock=None).where(and_(
+                MessageRouting.id.in_([_.id for _ in message_routes if _.id not in dispatched_ids]),
+                MessageRouting.lock == self.lock_uuid)))
+            saq.db.commit()
 
         return 0
 
+    def get_locked_routes(self):
+        """Returns the list of MessageRouting objects (with messages loaded) currently locked by this system."""
+        return saq.db.query(MessageRouting).options(joinedload('message')).filter(
+            MessageRouting.lock == self.lock_uuid).order_by(asc(MessageRouting.message_id)).limit(self.batch_size).all()
+
+    def dispatch_routes(self, message_routes):
+        """Dispatches the given list of MessageRouting objects grouped by destination.
+           Returns the list of the MessageRouting objects that were dispatched."""
+        destinations = collections.OrderedDict() # key = destination, value = [MessageRouting]
+        for message_route in message_routes:
+            destinations.setdefault(message_route.destination, []).append(message_route)
+
+        result = []
+        for destination, routes in destinations.items():
+            try:
+                dispatched = self.dispatch_messages([_.message for _ in routes], destination)
+            except Exception as e:
+                logging.error(f"unable to dispatch {len(routes)} messages to route {self.route} "
+                              f"destination {destination}: {e}")
+                report_exception()
+                continue
+
+            dispatched_ids = set([_.id for _ in dispatched])
+            result.extend([_ for _ in routes if _.message_id in dispatched_ids])
+
+        return result
+
+    def dispatch_messages(self, messages, destination):
+        """Dispatches the given list of messages to the given destination. Returns the list of messages that were sent.
+           The default implementation calls dispatch() for each message.
+           Systems that can send more than one message at a time can override this."""
+        result = []
+        for message in messages:
+            logging.debug(f"dispatching message {message.id} to route {self.route} destination {destination}")
+            try:
+                self.dispatch(message, destination)
+                result.append(message)
+            except Exception as e:
+                logging.error(f"unable to dispatch message {message.id} to route {self.route} "
+                              f"destination {destination}: {e}")
+                report_exception()
+
+        return result
+
+    def get_stats(self):
+        """Returns a dict of the throughput of this system and the backlog of its route."""
+        elapsed = time.time() - self.start_time
+        result = {
+            'dispatched': self.dispatched_count,
+            'failed': self.failed_count,
+            'batches': self.batch_count,
+            'messages_per_second': self.dispatched_count / elapsed if elapsed > 0 else 0.0,
+        }
+
+        result.update(get_message_backlog().get(self.route, { 'pending': 0, 'locked': 0 }))
+        return result
+
+    def record_metrics(self):
+        try:
+            stats = self.get_stats()
+            record_metric(f'message_dispatch_{self.route}', self.interval_dispatched_count)
+            record_metric(f'message_backlog_{self.route}', stats['pending'] + stats['locked'])
+            self.interval_dispatched_count = 0
+            logging.info(f"{self.name} route {self.route} dispatched {stats['dispatched']} "
+                         f"({stats['messages_per_second']:.2f}/sec) failed {stats['failed']} "
+                         f"backlog {stats['pending']} pending {stats['locked']} locked")
+        except Exception as e:
+            logging.error(f"unable to record message dispatch metrics: {e}")
+
     @property
     def name(self):
         return type(self).__name__
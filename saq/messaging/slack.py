@@ -15,18 +15,65 @@ from saq.proxy import proxies
 import requests
 
 class SlackMessageDispatchSystem(MessageDispatchSystem):
-    def dispatch(self, message, destination):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the connection to slack is reused for all the messages
+        self.session = requests.Session()
+        # when enabled, the messages in a batch are combined into as few posts as possible
+        self.combine_messages = self.config.getboolean('combine_messages', fallback=False)
+        # the maximum length of the text of a combined post
+        self.max_combined_length = self.config.getint('max_combined_length', fallback=4000)
+
+    def get_slack_url(self, destination):
         # the destination is a lookup key in the config
         try:
-            slack_url = self.config[f'destination_{destination}']
+            return self.config[f'destination_{destination}']
         except KeyError:
             logging.error(f"missing slack destination {destination}")
-            return
-        
-        logging.info(f"submitting message {message.id} to {slack_url}")
-        result = requests.post(slack_url, 
+            return None
+
+    def post(self, slack_url, text):
+        return self.session.post(slack_url, 
             proxies=proxies(),
             headers={'Content-Type': 'application/json'}, 
-            json={'text': message.content})
+            json={'text': text})
 
+    def dispatch(self, message, destination):
+        slack_url = self.get_slack_url(destination)
+        if slack_url is None:
+            return
+        
+        logging.info(f"submitting message {message.id} to {slack_url}")
+        result = self.post(slack_url, message.content)
         logging.info(f"got result {result.text} ({result.status_code}) for message {message.id}")
+
+    def dispatch_messages(self, messages, destination):
+        if not self.combine_messages:
+            return super().dispatch_messages(messages, destination)
+
+        slack_url = self.get_slack_url(destination)
+        if slack_url is None:
+            return messages
+
+        # split the messages into posts that fit in the maximum length
+        posts = [] # list of lists of messages
+        length = 0
+        for message in messages:
+            if not posts or length + len(message.content) + 1 > self.max_combined_length:
+                posts.append([])
+                length = 0
+
+            posts[-1].append(message)
+            length += len(message.content) + 1
+
+        result = []
+        for post in posts:
+            logging.info(f"submitting {len(post)} messages to {slack_url}")
+            try:
+                response = self.post(slack_url, '\n'.join([_.content for _ in post]))
+                logging.info(f"got result {response.text} ({response.status_code}) for {len(post)} messages")
+                result.extend(post)
+            except Exception as e:
+                logging.error(f"unable to submit {len(post)} messages to {slack_url}: {e}")
+
+        return result
@@ -8,9 +8,9 @@ import saq
 import saq.test
 
 from saq.constants import *
-from saq.database import Message
+from saq.database import Message, MessageRouting
 from saq.messaging import MessageDispatchSystem, initialize_message_system, send_message, \
-                          start_message_system, stop_message_system
+                          start_message_system, stop_message_system, get_message_backlog
 from saq.test import *
 
 class TestMessageDispatchSystem(MessageDispatchSystem):
@@ -23,6 +23,13 @@ class TestMessageDispatchSystem(MessageDispatchSystem):
         self.messages_received.append((message, destination))
         self.message_dispatched.set()
 
+class FailingTestMessageDispatchSystem(TestMessageDispatchSystem):
+    def dispatch(self, message, destination):
+        if message.content == 'fail':
+            raise RuntimeError("dispatch failed")
+
+        super().dispatch(message, destination)
+
 class TestCase(ACEBasicTestCase):
 
     def test_mds_load(self):
@@ -100,3 +107,46 @@ class TestCase(ACEBasicTestCase):
         self.assertTrue(saq.MESSAGE_SYSTEM.systems['test_2'].message_dispatched.wait(5))
         stop_message_system()
         self.assertIsNone(saq.db.query(Message).first())
+
+    def test_batch_submit(self):
+        saq.CONFIG['messaging']['batch_size'] = '10'
+        initialize_message_system()
+        for i in range(25):
+            send_message(f'message {i}', 'test')
+
+        start_message_system()
+        system = saq.MESSAGE_SYSTEM.systems['test']
+        wait_for(lambda: len(system.messages_received) == 25, 1, 10)
+        stop_message_system()
+        self.assertEquals(len(system.messages_received), 25)
+        # messages are dispatched in the order they were sent
+        self.assertEquals([_[0].content for _ in system.messages_received], [f'message {i}' for i in range(25)])
+        self.assertEquals(system.dispatched_count, 25)
+        self.assertEquals(system.batch_count, 3)
+        self.assertIsNone(saq.db.query(Message).first())
+        self.assertIsNone(saq.db.query(MessageRouting).first())
+
+    def test_failed_dispatch(self):
+        saq.CONFIG['messaging_system_test']['class'] = 'FailingTestMessageDispatchSystem'
+        initialize_message_system()
+        send_message('fail', 'test')
+        send_message('hello world', 'test')
+        start_message_system()
+        system = saq.MESSAGE_SYSTEM.systems['test']
+        self.assertTrue(system.message_dispatched.wait(5))
+        stop_message_system()
+
+        # the message that failed is still waiting to be sent
+        self.assertEquals([_.content for _ in saq.db.query(Message)], [ 'fail' ])
+        self.assertEquals(saq.db.query(MessageRouting).count(), 1)
+        self.assertTrue(system.failed_count > 0)
+
+    def test_get_message_backlog(self):
+        initialize_message_system()
+        self.assertEquals(get_message_backlog(), {})
+        send_message('hello world', 'test')
+        send_message('hello world', 'test')
+        self.assertEquals(get_message_backlog(), { 'test': { 'pending': 2, 'locked': 0 }})
+        stats = saq.MESSAGE_SYSTEM.systems['test'].get_stats()
+        self.assertEquals(stats['pending'], 2)
+        self.assertEquals(stats['dispatched'], 0)
@@ -18,6 +18,7 @@ import saq
 
 from saq import graph_api
 from saq.analysis import Analysis, Observable, MODULE_PATH, SPLIT_MODULE_PATH
+from saq.analysis.cache import get_analysis_cache
 from saq.constants import *
 from saq.error import report_exception
 from saq.network_semaphore import NetworkSemaphoreClient
@@ -549,33 +550,31 @@ class AnalysisModule(object):
     def cache_expiration(self):
         return create_timedelta(self.config['cache_expiration']) if 'cache_expiration' in self.config else datetime.timedelta(hours=24)
 
+    def get_cache_key(self, observable):
+        """Returns the key of the cached analysis of this module for the given observable."""
+        return f'{observable.cache_id}.{self.generated_analysis_type.__name__}.v{self.version}'
+
     def load_cached_analysis(self, observable):
         try:
             # do not load cached analysis if caching is not enabled
             if not self.cache:
                 return False
 
-            # path to cached analysis
-            path = os.path.join(saq.SAQ_HOME, saq.DATA_DIR, 'analysis_cache', f'{observable.cache_id}.{self.generated_analysis_type.__name__}.v{self.version}.json')
-
-            # return false if there is no cached analysis at the cached analysis path
-            if not os.path.isfile(path):
-                return False
-
-            # do not use cached analysis if it is expired
-            if os.path.getmtime(path) + self.cache_expiration.total_seconds() < time.time():
+            # return false if there is no cached analysis (or it has expired)
+            cached_analysis_json = get_analysis_cache().get(self.config_section, self.get_cache_key(observable))
+            if cached_analysis_json is None:
                 return False
 
             # create analysis from cached analysis
-            with atomic_open(path) as f:
-                cached_analysis = json.load(f)
-                analysis = self.create_analysis(observable)
-                analysis.details = cached_analysis['details']
-                for cached_observable in cached_analysis['observables']:
-                    analysis.add_observable(cached_observable['type'], cached_observable['value'])
+            cached_analysis = json.loads(cached_analysis_json)
+            analysis = self.create_analysis(observable)
+            analysis.details = cached_analysis['details']
+            for cached_observable in cached_analysis['observables']:
+                analysis.add_observable(cached_observable['type'], cached_observable['value'])
 
         # do not use cacheed analysis if it fails to load for any reason
         except Exception as e:
+            logging.debug(f"unable to load cached analysis for {observable}: {e}")
             return False
 
         # cached analysis successfully loaded
@@ -583,16 +582,13 @@ class AnalysisModule(object):
 
     def cache_analysis(self, observable):
         try:
-            base_path = os.path.join(saq.SAQ_HOME, saq.DATA_DIR, "analysis_cache")
-            create_directory(base_path)
-            path = os.path.join(base_path, f'{observable.cache_id}.{self.generated_analysis_type.__name__}.v{self.version}.json')
-            with atomic_open(path, 'w') as f:
-                analysis = observable.get_analysis(self.generated_analysis_type, instance=self.instance)
-                cached_analysis = {
-                    "details": analysis.details,
-                    "observables": [ {"type":o.type, "value":o.value} for o in analysis.observables ]
-                }
-                json.dump(cached_analysis, f)
+            analysis = observable.get_analysis(self.generated_analysis_type, instance=self.instance)
+            cached_analysis = {
+                "details": analysis.details,
+                "observables": [ {"type":o.type, "value":o.value} for o in analysis.observables ]
+            }
+            get_analysis_cache().put(self.config_section, self.get_cache_key(observable), 
+                                     json.dumps(cached_analysis), self.cache_expiration.total_seconds())
 
         except Exception as e:
             logging.warn(f"failed to cache analysis: {e}")
@@ -3,7 +3,6 @@ import datetime
 import email.header
 import email.parser
 import email.utils
-import gzip
 import hashlib
 import json
 import logging
@@ -23,11 +22,12 @@ from saq.analysis import Analysis, Observable, recurse_tree, search_down
 from saq.brocess import query_brocess_by_email_conversation, query_brocess_by_source_email
 from saq.constants import *
 from saq.cracking import generate_wordlist
-from saq.crypto import encrypt, decrypt
+from saq.crypto import CHUNK_SIZE, COMPRESSION_GZIP, open_encrypted
 from saq.database import get_db_connection, execute_with_retry, Alert, use_db
 from saq.email import (
         decode_rfc2822,
         get_email_archive_sections, 
+        index_archive_trigrams,
         is_local_email_domain,
         normalize_email_address, 
         normalize_message_id, 
@@ -121,6 +121,21 @@ def get_received_time(received_header):
 
     return None
 
+def write_archive_file(source_path, archive_path):
+    """Compresses (gzip) and encrypts the given file into archive_path in a single pass.
+       The data is written to a temporary file that is renamed to archive_path when complete
+       so that a partial archive file is never seen at archive_path."""
+    temp_path = f'{archive_path}.{uuid.uuid4()}.tmp'
+    try:
+        with open(source_path, 'rb') as fp_in:
+            with open_encrypted(temp_path, 'wb', compression=COMPRESSION_GZIP) as fp_out:
+                shutil.copyfileobj(fp_in, fp_out, CHUNK_SIZE)
+
+        os.rename(temp_path, archive_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 class MailboxEmailAnalysis(Analysis):
     def initialize_details(self):
         self.details = None
@@ -442,15 +457,13 @@ class EncryptedArchiveAnalyzer(AnalysisModule):
             return False
 
         file_path = os.path.join(self.root.storage_dir, _file.value)
-        gzip_path = '{}.rfc822.gz'.format(file_path[:-len('.gz.e')])
         dest_path = '{}.rfc822'.format(file_path[:-len('.gz.e')])
 
-        # decrypt and decompress the archive file
+        # decrypt and decompress the archive file in a single pass
         try:
-            decrypt(file_path, gzip_path)
-            with gzip.open(gzip_path, 'rb') as fp_in:
+            with open_encrypted(file_path, 'rb', compression=COMPRESSION_GZIP) as fp_in:
                 with open(dest_path, 'wb') as fp_out:
-                    shutil.copyfileobj(fp_in, fp_out)
+                    shutil.copyfileobj(fp_in, fp_out, CHUNK_SIZE)
 
         except Exception as e:
             logging.error("unable to decrypt {}: {}".format(file_path, e))
@@ -536,37 +549,11 @@ class BrotexSMTPStreamArchiveAction(AnalysisModule):
             shutil.copy2(source_path, archive_path)
 
         archive_path += '.gz'
-
-        # compress the data
-        logging.debug("compressing {}".format(archive_path))
-        try:
-            with open(source_path, 'rb') as fp_in:
-                with gzip.open(archive_path, 'wb') as fp_out:
-                    shutil.copyfileobj(fp_in, fp_out)
-
-        except Exception as e:
-            logging.error("compression failed for {}: {}".format(archive_path, e))
-
-        if not os.path.exists(archive_path):
-            raise Exception("compression failed for {}".format(archive_path))
-
-        # encrypt the archive file
         encrypted_file = '{}.e'.format(archive_path)
 
-        try:
-            encrypt(archive_path, encrypted_file)
-        except Exception as e:
-            logging.error("unable to encrypt archived stream {}: {}".format(archive_path, e))
-
-        if os.path.exists(encrypted_file):
-            logging.debug("encrypted {}".format(archive_path))
-            try:
-                os.remove(archive_path)
-            except Exception as e:
-                logging.error("unable to delete unencrypted archive file {}: {}".format(archive_path, e))
-                raise e
-        else:
-            raise Exception("expected encrypted output file {} does not exist".format(encrypted_file))
+        # compress and encrypt the data in a single pass
+        logging.debug("compressing and encrypting {}".format(encrypted_file))
+        write_archive_file(source_path, encrypted_file)
 
         logging.debug("archived stream {} to {}".format(source_path, encrypted_file))
 
@@ -2241,37 +2228,17 @@ class EmailArchiveAction(AnalysisModule):
                 analysis.details = archive_path
                 return True
                 
-            # compress the data
-            logging.debug(f"compressing {archive_path}")
-            try:
-                with open(source_path, 'rb') as fp_in:
-                    with gzip.open(archive_path, 'wb') as fp_out:
-                        shutil.copyfileobj(fp_in, fp_out)
-
-            except Exception as e:
-                logging.error(f"compression failed for {archive_path}: {e}".format(archive_path, e))
-                return False
-
-            # encrypt the archive file
+            # compress and encrypt the email in a single pass
             encrypted_file = f'{archive_path}.e'
 
             try:
-                encrypt(archive_path, encrypted_file)
+                write_archive_file(source_path, encrypted_file)
             except Exception as e:
-                logging.error(f"unable to encrypt archived email {archive_path}: {e}")
-
-            logging.info(f"archived email {archive_path} to {encrypted_file}")
-
-            # delete the unencrypted copy
-            if os.path.exists(encrypted_file):
-                try:
-                    os.remove(archive_path)
-                except Exception as e:
-                    logging.error(f"unable to delete unencrypted archive file {archive_path}: {e}")
-            else:
-                logging.error(f"expected encrypted output file {encrypted_file} does not exist")
+                logging.error(f"unable to archive email {source_path} to {encrypted_file}: {e}")
                 return False
 
+            logging.info(f"archived email {source_path} to {encrypted_file}")
+
             analysis.details = archive_path
 
         self.index_email(_file, email_analysis)
@@ -2382,6 +2349,11 @@ class EmailArchiveAction(AnalysisModule):
                     "INSERT IGNORE INTO archive_search ( field, value, archive_id ) VALUES ( %s, %s, %s )", 
                     (field, email_property[:2083], archive_id))
 
+            # update the substring search index (see saq.email.ArchiveTrigramSearch)
+            if saq.CONFIG['email_archive'].getboolean('trigram_index', fallback=False):
+                index_archive_trigrams(db, c, archive_id, 
+                                       [(field, email_property[:2083]) for field, email_property in transactions])
+
             db.commit()
 
     #
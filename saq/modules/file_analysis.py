@@ -39,6 +39,7 @@ from saq.analysis import Analysis, Observable, RootAnalysis, _JSONEncoder
 from saq.constants import *
 from saq.crypto import encrypt
 from saq.error import report_exception
+from saq.file_type import get_file_typer, is_ole_header, is_rtf_header, is_pdf_header, is_pe_header, is_zip_header
 from saq.modules import AnalysisModule
 from saq.process_server import Popen, PIPE, DEVNULL, TimeoutExpired
 from saq.util import is_url, URL_REGEX_B, URL_REGEX_STR, is_subdomain, abs_path
@@ -150,25 +151,23 @@ def is_macro_ext(path):
 
 def is_ole_file(path):
     with open(path, 'rb') as fp:
-        return fp.read(8) == b'\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1'
+        return is_ole_header(fp.read(8))
 
 def is_rtf_file(path):
     with open(path, 'rb') as fp:
-        data = fp.read(4)
-        return data[:3] == b'\\rt' or data == b'{\\rt'
-
+        return is_rtf_header(fp.read(4))
 
 def is_pdf_file(path):
     with open(path, 'rb') as fp:
-        return b'%PDF-' in fp.read(1024)
+        return is_pdf_header(fp.read(1024))
 
 def is_pe_file(path):
     with open(path, 'rb') as fp:
-        return fp.read(2) == b'MZ'
+        return is_pe_header(fp.read(2))
 
 def is_zip_file(path):
     with open(path, 'rb') as fp:
-        return fp.read(2) == b'PK'
+        return is_zip_header(fp.read(2))
 
 def is_empty_macro(path):
     """Returns True if the given macro file only has empty lines and/or Attribute settings."""
@@ -2020,30 +2019,19 @@ class FileTypeAnalyzer(AnalysisModule):
         logging.debug("analyzing file {}".format(local_file_path))
         analysis = self.create_analysis(_file)
 
-        # get the human readable
-        p = Popen(['file', '-b', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {0}".format(local_file_path))
-
-        analysis.details['type'] = stdout.decode().strip()
-
-        # get the mime type
-        p = Popen(['file', '-b', '--mime-type', '-L', local_file_path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {0}".format(local_file_path))
+        # the type is cached by the content of the file if the hashes have already been computed (see saq.file_type)
+        file_type = get_file_typer().get_type(local_file_path, sha256=_file._sha256_hash)
 
-        analysis.details['mime'] = stdout.decode().strip()
+        # the human readable type and the mime type
+        analysis.details['type'] = file_type.description
+        analysis.details['mime'] = file_type.mime
 
         analysis.details['is_office_ext'] = is_office_ext(local_file_path)
-        analysis.details['is_ole_file'] = is_ole_file(local_file_path)
-        analysis.details['is_rtf_file'] = is_rtf_file(local_file_path)
-        analysis.details['is_pdf_file'] = is_pdf_file(local_file_path)
-        analysis.details['is_pe_ext'] = is_pe_file(local_file_path)
-        analysis.details['is_zip_file'] = is_zip_file(local_file_path)
+        analysis.details['is_ole_file'] = file_type.is_ole_file
+        analysis.details['is_rtf_file'] = file_type.is_rtf_file
+        analysis.details['is_pdf_file'] = file_type.is_pdf_file
+        analysis.details['is_pe_ext'] = file_type.is_pe_file
+        analysis.details['is_zip_file'] = file_type.is_zip_file
 
         is_office_document = analysis.details['is_office_ext']
         is_office_document |= 'microsoft powerpoint' in analysis.file_type.lower()
@@ -13,6 +13,7 @@ import saq
 import saq.test
 from saq.constants import *
 from saq.analysis import Analysis
+from saq.analysis.cache import get_analysis_cache
 from saq.modules import AnalysisModule
 from saq.test import *
 from saq.util import *
@@ -258,8 +259,7 @@ class CacheTestAnalyzer(AnalysisModule):
     def execute_analysis(self, observable):
         analysis = self.create_analysis(observable)
         # change analysis details depending on if analysis is cached or not
-        path = os.path.join(saq.SAQ_HOME, saq.DATA_DIR, 'analysis_cache', f'{observable.cache_id}.{self.generated_analysis_type.__name__}.v{self.version}.json')
-        if os.path.isfile(path):
+        if get_analysis_cache().contains(self.get_cache_key(observable)):
             analysis.details['cached'] = True
         return True
 
@@ -5,12 +5,17 @@
 # to make sure they don't overwhelm the resources they use
 # see semaphores.txt
 
+import asyncio
+import bisect
+import collections
 import datetime
 import ipaddress
+import itertools
+import json
 import logging
 import multiprocessing
 import os
-import re
+import select
 import socket
 import sys
 import threading
@@ -97,6 +102,224 @@ class LoggingSemaphore(Semaphore):
             self.count -= 1
         logging.debug(f"release: semaphore {self.semaphore_name} count is {self.count}")
 
+# how often (in seconds) the watchdog of a multiplexed connection sends a keep alive for held semaphores
+MULTIPLEXED_KEEPALIVE_INTERVAL = 3
+# how long (in seconds) to wait to connect to the network semaphore server
+CONNECT_TIMEOUT = 5
+
+class MultiplexedRequest(object):
+    """A request for one or more semaphores made over a MultiplexedSemaphoreConnection."""
+    def __init__(self, request_id, semaphore_names):
+        self.request_id = request_id
+        self.semaphore_names = semaphore_names
+        # set when the state of the request changes
+        self.event = threading.Event()
+        # set to True when the server responds to the request
+        self.responded = False
+        # set to True when all the semaphores are acquired
+        self.granted = False
+        self.grant_time = None
+        # set to the exception if the connection fails before the request is granted
+        self.error = None
+
+class MultiplexedSemaphoreConnection(object):
+    """A persistent connection to the network semaphore server shared by all the NetworkSemaphoreClient objects
+       of a process. Any number of requests can be made over the connection at the same time.
+       A single watchdog thread reads the responses from the server and sends keep alives for held semaphores."""
+    def __init__(self, remote_address, remote_port):
+        self.remote_address = remote_address
+        self.remote_port = remote_port
+        # the connection to the server (None if not connected)
+        self.socket = None
+        # protects the socket and the requests
+        self.lock = threading.RLock()
+        # key = request_id, value = MultiplexedRequest
+        self.requests = {}
+        self.request_ids = itertools.count()
+        self.watchdog_thread = None
+
+    def connect(self):
+        with self.lock:
+            if self.socket is not None:
+                return
+
+            logging.debug(f"connecting to network semaphore server {self.remote_address}:{self.remote_port}")
+            self.socket = socket.create_connection((self.remote_address, self.remote_port), timeout=CONNECT_TIMEOUT)
+            self.socket.settimeout(None)
+            self.watchdog_thread = Thread(target=self.watchdog_loop, args=(self.socket,), name="Semaphore Watchdog")
+            self.watchdog_thread.daemon = True
+            self.watchdog_thread.start()
+
+    def disconnect(self, _socket, error):
+        """Closes the given socket (if it's still the current connection) and fails the requests made over it."""
+        with self.lock:
+            if self.socket is not _socket:
+                return
+
+            self.socket = None
+            try:
+                _socket.close()
+            except Exception:
+                pass
+
+            for request in self.requests.values():
+                if request.granted:
+                    logging.error(f"lost connection to network semaphore server while holding "
+                                  f"{','.join(request.semaphore_names)}: {error}")
+                else:
+                    request.error = error
+                    request.event.set()
+
+            self.requests = {}
+
+    def send(self, message):
+        with self.lock:
+            if self.socket is None:
+                raise RuntimeError("not connected to network semaphore server")
+
+            self.socket.sendall(message.encode('ascii'))
+
+    def acquire(self, semaphore_names, deadline=None, is_cancelled=None):
+        """Acquires all of the given semaphores in a single request.
+           Returns the MultiplexedRequest once they are acquired or None if the deadline (a datetime) passes 
+           or is_cancelled() returns True first. Raises an exception if the server cannot be used."""
+        for semaphore_name in semaphore_names:
+            if not semaphore_name or '|' in semaphore_name or ',' in semaphore_name:
+                raise ValueError(f"invalid semaphore name {semaphore_name}")
+
+        # a connection that was closed by the server is only detected when it's used so we try again once
+        for attempt in range(2):
+            request = MultiplexedRequest(str(next(self.request_ids)), semaphore_names)
+            with self.lock:
+                reused = self.socket is not None
+                try:
+                    self.connect()
+                    self.requests[request.request_id] = request
+                    self.send(f"lock:{request.request_id}:{','.join(semaphore_names)}|")
+                except Exception as e:
+                    self.requests.pop(request.request_id, None)
+                    if self.socket is not None:
+                        self.disconnect(self.socket, e)
+
+                    if not reused or attempt > 0:
+                        raise
+
+                    continue
+
+            while True:
+                request.event.clear()
+                if request.error is not None:
+                    break
+
+                if request.granted:
+                    return request
+
+                if is_cancelled is not None and is_cancelled():
+                    logging.debug(f"semaphore request for {','.join(semaphore_names)} cancelled")
+                    self.release(request)
+                    return None
+
+                # we always wait for the server to respond to know if the semaphores are available right now
+                if request.responded and deadline is not None and datetime.datetime.now() >= deadline:
+                    logging.error(f"attempt to acquire semaphore {','.join(semaphore_names)} timed out")
+                    self.release(request)
+                    return None
+
+                request.event.wait(1)
+
+            # retry if a connection that was already open failed before the server saw the request
+            if request.responded or not reused or attempt > 0:
+                raise request.error
+
+    def release(self, request):
+        """Releases the semaphores of the given MultiplexedRequest (or cancels the request if it's still waiting.)"""
+        with self.lock:
+            if self.requests.pop(request.request_id, None) is None:
+                return
+
+            try:
+                self.send(f'unlock:{request.request_id}|')
+            except Exception as e:
+                logging.error(f"unable to release semaphore {','.join(request.semaphore_names)}: {e}")
+                self.disconnect(self.socket, e)
+
+    def handle_response(self, response):
+        if response == 'wait':
+            return
+
+        command, _, request_id = response.partition(':')
+        if command == 'ok':
+            return
+
+        if command not in [ 'wait', 'locked' ]:
+            raise ValueError(f"received invalid response {response}")
+
+        with self.lock:
+            request = self.requests.get(request_id)
+
+        if request is None:
+            return
+
+        request.responded = True
+        if command == 'locked':
+            request.granted = True
+            request.grant_time = datetime.datetime.now()
+
+        request.event.set()
+
+    def watchdog_loop(self, _socket):
+        buffer = ''
+        last_keep_alive = time.monotonic()
+        try:
+            while True:
+                readable, _, _ = select.select([_socket], [], [], MULTIPLEXED_KEEPALIVE_INTERVAL)
+                if readable:
+                    data = _socket.recv(4096)
+                    if not data:
+                        raise RuntimeError("detected server disconnect")
+
+                    # deal with the possibility of multiple (or partial) responses received at once
+                    *responses, buffer = (buffer + data.decode('ascii')).split('|')
+                    for response in responses:
+                        self.handle_response(response)
+
+                if time.monotonic() - last_keep_alive < MULTIPLEXED_KEEPALIVE_INTERVAL:
+                    continue
+
+                last_keep_alive = time.monotonic()
+                with self.lock:
+                    if self.socket is not _socket:
+                        return
+
+                    granted_requests = [r for r in self.requests.values() if r.granted]
+                    for request in granted_requests:
+                        logging.debug("semaphore {} lock time {}".format(
+                            ','.join(request.semaphore_names), datetime.datetime.now() - request.grant_time))
+
+                    if granted_requests:
+                        self.send('wait|')
+
+        except Exception as e:
+            logging.debug(f"network semaphore connection closed: {e}")
+            self.disconnect(_socket, e)
+
+# the MultiplexedSemaphoreConnection of this process
+_multiplexed_connection = None
+_multiplexed_connection_pid = None
+_multiplexed_connection_lock = threading.Lock()
+
+def get_multiplexed_connection():
+    """Returns the MultiplexedSemaphoreConnection for this process."""
+    global _multiplexed_connection, _multiplexed_connection_pid
+    with _multiplexed_connection_lock:
+        # connections cannot be shared with forked processes
+        if _multiplexed_connection is None or _multiplexed_connection_pid != os.getpid():
+            config = saq.CONFIG['service_network_semaphore']
+            _multiplexed_connection = MultiplexedSemaphoreConnection(config['remote_address'], config.getint('remote_port'))
+            _multiplexed_connection_pid = os.getpid()
+
+        return _multiplexed_connection
+
 class NetworkSemaphoreClient(object):
     def __init__(self, cancel_request_callback=None):
         # the remote connection to the network semaphore server
@@ -111,14 +334,22 @@ class NetworkSemaphoreClient(object):
         self.release_event = None
         # reference to the relavent configuration section
         self.config = saq.CONFIG['service_network_semaphore']
-        # if we ended up using a fallback semaphore
-        self.fallback_semaphore = None
+        # the fallback semaphores we ended up using (if any)
+        self.fallback_semaphores = []
+        # the MultiplexedSemaphoreConnection and MultiplexedRequest used to acquire the semaphore (if any)
+        self.multiplexed_connection = None
+        self.multiplexed_request = None
         # use this to cancel the request to acquire a semaphore
         self.cancel_request_flag = False
         # OR use this function to determine if we should cancel the request
         # the function returns True if the request should be cancelled, False otherwise
         self.cancel_request_callback = cancel_request_callback
 
+    @property
+    def fallback_semaphore(self):
+        """The fallback semaphore that was acquired, or None if the network semaphore server was used."""
+        return self.fallback_semaphores[0] if self.fallback_semaphores else None
+
     @property
     def request_is_cancelled(self):
         """Returns True if the request has been cancelled, False otherwise.
@@ -129,6 +360,9 @@ class NetworkSemaphoreClient(object):
                                              and self.cancel_request_callback() )
 
     def acquire(self, semaphore_name, timeout=None):
+        """Acquires the semaphore with the given name (or all the semaphores if given a list of names.)
+           Waits up to timeout seconds (forever if timeout is None.)
+           Returns True if the semaphore was acquired, False otherwise."""
         if self.semaphore_acquired:
             logging.warning(f"semaphore {self.semaphore_name} already acquired")
             return True
@@ -137,104 +371,155 @@ class NetworkSemaphoreClient(object):
         if timeout is not None:
             deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
 
+        if isinstance(semaphore_name, str):
+            semaphore_names = [ semaphore_name ]
+        else:
+            semaphore_names = sorted(set(semaphore_name))
+
         try:
-            self.socket = socket.socket()
-            logging.debug("attempting connection to {} port {}".format(self.config['remote_address'], self.config.getint('remote_port')))
+            # multiple semaphores can only be acquired over a multiplexed connection
+            if len(semaphore_names) > 1 or self.config.getboolean('multiplexed', fallback=True):
+                return self.acquire_multiplexed(semaphore_name, semaphore_names, deadline)
 
-            self.socket.connect((self.config['remote_address'], self.config.getint('remote_port')))
-            logging.debug(f"requesting semaphore {semaphore_name}")
+            return self.acquire_network(semaphore_name, deadline)
 
-            # request the semaphore
-            self.socket.sendall('acquire:{}|'.format(semaphore_name).encode('ascii'))
+        except Exception as e:
+            logging.error(f"unable to acquire network semaphore: {e}")
 
-            # wait for the acquire to complete
-            wait_start = datetime.datetime.now()
+            if self.socket is not None:
+                try:
+                    self.socket.close()
+                except Exception as e:
+                    pass
 
-            while not self.request_is_cancelled:
-                command = self.socket.recv(128).decode('ascii')
-                if command == '':
-                    raise RuntimeError("detected client disconnect")
+            return self.acquire_fallback(semaphore_name, semaphore_names, deadline)
 
-                logging.debug(f"received command {command} from server")
+    def acquire_multiplexed(self, semaphore_name, semaphore_names, deadline):
+        """Acquires the semaphores over the shared connection of this process."""
+        connection = get_multiplexed_connection()
+        logging.debug(f"requesting semaphore {semaphore_name}")
+        request = connection.acquire(semaphore_names, deadline=deadline, 
+                                     is_cancelled=lambda: self.request_is_cancelled)
+        if request is None:
+            return False
 
-                # deal with the possibility of multiple commands sent in a single packet
-                # (remember to strip the last pipe)
-                commands = command[:-1].split('|')
-                if 'locked' in commands:
-                    logging.debug(f"semaphore {semaphore_name} locked")
-                    self.semaphore_acquired = True
-                    self.semaphore_name = semaphore_name
-                    self.release_event = threading.Event()
-                    self.start_failsafe_monitor()
-                    return True
+        logging.debug(f"semaphore {semaphore_name} locked")
+        self.multiplexed_connection = connection
+        self.multiplexed_request = request
+        self.semaphore_acquired = True
+        self.semaphore_name = semaphore_name
+        return True
 
-                elif all([x == 'wait' for x in commands]):
-                    pass
+    def acquire_network(self, semaphore_name, deadline):
+        """Acquires the semaphore over a new connection to the server."""
+        self.socket = socket.socket()
+        logging.debug("attempting connection to {} port {}".format(self.config['remote_address'], self.config.getint('remote_port')))
 
-                else:
-                    raise ValueError(f"received invalid command {command}")
+        self.socket.connect((self.config['remote_address'], self.config.getint('remote_port')))
+        logging.debug(f"requesting semaphore {semaphore_name}")
 
-                # have we timed out waiting?
-                if deadline and datetime.datetime.now() >= deadline:
-                    logging.error(f"attempt to acquire semaphore {semaphore_name} timed out")
+        # request the semaphore
+        self.socket.sendall('acquire:{}|'.format(semaphore_name).encode('ascii'))
 
-                    try:
-                        self.socket.close()
-                    except Exception as e:
-                        pass
+        # wait for the acquire to complete
+        wait_start = datetime.datetime.now()
 
-                    return False
+        while not self.request_is_cancelled:
+            command = self.socket.recv(128).decode('ascii')
+            if command == '':
+                raise RuntimeError("detected client disconnect")
+
+            logging.debug(f"received command {command} from server")
+
+            # deal with the possibility of multiple commands sent in a single packet
+            # (remember to strip the last pipe)
+            commands = command[:-1].split('|')
+            if 'locked' in commands:
+                logging.debug(f"semaphore {semaphore_name} locked")
+                self.semaphore_acquired = True
+                self.semaphore_name = semaphore_name
+                self.release_event = threading.Event()
+                self.start_failsafe_monitor()
+                return True
+
+            elif all([x == 'wait' for x in commands]):
+                pass
 
-            logging.debug(f"semaphore request for {semaphore_name} cancelled")
+            else:
+                raise ValueError(f"received invalid command {command}")
 
-            try:
-                self.socket.close()
-            except Exception as e:
-                pass
+            # have we timed out waiting?
+            if deadline and datetime.datetime.now() >= deadline:
+                logging.error(f"attempt to acquire semaphore {semaphore_name} timed out")
 
-            return False
+                try:
+                    self.socket.close()
+                except Exception as e:
+                    pass
 
+                return False
+
+        logging.debug(f"semaphore request for {semaphore_name} cancelled")
+
+        try:
+            self.socket.close()
         except Exception as e:
-            logging.error(f"unable to acquire network semaphore: {e}")
+            pass
 
-            try:
-                self.socket.close()
-            except Exception as e:
-                pass
+        return False
 
-            # use the fallback semaphore
-            try:
-                logging.warning(f"acquiring fallback semaphore {semaphore_name}")
-                while not self.request_is_cancelled:
-                    try:
-                        semaphore = defined_fallback_semaphores[semaphore_name]
-                    except KeyError:
+    def acquire_fallback(self, semaphore_name, semaphore_names, deadline):
+        """Acquires the local fallback semaphores."""
+        try:
+            logging.warning(f"acquiring fallback semaphore {semaphore_name}")
+            for name in semaphore_names:
+                try:
+                    semaphore = defined_fallback_semaphores[name]
+                except KeyError:
+                    with undefined_fallback_semaphores_lock:
                         try:
-                            with undefined_fallback_semaphores_lock:
-                                semaphore = undefined_fallback_semaphores[semaphore_name]
+                            semaphore = undefined_fallback_semaphores[name]
                         except KeyError:
-                            semaphore = add_undefined_fallback_semaphore(semaphore_name)
+                            semaphore = add_undefined_fallback_semaphore(name)
+
+                while True:
+                    if self.request_is_cancelled:
+                        self.release_fallback_semaphores()
+                        return False
 
                     if semaphore.acquire(blocking=True, timeout=0.1):
-                        logging.debug(f"fallback semaphore {semaphore_name} acquired")
-                        self.fallback_semaphore = semaphore
-                        self.semaphore_acquired = True
-                        self.semaphore_name = semaphore_name
-                        self.release_event = threading.Event()
-                        self.start_failsafe_monitor()
-                        return True
+                        logging.debug(f"fallback semaphore {name} acquired")
+                        self.fallback_semaphores.append(semaphore)
+                        break
 
                     if deadline and datetime.datetime.now() >= deadline:
                         logging.error(f"attempt to acquire semaphore {semaphore_name} timed out")
+                        self.release_fallback_semaphores()
                         return False
+
+            self.semaphore_acquired = True
+            self.semaphore_name = semaphore_name
+            self.release_event = threading.Event()
+            self.start_failsafe_monitor()
+            return True
                 
-                return False
-                    
+        except Exception as e:
+            logging.error(f"unable to use fallback semaphore {semaphore_name}: {e}")
+            report_exception()
+            self.release_fallback_semaphores()
+
+        return False
+
+    def release_fallback_semaphores(self):
+        for semaphore in reversed(self.fallback_semaphores):
+            try:
+                semaphore.release()
             except Exception as e:
-                logging.error(f"unable to use fallback semaphore {semaphore_name}: {e}")
-                report_exception()
+                logging.error(f"unable to release fallback semaphore {self.semaphore_name}: {e}")
+                report_exception(e)
 
-            return False
+        self.fallback_semaphores = []
+        maintain_undefined_semaphores()
 
     def cancel_request(self):
         self.cancel_request_flag = True
@@ -271,20 +556,27 @@ class NetworkSemaphoreClient(object):
         if not self.semaphore_acquired:
             logging.warning(f"release called on unacquired semaphore {self.semaphore_name}")
 
+        # are we releasing a multiplexed request?
+        if self.multiplexed_request is not None:
+            logging.debug(f"releasing semaphore {self.semaphore_name}")
+            try:
+                self.multiplexed_connection.release(self.multiplexed_request)
+            finally:
+                self.multiplexed_request = None
+                self.multiplexed_connection = None
+                self.semaphore_acquired = False
+
+            return
+
         # are we releasing a fallback semaphore?
-        if self.fallback_semaphore is not None:
+        if self.fallback_semaphores:
             logging.debug(f"releasing fallback semaphore {self.semaphore_name}")
-            try:
-                self.fallback_semaphore.release()
-            except Exception as e:
-                logging.error(f"unable to release fallback semaphore {self.semaphore_name}: {e}")
-                report_exception(e)
+            self.release_fallback_semaphores()
 
             # make sure we set this so that the monitor thread exits
             self.semaphore_acquired = False
             self.release_event.set()
             self.failsafe_thread.join()
-            maintain_undefined_semaphores()
             return
 
         try:
@@ -319,6 +611,303 @@ class NetworkSemaphoreClient(object):
             self.release_event.set()
             self.failsafe_thread.join()
 
+# the upper bounds (in seconds) of the buckets of the wait time histograms
+WAIT_TIME_BUCKETS = [ 0.01, 0.1, 1, 5, 15, 60, 300, 900 ]
+
+# the maximum length of a single command sent to the server
+MAX_COMMAND_LENGTH = 4096
+
+class WaitTimeHistogram(object):
+    """Histogram of the time requests waited to acquire a semaphore."""
+    def __init__(self, buckets=WAIT_TIME_BUCKETS):
+        self.buckets = buckets
+        # the last count is for everything greater than the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def to_dict(self):
+        result = {
+            'count': self.count,
+            'total': self.total,
+            'max': self.maximum,
+            'buckets': {},
+        }
+
+        for bucket, count in zip(self.buckets, self.counts):
+            result['buckets'][f'<={bucket}'] = count
+
+        result['buckets'][f'>{self.buckets[-1]}'] = self.counts[-1]
+        return result
+
+class SemaphoreRequest(object):
+    """A request from a client connection for a FairSemaphore.
+       callback is called with the request when it is granted (defaults to connection.on_granted)"""
+    def __init__(self, connection, semaphore, callback=None):
+        self.connection = connection
+        self.semaphore = semaphore
+        self.callback = callback if callback is not None else connection.on_granted
+        self.request_time = time.monotonic()
+        # set to True when the semaphore is acquired
+        self.granted = False
+        # set to True when the request is cancelled while waiting
+        self.cancelled = False
+
+class FairSemaphore(object):
+    """A counting semaphore that grants requests in the order they are made.
+       This is only used from the event loop of the NetworkSemaphoreServer."""
+    def __init__(self, semaphore_name, limit):
+        self.semaphore_name = semaphore_name
+        self.limit = limit
+        # the number of requests that currently hold the semaphore
+        self.count = 0
+        # FIFO queue of SemaphoreRequest objects (cancelled requests are skipped when they reach the front)
+        self.waiters = collections.deque()
+        # the number of requests in the queue that are not cancelled
+        self.waiting = 0
+        self.wait_times = WaitTimeHistogram()
+
+    def acquire(self, request):
+        """Grants the request now if the semaphore is available and nothing is waiting, otherwise queues it."""
+        if self.count < self.limit and not self.waiting:
+            self._grant(request)
+        else:
+            self.waiters.append(request)
+            self.waiting += 1
+
+    def release(self, request):
+        """Releases a granted request or cancels a waiting request."""
+        if request.granted:
+            request.granted = False
+            self.count -= 1
+        elif not request.cancelled:
+            request.cancelled = True
+            self.waiting -= 1
+
+        while self.waiters and self.count < self.limit:
+            next_request = self.waiters.popleft()
+            if next_request.cancelled:
+                continue
+
+            self.waiting -= 1
+            self._grant(next_request)
+
+        # drop cancelled requests at the front of the queue
+        while self.waiters and self.waiters[0].cancelled:
+            self.waiters.popleft()
+
+    def _grant(self, request):
+        request.granted = True
+        self.count += 1
+        self.wait_times.record(time.monotonic() - request.request_time)
+        request.callback(request)
+
+    def get_status(self):
+        return {
+            'limit': self.limit,
+            'count': self.count,
+            'waiting': self.waiting,
+            'wait_times': self.wait_times.to_dict(),
+        }
+
+class SemaphoreRequestGroup(object):
+    """A multiplexed request for one or more semaphores.
+       The semaphores are acquired one at a time in sorted order so that groups that overlap cannot deadlock."""
+    def __init__(self, server, connection, request_id, semaphore_names):
+        self.server = server
+        self.connection = connection
+        self.request_id = request_id
+        # the names of the semaphores that have not been requested yet
+        self.pending_names = sorted(set(semaphore_names))
+        # the SemaphoreRequest objects made so far
+        self.requests = []
+        # set to True once the client is told it needs to wait
+        self.wait_sent = False
+
+    def acquire_next(self):
+        if not self.pending_names:
+            logging.info(f"{self.connection.remote_connection} acquired semaphores "
+                         f"{','.join([r.semaphore.semaphore_name for r in self.requests])} "
+                         f"for request {self.request_id}")
+            self.connection.send(f'locked:{self.request_id}|')
+            return
+
+        # the next request is made when this one is granted
+        request = SemaphoreRequest(self.connection, 
+                                   self.server.get_semaphore(self.pending_names.pop(0)), 
+                                   callback=self.on_granted)
+        self.requests.append(request)
+        request.semaphore.acquire(request)
+
+        if not request.granted and not self.wait_sent:
+            self.wait_sent = True
+            self.connection.send(f'wait:{self.request_id}|')
+
+    def on_granted(self, request):
+        self.acquire_next()
+
+    def release(self):
+        self.pending_names = []
+        # waiting requests are cancelled before anything is released
+        for request in reversed(self.requests):
+            self.server.release_request(request)
+
+        self.requests = []
+
+class SemaphoreConnection(object):
+    """A client connection to the NetworkSemaphoreServer.
+
+       super simple protocol
+       CLIENT SEND -> acquire:semaphore_name|
+       SERVER SEND -> wait| (when the request is queued and then once per heartbeat interval while waiting)
+       SERVER SEND -> locked|
+       CLIENT SEND -> wait| (optional keep alive)
+       CLIENT SEND -> release|
+       SERVER SEND -> ok|
+
+       multiplexed protocol (any number of requests on a single connection)
+       CLIENT SEND -> lock:request_id:semaphore_name[,semaphore_name...]|
+       SERVER SEND -> wait:request_id| (if the request is queued)
+       SERVER SEND -> locked:request_id| (once every semaphore is acquired)
+       CLIENT SEND -> unlock:request_id| (releases the semaphores or cancels the request)
+       SERVER SEND -> ok:request_id|
+       SERVER SEND -> wait| (once per heartbeat interval while any request is waiting)
+
+       CLIENT SEND -> status|
+       SERVER SEND -> status:json|
+
+       any invalid input or errors causes the connection to terminate
+       disconnecting releases (or cancels) the request of the connection"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        host, port = writer.get_extra_info('peername')[:2]
+        self.remote_connection = f'{host}:{port}'
+        # the current SemaphoreRequest of this connection
+        self.request = None
+        # multiplexed requests
+        # key = request_id, value = SemaphoreRequestGroup
+        self.request_groups = {}
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(message.encode('ascii'))
+
+    def on_granted(self, request):
+        logging.info(f"{self.remote_connection} acquired semaphore {request.semaphore.semaphore_name}")
+        self.send('locked|')
+
+    async def execute(self):
+        buffer = ''
+        try:
+            while True:
+                data = await self.reader.read(1024)
+                if not data:
+                    logging.debug(f"detected client disconnect from {self.remote_connection}")
+                    return
+
+                buffer += data.decode('ascii')
+                if len(buffer) > MAX_COMMAND_LENGTH:
+                    logging.error(f"command too long from {self.remote_connection}")
+                    return
+
+                # deal with the possibility of multiple (or partial) commands sent in a single packet
+                *commands, buffer = buffer.split('|')
+                for command in commands:
+                    if not self.execute_command(command):
+                        return
+
+                await self.writer.drain()
+
+        except Exception as e:
+            logging.error(f"uncaught exception for {self.remote_connection}: {e}")
+        finally:
+            if self.request is not None:
+                self.server.release_request(self.request)
+                self.request = None
+
+            for request_group in self.request_groups.values():
+                request_group.release()
+
+            self.request_groups = {}
+
+            try:
+                self.writer.close()
+            except:
+                pass
+
+    def execute_command(self, command):
+        """Executes the given command. Returns False if the connection should be closed."""
+        logging.debug(f"got command [{command}] from {self.remote_connection}")
+        if command.startswith('acquire:'):
+            if self.request is not None:
+                logging.error(f"semaphore already requested by {self.remote_connection}")
+                return False
+
+            semaphore_name = command[len('acquire:'):]
+            if not semaphore_name:
+                logging.error(f"invalid command \"{command}\" from {self.remote_connection}")
+                return False
+
+            self.request = self.server.request_semaphore(self, semaphore_name)
+            if not self.request.granted:
+                self.send('wait|')
+
+            return True
+
+        if command.startswith('lock:'):
+            _, request_id, semaphore_names = command.split(':', 2)
+            semaphore_names = [_ for _ in semaphore_names.split(',') if _]
+            if not request_id or not semaphore_names or request_id in self.request_groups:
+                logging.error(f"invalid command \"{command}\" from {self.remote_connection}")
+                return False
+
+            request_group = SemaphoreRequestGroup(self.server, self, request_id, semaphore_names)
+            self.request_groups[request_id] = request_group
+            request_group.acquire_next()
+            return True
+
+        if command.startswith('unlock:'):
+            request_id = command[len('unlock:'):]
+            request_group = self.request_groups.pop(request_id, None)
+            if request_group is not None:
+                request_group.release()
+
+            self.send(f'ok:{request_id}|')
+            return True
+
+        if command == 'release':
+            if self.request is None:
+                logging.error(f"release without acquire from {self.remote_connection}")
+                return False
+
+            self.server.release_request(self.request)
+            self.request = None
+            self.send('ok|')
+            return True
+
+        if command == 'wait':
+            return True
+
+        if command == 'status':
+            self.send('status:{}|'.format(json.dumps(self.server.get_status())))
+            return True
+
+        logging.error(f"invalid command \"{command}\" from {self.remote_connection}")
+        return False
+
 class NetworkSemaphoreServer(ACEService):
     def __init__(self, *args, **kwargs):
         super().__init__(
@@ -326,12 +915,6 @@ class NetworkSemaphoreServer(ACEService):
             *args, 
             **kwargs)
 
-        # the main thread that listens for new connections
-        self.server_thread = None
-
-        # the main listening socket
-        self.server_socket = None
-
         # configuration settings
         if 'service_network_semaphore' not in saq.CONFIG:
             logging.error("missing configuration service_network_semaphore")
@@ -340,15 +923,22 @@ class NetworkSemaphoreServer(ACEService):
         # binding address
         self.bind_address = self.service_config['bind_address']
         self.bind_port = self.service_config.getint('bind_port')
+        # the maximum number of pending connections
+        self.listen_backlog = self.service_config.getint('listen_backlog', fallback=1024)
+        # how often (in seconds) waiting clients are sent a heartbeat
+        self.heartbeat_interval = self.service_config.getfloat('heartbeat_interval', fallback=1.0)
 
         # source IP addresses that are allowed to connect
         self.allowed_ipv4 = [ipaddress.ip_network(x.strip()) for x in self.service_config['allowed_ipv4'].split(',')]
 
         # load and initialize all the semaphores we're going to use
-        self.defined_semaphores = {} # key = semaphore_name, value = LoggingSemaphore
-        self.undefined_semaphores = {} # key = semaphore_name, value = LoggingSemaphore
+        self.defined_semaphores = {} # key = semaphore_name, value = FairSemaphore
+        self.undefined_semaphores = {} # key = semaphore_name, value = FairSemaphore
         self.undefined_semaphores_lock = threading.RLock()
 
+        # the asyncio server that accepts connections
+        self.server = None
+
         # we keep some stats and metrics on semaphores in this directory
         self.stats_dir = os.path.join(saq.DATA_DIR, self.service_config['stats_dir'])
         if not os.path.isdir(self.stats_dir):
@@ -358,226 +948,162 @@ class NetworkSemaphoreServer(ACEService):
                 logging.error(f"unable to create directory {self.stats_dir}: {e}")
                 sys.exit(1)
 
-        # a thread monitors and records statistics
-        self.monitor_thread = None
-
     def add_undefined_semaphore(self, name, count=1):
         """Adds a new undefined network semaphore with the given name and optional count.
            Returns the created semaphore."""
         with self.undefined_semaphores_lock:
-            self.undefined_semaphores[name] = LoggingSemaphore(count)
-            self.undefined_semaphores[name].semaphore_name = name 
+            self.undefined_semaphores[name] = FairSemaphore(name, count)
             logging.info(f"adding undefined semaphore {name}")
             return self.undefined_semaphores[name]
 
-    def maintain_undefined_semaphores(self):
-        with self.undefined_semaphores_lock:
-            targets = []
-            for semaphore_name in self.undefined_semaphores.keys():
-                if self.undefined_semaphores[semaphore_name].count == 0:
-                    targets.append(semaphore_name)
-
-            for target in targets:
-                logging.debug(f"finished with undefined semaphore {target}")
-                del self.undefined_semaphores[target]
-
-            if self.undefined_semaphores:
-                logging.info(f"tracking {len(self.undefined_semaphores)} undefined semaphores")
-
     def load_configured_semaphores(self):
         """Loads all network semaphores defined in the configuration."""
         for key in self.service_config.keys():
             if key.startswith('semaphore_'):
                 semaphore_name = key[len('semaphore_'):]
                 count = self.service_config.getint(key)
-                self.defined_semaphores[semaphore_name] = LoggingSemaphore(count)
-                self.defined_semaphores[semaphore_name].semaphore_name = semaphore_name 
-
-    def execute_service(self):
-        if self.service_is_debug:
-            return self.server_loop()
-
-        self.server_thread = Thread(target=self.server_loop, name="Network Server")
-        self.server_thread.start()
-
-        self.monitor_thread = Thread(target=self.monitor_loop, name="Monitor")
-        self.monitor_thread.daemon = True
-        self.monitor_thread.start()
-
-        self.server_thread.join()
-        self.monitor_thread.join()
-
-    def stop_service(self, *args, **kwargs):
-        super().stop_service(*args, **kwargs)
+                self.defined_semaphores[semaphore_name] = FairSemaphore(semaphore_name, count)
 
+    def get_semaphore(self, semaphore_name):
+        """Returns the FairSemaphore with the given name, creating an undefined semaphore if needed."""
         try:
-            logging.debug("closing network socket...")
-            # force the accept() call to break
-            try:
-                s = socket.socket()
-                s.connect((self.service_config['bind_address'], self.service_config.getint('bind_port')))
-                s.close()
-            except:
-                pass # doesn't matter...
-        except Exception as e:
-            logging.error(f"unable to close network socket: {e}")
+            return self.defined_semaphores[semaphore_name]
+        except KeyError:
+            with self.undefined_semaphores_lock:
+                try:
+                    return self.undefined_semaphores[semaphore_name]
+                except KeyError:
+                    return self.add_undefined_semaphore(semaphore_name, 1)
+
+    def request_semaphore(self, connection, semaphore_name):
+        """Requests the given semaphore for the given connection. Returns the SemaphoreRequest."""
+        request = SemaphoreRequest(connection, self.get_semaphore(semaphore_name))
+        logging.debug(f"{connection.remote_connection} requesting semaphore {semaphore_name}")
+        request.semaphore.acquire(request)
+        return request
+
+    def release_request(self, request):
+        """Releases (or cancels) the given SemaphoreRequest."""
+        was_granted = request.granted
+        request.semaphore.release(request)
+        if was_granted:
+            logging.info(f"{request.connection.remote_connection} released semaphore {request.semaphore.semaphore_name}")
+
+        # undefined semaphores are deleted when they are no longer used
+        semaphore = request.semaphore
+        if semaphore.count == 0 and semaphore.waiting == 0 and semaphore.semaphore_name not in self.defined_semaphores:
+            with self.undefined_semaphores_lock:
+                if self.undefined_semaphores.get(semaphore.semaphore_name) is semaphore:
+                    logging.debug(f"finished with undefined semaphore {semaphore.semaphore_name}")
+                    del self.undefined_semaphores[semaphore.semaphore_name]
+
+    def get_status(self):
+        """Returns a dict of the status of all defined and undefined semaphores."""
+        result = { 'defined': {}, 'undefined': {} }
+        for semaphore in list(self.defined_semaphores.values()):
+            result['defined'][semaphore.semaphore_name] = semaphore.get_status()
 
-    def monitor_loop(self):
-        semaphore_status_path = os.path.join(self.stats_dir, 'semaphore.status')
-        while not self.is_service_shutdown:
-            with open(semaphore_status_path, 'w') as fp:
-                for semaphore in self.defined_semaphores.values():
-                    fp.write(f'{semaphore.semaphore_name}: {semaphore.count}')
+        with self.undefined_semaphores_lock:
+            for semaphore in list(self.undefined_semaphores.values()):
+                result['undefined'][semaphore.semaphore_name] = semaphore.get_status()
 
-            time.sleep(1)
+        return result
+
+    def execute_service(self):
+        self.server_loop()
 
     def server_loop(self):
         self.load_configured_semaphores()
         while not self.is_service_shutdown:
             try:
-                self.server_socket = socket.socket() # defaults to AF_INET, SOCK_STREAM
-                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self.server_socket.bind((self.bind_address, self.bind_port))
-                self.server_socket.listen(5)
-
-                while not self.is_service_shutdown:
-                    logging.debug(f"waiting for next connection on {self.bind_address}:{self.bind_port}")
-                    client_socket, remote_address = self.server_socket.accept()
-                    remote_host, remote_port = remote_address
-                    logging.info(f"got connection from {remote_host}:{remote_port}")
-                    if self.is_service_shutdown:
-                        return
-
-                    allowed = False
-                    remote_host_ipv4 = ipaddress.ip_address(remote_host)
-                    for ipv4_network in self.allowed_ipv4:
-                        if remote_host_ipv4 in ipv4_network:
-                            allowed = True
-                            break
-
-                    if not allowed:
-                        logging.warning(f"blocking invalid remote host {remote_host}")
-                        try:
-                            client_socket.close()
-                        except:
-                            pass
-
-                        continue
-
-                    # start a thread to deal with this client
-                    if self.service_is_debug:
-                        self.client_loop(remote_host, remote_port, client_socket)
-                    else:
-                        t = Thread(target=self.client_loop, args=(remote_host, remote_port, client_socket), name=f"Client {remote_host}")
-                        t.daemon = True
-                        t.start()
-                    
+                asyncio.run(self.serve())
             except Exception as e:
                 logging.error(f"uncaught exception: {e}")
                 report_exception()
-
-                # TODO clean up socket stuff to restart
                 self.service_shutdown_event.wait(1)
 
-    def client_loop(self, remote_host, remote_port, client_socket):
-        remote_connection = f'{remote_host}:{remote_port}'
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handle_connection, 
+                                                 host=self.bind_address, 
+                                                 port=self.bind_port, 
+                                                 backlog=self.listen_backlog,
+                                                 reuse_address=True)
+
+        logging.info(f"listening for connections on {self.bind_address}:{self.bind_port}")
+        tasks = [ asyncio.ensure_future(self.heartbeat_loop()), asyncio.ensure_future(self.monitor_loop()) ]
+
         try:
-            logging.debug(f"started thread to handle connection from {remote_connection}")
+            while not self.is_service_shutdown:
+                await asyncio.sleep(0.1)
+        finally:
+            for task in tasks:
+                task.cancel()
 
-            # read the next command from the client
-            command = client_socket.recv(128).decode('ascii')
-            if command == '':
-                logging.debug("detected client disconnect")
-                return
+            self.server.close()
+            await self.server.wait_closed()
 
-            logging.info(f"got command [{command}] from {remote_connection}")
-            # super simple protocol
-            # CLIENT SEND -> acquire:semaphore_name|
-            # SERVER SEND -> wait|
-            # SERVER SEND -> locked|
-            # CLIENT SEND -> wait|
-            # CLIENT SEND -> release|
-            # SERVER SEND -> ok|
-            # any invalid input or errors causes the connection to terminate
-
-            m = re.match(r'^acquire:([^|]+)\|$', command)
-            if m is None:
-                logging.error(f"invalid command \"{command}\" from {remote_connection}")
-                return
+    async def handle_connection(self, reader, writer):
+        remote_host, remote_port = writer.get_extra_info('peername')[:2]
+        logging.debug(f"got connection from {remote_host}:{remote_port}")
 
-            semaphore_name = m.group(1)
+        remote_host_ipv4 = ipaddress.ip_address(remote_host)
+        if not any([remote_host_ipv4 in ipv4_network for ipv4_network in self.allowed_ipv4]):
+            logging.warning(f"blocking invalid remote host {remote_host}")
+            writer.close()
+            return
 
+        try:
+            await SemaphoreConnection(self, reader, writer).execute()
+        except asyncio.CancelledError:
+            # connections that are still open when the service stops are cancelled
+            pass
+
+    async def heartbeat_loop(self):
+        """Sends a heartbeat to every client that is waiting for a semaphore."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            with self.undefined_semaphores_lock:
+                semaphores = list(self.defined_semaphores.values()) + list(self.undefined_semaphores.values())
+
+            # multiplexed connections get a single heartbeat no matter how many requests are waiting
+            connections = set()
+            for semaphore in semaphores:
+                for request in semaphore.waiters:
+                    if not request.cancelled:
+                        connections.add(request.connection)
+
+            for connection in connections:
+                connection.send('wait|')
+
+    async def monitor_loop(self):
+        """Records the status of the semaphores in the stats directory."""
+        semaphore_status_path = os.path.join(self.stats_dir, 'semaphore.status')
+        while True:
             try:
-                semaphore = self.defined_semaphores[semaphore_name]
-            except KeyError:
-                with self.undefined_semaphores_lock:
-                    try:
-                        semaphore = self.undefined_semaphores[semaphore_name]
-                    except KeyError:
-                        semaphore = self.add_undefined_semaphore(semaphore_name, 1)
-
-            semaphore_acquired = False
-            request_time = datetime.datetime.now()
-            try:
-                while True:
-                    logging.debug(f"attempting to acquire semaphore {semaphore_name}")
-                    semaphore_acquired = semaphore.acquire(blocking=True, timeout=1)
-                    if not semaphore_acquired:
-                        logging.info("{} waiting for semaphore {} cumulative waiting time {}".format(
-                            remote_connection, semaphore_name, datetime.datetime.now() - request_time))
-                        # send a heartbeat message back to the client
-                        client_socket.sendall("wait|".encode('ascii'))
-                        continue
-
-                    logging.info(f"acquired semaphore {semaphore_name}")
-                    client_socket.sendall("locked|".encode('ascii'))
-                    break
-
-                # now wait for either the client to release the semaphore
-                # or for the connection to break
-                release_time = datetime.datetime.now()
-                while True:
-                    command = client_socket.recv(128).decode('ascii')
-                    if command == '':
-                        logging.debug("detected client disconnect")
-                        return
+                with open(f'{semaphore_status_path}.tmp', 'w') as fp:
+                    json.dump(self.get_status(), fp, indent=4)
 
-                    logging.debug("got command {} from {} semaphore capture time {}".format(
-                        command, remote_connection, datetime.datetime.now() - release_time))
+                os.replace(f'{semaphore_status_path}.tmp', semaphore_status_path)
+            except Exception as e:
+                logging.error(f"unable to write {semaphore_status_path}: {e}")
 
-                    if not command.endswith('|'):
-                        logging.error("missing pipe at end of command")
-                        return
+            await asyncio.sleep(1)
 
-                    # deal with the possibility of multiple commands sent in a single packet
-                    # strip the last pipe
-                    # XXX not 100% sure on this but here it is
-                    command = command[:-1]
-                    commands = command.split('|')
-                    if 'release' in commands:
-                        # send the OK to the client
-                        client_socket.sendall('ok|'.encode('ascii'))
-                        break
+def get_network_semaphore_status(timeout=5):
+    """Returns the status dict of the network semaphore server (see NetworkSemaphoreServer.get_status.)"""
+    config = saq.CONFIG['service_network_semaphore']
+    with socket.create_connection((config['remote_address'], config.getint('remote_port')), timeout=timeout) as s:
+        s.sendall('status|'.encode('ascii'))
+        data = b''
+        while not data.endswith(b'|'):
+            chunk = s.recv(4096)
+            if not chunk:
+                raise RuntimeError("detected server disconnect")
 
-                    if all([x == 'wait' for x in commands]):
-                        logging.debug("got wait command(s)...")
-                        continue
+            data += chunk
 
-                    logging.error(f"invalid command {command} from connection {remote_connection}")
-                    return
-            finally:
-                try:
-                    if semaphore_acquired:
-                        semaphore.release()
-                        logging.info(f"released semaphore {semaphore_name}")
-                        self.maintain_undefined_semaphores()
-                except Exception as e:
-                    logging.error(f"error releasing semaphore {semaphore_name}: {e}")
+    response = data.decode('ascii')
+    if not response.startswith('status:'):
+        raise ValueError(f"invalid status response {response}")
 
-        except Exception as e:
-            logging.error(f"uncaught exception for {remote_connection}: {e}")
-        finally:
-            try:
-                client_socket.close()
-            except:
-                pass
+    return json.loads(response[len('status:'):-1])
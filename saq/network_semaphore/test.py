@@ -9,7 +9,12 @@ from saq.network_semaphore import (
         add_undefined_fallback_semaphore,
         NetworkSemaphoreServer,
         NetworkSemaphoreClient,
-        LoggingSemaphore
+        LoggingSemaphore,
+        FairSemaphore,
+        SemaphoreRequest,
+        WaitTimeHistogram,
+        get_network_semaphore_status,
+        get_multiplexed_connection,
 )
 from saq.service import *
 from saq.test import *
@@ -27,12 +32,139 @@ class TestCase(ACEBasicTestCase):
     # test network semaphores
     #
 
+    def test_fair_semaphore(self):
+        class _connection(object):
+            def __init__(self):
+                self.granted = []
+            def on_granted(self, request):
+                self.granted.append(request)
+
+        connection = _connection()
+        semaphore = FairSemaphore('test', 2)
+        requests = [ SemaphoreRequest(connection, semaphore) for _ in range(5) ]
+        for request in requests:
+            semaphore.acquire(request)
+
+        self.assertEquals(connection.granted, requests[0:2])
+        self.assertEquals(semaphore.count, 2)
+        self.assertEquals(semaphore.waiting, 3)
+
+        # a cancelled request is skipped
+        semaphore.release(requests[2])
+        self.assertEquals(semaphore.waiting, 2)
+
+        # requests are granted in the order they were made
+        semaphore.release(requests[0])
+        self.assertEquals(connection.granted, [ requests[0], requests[1], requests[3] ])
+        semaphore.release(requests[1])
+        self.assertEquals(connection.granted, [ requests[0], requests[1], requests[3], requests[4] ])
+        self.assertEquals(semaphore.waiting, 0)
+        self.assertEquals(semaphore.wait_times.count, 4)
+
+        semaphore.release(requests[3])
+        semaphore.release(requests[4])
+        self.assertEquals(semaphore.count, 0)
+        self.assertEquals(len(semaphore.waiters), 0)
+
+    def test_wait_time_histogram(self):
+        histogram = WaitTimeHistogram([ 1, 10 ])
+        for seconds in [ 0.5, 1, 5, 20 ]:
+            histogram.record(seconds)
+
+        self.assertEquals(histogram.to_dict(), {
+            'count': 4,
+            'total': 26.5,
+            'max': 20,
+            'buckets': { '<=1': 2, '<=10': 1, '>10': 1 }, })
+
+    def test_acquire_release_legacy_network_semaphore(self):
+        # clients that use a connection per request
+        saq.CONFIG['service_network_semaphore']['multiplexed'] = 'no'
+
+        service = NetworkSemaphoreServer()
+        service.start_service(threaded=True)
+        self.wait_for_condition(lambda: service.service_status == SERVICE_STATUS_RUNNING)
+
+        client_1 = NetworkSemaphoreClient()
+        self.assertTrue(client_1.acquire('test'))
+        self.assertIsNone(client_1.multiplexed_request)
+        client_2 = NetworkSemaphoreClient()
+        self.assertFalse(client_2.acquire('test', 0))
+        client_1.release()
+        self.assertTrue(client_2.acquire('test', 0))
+        client_2.release()
+        self.wait_for_condition(lambda: len(service.undefined_semaphores) == 0)
+
+        service.stop_service()
+        service.wait_service()
+
+        self.assertEquals(log_count('acquiring fallback'), 0)
+
+    def test_acquire_multiple_network_semaphores(self):
+        service = NetworkSemaphoreServer()
+        service.start_service(threaded=True)
+        self.wait_for_condition(lambda: service.service_status == SERVICE_STATUS_RUNNING)
+
+        client_1 = NetworkSemaphoreClient()
+        self.assertTrue(client_1.acquire(['test_1', 'test_2']))
+        self.assertEquals(len(service.undefined_semaphores), 2)
+
+        # all of the semaphores are required
+        client_2 = NetworkSemaphoreClient()
+        self.assertFalse(client_2.acquire(['test_2', 'test_3'], 0))
+
+        # every client of the process shares the same connection
+        client_3 = NetworkSemaphoreClient()
+        self.assertTrue(client_3.acquire('test_3'))
+        self.assertIs(client_1.multiplexed_connection, client_3.multiplexed_connection)
+        self.assertIs(client_1.multiplexed_connection, get_multiplexed_connection())
+
+        client_1.release()
+        client_3.release()
+        self.assertTrue(client_2.acquire(['test_2', 'test_3'], 0))
+        client_2.release()
+        self.wait_for_condition(lambda: len(service.undefined_semaphores) == 0)
+
+        service.stop_service()
+        service.wait_service()
+
+        self.assertEquals(log_count('acquiring fallback'), 0)
+
+    def test_acquire_multiple_fallback_semaphores(self):
+        client_1 = NetworkSemaphoreClient()
+        self.assertTrue(client_1.acquire(['test_1', 'test_2']))
+        self.assertEquals(len(client_1.fallback_semaphores), 2)
+        client_2 = NetworkSemaphoreClient()
+        self.assertFalse(client_2.acquire(['test_2', 'test_3'], 0))
+        # nothing is held after a failed attempt
+        self.assertEquals(len(client_2.fallback_semaphores), 0)
+        client_1.release()
+        self.assertEquals(len(saq.network_semaphore.undefined_fallback_semaphores), 0)
+
+    def test_network_semaphore_status(self):
+        saq.CONFIG['service_network_semaphore']['semaphore_test'] = '3'
+
+        service = NetworkSemaphoreServer()
+        service.start_service(threaded=True)
+        self.wait_for_condition(lambda: service.service_status == SERVICE_STATUS_RUNNING)
+
+        client = NetworkSemaphoreClient()
+        self.assertTrue(client.acquire('test'))
+        status = get_network_semaphore_status()
+        self.assertEquals(status['defined']['test']['limit'], 3)
+        self.assertEquals(status['defined']['test']['count'], 1)
+        self.assertEquals(status['defined']['test']['wait_times']['count'], 1)
+        client.release()
+
+        service.stop_service()
+        service.wait_service()
+
     def test_add_semaphore(self):
         server = NetworkSemaphoreServer()
         self.assertEquals(len(server.undefined_semaphores), 0)
         semaphore = server.add_undefined_semaphore('test', 1)
         self.assertIsNotNone(semaphore)
-        self.assertTrue(isinstance(semaphore, LoggingSemaphore))
+        self.assertTrue(isinstance(semaphore, FairSemaphore))
         self.assertEquals(len(server.undefined_semaphores), 1)
         self.assertTrue('test' in server.undefined_semaphores)
 
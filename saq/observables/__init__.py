@@ -9,7 +9,6 @@ import re
 import unicodedata
 import html
 
-from subprocess import Popen, PIPE
 from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
 from urlfinderlib import find_urls
 from urlfinderlib import is_url
@@ -82,6 +81,9 @@ class CaselessObservable(Observable):
     def _compare_value(self, other):
         return self.normalize_caseless(self.value) == self.normalize_caseless(other)
 
+    def _index_value(self, value):
+        return self.normalize_caseless(value)
+
 class IPv4Observable(Observable):
 
     def __init__(self, *args, **kwargs):
@@ -505,6 +507,19 @@ class FileObservable(Observable):
         if self.root.storage_dir is None:
             logging.error("compute_hashes was called before root.storage_dir was set for {}".format(self))
             return False
+
+        # files that are already in the blob store do not need to be hashed again
+        from saq.blobs import get_blob_store
+        blob_store = get_blob_store()
+        if blob_store is not None:
+            try:
+                hashes = blob_store.get_hashes(self.path)
+                if hashes is not None:
+                    self._md5_hash, self._sha1_hash, self._sha256_hash = hashes
+                    self.invalidate_json_cache()
+                    return True
+            except Exception as e:
+                logging.debug(f"unable to look up {self.value} in the blob store: {e}")
         
         md5_hasher = hashlib.md5()
         sha1_hasher = hashlib.sha1()
@@ -534,7 +549,29 @@ class FileObservable(Observable):
         self._md5_hash = md5_hash
         self._sha1_hash = sha1_hash
         self._sha256_hash = sha256_hash
+        self.invalidate_json_cache()
+
+        return True
+
+    def store(self):
+        """Stores the file in the blob store (see saq.blobs) if it is enabled. The stored file is read-only.
+           Returns True if the file was stored."""
+        from saq.blobs import get_blob_store
+        blob_store = get_blob_store()
+        if blob_store is None:
+            return False
 
+        try:
+            hashes = blob_store.store(self.path)
+        except Exception as e:
+            logging.warning(f"unable to store {self.value} in the blob store: {e}")
+            return False
+
+        if hashes is None:
+            return False
+
+        self._md5_hash, self._sha1_hash, self._sha256_hash = hashes
+        self.invalidate_json_cache()
         return True
 
     @property
@@ -555,13 +592,16 @@ class FileObservable(Observable):
         if self._mime_type:
             return self._mime_type
 
-        p = Popen(['file', '-b', '--mime-type', '-L', self.path], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-
-        if len(stderr) > 0:
-            logging.warning("file command returned error output for {}".format(self.path))
+        from saq.file_type import get_file_typer
+        try:
+            # the type is cached by the content of the file if the hashes have already been computed
+            self._mime_type = get_file_typer().get_type(self.path, sha256=self._sha256_hash).mime
+            self.invalidate_json_cache()
+        except OSError as e:
+            logging.warning("unable to determine the mime type of {}: {}".format(self.path, e))
+            # callers expect a string (the file command returned an empty string for a missing file)
+            return ""
 
-        self._mime_type = stdout.decode(errors='ignore').strip()
         #logging.info("MARKER: {} mime type {}".format(self.path, self._mime_type))
         return self._mime_type
 
@@ -1,4 +1,6 @@
 from base64 import b64encode, b64decode
+import concurrent.futures
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Union, List
 import importlib
@@ -62,6 +64,55 @@ def RemediationSuccess(message, restore_key=None):
     return RemediationResult(REMEDIATOR_STATUS_SUCCESS, message, restore_key=restore_key)
 
 
+class SessionPool():
+    """A pool of reusable (authenticated) sessions shared by the threads of a Remediator.
+
+    Sessions are created on demand by the given factory and returned to the pool after use so that
+    connections and authentication tokens are reused across targets. At most max_idle sessions are kept."""
+    def __init__(self, factory, max_idle=10):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        """Context manager that yields a session from the pool."""
+        session = None
+        with self.lock:
+            if self.idle:
+                session = self.idle.pop()
+
+        if session is None:
+            session = self.factory()
+
+        try:
+            yield session
+        finally:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(session)
+                    session = None
+
+            if session is not None:
+                self.close_session(session)
+
+    def close_session(self, session):
+        try:
+            if hasattr(session, 'close'):
+                session.close()
+        except Exception as e:
+            logging.debug(f"unable to close session: {e}")
+
+    def close(self):
+        """Closes all the idle sessions."""
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for session in idle:
+            self.close_session(session)
+
 class Remediator():
     def __init__(self, config_section):        
         self.name = config_section
@@ -71,11 +122,32 @@ class Remediator():
     def type(self): 
         return 'base'
 
+    def group_key(self, target):
+        """Returns the key used to group targets that this remediator can remediate together (for example the
+        mailbox of an email), or None if targets are remediated individually."""
+        return None
+
     def remediate(self, target):
         if target.action == REMEDIATION_ACTION_REMOVE:
             return self.remove(target.key)
         return self.restore(target.key, target.restore_key)
 
+    def remediate_batch(self, targets):
+        """Remediates a list of targets that share the same action and group key.
+        Returns the list of results in the same order as the targets.
+
+        The default implementation remediates each target individually. Remediators that can act on many
+        targets per API call or session override this."""
+        results = []
+        for target in targets:
+            try:
+                results.append(self.remediate(target))
+            except Exception as e:
+                logging.error(f"{self.name} failed to {target.action} {target.type} {target.key}: {e}")
+                logging.error(traceback.format_exc())
+                results.append(RemediationError(f"{e.__class__.__name__}: {e}"))
+        return results
+
     def remove(self, target):
         return RemediationFailure('remove not implemented')
 
@@ -201,6 +273,13 @@ class RemediationTarget():
             return self.history[0]
         return None
 
+    def stop_remediation(self):
+        for h in self.history:
+            if h.status != 'COMPLETED':
+                h.status = 'COMPLETED'
+                h.successful = False
+        saq.db.commit()
+
     def __str__(self):
         return f"RemediationTarget: {self.type} - {self.key} - {self.state} - history={len(self.history)}"
 
@@ -217,85 +296,76 @@ def load_all_remediators() -> List[Remediator]:
 
 def remediate_target(remediators: List[Remediator], target: Union[RemediationTarget, Remediation]) -> None:
     """Execute the remediation of a target."""
+    remediate_targets(remediators, [target])
+
+def remediate_targets(remediators: List[Remediator], targets: List[Union[RemediationTarget, Remediation]]) -> None:
+    """Execute the remediation of a list of targets.
+
+    Each remediator is given all the targets it has not already completed in a single call to remediate_batch
+    so that remediators can group the work by mailbox, tenant, etc..."""
 
     try:
-        logging.info(f"STARTED {target.action[:-1]}ing {target.type} {target.key}")
+        for target in targets:
+            logging.info(f"STARTED {target.action[:-1]}ing {target.type} {target.key}")
 
         # load results from previous runs
-        results = {}
-        if isinstance(target, Remediation) and target.result:
-            results = json.loads(target.result)
-
-        # run all remediators on the target
-        status = REMEDIATION_STATUS_COMPLETED
-        restore_key = target.restore_key
+        all_results = []
+        for target in targets:
+            results = {}
+            if isinstance(target, Remediation) and target.result:
+                results = json.loads(target.result)
+            all_results.append(results)
+
+        # run all remediators on the targets
+        statuses = [REMEDIATION_STATUS_COMPLETED for target in targets]
+        restore_keys = [target.restore_key for target in targets]
         for remediator in remediators:
 
-            # only run remediators for target type
-            if remediator.type != target.type:
+            # only run remediators for target type that are not already complete for the target
+            indexes = []
+            for index, target in enumerate(targets):
+                results = all_results[index]
+                if remediator.type != target.type:
+                    continue
+                if remediator.name in results and results[remediator.name]['status'] in COMPLETED_REMEDIATOR_STATUSES:
+                    continue
+                indexes.append(index)
+
+            if not indexes:
                 continue
 
-            # only run remediators that are not already complete for this target
-            if remediator.name not in results or results[remediator.name]['status'] not in COMPLETED_REMEDIATOR_STATUSES:
+            # run the remediator on the targets, grouped by action
+            for action in set([targets[index].action for index in indexes]):
+                action_indexes = [index for index in indexes if targets[index].action == action]
                 try:
-                    # run the remediator on the target
-                    results[remediator.name] = remediator.remediate(target)
+                    batch_results = remediator.remediate_batch([targets[index] for index in action_indexes])
+                    if len(batch_results) != len(action_indexes):
+                        raise RuntimeError(f"got {len(batch_results)} results for {len(action_indexes)} targets")
                 except Exception as e:
                     # delay remediation and log error
-                    results[remediator.name] = RemediationError(f"{e.__class__.__name__}: {e}")
-                    logging.error(f"{remediator.name} failed to {target.action} {target.type} {target.key}: {e}")
+                    logging.error(f"{remediator.name} failed to {action} {len(action_indexes)} targets: {e}")
                     logging.error(traceback.format_exc())
+                    batch_results = [RemediationError(f"{e.__class__.__name__}: {e}") for index in action_indexes]
+
+                for index, result in zip(action_indexes, batch_results):
+                    all_results[index][remediator.name] = result
+
+                    # delay remediation if not complete
+                    if result['status'] not in COMPLETED_REMEDIATOR_STATUSES:
+                        statuses[index] = REMEDIATION_STATUS_IN_PROGRESS
+
+                    # set restore key if one was given
+                    if result['restore_key'] is not None:
+                        restore_keys[index] = result['restore_key']
 
-                # delay remediation if not complete
-                if results[remediator.name]['status'] not in COMPLETED_REMEDIATOR_STATUSES:
-                    status = REMEDIATION_STATUS_IN_PROGRESS
-
-                # set restore key if one was given
-                if results[remediator.name]['restore_key'] is not None:
-                    restore_key = results[remediator.name]['restore_key']
-
-        # mark as successful if no remediators failed/errored and at least one remediator succeeded
-        successful = False
-        for remediator in results:
-            if results[remediator]['status'] in UNSUCCESSFUL_REMEDIATOR_STATUSES:
-                successful = False
-                break
-            elif results[remediator]['status'] in SUCCESSFUL_REMEDIATOR_STATUSES:
-                successful = True
-
-        # log result
-        logging.info(f"{status} {target.action[:-1]}ing {target.type} {target.key}")
-
-        # database result
-        if target.id is None or isinstance(target, RemediationTarget):
-            # record this target remediation in the remediation table
-            remediation = Remediation(
-                action = target.action,
-                type = target.type,
-                key = target.key,
-                status = status,
-                successful = successful,
-                result = json.dumps(results),
-                user_id = target.user_id,
-                restore_key = restore_key,
-                comment = target.comment,
-            )
-            saq.db.add(remediation)
-            saq.db.commit()
-        else:
-            # update target in remediation table
-            update = Remediation.__table__.update()
-            update = update.values(
-                lock = None,
-                status = status,
-                successful = successful,
-                result = json.dumps(results),
-                restore_key = restore_key,
-                update_time = datetime.utcnow(),
-            )
-            update = update.where(Remediation.id == target.id)
-            saq.db.execute(update)
-            saq.db.commit()
+        for target, results, status, restore_key in zip(targets, all_results, statuses, restore_keys):
+            try:
+                record_remediation(target, results, status, restore_key)
+            except Exception as e:
+                logging.error(f"unable to record remediation of {target.type} {target.key}: {e}")
+                logging.error(traceback.format_exc())
+                report_exception()
+                saq.db.rollback()
 
     except Exception as e:
         logging.error(f"Unhandled exception: {e}")
@@ -308,11 +378,50 @@ def remediate_target(remediators: List[Remediator], target: Union[RemediationTar
             logging.error(f"unable to return db session: {e}")
             report_exception()
 
-    def stop_remediation(self):
-        for h in self.history:
-            if h.status != 'COMPLETED':
-                h.status = 'COMPLETED'
-                h.successful = False
+def record_remediation(target: Union[RemediationTarget, Remediation], results: dict, status: str, restore_key: str) -> None:
+    """Record the results of the remediators for the given target."""
+
+    # mark as successful if no remediators failed/errored and at least one remediator succeeded
+    successful = False
+    for remediator in results:
+        if results[remediator]['status'] in UNSUCCESSFUL_REMEDIATOR_STATUSES:
+            successful = False
+            break
+        elif results[remediator]['status'] in SUCCESSFUL_REMEDIATOR_STATUSES:
+            successful = True
+
+    # log result
+    logging.info(f"{status} {target.action[:-1]}ing {target.type} {target.key}")
+
+    # database result
+    if target.id is None or isinstance(target, RemediationTarget):
+        # record this target remediation in the remediation table
+        remediation = Remediation(
+            action = target.action,
+            type = target.type,
+            key = target.key,
+            status = status,
+            successful = successful,
+            result = json.dumps(results),
+            user_id = target.user_id,
+            restore_key = restore_key,
+            comment = target.comment,
+        )
+        saq.db.add(remediation)
+        saq.db.commit()
+    else:
+        # update target in remediation table
+        update = Remediation.__table__.update()
+        update = update.values(
+            lock = None,
+            status = status,
+            successful = successful,
+            result = json.dumps(results),
+            restore_key = restore_key,
+            update_time = datetime.utcnow(),
+        )
+        update = update.where(Remediation.id == target.id)
+        saq.db.execute(update)
         saq.db.commit()
 
 class RemediationService(ACEService):
@@ -321,56 +430,113 @@ class RemediationService(ACEService):
         self.remediators = []
         self.uuid = str(uuid.uuid4())
         self.delay_time = timedelta(minutes=self.service_config.getint('delay_minutes', fallback=5))
-        self.batch_size = self.service_config.getint('batch_size', fallback=1)
+        self.batch_size = self.service_config.getint('batch_size', fallback=100)
         self.max_threads = self.service_config.getint('max_threads', fallback=1)
+        self.max_group_size = self.service_config.getint('max_group_size', fallback=20)
         self.lock_timeout = timedelta(seconds=self.service_config.getint('lock_timeout_seconds', fallback=60))
+        # the ids of the targets currently being remediated by the workers
+        self.processing = set()
+        self.processing_lock = threading.Lock()
 
     def execute_service(self):
         # load all remediators
         self.remediators = load_all_remediators()
 
         # process targets until shutdown event is set
-        targets = []
-        while not self.service_shutdown_event.is_set():
-            # if there are threads available
-            if len(threading.enumerate()) - 1 < self.max_threads:
-                # get targets to process if we have none
-                if len(targets) == 0:
-                    try:
-                        targets = self.get_targets()
-                    except Exception as e:
-                        logging.error(f"call to get_targets() failed: {e}")
-                        report_exception()
-                    finally:
-                        saq.db.remove()
-
-                # spawn thread to process worker
-                if len(targets) > 0:
-                    threading.Thread(target=self.remediate, args=(targets.pop(0),)).start()
-            else:
-                time.sleep(1)
-
-        # wait for child threads to finish
-        for thread in threading.enumerate():
-            if thread.ident != threading.get_ident():
-                thread.join()
-
-    def get_targets(self):
+        # targets are only fetched when a worker is available so that locked targets do not sit in the queue
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix='remediation') as executor:
+            while not self.service_shutdown_event.is_set():
+                pending = set([future for future in pending if not future.done()])
+                if len(pending) >= self.max_threads:
+                    concurrent.futures.wait(pending, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+                    continue
+
+                try:
+                    # only lock as many batches as there are free workers to run them
+                    targets = self.get_targets(exclude=self.processing_ids, max_batches=self.max_threads - len(pending))
+                except Exception as e:
+                    logging.error(f"call to get_targets() failed: {e}")
+                    report_exception()
+                    targets = []
+                finally:
+                    saq.db.remove()
+
+                for batch in self.group_targets(targets):
+                    pending.add(self.submit_batch(executor, batch))
+
+        # NOTE the executor waits for the workers to finish when it exits
+
+        for remediator in self.remediators:
+            if hasattr(remediator, 'sessions'):
+                remediator.sessions.close()
+
+    @property
+    def processing_ids(self):
+        """The ids of the targets currently being remediated by this service."""
+        with self.processing_lock:
+            return list(self.processing)
+
+    def submit_batch(self, executor, targets):
+        """Submits the remediation of the given targets to the executor. Returns the Future."""
+        with self.processing_lock:
+            self.processing.update([target.id for target in targets])
+
+        future = executor.submit(self.remediate_batch, targets)
+
+        def _done(future):
+            with self.processing_lock:
+                self.processing.difference_update([target.id for target in targets])
+
+        future.add_done_callback(_done)
+        return future
+
+    def group_targets(self, targets):
+        """Returns the given targets as a list of batches of targets that can be remediated together.
+
+        Targets are grouped by type, action and the group keys of the remediators for the type (for example the
+        recipient mailbox for email remediators.) Targets without a group key are remediated individually."""
+        groups = {}
+        batches = []
+        for target in targets:
+            group_keys = tuple([remediator.group_key(target) for remediator in self.remediators if remediator.type == target.type])
+            if all([key is None for key in group_keys]):
+                batches.append([target])
+                continue
+
+            groups.setdefault((target.type, target.action, group_keys), []).append(target)
+
+        for group in groups.values():
+            for index in range(0, len(group), self.max_group_size):
+                batches.append(group[index:index + self.max_group_size])
+
+        return batches
+
+    def get_targets(self, exclude=[], max_batches=None):
+        """Locks and returns up to batch_size targets that are ready to be remediated.
+           If max_batches is given then only the targets of the first max_batches batches (see group_targets) are locked."""
         # find targets to process
         logging.info('looking for new targets')
-        query = saq.db.query(Remediation)
-        query = query.filter(or_(
+        lock_available = or_(
             Remediation.lock == None,
             Remediation.lock_time < datetime.utcnow() - self.lock_timeout,
-        ))
+        )
+        query = saq.db.query(Remediation)
+        query = query.filter(lock_available)
         query = query.filter(Remediation.status != REMEDIATION_STATUS_COMPLETED)
         query = query.filter(or_(
             Remediation.update_time == None,
             Remediation.update_time < datetime.utcnow() - self.delay_time,
         ))
+        if exclude:
+            query = query.filter(Remediation.id.notin_(exclude))
         query = query.order_by(Remediation.insert_date.desc())
         query = query.limit(self.batch_size)
-        target_ids = [t.id for t in query.all()]
+        targets = query.all()
+        if max_batches is not None:
+            targets = [target for batch in self.group_targets(targets)[:max_batches] for target in batch]
+
+        target_ids = [t.id for t in targets]
 
         # wait a bit if there are no targets
         if len(target_ids) == 0:
@@ -386,20 +552,25 @@ class RemediationService(ACEService):
             status = REMEDIATION_STATUS_IN_PROGRESS,
         )
         update = update.where(Remediation.id.in_(target_ids))
+        update = update.where(lock_available)
         saq.db.execute(update)
         saq.db.commit()
 
         # fetch successfully locked targets
         query = saq.db.query(Remediation)
         query = query.filter(Remediation.lock == self.uuid)
+        query = query.filter(Remediation.id.in_(target_ids))
         query = query.order_by(Remediation.insert_date.desc())
         result = query.all()
         saq.db.expunge_all()
         return result
 
     def remediate(self, target):
+        self.remediate_batch([target])
+
+    def remediate_batch(self, targets):
         try:
-            remediate_target(self.remediators, target)
+            remediate_targets(self.remediators, targets)
         except Exception as e:
             logging.error(f"Unhandled exception: {e}")
             report_exception()
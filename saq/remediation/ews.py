@@ -3,27 +3,53 @@ from requests.auth import HTTPBasicAuth
 from requests_ntlm import HttpNtlmAuth
 import saq
 from saq.email import is_local_email_domain
-from saq.phishfry import Phishfry, ErrorNonExistentMailbox, ErrorNonExistentMessage, ErrorUnsupportedMailboxType, ErrorAccessDenied
+from saq.phishfry import Phishfry, DistinguishedFolder, ErrorNonExistentMailbox, ErrorNonExistentMessage, ErrorUnsupportedMailboxType, ErrorAccessDenied
 from saq.proxy import proxies
-from saq.remediation import Remediator, RemediationDelay, RemediationFailure, RemediationSuccess, RemediationIgnore
+from saq.remediation import Remediator, RemediationDelay, RemediationError, RemediationFailure, RemediationSuccess, RemediationIgnore, SessionPool, REMEDIATION_ACTION_REMOVE
+import traceback
+
+# the results of the phishfry errors when removing a message
+REMOVE_ERROR_RESULTS = {
+    ErrorAccessDenied: RemediationFailure,
+    ErrorNonExistentMailbox: RemediationSuccess, # consider non existent mailbox success
+    ErrorNonExistentMessage: RemediationSuccess, # consider non existent message success
+    ErrorUnsupportedMailboxType: RemediationFailure,
+}
+
+# the results of the phishfry errors when restoring a message
+RESTORE_ERROR_RESULTS = {
+    ErrorAccessDenied: RemediationFailure,
+    ErrorNonExistentMailbox: RemediationIgnore, # ignore non existent mailboxes
+    ErrorNonExistentMessage: RemediationFailure,
+    ErrorUnsupportedMailboxType: RemediationFailure,
+}
 
 class EmailRemediator(Remediator):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.phishfry = Phishfry(self.config['server'], self.config['version'])
+        self.sessions = SessionPool(self.create_session, self.config.getint('max_sessions', fallback=10))
+
+    def create_session(self):
+        """Returns a new authenticated Phishfry session."""
+        phishfry = Phishfry(self.config['server'], self.config['version'])
         auth = self.config.get('auth') or 'ntlm'
         if auth == 'ntlm':
-            self.phishfry.session.auth = HttpNtlmAuth(self.config['user'], self.config['pass'])
+            phishfry.session.auth = HttpNtlmAuth(self.config['user'], self.config['pass'])
         elif auth == 'basic':
-            self.phishfry.session.auth = HTTPBasicAuth(self.config['user'], self.config['pass'])
+            phishfry.session.auth = HTTPBasicAuth(self.config['user'], self.config['pass'])
         if self.config.getboolean('use_proxy') or False:
             logging.info(f"using proxy...")
-            self.phishfry.session.proxies.update(proxies())
+            phishfry.session.proxies.update(proxies())
+        return phishfry
 
     @property
     def type(self): 
         return "email"
 
+    def group_key(self, target):
+        # targets are grouped by recipient mailbox
+        return target.key.split('|', 1)[-1].lower()
+
     def remove(self, target):
         # break target into components
         message_id, recipient = target.split('|', 1)
@@ -34,23 +60,10 @@ class EmailRemediator(Remediator):
 
         # attempt to remove the message
         try:
-            self.phishfry.remove(recipient, message_id)
-
-        # fail if access denied
-        except ErrorAccessDenied as e:
-            return RemediationFailure(e.message)
-
-        # consider non existent mailbox success
-        except ErrorNonExistentMailbox as e:
-            return RemediationSuccess(e.message)
-
-        # consider non existent message success
-        except ErrorNonExistentMessage as e:
-            return RemediationSuccess(e.message)
-
-        # fail if unsupported mailbox type
-        except ErrorUnsupportedMailboxType as e:
-            return RemediationFailure(e.message)
+            with self.sessions.session() as phishfry:
+                phishfry.remove(recipient, message_id)
+        except tuple(REMOVE_ERROR_RESULTS) as e:
+            return REMOVE_ERROR_RESULTS[type(e)](e.message)
 
         return RemediationSuccess("removed")
 
@@ -64,22 +77,68 @@ class EmailRemediator(Remediator):
 
         # attempt to restore the message
         try:
-            self.phishfry.restore(recipient, message_id)
-
-        # fail if access denied
-        except ErrorAccessDenied as e:
-            return RemediationFailure(e.message)
-
-        # ignore non existent mailboxes
-        except ErrorNonExistentMailbox as e:
-            return RemediationIgnore(e.message)
-
-        # fail if no existent message
-        except ErrorNonExistentMessage as e:
-            return RemediationFailure(e.message)
-
-        # fail if unsupported mailbox type
-        except ErrorUnsupportedMailboxType as e:
-            return RemediationFailure(e.message)
+            with self.sessions.session() as phishfry:
+                phishfry.restore(recipient, message_id)
+        except tuple(RESTORE_ERROR_RESULTS) as e:
+            return RESTORE_ERROR_RESULTS[type(e)](e.message)
 
         return RemediationSuccess("restored")
+
+    def remediate_batch(self, targets):
+        # a single target is remediated as usual
+        if len(targets) < 2:
+            return super().remediate_batch(targets)
+
+        # group messages by recipient mailbox
+        results = [None] * len(targets)
+        mailboxes = {}
+        for index, target in enumerate(targets):
+            message_id, recipient = target.key.split('|', 1)
+            if not is_local_email_domain(recipient):
+                results[index] = RemediationFailure('external domain')
+                continue
+            mailboxes.setdefault(recipient.lower(), (recipient, []))[1].append(index)
+
+        # each mailbox is looked up once for all of the messages in it
+        with self.sessions.session() as phishfry:
+            for recipient, indexes in mailboxes.values():
+                action = targets[indexes[0]].action
+                message_ids = [targets[index].key.split('|', 1)[0] for index in indexes]
+                for index, result in zip(indexes, self.remediate_mailbox(phishfry, action, recipient, message_ids)):
+                    results[index] = result
+
+        return results
+
+    def remediate_mailbox(self, phishfry, action, recipient, message_ids):
+        """Removes or restores the given messages in the mailbox of the recipient using a single mailbox and folder lookup.
+        Returns the list of results in the same order as the message ids."""
+        error_results = REMOVE_ERROR_RESULTS if action == REMEDIATION_ACTION_REMOVE else RESTORE_ERROR_RESULTS
+
+        # find the folder to search for messages
+        try:
+            mailbox = phishfry.find_mailbox(recipient)
+            if action == REMEDIATION_ACTION_REMOVE:
+                folder = phishfry.find_folder(mailbox, "AllItems")
+            else:
+                folder = DistinguishedFolder(mailbox, "recoverableitemsdeletions")
+        except tuple(error_results) as e:
+            return [error_results[type(e)](e.message) for message_id in message_ids]
+
+        results = []
+        for message_id in message_ids:
+            try:
+                item = phishfry.find_item(folder, message_id)
+                if action == REMEDIATION_ACTION_REMOVE:
+                    phishfry.delete(item, 'SoftDelete')
+                    results.append(RemediationSuccess("removed"))
+                else:
+                    phishfry.move(item, 'inbox')
+                    results.append(RemediationSuccess("restored"))
+            except tuple(error_results) as e:
+                results.append(error_results[type(e)](e.message))
+            except Exception as e:
+                logging.error(f"{self.name} failed to {action} {message_id} for {recipient}: {e}")
+                logging.error(traceback.format_exc())
+                results.append(RemediationError(f"{e.__class__.__name__}: {e}"))
+
+        return results
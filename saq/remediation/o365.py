@@ -5,213 +5,324 @@ import logging
 from saq.email import is_local_email_domain
 import saq.graph_api
 import saq.proxy
-from saq.remediation import Remediator, RemediationDelay, RemediationFailure, RemediationSuccess, RemediationIgnore
+from saq.remediation import Remediator, RemediationDelay, RemediationError, RemediationFailure, RemediationSuccess, RemediationIgnore, SessionPool, REMEDIATION_ACTION_REMOVE
 import time
 
-class EmailRemediator(Remediator):
+# the maximum number of requests in a graph api json batch
+GRAPH_BATCH_SIZE = 20
+
+class GraphRemediator(Remediator):
+    """Base class of remediators that use the graph api."""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.graph = requests.Session()
-        self.graph.proxies = saq.proxy.proxies()
-        self.graph.auth = saq.graph_api.GraphApiAuth(
+        self.sessions = SessionPool(self.create_session, self.config.getint('max_sessions', fallback=10))
+        self.base_uri = self.config.get('base_uri') or 'https://graph.microsoft.com/v1.0'
+
+    def create_session(self):
+        """Returns a new authenticated graph api session."""
+        graph = requests.Session()
+        graph.proxies = saq.proxy.proxies()
+        graph.auth = saq.graph_api.GraphApiAuth(
             self.config['client_id'],
             self.config['tenant_id'],
             thumbprint = self.config['thumbprint'],
             private_key_path = self.config['private_key'],
             client_credential = self.config.get("client_credential", None)
         )
-        self.base_uri = self.config.get('base_uri') or 'https://graph.microsoft.com/v1.0'
+        return graph
 
+class EmailRemediator(GraphRemediator):
     @property
     def type(self): 
         return "email"
 
+    def group_key(self, target):
+        # targets are grouped by recipient mailbox
+        return target.key.split('|', 1)[-1].lower()
+
+    def remediate_batch(self, targets):
+        # a single target is remediated as usual
+        if len(targets) < 2:
+            return super().remediate_batch(targets)
+
+        # group messages by recipient mailbox
+        results = [None] * len(targets)
+        mailboxes = {}
+        for index, target in enumerate(targets):
+            message_id, recipient = target.key.split('|', 1)
+            if not is_local_email_domain(recipient):
+                results[index] = RemediationFailure('external domain')
+                continue
+            mailboxes.setdefault(recipient.lower(), (recipient, []))[1].append(index)
+
+        with self.sessions.session() as graph:
+            for recipient, indexes in mailboxes.values():
+                action = targets[indexes[0]].action
+                message_ids = [targets[index].key.split('|', 1)[0] for index in indexes]
+                for index, result in zip(indexes, self.remediate_mailbox(graph, action, recipient, message_ids)):
+                    results[index] = result
+
+        return results
+
+    def remediate_mailbox(self, graph, action, recipient, message_ids):
+        """Removes or restores the given messages in the mailbox of the recipient.
+        Messages are looked up and moved GRAPH_BATCH_SIZE at a time. Returns the list of results in the same order as the message ids."""
+        if action == REMEDIATION_ACTION_REMOVE:
+            folder_uri = f"{self.base_uri}/users/{recipient}/messages"
+            destination = 'recoverableitemsdeletions'
+            missing_result = RemediationSuccess
+        else:
+            folder_uri = f"{self.base_uri}/users/{recipient}/mailFolders/recoverableitemsdeletions/messages"
+            destination = 'inbox'
+            missing_result = RemediationIgnore
+
+        results = {}
+        unique_message_ids = list(dict.fromkeys(message_ids))
+        for index in range(0, len(unique_message_ids), GRAPH_BATCH_SIZE):
+            chunk = unique_message_ids[index:index + GRAPH_BATCH_SIZE]
+
+            # find all of the messages in the recipient's folder with a single query
+            item_ids = {}
+            quoted = [message_id.replace("'", "''") for message_id in chunk]
+            params = {
+                '$select': 'id,internetMessageId',
+                '$filter': ' or '.join([f"internetMessageId eq '{message_id}'" for message_id in quoted]),
+                '$top': len(chunk) * 10,
+            }
+            uri = folder_uri
+            while uri is not None:
+                r = graph.get(uri, params=params)
+                if r.status_code == requests.codes.not_found:
+                    # the messages of earlier chunks keep their results
+                    result = self.mailbox_not_found_result(action, recipient, r)
+                    for message_id in unique_message_ids:
+                        results.setdefault(message_id, result)
+
+                    return [dict(results[message_id]) for message_id in message_ids]
+                r.raise_for_status()
+                r = r.json()
+                for item in r['value']:
+                    item_ids.setdefault(item['internetMessageId'], item['id'])
+
+                # the next link already contains the query parameters
+                uri = r.get('@odata.nextLink')
+                params = None
+
+            # move all of the found messages with a single json batch request
+            requests_by_id = {}
+            for message_id in chunk:
+                if message_id not in item_ids:
+                    results[message_id] = missing_result('message does not exist')
+                    continue
+                requests_by_id[str(len(requests_by_id))] = message_id
+
+            if not requests_by_id:
+                continue
+
+            batch = { 'requests': [ {
+                'id': request_id,
+                'method': 'POST',
+                'url': f"/users/{recipient}/messages/{item_ids[message_id]}/move",
+                'body': { 'destinationId': destination },
+                'headers': { 'Content-Type': 'application/json' },
+            } for request_id, message_id in requests_by_id.items() ] }
+            r = graph.post(f"{self.base_uri}/$batch", json=batch)
+            r.raise_for_status()
+            for response in r.json()['responses']:
+                message_id = requests_by_id[response['id']]
+                if response['status'] == requests.codes.not_found:
+                    results[message_id] = missing_result('message does not exist')
+                elif 200 <= response['status'] < 300:
+                    results[message_id] = RemediationSuccess('removed' if action == REMEDIATION_ACTION_REMOVE else 'restored')
+                else:
+                    results[message_id] = RemediationError(f"move failed with status {response['status']}: {response.get('body')}")
+
+        return [dict(results.get(message_id, RemediationError('no response'))) for message_id in message_ids]
+
+    def mailbox_not_found_result(self, action, recipient, r):
+        """Returns the result of a mailbox lookup that was not found."""
+        if action != REMEDIATION_ACTION_REMOVE:
+            return RemediationIgnore('mailbox does not exist')
+
+        try:
+            error_result = r.json()
+            error_code = error_result['error']['code']
+            error_message = error_result['error']['message']
+            logging.warning(f'Remediator={self.name}: lookup of {recipient}: {error_code}: {error_message}')
+            if 'MailboxNotEnabledForRESTAPI' == error_code:
+                return RemediationFailure(f'{error_code}: {error_message}')
+            if 'ErrorInvalidUser' == error_code:
+                return RemediationIgnore(f'Mailbox does not exist.')
+            return RemediationIgnore(f'{error_code}: {error_message}')
+        except Exception as e:
+            logging.warning(f"{r.status_code} unexpected: {r.content}")
+            return RemediationIgnore(f'Unexpected result from MS o365: {r.content}')
+
     def remove(self, target):
-        # break target into components
-        message_id, recipient = target.split('|', 1)
-
-        # skip external domains
-        if not is_local_email_domain(recipient):
-            return RemediationFailure('external domain')
-
-        # find message in recipient's mailbox
-        params = { '$select': 'id', '$filter': f"internetMessageId eq '{message_id}'" }
-        r = self.graph.get(f"{self.base_uri}/users/{recipient}/messages", params=params)
-        if r.status_code == requests.codes.not_found:
-            try:
-                error_result = r.json()
-                error_code = error_result['error']['code']
-                error_message = error_result['error']['message']
-                logging.warning(f'Remediator={self.name}: lookup of {recipient}: {error_code}: {error_message}')
-                if 'MailboxNotEnabledForRESTAPI' == error_code:
-                    return RemediationFailure(f'{error_code}: {error_message}')
-                if 'ErrorInvalidUser' == error_code:
-                    return RemediationIgnore(f'Mailbox does not exist.')
-                return RemediationIgnore(f'{error_code}: {error_message}')
-            except Exception as e:
-                logging.warning(f"{r.status_code} unexpected: {r.content}")
-                return RemediationIgnore(f'Unexpected result from MS o365: {r.content}')
-        r.raise_for_status()
-        r = r.json()
-        if len(r['value']) == 0:
-            logging.info(f"got empty result response: {r}")
-            return RemediationSuccess('message does not exist')
-        item_id = r['value'][0]['id']
-
-        # move email into the recoverable items deletions folder
-        params = { 'destinationId': 'recoverableitemsdeletions' }
-        r = self.graph.post(f"{self.base_uri}/users/{recipient}/messages/{item_id}/move", json=params)
-        if r.status_code == requests.codes.not_found:
-            return RemediationSuccess('message does not exist')
-        r.raise_for_status()
-        return RemediationSuccess("removed")
+        with self.sessions.session() as graph:
+            # break target into components
+            message_id, recipient = target.split('|', 1)
+
+            # skip external domains
+            if not is_local_email_domain(recipient):
+                return RemediationFailure('external domain')
+
+            # find message in recipient's mailbox
+            params = { '$select': 'id', '$filter': f"internetMessageId eq '{message_id}'" }
+            r = graph.get(f"{self.base_uri}/users/{recipient}/messages", params=params)
+            if r.status_code == requests.codes.not_found:
+                return self.mailbox_not_found_result(REMEDIATION_ACTION_REMOVE, recipient, r)
+            r.raise_for_status()
+            r = r.json()
+            if len(r['value']) == 0:
+                logging.info(f"got empty result response: {r}")
+                return RemediationSuccess('message does not exist')
+            item_id = r['value'][0]['id']
+
+            # move email into the recoverable items deletions folder
+            params = { 'destinationId': 'recoverableitemsdeletions' }
+            r = graph.post(f"{self.base_uri}/users/{recipient}/messages/{item_id}/move", json=params)
+            if r.status_code == requests.codes.not_found:
+                return RemediationSuccess('message does not exist')
+            r.raise_for_status()
+            return RemediationSuccess("removed")
 
     def restore(self, target, restore_target):
-        # break target into components
-        message_id, recipient = target.split('|', 1)
+        with self.sessions.session() as graph:
+            # break target into components
+            message_id, recipient = target.split('|', 1)
 
-        # skip external domains
-        if not is_local_email_domain(recipient):
-            return RemediationFailure('external domain')
+            # skip external domains
+            if not is_local_email_domain(recipient):
+                return RemediationFailure('external domain')
 
-        # find message in recipient's recoverableitemsdeletions folder
-        params = { '$select': 'id', '$filter': f"internetMessageId eq '{message_id}'" }
-        r = self.graph.get(f"{self.base_uri}/users/{recipient}/mailFolders/recoverableitemsdeletions/messages", params=params)
-        if r.status_code == requests.codes.not_found:
-            return RemediationIgnore('mailbox does not exist')
-        r.raise_for_status()
-        r = r.json()
-        if len(r['value']) == 0:
-            return RemediationIgnore('message does not exist')
-        item_id = r['value'][0]['id']
-
-        # move email into the inbox
-        params = { 'destinationId': 'inbox' }
-        r = self.graph.post(f"{self.base_uri}/users/{recipient}/messages/{item_id}/move", json=params)
-        if r.status_code == requests.codes.not_found:
-            return RemediationIgnore('message does not exist')
-        r.raise_for_status()
-        return RemediationSuccess("restored")
-
-class FileRemediator(Remediator):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.graph = requests.Session()
-        self.graph.proxies = saq.proxy.proxies()
-        self.graph.auth = saq.graph_api.GraphApiAuth(
-            self.config['client_id'],
-            self.config['tenant_id'],
-            thumbprint = self.config['thumbprint'],
-            private_key_path = self.config['private_key'],
-            client_credential = section.get("client_credential", None)
-        )
-        self.base_uri = self.config.get('base_uri', fallback='https://graph.microsoft.com/v1.0')
+            # find message in recipient's recoverableitemsdeletions folder
+            params = { '$select': 'id', '$filter': f"internetMessageId eq '{message_id}'" }
+            r = graph.get(f"{self.base_uri}/users/{recipient}/mailFolders/recoverableitemsdeletions/messages", params=params)
+            if r.status_code == requests.codes.not_found:
+                return RemediationIgnore('mailbox does not exist')
+            r.raise_for_status()
+            r = r.json()
+            if len(r['value']) == 0:
+                return RemediationIgnore('message does not exist')
+            item_id = r['value'][0]['id']
 
+            # move email into the inbox
+            params = { 'destinationId': 'inbox' }
+            r = graph.post(f"{self.base_uri}/users/{recipient}/messages/{item_id}/move", json=params)
+            if r.status_code == requests.codes.not_found:
+                return RemediationIgnore('message does not exist')
+            r.raise_for_status()
+            return RemediationSuccess("restored")
+
+class FileRemediator(GraphRemediator):
     @property
     def type(self): 
         return "o365_file"
 
     def remove(self, target):
-        # get file info
-        r = self.graph.get(f"{self.base_uri}{target}")
-        if r.status_code == requests.codes.not_found:
-            return RemediationSuccess("file does not exist")
-        r.raise_for_status()
-        item = r.json()
-
-        # rename file to prevent name collision during transfer
-        data = { 'name': item['id'] }
-        r = self.graph.patch(f"{self.base_uri}/drives/{item['parentReference']['driveId']}/items/{item['id']}", json=data)
-        r.raise_for_status()
-
-        # get creator's root drive info
-        r = self.graph.get(f"{self.base_uri}/users/{item['createdBy']['user']['email']}/drive/root")
-        creator = r.json()
-        r.raise_for_status()
-
-        # start moving file to creator's root drive
-        data = { "parentReference": { "driveId": creator['parentReference']['driveId'], "id": creator['id'] } }
-        headers = { "Prefer": "respond-async" }
-        r = self.graph.patch(f"{self.base_uri}/drives/{item['parentReference']['driveId']}/items/{item['id']}", json=data, headers=headers)
-        r.raise_for_status()
-        location = r.headers['location']
-
-        # wait for move operation to complete
-        status = 'inProgress'
-        while status == 'inProgress':
-            time.sleep(0.5)
-            r = requests.get(location, proxies=proxies()) # monitor url does not use auth, using auth actually fails ¯\_(ツ)_/¯
+        with self.sessions.session() as graph:
+            # get file info
+            r = graph.get(f"{self.base_uri}{target}")
+            if r.status_code == requests.codes.not_found:
+                return RemediationSuccess("file does not exist")
             r.raise_for_status()
-            result = r.json()
-            status = result['status']
-        if status == "failed":
-            raise Exception(f"failed to move file: {result['error']['message']}")
-        restore_key = f"/drives/{creator['parentReference']['driveId']}/items/{result['resourceId']}"
-
-        # rename file to original name
-        name = item['name']
-        count = 0
-        while True:
-            data = { 'name': name }
-            r = self.graph.patch(f"{self.base_uri}{restore_key}", json=data)
-            if r.status_code == requests.codes.conflict:
-                count += 1
-                name = f"({count}) {item['name']}"
-                continue
+            item = r.json()
+
+            # rename file to prevent name collision during transfer
+            data = { 'name': item['id'] }
+            r = graph.patch(f"{self.base_uri}/drives/{item['parentReference']['driveId']}/items/{item['id']}", json=data)
             r.raise_for_status()
-            break
 
-        # move to recycle bin
-        r = self.graph.delete(f"{self.base_uri}{restore_key}")
-        r.raise_for_status()
+            # get creator's root drive info
+            r = graph.get(f"{self.base_uri}/users/{item['createdBy']['user']['email']}/drive/root")
+            creator = r.json()
+            r.raise_for_status()
+
+            # start moving file to creator's root drive
+            data = { "parentReference": { "driveId": creator['parentReference']['driveId'], "id": creator['id'] } }
+            headers = { "Prefer": "respond-async" }
+            r = graph.patch(f"{self.base_uri}/drives/{item['parentReference']['driveId']}/items/{item['id']}", json=data, headers=headers)
+            r.raise_for_status()
+            location = r.headers['location']
+
+            # wait for move operation to complete
+            status = 'inProgress'
+            while status == 'inProgress':
+                time.sleep(0.5)
+                r = requests.get(location, proxies=saq.proxy.proxies()) # monitor url does not use auth, using auth actually fails ¯\_(ツ)_/¯
+                r.raise_for_status()
+                result = r.json()
+                status = result['status']
+            if status == "failed":
+                raise Exception(f"failed to move file: {result['error']['message']}")
+            restore_key = f"/drives/{creator['parentReference']['driveId']}/items/{result['resourceId']}"
+
+            # rename file to original name
+            name = item['name']
+            count = 0
+            while True:
+                data = { 'name': name }
+                r = graph.patch(f"{self.base_uri}{restore_key}", json=data)
+                if r.status_code == requests.codes.conflict:
+                    count += 1
+                    name = f"({count}) {item['name']}"
+                    continue
+                r.raise_for_status()
+                break
+
+            # move to recycle bin
+            r = graph.delete(f"{self.base_uri}{restore_key}")
+            r.raise_for_status()
 
-        # TODO notify user via email
+            # TODO notify user via email
 
-        # return success with a restore key in case we need to restore the file
-        return RemediationSuccess("removed", restore_key=restore_key)
+            # return success with a restore key in case we need to restore the file
+            return RemediationSuccess("removed", restore_key=restore_key)
 
     def restore(self, target, restore_target):
-        # a restoration key is required
-        if restore_target is None:
-            return RemediationFailure("missing restoration key")
-
-        # get file info
-        r = self.graph.get(f"{self.base_uri}{target}")
-        if r.ok:
-            return RemediationSuccess("file already restored")
-
-        # get original location info
-        origin, _ = target.rsplit('/', 1)
-        if origin.endswith(':'):
-            origin = origin[:-1]
-        r = self.graph.get(f"{self.base_uri}{origin}")
-        if r.status_code == requests.codes.not_found:
-            return RemediationFailure("original location no longer exists")
-        r.raise_for_status()
-        origin = r.json()
-
-        # retrieve file from recycle bin
-        r = self.graph.post(f"{self.base_uri}{restore_target}/restore")
-        if r.status_code == requests.codes.not_found:
-            return RemediationFailure("file does not exist")
-        r.raise_for_status
-        item = r.json()
-
-        # start moving file back to original location
-        data = { "parentReference": { "driveId": origin['parentReference']['driveId'], "id": origin['id'] } }
-        headers = { "Prefer": "respond-async" }
-        r = self.graph.patch(f"{self.base_uri}{restore_target}", json=data, headers=headers)
-        r.raise_for_status()
-        location = r.headers['location']
-
-        # wait for move operation to complete
-        status = 'inProgress'
-        while status == 'inProgress':
-            time.sleep(0.5)
-            r = requests.get(location, proxies=proxies()) # monitor url does not use auth, using auth actually fails ¯\_(ツ)_/¯
+        with self.sessions.session() as graph:
+            # a restoration key is required
+            if restore_target is None:
+                return RemediationFailure("missing restoration key")
+
+            # get file info
+            r = graph.get(f"{self.base_uri}{target}")
+            if r.ok:
+                return RemediationSuccess("file already restored")
+
+            # get original location info
+            origin, _ = target.rsplit('/', 1)
+            if origin.endswith(':'):
+                origin = origin[:-1]
+            r = graph.get(f"{self.base_uri}{origin}")
+            if r.status_code == requests.codes.not_found:
+                return RemediationFailure("original location no longer exists")
+            r.raise_for_status()
+            origin = r.json()
+
+            # retrieve file from recycle bin
+            r = graph.post(f"{self.base_uri}{restore_target}/restore")
+            if r.status_code == requests.codes.not_found:
+                return RemediationFailure("file does not exist")
+            r.raise_for_status
+            item = r.json()
+
+            # start moving file back to original location
+            data = { "parentReference": { "driveId": origin['parentReference']['driveId'], "id": origin['id'] } }
+            headers = { "Prefer": "respond-async" }
+            r = graph.patch(f"{self.base_uri}{restore_target}", json=data, headers=headers)
             r.raise_for_status()
-            result = r.json()
-            status = result['status']
-        if status == "failed":
-            raise Exception(f"failed to move file: result['error']['message']")
-        return RemediationSuccess("restored")
+            location = r.headers['location']
+
+            # wait for move operation to complete
+            status = 'inProgress'
+            while status == 'inProgress':
+                time.sleep(0.5)
+                r = requests.get(location, proxies=saq.proxy.proxies()) # monitor url does not use auth, using auth actually fails ¯\_(ツ)_/¯
+                r.raise_for_status()
+                result = r.json()
+                status = result['status']
+            if status == "failed":
+                raise Exception(f"failed to move file: result['error']['message']")
+            return RemediationSuccess("restored")
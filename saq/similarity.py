@@ -0,0 +1,70 @@
+# vim: sw=4:ts=4:et
+#
+# MinHash signatures and locality sensitive hashing (LSH) used to find similar alerts
+#
+# the features of an alert are the names of the tags and the md5 hashes of the observables
+# the MinHash signature of an alert is a list of integers such that the fraction of equal values
+# between two signatures estimates the Jaccard similarity of the features of the two alerts
+#
+# the signature is split into bands of rows and each band is hashed
+# alerts that share at least one band hash are candidates for being similar
+# (see the [similar_alerts] configuration section for the number of permutations and bands)
+#
+
+import hashlib
+import random
+import struct
+
+# mersenne prime used for the permutations
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# key = num_perm, value = list of (a, b) tuples for each permutation
+_permutations = {}
+
+def _get_permutations(num_perm):
+    if num_perm not in _permutations:
+        # this must be the same for every process so we use a fixed seed
+        generator = random.Random(1)
+        _permutations[num_perm] = [ (generator.randint(1, _MERSENNE_PRIME - 1), generator.randint(0, _MERSENNE_PRIME - 1))
+                                    for _ in range(num_perm) ]
+
+    return _permutations[num_perm]
+
+def _hash_feature(feature):
+    return struct.unpack('<I', hashlib.blake2b(feature.encode('utf8', errors='ignore'), digest_size=4).digest())[0]
+
+def minhash_signature(features, num_perm):
+    """Returns the MinHash signature (a list of num_perm integers) of the given iterable of strings.
+       Returns None if there are no features."""
+    hashes = set([_hash_feature(f) for f in features])
+    if not hashes:
+        return None
+
+    return [ min([((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes]) for a, b in _get_permutations(num_perm) ]
+
+def pack_signature(signature):
+    """Returns the given signature as bytes."""
+    return struct.pack(f'<{len(signature)}I', *signature)
+
+def unpack_signature(data):
+    """Returns the signature packed by pack_signature."""
+    return list(struct.unpack(f'<{len(data) // 4}I', data))
+
+def lsh_bands(signature, bands):
+    """Returns a list of (band, hash) tuples for the given signature split into the given number of bands.
+       Any rows left over if the signature does not split evenly are ignored."""
+    rows = len(signature) // bands
+    result = []
+    for band in range(bands):
+        band_data = pack_signature(signature[band * rows:(band + 1) * rows])
+        result.append((band, struct.unpack('<Q', hashlib.blake2b(band_data, digest_size=8).digest())[0]))
+
+    return result
+
+def estimate_similarity(signature_a, signature_b):
+    """Returns the estimated Jaccard similarity (0.0 to 1.0) of the features of the given signatures."""
+    if not signature_a or len(signature_a) != len(signature_b):
+        return 0.0
+
+    return sum([1 for a, b in zip(signature_a, signature_b) if a == b]) / len(signature_a)
@@ -0,0 +1,172 @@
+# vim: sw=4:ts=4:et
+
+import hashlib
+import os
+import os.path
+import shutil
+import stat
+import uuid
+
+from saq.test import *
+from saq.blobs import BlobStore, get_blob_store, reset_blob_store
+from saq.constants import *
+from saq.modules.test import BasicTestAnalysis
+
+class BlobStoreTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.blob_dir = os.path.join(saq.TEMP_DIR, 'blobs')
+        self.work_dir = os.path.join(saq.TEMP_DIR, 'blob_files')
+        for path in [ self.blob_dir, self.work_dir ]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+            os.makedirs(path)
+
+        self.blob_store = BlobStore(self.blob_dir)
+
+    def tearDown(self, *args, **kwargs):
+        self.blob_store.close()
+        super().tearDown(*args, **kwargs)
+
+    def create_file(self, name, data):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        return path
+
+    def test_store(self):
+        path_1 = self.create_file('file_1', b'test data')
+        path_2 = self.create_file('file_2', b'test data')
+
+        md5, sha1, sha256 = self.blob_store.store(path_1)
+        self.assertEquals(md5, hashlib.md5(b'test data').hexdigest())
+        self.assertEquals(sha1, hashlib.sha1(b'test data').hexdigest())
+        self.assertEquals(sha256, hashlib.sha256(b'test data').hexdigest())
+        self.assertTrue(os.path.exists(self.blob_store.blob_path(sha256)))
+
+        # the second copy of the same content is replaced by a link to the blob
+        self.assertEquals(self.blob_store.store(path_2), (md5, sha1, sha256))
+        self.assertTrue(os.path.samefile(path_1, path_2))
+        self.assertEquals(os.stat(self.blob_store.blob_path(sha256)).st_nlink, 3)
+
+        # files already in the store are not hashed again
+        self.assertEquals(self.blob_store.get_hashes(path_2), (md5, sha1, sha256))
+        with open(path_2, 'rb') as fp:
+            self.assertEquals(fp.read(), b'test data')
+
+    def test_min_size(self):
+        self.blob_store.min_size = 1024
+        self.assertIsNone(self.blob_store.store(self.create_file('file_1', b'test data')))
+        self.assertEquals(self.blob_store.stats()['blobs'], 0)
+
+    def test_link(self):
+        source_path = self.create_file('source', b'test data')
+        _, _, sha256 = self.blob_store.link(source_path, os.path.join(self.work_dir, 'target_1'))
+        self.assertTrue(os.path.exists(source_path))
+        self.blob_store.link(os.path.join(self.work_dir, 'target_1'), os.path.join(self.work_dir, 'target_2'), move=True)
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'target_1')))
+        self.assertTrue(os.path.samefile(self.blob_store.blob_path(sha256), os.path.join(self.work_dir, 'target_2')))
+
+    def test_collect(self):
+        path_1 = self.create_file('file_1', b'test data')
+        path_2 = self.create_file('file_2', b'test data')
+        _, _, sha256 = self.blob_store.store(path_1)
+        self.blob_store.store(path_2)
+        self.assertEquals(self.blob_store.stats(), { 'blobs': 1, 'size': 9, 'links': 2 })
+
+        # the blob is kept while anything still links to it
+        os.remove(path_1)
+        self.assertFalse(self.blob_store.release(sha256))
+        self.assertEquals(self.blob_store.collect(), 0)
+
+        os.remove(path_2)
+        self.assertEquals(self.blob_store.collect(), 1)
+        self.assertFalse(os.path.exists(self.blob_store.blob_path(sha256)))
+        self.assertEquals(self.blob_store.stats()['blobs'], 0)
+
+    def test_read_only(self):
+        path_1 = self.create_file('file_1', b'test data')
+        self.blob_store.store(path_1)
+        self.assertFalse(os.stat(path_1).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def test_detach(self):
+        path_1 = self.create_file('file_1', b'test data')
+        path_2 = self.create_file('file_2', b'test data')
+        _, _, sha256 = self.blob_store.store(path_1)
+        self.blob_store.store(path_2)
+
+        # a detached file is a private copy that can be modified without changing the blob
+        self.assertTrue(self.blob_store.detach(path_1))
+        self.assertFalse(os.path.samefile(path_1, path_2))
+        self.assertEquals(os.stat(self.blob_store.blob_path(sha256)).st_nlink, 2)
+        with open(path_1, 'ab') as fp:
+            fp.write(b'more test data')
+
+        with open(path_2, 'rb') as fp:
+            self.assertEquals(fp.read(), b'test data')
+
+        # files that are not in the store are left alone
+        self.assertFalse(self.blob_store.detach(path_1))
+
+    def test_modified_blob(self):
+        path_1 = self.create_file('file_1', b'test data')
+        path_2 = self.create_file('file_2', b'test data')
+        _, _, sha256 = self.blob_store.store(path_1)
+
+        # a blob that is modified anyway (after a chmod) is no longer a known blob
+        os.chmod(path_1, stat.S_IRUSR | stat.S_IWUSR)
+        with open(path_1, 'ab') as fp:
+            fp.write(b'more test data')
+
+        self.assertIsNone(self.blob_store.get_hashes(path_1))
+
+        # and it is not linked to new files with the original content
+        self.blob_store.store(path_2)
+        self.assertFalse(os.path.samefile(path_1, path_2))
+        with open(path_2, 'rb') as fp:
+            self.assertEquals(fp.read(), b'test data')
+
+class RootAnalysisBlobTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        saq.CONFIG['blob_store']['enabled'] = 'yes'
+        saq.CONFIG['blob_store']['min_size'] = '0'
+        reset_blob_store()
+
+    def tearDown(self, *args, **kwargs):
+        reset_blob_store()
+        saq.CONFIG['blob_store']['enabled'] = 'no'
+        super().tearDown(*args, **kwargs)
+
+    def create_root_with_file(self):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        analysis = BasicTestAnalysis()
+        observable.add_analysis(analysis)
+        with open(os.path.join(root.storage_dir, 'test.txt'), 'wb') as fp:
+            fp.write(uuid.uuid4().bytes)
+
+        file_observable = analysis.add_observable(F_FILE, 'test.txt')
+
+        # hashing the file does not store it
+        file_observable.compute_hashes()
+        self.assertEquals(os.stat(file_observable.path).st_nlink, 1)
+
+        root.store_files()
+        blob_path = get_blob_store().blob_path(file_observable.sha256_hash)
+        self.assertEquals(os.stat(blob_path).st_nlink, 2)
+        return root, blob_path
+
+    def test_archive_releases_blobs(self):
+        root, blob_path = self.create_root_with_file()
+        root.archive()
+        self.assertFalse(os.path.exists(blob_path))
+
+    def test_reset_releases_blobs(self):
+        root, blob_path = self.create_root_with_file()
+        root.reset()
+        self.assertFalse(os.path.exists(os.path.join(root.storage_dir, 'test.txt')))
+        self.assertFalse(os.path.exists(blob_path))
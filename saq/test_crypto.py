@@ -1,6 +1,9 @@
 # vim: sw=4:ts=4:et
 
+import gzip
 import logging
+import os
+import os.path
 
 import saq
 
@@ -75,3 +78,68 @@ class TestCase(ACEBasicTestCase):
         self.assertNotEquals(chunk, encrypted_chunk)
         decrypted_chunk = decrypt_chunk(encrypted_chunk)
         self.assertEquals(chunk, decrypted_chunk)
+
+    def test_encrypt_file(self):
+        set_encryption_password('test')
+        source_path = os.path.join(saq.TEMP_DIR, 'test.txt')
+        target_path = os.path.join(saq.TEMP_DIR, 'test.txt.e')
+        decrypted_path = os.path.join(saq.TEMP_DIR, 'test.txt.d')
+        # more than one chunk and not a multiple of the block size
+        data = os.urandom(CHUNK_SIZE * 2 + 17)
+        with open(source_path, 'wb') as fp:
+            fp.write(data)
+
+        encrypt(source_path, target_path)
+        # the streaming reader reads what encrypt() writes
+        with open_encrypted(target_path, 'rb') as fp:
+            self.assertEquals(fp.read(), data)
+
+        # and decrypt() reads what the streaming writer writes
+        with open_encrypted(target_path, 'wb') as fp:
+            for index in range(0, len(data), 1000):
+                fp.write(data[index:index + 1000])
+
+        decrypt(target_path, decrypted_path)
+        with open(decrypted_path, 'rb') as fp:
+            self.assertEquals(fp.read(), data)
+
+    def test_open_encrypted_gzip(self):
+        set_encryption_password('test')
+        target_path = os.path.join(saq.TEMP_DIR, 'test.gz.e')
+        data = b'line 1\nline 2\n' * 10000
+        with open_encrypted(target_path, 'wb', compression=COMPRESSION_GZIP) as fp:
+            fp.write(data)
+
+        # the stream is compressed before it is encrypted
+        with open(target_path, 'rb') as fp:
+            self.assertEquals(gzip.decompress(decrypt_chunk(fp.read())), data)
+
+        with open_encrypted(target_path, 'rb', compression=COMPRESSION_GZIP) as fp:
+            self.assertEquals(fp.readline(), b'line 1\n')
+            self.assertEquals(fp.read(), data[len(b'line 1\n'):])
+
+    def test_open_encrypted_empty(self):
+        set_encryption_password('test')
+        target_path = os.path.join(saq.TEMP_DIR, 'test.e')
+        with open_encrypted(target_path, 'wb') as fp:
+            pass
+
+        with open_encrypted(target_path, 'rb') as fp:
+            self.assertEquals(fp.read(), b'')
+
+    def test_open_encrypted_truncated(self):
+        set_encryption_password('test')
+        target_path = os.path.join(saq.TEMP_DIR, 'test.e')
+        with open_encrypted(target_path, 'wb') as fp:
+            fp.write(os.urandom(1024))
+
+        with open(target_path, 'rb+') as fp:
+            fp.truncate(512)
+
+        with open_encrypted(target_path, 'rb') as fp:
+            with self.assertRaises(EOFError):
+                fp.read()
+
+    def test_open_encrypted_invalid_compression(self):
+        with self.assertRaises(ValueError):
+            open_encrypted(os.path.join(saq.TEMP_DIR, 'test.e'), 'wb', compression='lzma')
@@ -5,6 +5,10 @@ import unittest
 from exchangelib.errors import DoesNotExist
 
 from saq.email import (
+    ArchiveTrigramSearch,
+    get_covering_trigrams,
+    get_trigrams,
+    index_archive_trigrams,
     normalize_email_address,
     decode_rfc2822,
     normalize_message_id,
@@ -37,6 +41,82 @@ class TestCase(ACEBasicTestCase):
                           'Re:亞什兰的推廣策略')
 
 
+class ArchiveTrigramTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        from saq.database import get_db_connection
+        with get_db_connection("email_archive") as db:
+            c = db.cursor()
+            c.execute("DELETE FROM archive")
+            c.execute("DELETE FROM archive_server")
+            c.execute("INSERT INTO archive_server ( hostname ) VALUES ( %s )", ('localhost',))
+            server_id = c.lastrowid
+            self.archive_ids = []
+            for index, (url, subject) in enumerate([
+                ('http://evil.com/payload.exe', 'Invoice 100%'),
+                ('http://example.com/index.html', 'Meeting notes'),
+                ('http://evil.com/other.html', 'Invoice_200') ]):
+                c.execute("INSERT INTO archive ( server_id, md5 ) VALUES ( %s, UNHEX(MD5(%s)) )", (server_id, str(index)))
+                archive_id = c.lastrowid
+                values = [ ('url', url), ('subject', subject) ]
+                for field, value in values:
+                    c.execute("INSERT INTO archive_search ( field, value, archive_id ) VALUES ( %s, %s, %s )",
+                              (field, value, archive_id))
+
+                index_archive_trigrams(db, c, archive_id, values)
+                self.archive_ids.append(archive_id)
+
+            db.commit()
+
+    def test_get_trigrams(self):
+        self.assertEquals(get_trigrams('ab'), set())
+        self.assertEquals(get_trigrams('abcd'), { int.from_bytes(b'abc', 'big'), int.from_bytes(b'bcd', 'big') })
+        self.assertEquals(get_trigrams(b'aaaa'), { int.from_bytes(b'aaa', 'big') })
+        self.assertEquals(get_covering_trigrams('ab'), [])
+        self.assertEquals(get_covering_trigrams('abcdefg'), 
+                          [ int.from_bytes(b'abc', 'big'), int.from_bytes(b'def', 'big'), int.from_bytes(b'efg', 'big') ])
+
+    def test_search(self):
+        from saq.database import get_db_connection
+        with get_db_connection("email_archive") as db:
+            c = db.cursor()
+            search = ArchiveTrigramSearch(c)
+            self.assertEquals(search.search('evil.com'), { self.archive_ids[0], self.archive_ids[2] })
+            self.assertEquals(search.search('payload'), { self.archive_ids[0] })
+            self.assertEquals(search.search('nothing like this'), set())
+            # all the trigrams exist but not in that order
+            self.assertEquals(search.search('html.evil'), set())
+            # wildcards are treated literally
+            self.assertEquals(search.search('100%'), { self.archive_ids[0] })
+            self.assertEquals(search.search('e_1'), set())
+            # too short to use the index
+            self.assertEquals(search.search('_2'), { self.archive_ids[2] })
+
+    def test_search_fields(self):
+        from saq.database import get_db_connection
+        with get_db_connection("email_archive") as db:
+            c = db.cursor()
+            self.assertEquals(ArchiveTrigramSearch(c, fields=['subject']).search('Invoice'), 
+                              { self.archive_ids[0], self.archive_ids[2] })
+            self.assertEquals(ArchiveTrigramSearch(c, fields=['subject']).search('evil'), set())
+
+    def test_search_many(self):
+        from saq.database import get_db_connection
+        with get_db_connection("email_archive") as db:
+            c = db.cursor()
+            search = ArchiveTrigramSearch(c)
+            self.assertEquals(search.search_many(['payload', 'Meeting']), { self.archive_ids[0], self.archive_ids[1] })
+
+    def test_max_postings(self):
+        from saq.database import get_db_connection
+        with get_db_connection("email_archive") as db:
+            c = db.cursor()
+            # every trigram is too common so the search falls back to a scan
+            search = ArchiveTrigramSearch(c, max_postings=0)
+            self.assertIsNone(search.get_candidates('evil.com'))
+            self.assertEquals(search.search('evil.com'), { self.archive_ids[0], self.archive_ids[2] })
+
+
 class TestMessageIdFormatter(unittest.TestCase):
     def setUp(self):
         self.expected_message_id = '<this_is_fake@local.local>'
@@ -0,0 +1,71 @@
+# vim: sw=4:ts=4:et
+
+import hashlib
+import os
+import os.path
+import shutil
+
+from saq.test import *
+from saq.file_type import FileTyper, OLE_SIGNATURE
+
+class FileTyperTestCase(ACEBasicTestCase):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.work_dir = os.path.join(saq.TEMP_DIR, 'file_type')
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+
+        os.makedirs(self.work_dir)
+
+    def create_file(self, name, data):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        return path
+
+    def test_get_type(self):
+        for use_libmagic in [ True, False ]:
+            typer = FileTyper(use_libmagic=use_libmagic)
+            file_type = typer.get_type(self.create_file('test.pdf', b'%PDF-1.4\n%test\n'))
+            self.assertEquals(file_type.mime, 'application/pdf')
+            self.assertTrue(file_type.description.startswith('PDF document'))
+            self.assertTrue(file_type.is_pdf_file)
+            self.assertFalse(file_type.is_ole_file)
+            self.assertFalse(file_type.is_rtf_file)
+            self.assertFalse(file_type.is_pe_file)
+            self.assertFalse(file_type.is_zip_file)
+
+            file_type = typer.get_type(self.create_file('test.txt', b'test data\n'))
+            self.assertEquals(file_type.mime, 'text/plain')
+            self.assertFalse(file_type.is_pdf_file)
+
+    def test_large_file(self):
+        # only the start of the file is read for the header checks but libmagic still sees the whole file
+        for use_libmagic in [ True, False ]:
+            typer = FileTyper(use_libmagic=use_libmagic)
+            file_type = typer.get_type(self.create_file('test.pdf', b'%PDF-1.4\n%test\n' + b'A' * 65536))
+            self.assertEquals(file_type.mime, 'application/pdf')
+            self.assertTrue(file_type.is_pdf_file)
+
+    def test_header_checks(self):
+        typer = FileTyper()
+        self.assertTrue(typer.get_type(self.create_file('ole', OLE_SIGNATURE + b'\x00' * 512)).is_ole_file)
+        self.assertTrue(typer.get_type(self.create_file('rtf', b'{\\rtf1\\ansi test}')).is_rtf_file)
+        self.assertTrue(typer.get_type(self.create_file('pe', b'MZ' + b'\x00' * 62)).is_pe_file)
+        self.assertTrue(typer.get_type(self.create_file('zip', b'PK\x03\x04' + b'\x00' * 26)).is_zip_file)
+
+    def test_cache(self):
+        typer = FileTyper(cache_size=1)
+        path = self.create_file('test.pdf', b'%PDF-1.4\n%test\n')
+        sha256 = hashlib.sha256(b'%PDF-1.4\n%test\n').hexdigest()
+        file_type = typer.get_type(path, sha256=sha256)
+        self.assertTrue(typer.get_cached_type(sha256) is file_type)
+
+        # the same content is not typed again
+        os.remove(path)
+        self.assertTrue(typer.get_type(path, sha256=sha256) is file_type)
+
+        # only cache_size results are kept
+        typer.get_type(self.create_file('test.txt', b'test data\n'), sha256='other')
+        self.assertIsNone(typer.get_cached_type(sha256))
@@ -0,0 +1,42 @@
+# vim: sw=4:ts=4:et
+
+from saq.test import *
+from saq.similarity import minhash_signature, pack_signature, unpack_signature, lsh_bands, estimate_similarity
+
+class SimilarityTestCase(ACEBasicTestCase):
+    def test_identical_features(self):
+        features = [ 'tag:phish', 'observable:abc', 'observable:def' ]
+        a = minhash_signature(features, 64)
+        b = minhash_signature(list(reversed(features)), 64)
+        self.assertEquals(len(a), 64)
+        self.assertEquals(a, b)
+        self.assertEquals(estimate_similarity(a, b), 1.0)
+        self.assertEquals(lsh_bands(a, 16), lsh_bands(b, 16))
+
+    def test_disjoint_features(self):
+        a = minhash_signature([ f'observable:a{i}' for i in range(50) ], 64)
+        b = minhash_signature([ f'observable:b{i}' for i in range(50) ], 64)
+        self.assertLess(estimate_similarity(a, b), 0.2)
+
+    def test_partial_overlap(self):
+        # jaccard similarity of 50 / 150
+        a = minhash_signature([ f'observable:{i}' for i in range(0, 100) ], 128)
+        b = minhash_signature([ f'observable:{i}' for i in range(50, 150) ], 128)
+        self.assertGreater(estimate_similarity(a, b), 0.1)
+        self.assertLess(estimate_similarity(a, b), 0.6)
+
+    def test_no_features(self):
+        self.assertIsNone(minhash_signature([], 64))
+        self.assertEquals(estimate_similarity([], []), 0.0)
+
+    def test_pack_signature(self):
+        signature = minhash_signature([ 'tag:test' ], 64)
+        data = pack_signature(signature)
+        self.assertEquals(len(data), 64 * 4)
+        self.assertEquals(unpack_signature(data), signature)
+
+    def test_lsh_bands(self):
+        signature = minhash_signature([ 'tag:test' ], 64)
+        bands = lsh_bands(signature, 16)
+        self.assertEquals(len(bands), 16)
+        self.assertEquals([band for band, _ in bands], list(range(16)))
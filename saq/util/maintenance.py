@@ -88,3 +88,10 @@ def cleanup_alerts(fp_days_old=None, ignore_days_old=None, dry_run=False):
         
     if dry_run:
         logging.info(f"{dry_run_count} fp alerts would be archived")
+        return
+
+    # remove the blobs that were only used by the alerts we just deleted
+    from saq.blobs import get_blob_store
+    blob_store = get_blob_store()
+    if blob_store is not None:
+        blob_store.collect()
@@ -0,0 +1,195 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# compiled matchers for large lists of domains, networks and substrings
+#
+# SuffixMatcher - matches values that end with any of the entries (trie of reversed characters)
+# DomainMatcher - matches fqdns that are equal to or a subdomain of any of the entries (trie of reversed labels)
+# NetworkMatcher - matches ip addresses contained in any of the entries (sorted ranges searched with bisect)
+# SubstringMatcher - matches values that contain any of the entries (Aho-Corasick automaton)
+#
+# each match function returns the entry that matched (useful for logging) or None if nothing matched
+#
+
+import bisect
+import ipaddress
+
+# the trie key used to store the entry that terminates at a node
+# (all other keys are strings so this can never collide)
+_TERMINAL = None
+
+class SuffixMatcher(object):
+    """Matches values that end with any of the entries."""
+    def __init__(self, entries=(), ignore_case=True):
+        self.ignore_case = ignore_case
+        self.root = {}
+        self.count = 0
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return self.count
+
+    def split(self, value):
+        """Returns the list of keys of the given value in the order they are stored in the trie."""
+        return reversed(value)
+
+    def add(self, entry):
+        node = self.root
+        for key in self.split(entry.lower() if self.ignore_case else entry):
+            node = node.setdefault(key, {})
+
+        if _TERMINAL not in node:
+            node[_TERMINAL] = entry
+            self.count += 1
+
+    def match(self, value):
+        """Returns the entry that matches the given value, or None if no entry matches."""
+        node = self.root
+        if _TERMINAL in node:
+            return node[_TERMINAL]
+
+        for key in self.split(value.lower() if self.ignore_case else value):
+            node = node.get(key)
+            if node is None:
+                return None
+
+            if _TERMINAL in node:
+                return node[_TERMINAL]
+
+        return None
+
+class DomainMatcher(SuffixMatcher):
+    """Matches fqdns that are equal to or a subdomain of any of the entries (see saq.util.is_subdomain)."""
+    def split(self, value):
+        return reversed(value.split('.'))
+
+class NetworkMatcher(object):
+    """Matches ip addresses that are contained in any of the entries. Entries are ip addresses or CIDR notation."""
+    def __init__(self, entries=()):
+        # key = ip version, value = sorted list of (start, end, entry) with overlapping ranges merged
+        self.ranges = {}
+        # key = ip version, value = list of the start of each range (for bisect)
+        self.starts = {}
+        self.count = 0
+        pending = {}
+        for entry in entries:
+            network = ipaddress.ip_network(entry.strip(), strict=False)
+            pending.setdefault(network.version, []).append(
+                (int(network.network_address), int(network.broadcast_address), entry))
+            self.count += 1
+
+        for version, ranges in pending.items():
+            ranges.sort()
+            merged = []
+            for start, end, entry in ranges:
+                if merged and start <= merged[-1][1] + 1:
+                    if end > merged[-1][1]:
+                        merged[-1] = (merged[-1][0], end, merged[-1][2])
+                else:
+                    merged.append((start, end, entry))
+
+            self.ranges[version] = merged
+            self.starts[version] = [start for start, _, _ in merged]
+
+    def __len__(self):
+        return self.count
+
+    def match(self, value):
+        """Returns the entry that contains the given ip address, or None if no entry matches.
+           When ranges overlap the entry returned is the one that starts first."""
+        try:
+            address = ipaddress.ip_address(value.strip() if isinstance(value, str) else value)
+        except ValueError:
+            return None
+
+        version = address.version
+        starts = self.starts.get(version)
+        if not starts:
+            return None
+
+        address = int(address)
+        index = bisect.bisect_right(starts, address) - 1
+        if index < 0:
+            return None
+
+        start, end, entry = self.ranges[version][index]
+        if address <= end:
+            return entry
+
+        return None
+
+class SubstringMatcher(object):
+    """Matches values that contain any of the entries using an Aho-Corasick automaton."""
+    def __init__(self, entries=(), ignore_case=True):
+        self.ignore_case = ignore_case
+        # each state is a dict of key = character, value = next state index
+        self.transitions = [{}]
+        # the state to go to when there is no transition for a character
+        self.failures = [0]
+        # the entry matched when a state is reached (including entries matched through the failure links)
+        self.outputs = [None]
+        self.count = 0
+
+        for entry in entries:
+            self.add(entry)
+
+        self.compile()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, entry):
+        if not entry:
+            return
+
+        state = 0
+        for char in (entry.lower() if self.ignore_case else entry):
+            next_state = self.transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions[state][char] = next_state
+                self.transitions.append({})
+                self.failures.append(0)
+                self.outputs.append(None)
+
+            state = next_state
+
+        if self.outputs[state] is None:
+            self.outputs[state] = entry
+            self.count += 1
+
+    def compile(self):
+        """Computes the failure links. This must be called after entries are added."""
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            self.failures[state] = 0
+
+        index = 0
+        while index < len(queue):
+            state = queue[index]
+            index += 1
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+
+                self.failures[next_state] = self.transitions[failure].get(char, 0)
+                if self.failures[next_state] == next_state:
+                    self.failures[next_state] = 0
+
+                if self.outputs[next_state] is None:
+                    self.outputs[next_state] = self.outputs[self.failures[next_state]]
+
+    def match(self, value):
+        """Returns the first entry found in the given value, or None if no entry matches."""
+        state = 0
+        for char in (value.lower() if self.ignore_case else value):
+            while state and char not in self.transitions[state]:
+                state = self.failures[state]
+
+            state = self.transitions[state].get(char, 0)
+            if self.outputs[state] is not None:
+                return self.outputs[state]
+
+        return None
@@ -0,0 +1,58 @@
+import unittest
+
+from saq.util import is_subdomain
+from saq.util.matcher import *
+
+class TestCase(unittest.TestCase):
+    def test_suffix_matcher(self):
+        matcher = SuffixMatcher([ 'example.com', 'Test.ORG' ])
+        self.assertEquals(len(matcher), 2)
+        self.assertEquals(matcher.match('example.com'), 'example.com')
+        self.assertEquals(matcher.match('www.EXAMPLE.com'), 'example.com')
+        # character suffix (same as str.endswith)
+        self.assertEquals(matcher.match('myexample.com'), 'example.com')
+        self.assertEquals(matcher.match('sub.test.org'), 'Test.ORG')
+        self.assertIsNone(matcher.match('example.org'))
+        self.assertIsNone(matcher.match('com'))
+        self.assertIsNone(SuffixMatcher().match('example.com'))
+
+    def test_domain_matcher(self):
+        entries = [ 'localhost.local', 'example.com', 'a.b.c.net' ]
+        matcher = DomainMatcher(entries)
+        for value in [ 'localhost.local', 'sub.localhost.local', 'LOCALHOST.LOCAL', 'example.com', 'www.example.com',
+                       'myexample.com', 'example.com.evil.org', 'b.c.net', 'x.a.b.c.net', 'local', '' ]:
+            expected = any([is_subdomain(value, dst) for dst in entries])
+            self.assertEquals(matcher.match(value) is not None, expected, value)
+
+    def test_network_matcher(self):
+        matcher = NetworkMatcher([ '10.0.0.0/8', '10.1.0.0/16', '192.168.1.1', '172.16.0.0/12', '::1' ])
+        self.assertEquals(len(matcher), 5)
+        self.assertEquals(matcher.match('10.1.2.3'), '10.0.0.0/8')
+        self.assertEquals(matcher.match('10.255.255.255'), '10.0.0.0/8')
+        self.assertIsNone(matcher.match('11.0.0.0'))
+        self.assertIsNone(matcher.match('9.255.255.255'))
+        self.assertEquals(matcher.match('192.168.1.1'), '192.168.1.1')
+        self.assertIsNone(matcher.match('192.168.1.2'))
+        self.assertEquals(matcher.match('172.31.255.255'), '172.16.0.0/12')
+        self.assertEquals(matcher.match('::1'), '::1')
+        self.assertIsNone(matcher.match('::2'))
+        self.assertIsNone(matcher.match('not an ip'))
+        self.assertIsNone(NetworkMatcher().match('10.0.0.1'))
+
+        with self.assertRaises(ValueError):
+            NetworkMatcher([ 'not an ip' ])
+
+    def test_substring_matcher(self):
+        entries = [ 'he', 'she', 'his', 'hers', '@Example.com' ]
+        matcher = SubstringMatcher(entries)
+        self.assertEquals(len(matcher), 5)
+        self.assertEquals(matcher.match('ushers'), 'she')
+        self.assertEquals(matcher.match('this'), 'his')
+        self.assertEquals(matcher.match('john@EXAMPLE.COM'), '@Example.com')
+        self.assertIsNone(matcher.match('nothing'))
+        self.assertIsNone(matcher.match(''))
+        self.assertIsNone(SubstringMatcher().match('anything'))
+
+        for value in [ 'ahishers', 'shhe', 'hhis', 'xyz', 'hi' ]:
+            expected = any([entry.lower() in value.lower() for entry in entries])
+            self.assertEquals(matcher.match(value) is not None, expected, value)
@@ -1,9 +1,10 @@
 # vim: sw=4:ts=4:et:cc=120
 
+import ipaddress
 import logging
 import os.path
 
-from iptools import IpRangeList
+from saq.util.matcher import SuffixMatcher, NetworkMatcher, SubstringMatcher
 
 WHITELIST_TYPE_SMTP_FROM = 'smtp_from'
 WHITELIST_TYPE_SMTP_TO = 'smtp_to'
@@ -29,6 +30,7 @@ class BrotexWhitelist(object):
         # last mtime when the whitelist was loaded
         self.whitelist_timestamp = None
         self.whitelist = {} # key = smtp_to, smtp_from, etc... value = set() of values
+        self.matchers = {} # key = smtp_to, smtp_from, etc... value = compiled matcher (see saq.util.matcher)
 
     def load_whitelist(self):
         logging.debug("loading whitelist from {}".format(self.whitelist_path))
@@ -61,29 +63,32 @@ class BrotexWhitelist(object):
 
                 self.whitelist[key].add(value.strip())
 
-        # translate all the IP addresses to iptools.IpRange 
-        if WHITELIST_TYPE_HTTP_SRC_IP in self.whitelist:
-            temp = set()
-            for value in self.whitelist[WHITELIST_TYPE_HTTP_SRC_IP]:
-                try:
-                    temp.add(IpRangeList(value))
-                except Exception as e:
-                    logging.error("unable to translate {} to an IPv4 in brotex whitelist: {}".format(value, e))
-                    continue
-            
-                self.whitelist[WHITELIST_TYPE_HTTP_SRC_IP] = temp
+        # compile the values into matchers
+        matchers = {}
+        for key in [ WHITELIST_TYPE_SMTP_FROM, WHITELIST_TYPE_SMTP_TO ]:
+            if key in self.whitelist:
+                matchers[key] = SubstringMatcher(self.whitelist[key])
 
-        # translate all the IP addresses to iptools.IpRange 
-        if WHITELIST_TYPE_HTTP_DEST_IP in self.whitelist:
-            temp = set()
-            for value in self.whitelist[WHITELIST_TYPE_HTTP_DEST_IP]:
+        if WHITELIST_TYPE_HTTP_HOST in self.whitelist:
+            matchers[WHITELIST_TYPE_HTTP_HOST] = SuffixMatcher(self.whitelist[WHITELIST_TYPE_HTTP_HOST])
+
+        for key in [ WHITELIST_TYPE_HTTP_SRC_IP, WHITELIST_TYPE_HTTP_DEST_IP ]:
+            if key not in self.whitelist:
+                continue
+
+            networks = []
+            for value in self.whitelist[key]:
                 try:
-                    temp.add(IpRangeList(value))
+                    ipaddress.ip_network(value, strict=False)
+                    networks.append(value)
                 except Exception as e:
                     logging.error("unable to translate {} to an IPv4 in brotex whitelist: {}".format(value, e))
                     continue
-            
-                self.whitelist[WHITELIST_TYPE_HTTP_DEST_IP] = temp
+
+            self.whitelist[key] = set(networks)
+            matchers[key] = NetworkMatcher(networks)
+
+        self.matchers = matchers
 
     def check_whitelist(self):
         if self.whitelist_timestamp != os.path.getmtime(self.whitelist_path):
@@ -108,57 +113,28 @@ class BrotexWhitelist(object):
 
     # we have slightly different compare functions for various whitelist types
 
-    def is_whitelisted_email_from_address(self, value):
-        if WHITELIST_TYPE_SMTP_FROM not in self.whitelist:
+    def _match(self, _type, value):
+        if _type not in self.matchers:
             return False
 
-        for whitelist_item in self.whitelist[WHITELIST_TYPE_SMTP_FROM]:
-            if whitelist_item.lower() in value.lower():
-                logging.debug("whitelist item {} matches {}".format(whitelist_item, value))
-                return True
+        whitelist_item = self.matchers[_type].match(value)
+        if whitelist_item is not None:
+            logging.debug("whitelist item {} matches {}".format(whitelist_item, value))
+            return True
 
         return False
 
-    def is_whitelisted_email_to_address(self, value):
-        if WHITELIST_TYPE_SMTP_TO not in self.whitelist:
-            return False
-
-        for whitelist_item in self.whitelist[WHITELIST_TYPE_SMTP_TO]:
-            if whitelist_item.lower() in value.lower():
-                logging.debug("whitelist item {} matches {}".format(whitelist_item, value))
-                return True
+    def is_whitelisted_email_from_address(self, value):
+        return self._match(WHITELIST_TYPE_SMTP_FROM, value)
 
-        return False
+    def is_whitelisted_email_to_address(self, value):
+        return self._match(WHITELIST_TYPE_SMTP_TO, value)
 
     def is_whitelisted_fqdn(self, value):
-        if WHITELIST_TYPE_HTTP_HOST not in self.whitelist:
-            return False
-
-        for whitelist_item in self.whitelist[WHITELIST_TYPE_HTTP_HOST]:
-            if value.lower().endswith(whitelist_item.lower()):
-                logging.debug("whitelist item {} matches {}".format(whitelist_item, value))
-                return True
-
-        return False
+        return self._match(WHITELIST_TYPE_HTTP_HOST, value)
 
     def is_whitelisted_src_ip(self, value):
-        if WHITELIST_TYPE_HTTP_SRC_IP not in self.whitelist:
-            return False
-
-        for whitelist_item in self.whitelist[WHITELIST_TYPE_HTTP_SRC_IP]:
-            if value in whitelist_item:
-                logging.debug("whitelist item {} matches {}".format(whitelist_item, value))
-                return True
-
-        return False
+        return self._match(WHITELIST_TYPE_HTTP_SRC_IP, value)
 
     def is_whitelisted_dest_ip(self, value):
-        if WHITELIST_TYPE_HTTP_DEST_IP not in self.whitelist:
-            return False
-
-        for whitelist_item in self.whitelist[WHITELIST_TYPE_HTTP_DEST_IP]:
-            if value in whitelist_item:
-                logging.debug("whitelist item {} matches {}".format(whitelist_item, value))
-                return True
-
-        return False
+        return self._match(WHITELIST_TYPE_HTTP_DEST_IP, value)
@@ -19,6 +19,38 @@ CREATE DATABASE IF NOT EXISTS `ace`;
 ALTER DATABASE `ace` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_520_ci;
 USE `ace`;
 
+--
+-- Table structure for table `alert_similarity_band`
+--
+
+DROP TABLE IF EXISTS `alert_similarity_band`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `alert_similarity_band` (
+  `band` smallint(6) NOT NULL,
+  `hash` bigint(20) unsigned NOT NULL COMMENT 'The hash of the rows of the MinHash signature in this band.',
+  `alert_id` int(11) NOT NULL,
+  PRIMARY KEY (`band`,`hash`,`alert_id`),
+  KEY `fk_alert_similarity_band_alert_idx` (`alert_id`),
+  CONSTRAINT `fk_alert_similarity_band_alert` FOREIGN KEY (`alert_id`) REFERENCES `alerts` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `alert_similarity_signature`
+--
+
+DROP TABLE IF EXISTS `alert_similarity_signature`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `alert_similarity_signature` (
+  `alert_id` int(11) NOT NULL,
+  `signature` blob NOT NULL COMMENT 'The packed MinHash signature of the tags and observables of the alert.',
+  PRIMARY KEY (`alert_id`),
+  CONSTRAINT `fk_alert_similarity_signature_alert` FOREIGN KEY (`alert_id`) REFERENCES `alerts` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `alerts`
 --
@@ -53,6 +85,9 @@ CREATE TABLE `alerts` (
   `detection_count` int(11) DEFAULT '0',
   `event_time` timestamp NULL DEFAULT NULL,
   `queue` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_520_ci NOT NULL DEFAULT 'default',
+  `sla_approaching_date` timestamp NULL DEFAULT NULL COMMENT 'The time at which the alert is approaching SLA (NULL if SLA does not apply.)',
+  `sla_over_date` timestamp NULL DEFAULT NULL COMMENT 'The time at which the alert is over SLA (NULL if SLA does not apply.)',
+  `sla_config` char(32) CHARACTER SET ascii DEFAULT NULL COMMENT 'The hash of the SLA configuration used to compute the SLA dates.',
   PRIMARY KEY (`id`),
   UNIQUE KEY `uuid` (`uuid`),
   KEY `insert_date` (`insert_date`),
@@ -64,6 +99,8 @@ CREATE TABLE `alerts` (
   KEY `idx_alert_type` (`alert_type`),
   KEY `idx_location` (`location`(767)),
   KEY `idx_queue` (`queue`),
+  KEY `idx_sla_approaching_date` (`disposition`,`sla_approaching_date`),
+  KEY `idx_sla_config` (`disposition`,`sla_config`),
   CONSTRAINT `fk_company` FOREIGN KEY (`company_id`) REFERENCES `company` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
@@ -409,6 +446,8 @@ CREATE TABLE `message_routing` (
   `lock_time` datetime DEFAULT NULL COMMENT 'When the lock was set for this delivery. Used to time out locks.',
   PRIMARY KEY (`id`),
   KEY `idx_message_routing_mrd` (`message_id`,`route`,`destination`),
+  KEY `idx_message_routing_route_lock` (`route`,`lock`),
+  KEY `idx_message_routing_lock` (`lock`),
   CONSTRAINT `fk_message_routing_message_id` FOREIGN KEY (`message_id`) REFERENCES `messages` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
@@ -0,0 +1,147 @@
+import os
+
+import pytest
+
+import app.analysis.tree
+from app.analysis.tree import (
+        DisplayTreeCache,
+        build_display_tree,
+        compact_display_tree,
+        expand_display_tree,
+        get_display_tree )
+from saq.analysis import RootAnalysis
+from saq.constants import *
+from saq.modules.test import BasicTestAnalysis
+
+@pytest.fixture
+def alert(tmp_path):
+    # test_2 is observed by the root and by the analysis of test_1
+    # so the display tree has a reference to the node under the analysis of test_1
+    root = RootAnalysis(storage_dir=str(tmp_path))
+    root.initialize_storage()
+    o1 = root.add_observable(F_TEST, 'test_1')
+    o2 = root.add_observable(F_TEST, 'test_2')
+    a1 = BasicTestAnalysis()
+    o1.add_analysis(a1)
+    a1.add_observable(F_TEST, 'test_2')
+    a2 = BasicTestAnalysis()
+    o2.add_analysis(a2)
+    a2.add_observable(F_TEST, 'test_3')
+    with open(root.json_path, 'w') as fp:
+        fp.write('{}')
+
+    return root
+
+@pytest.fixture
+def display_tree_cache(monkeypatch):
+    cache = DisplayTreeCache(10)
+    monkeypatch.setattr(app.analysis.tree, '_display_tree_cache', cache)
+    return cache
+
+def dump_tree(display_tree):
+    """Returns a list of (obj, uuid, visible, reference uuid, child uuids) for each node in the given tree."""
+    result = []
+    def _dump(node):
+        result.append((node.obj,
+                       node.uuid,
+                       node.visible,
+                       node.reference_node.uuid if node.reference_node is not None else None,
+                       [child.uuid for child in node.children]))
+
+    display_tree.walk(_dump)
+    return result
+
+@pytest.mark.unit
+@pytest.mark.parametrize('prune, show_root_observables', [
+    (False, False),
+    (True, False),
+    (True, True),
+])
+def test_compact_display_tree(alert, prune, show_root_observables):
+    display_tree = build_display_tree(alert, prune, show_root_observables)
+    expanded_tree = expand_display_tree(alert, compact_display_tree(display_tree))
+    assert dump_tree(expanded_tree) == dump_tree(display_tree)
+
+@pytest.mark.unit
+def test_compact_display_tree_resolved_references(alert):
+    # the visible root node of test_2 takes the children of the hidden node it referred to
+    display_tree = build_display_tree(alert, True, True)
+    root_node = [node for node in display_tree.children if node.obj.value == 'test_2'][0]
+    assert root_node.reference_node is None
+    assert root_node.children
+
+    expanded_tree = expand_display_tree(alert, compact_display_tree(display_tree))
+    assert dump_tree(expanded_tree) == dump_tree(display_tree)
+
+    # the shared children are the same nodes in both places
+    hidden_node = [node for node in expanded_tree.children if node.obj.value == 'test_1'][0].children[0].children[0]
+    expanded_root_node = [node for node in expanded_tree.children if node.obj.value == 'test_2'][0]
+    assert hidden_node.obj is expanded_root_node.obj
+    assert not hidden_node.visible
+    assert expanded_root_node.children[0] is hidden_node.children[0]
+
+@pytest.mark.unit
+def test_expand_display_tree_missing(alert):
+    compact_tree = compact_display_tree(build_display_tree(alert, False, False))
+    compact_tree[1] = ('unknown_observable_id',) + compact_tree[1][1:]
+    with pytest.raises(KeyError):
+        expand_display_tree(alert, compact_tree)
+
+@pytest.mark.unit
+def test_display_tree_cache_lru():
+    cache = DisplayTreeCache(2)
+    cache.put('a', 1, [ 'tree_a' ])
+    cache.put('b', 1, [ 'tree_b' ])
+    assert cache.get('a', 1) == [ 'tree_a' ]
+
+    # b is the least recently used
+    cache.put('c', 1, [ 'tree_c' ])
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) == [ 'tree_a' ]
+    assert cache.get('c', 1) == [ 'tree_c' ]
+
+@pytest.mark.unit
+def test_display_tree_cache_revision():
+    cache = DisplayTreeCache(2)
+    cache.put('a', 1, [ 'tree_a' ])
+
+    # an entry for another revision is discarded
+    assert cache.get('a', 2) is None
+    assert cache.get('a', 1) is None
+
+@pytest.mark.unit
+def test_get_display_tree(alert, display_tree_cache):
+    display_tree = get_display_tree(alert, True, False)
+    assert len(display_tree_cache.entries) == 1
+
+    # the cached tree is used while data.json is unchanged
+    assert dump_tree(get_display_tree(alert, True, False)) == dump_tree(display_tree)
+
+@pytest.mark.unit
+@pytest.mark.parametrize('content, mtime_offset', [
+    ('{ }', 0), # size
+    ('{}', 10), # modification time
+])
+def test_get_display_tree_modified(alert, display_tree_cache, content, mtime_offset):
+    display_tree = get_display_tree(alert, True, False)
+    st = os.stat(alert.json_path)
+    with open(alert.json_path, 'w') as fp:
+        fp.write(content)
+
+    os.utime(alert.json_path, ns=(st.st_atime_ns, st.st_mtime_ns + mtime_offset * 1000000000))
+
+    # the tree is computed again (with new node uuids)
+    assert get_display_tree(alert, True, False).uuid != display_tree.uuid
+
+@pytest.mark.unit
+def test_get_display_tree_invalid(alert, display_tree_cache):
+    display_tree = get_display_tree(alert, True, False)
+
+    # a cached tree that refers to something that is not in the alert is computed again
+    key, (revision, compact_tree) = next(iter(display_tree_cache.entries.items()))
+    compact_tree = list(compact_tree)
+    compact_tree[1] = ('unknown_observable_id',) + compact_tree[1][1:]
+    display_tree_cache.put(key, revision, compact_tree)
+
+    assert get_display_tree(alert, True, False).uuid != display_tree.uuid
+    assert display_tree_cache.get(key, revision)[1][0] != 'unknown_observable_id'
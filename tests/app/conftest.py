@@ -0,0 +1,2 @@
+# the GUI tests use the same environment as the saq tests
+from tests.saq.conftest import initialize_environment
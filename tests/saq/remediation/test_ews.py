@@ -3,7 +3,8 @@ import requests
 import saq
 from saq.remediation import *
 from saq.remediation.ews import EmailRemediator
-from saq.phishfry import ErrorNonExistentMailbox, ErrorNonExistentMessage, ErrorUnsupportedMailboxType
+from saq.database import Remediation
+from saq.phishfry import Mailbox, Folder, Item, ErrorNonExistentMailbox, ErrorNonExistentMessage, ErrorUnsupportedMailboxType
 
 def mock_phishfry(monkeypatch, exception):
     class MockSession():
@@ -86,3 +87,52 @@ def test_email_restore(monkeypatch, target, exception, status, message):
     # validate result
     assert result['status'] == status
     assert result['message'] == message
+
+@pytest.mark.integration
+def test_email_remediate_batch(monkeypatch):
+    calls = []
+
+    class MockSession():
+        pass
+
+    class MockPhishfry():
+        def __init__(self, *args, **kwargs):
+            self.session = MockSession()
+
+        def find_mailbox(self, address):
+            calls.append(('find_mailbox', address))
+            return Mailbox(address, 'Mailbox')
+
+        def find_folder(self, mailbox, folder):
+            calls.append(('find_folder', mailbox.email_address))
+            return Folder(mailbox, 'AllItems')
+
+        def find_item(self, folder, message_id):
+            if message_id == '<missing>':
+                raise ErrorNonExistentMessage('message does not exist')
+            return Item(folder, message_id)
+
+        def delete(self, item, delete_type):
+            calls.append(('delete', item.item_id))
+
+    monkeypatch.setattr("saq.remediation.ews.Phishfry", MockPhishfry)
+
+    targets = [
+        Remediation(type='email', key='<1>|jdoe@company.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(type='email', key='<missing>|jdoe@company.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(type='email', key='<2>|jdoe@external.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(type='email', key='<3>|JDOE@company.com', action=REMEDIATION_ACTION_REMOVE),
+    ]
+
+    remediator = EmailRemediator('remediator_test')
+    results = remediator.remediate_batch(targets)
+    assert [result['message'] for result in results] == ['removed', 'message does not exist', 'external domain', 'removed']
+    assert [result['status'] for result in results] == [REMEDIATOR_STATUS_SUCCESS, REMEDIATOR_STATUS_SUCCESS, REMEDIATOR_STATUS_FAILED, REMEDIATOR_STATUS_SUCCESS]
+
+    # the mailbox is only looked up once
+    assert calls == [
+        ('find_mailbox', 'jdoe@company.com'),
+        ('find_folder', 'jdoe@company.com'),
+        ('delete', '<1>'),
+        ('delete', '<3>'),
+    ]
@@ -190,3 +190,40 @@ def test_email_restore(monkeypatch, datadir, requests_mock, target, status, mess
     assert result['status'] == status
     assert result['message'] == message
     assert result['restore_key'] == key
+
+class MockResponse():
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+class MockGraph():
+    def __init__(self, responses):
+        self.responses = responses
+
+    def get(self, uri, params=None):
+        return self.responses.pop(0)
+
+@pytest.mark.integration
+def test_email_remediate_mailbox_not_found(monkeypatch):
+    monkeypatch.setattr("saq.remediation.o365.GRAPH_BATCH_SIZE", 1)
+
+    # the first chunk is looked up and the mailbox is gone by the second
+    graph = MockGraph([
+        MockResponse(200, { 'value': [] }),
+        MockResponse(404, { 'error': { 'code': 'ErrorInvalidUser', 'message': 'test' } }),
+    ])
+
+    remediator = EmailRemediator('remediator_test')
+    results = remediator.remediate_mailbox(graph, REMEDIATION_ACTION_REMOVE, 'jdoe@company.com', [ '<1>', '<2>' ])
+
+    # the result of the first chunk is kept
+    assert results[0]['status'] == REMEDIATOR_STATUS_SUCCESS
+    assert results[0]['message'] == 'message does not exist'
+    assert results[1]['status'] == REMEDIATOR_STATUS_IGNORE
+    assert results[1]['message'] == 'Mailbox does not exist.'
@@ -286,3 +286,114 @@ def test_message_id_remediation_targets():
     assert 'email|<test>|foo@site.com' in target_strings
     assert 'email|<test>|john@site.com' in target_strings
     assert 'email|<test>|jane@site.com' in target_strings
+
+@pytest.mark.unit
+def test_session_pool():
+    created = []
+    def factory():
+        created.append(object())
+        return created[-1]
+
+    pool = SessionPool(factory, max_idle=1)
+    with pool.session() as session1:
+        # sessions in use are not shared
+        with pool.session() as session2:
+            assert session1 is not session2
+
+    # idle sessions are reused
+    with pool.session() as session3:
+        assert session3 in created
+    assert len(created) == 2
+    assert len(pool.idle) == 1
+
+class MockGroupRemediator(MockRemediator):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+
+    def group_key(self, target):
+        return target.key.split('|', 1)[1]
+
+    def remediate_batch(self, targets):
+        self.batches.append([target.key for target in targets])
+        return [self.result for target in targets]
+
+@pytest.mark.unit
+def test_group_targets():
+    service = RemediationService()
+    service.max_group_size = 2
+    targets = [
+        Remediation(id=1, type='email', key='<1>|jdoe@site.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(id=2, type='email', key='<2>|jdoe@site.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(id=3, type='email', key='<3>|jdoe@site.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(id=4, type='email', key='<1>|jane@site.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(id=5, type='email', key='<4>|jdoe@site.com', action=REMEDIATION_ACTION_RESTORE),
+        Remediation(id=6, type='o365_file', key='/drives/1/items/1', action=REMEDIATION_ACTION_REMOVE),
+    ]
+
+    # without group keys every target is remediated individually
+    service.remediators = [MockRemediator('test', RemediationSuccess('hello'))]
+    assert len(service.group_targets(targets)) == 6
+
+    # targets are grouped by type, action and mailbox
+    service.remediators = [MockGroupRemediator('test', RemediationSuccess('hello'))]
+    batches = [[target.id for target in batch] for batch in service.group_targets(targets)]
+    assert sorted(batches) == [[1, 2], [3], [4], [5], [6]]
+
+@pytest.mark.unit
+def test_remediator_remediate_batch():
+    class ErrorRemediator(MockRemediator):
+        def remove(self, target):
+            if target == '<2>|jdoe@site.com':
+                raise Exception('test')
+            return self.result
+
+    remediator = ErrorRemediator('test', RemediationSuccess('hello'))
+    targets = [
+        Remediation(type='email', key='<1>|jdoe@site.com', action=REMEDIATION_ACTION_REMOVE),
+        Remediation(type='email', key='<2>|jdoe@site.com', action=REMEDIATION_ACTION_REMOVE),
+    ]
+
+    # an error only affects the target that raised it
+    results = remediator.remediate_batch(targets)
+    assert results[0]['status'] == REMEDIATOR_STATUS_SUCCESS
+    assert results[1]['status'] == REMEDIATOR_STATUS_ERROR
+
+@pytest.mark.integration
+def test_remediate_targets():
+    remediator = MockGroupRemediator('test', RemediationSuccess('hello'))
+
+    # queue targets
+    for key in [ '<1>|jdoe@site.com', '<2>|jdoe@site.com' ]:
+        RemediationTarget('email', key).queue(REMEDIATION_ACTION_REMOVE, saq.AUTOMATION_USER_ID)
+
+    # remediate all targets with a single call to the remediator
+    service = RemediationService()
+    service.remediators.append(remediator)
+    targets = service.get_targets()
+    assert len(targets) == 2
+    service.remediate_batch(targets)
+    assert len(remediator.batches) == 1
+    assert sorted(remediator.batches[0]) == [ '<1>|jdoe@site.com', '<2>|jdoe@site.com' ]
+
+    # verify results
+    for key in [ '<1>|jdoe@site.com', '<2>|jdoe@site.com' ]:
+        target = RemediationTarget('email', key)
+        assert target.history[0].status == REMEDIATION_STATUS_COMPLETED
+        assert target.history[0].successful
+
+@pytest.mark.integration
+def test_get_targets_max_batches():
+    # queue targets for two different mailboxes
+    for key in [ '<1>|jdoe@site.com', '<2>|jdoe@site.com', '<1>|jane@site.com' ]:
+        RemediationTarget('email', key).queue(REMEDIATION_ACTION_REMOVE, saq.AUTOMATION_USER_ID)
+
+    # only the targets of a single batch are locked
+    service = RemediationService()
+    service.remediators.append(MockGroupRemediator('test', RemediationSuccess('hello')))
+    targets = service.get_targets(max_batches=1)
+    assert len(service.group_targets(targets)) == 1
+
+    # the rest are left for the next call
+    remaining = service.get_targets(exclude=[target.id for target in targets])
+    assert len(targets) + len(remaining) == 3
@@ -0,0 +1,15 @@
+CREATE TABLE `alert_similarity_signature` (
+  `alert_id` int(11) NOT NULL,
+  `signature` blob NOT NULL COMMENT 'The packed MinHash signature of the tags and observables of the alert.',
+  PRIMARY KEY (`alert_id`),
+  CONSTRAINT `fk_alert_similarity_signature_alert` FOREIGN KEY (`alert_id`) REFERENCES `alerts` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+CREATE TABLE `alert_similarity_band` (
+  `band` smallint(6) NOT NULL,
+  `hash` bigint(20) unsigned NOT NULL COMMENT 'The hash of the rows of the MinHash signature in this band.',
+  `alert_id` int(11) NOT NULL,
+  PRIMARY KEY (`band`,`hash`,`alert_id`),
+  KEY `fk_alert_similarity_band_alert_idx` (`alert_id`),
+  CONSTRAINT `fk_alert_similarity_band_alert` FOREIGN KEY (`alert_id`) REFERENCES `alerts` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
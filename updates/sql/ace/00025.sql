@@ -0,0 +1,6 @@
+ALTER TABLE `alerts`
+ADD COLUMN `sla_approaching_date` timestamp NULL DEFAULT NULL COMMENT 'The time at which the alert is approaching SLA (NULL if SLA does not apply.)' AFTER `queue`,
+ADD COLUMN `sla_over_date` timestamp NULL DEFAULT NULL COMMENT 'The time at which the alert is over SLA (NULL if SLA does not apply.)' AFTER `sla_approaching_date`,
+ADD COLUMN `sla_config` char(32) CHARACTER SET ascii DEFAULT NULL COMMENT 'The hash of the SLA configuration used to compute the SLA dates.' AFTER `sla_over_date`,
+ADD KEY `idx_sla_approaching_date` (`disposition`,`sla_approaching_date`),
+ADD KEY `idx_sla_config` (`disposition`,`sla_config`);
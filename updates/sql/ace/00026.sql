@@ -0,0 +1,3 @@
+ALTER TABLE `message_routing`
+ADD KEY `idx_message_routing_route_lock` (`route`,`lock`),
+ADD KEY `idx_message_routing_lock` (`lock`);
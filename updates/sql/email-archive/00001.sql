@@ -0,0 +1,8 @@
+CREATE TABLE `archive_trigram` (
+  `trigram` mediumint(8) unsigned NOT NULL COMMENT 'Three bytes of a value in archive_search as a big endian integer.',
+  `field` enum('env_from','env_to','body_from','body_to','subject','decoded_subject','message_id','content','url') NOT NULL,
+  `archive_id` int(11) NOT NULL,
+  PRIMARY KEY (`trigram`,`field`,`archive_id`),
+  KEY `archive_id` (`archive_id`),
+  CONSTRAINT `fk_archive_trigram_1` FOREIGN KEY (`archive_id`) REFERENCES `archive` (`archive_id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;